@@ -2,6 +2,7 @@
 
 from flask import request, jsonify, g, current_app
 from . import api
+from precios_pt import precios_pt_por_id
 import jwt
 
 # Proxy a la conexión de app.py (evita import circular directo)
@@ -114,7 +115,7 @@ def api_caja_config():
 def api_pt_list():
     """
     Catálogo de Productos Terminados (PT) para la app móvil.
-    Reutiliza el mismo catálogo PT que usas en el módulo web.
+    Reutiliza el mismo motor de precios PT que el módulo web (precios_pt.py).
     """
     eid = g.empresa_id
 
@@ -126,7 +127,6 @@ def api_pt_list():
             SELECT 
                 m.id,
                 m.nombre,
-                COALESCE(m.precio, 0) AS precio_venta,
                 COALESCE(inv.inventario_inicial, 0)
               + COALESCE(inv.entradas, 0)
               - COALESCE(inv.salidas, 0) AS stock
@@ -139,16 +139,18 @@ def api_pt_list():
             ORDER BY m.nombre
         """, (eid,))
         rows = cur.fetchall()
+        precios = precios_pt_por_id(eid, cur=cur)
     finally:
         cur.close()
         conn.close()
 
     items = []
     for r in rows:
+        p = precios.get(r["id"])
         items.append({
             "id": r["id"],
             "nombre": r["nombre"],
-            "precio_venta": float(r["precio_venta"] or 0),
+            "precio_venta": float(p["precio"]) if p else 0.0,
             "stock": float(r["stock"] or 0),
         })
 
@@ -4,12 +4,12 @@
 """
 
 # ===== IMPORTS ESTÁNDAR =====
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, Blueprint, g
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, Blueprint, g, Response, stream_with_context
 from flask_cors import CORS
 from flask_mail import Mail, Message
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import jwt
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import re
 from functools import wraps
 import bcrypt
@@ -20,6 +20,7 @@ from mysql.connector import Error
 import os
 from werkzeug.utils import secure_filename
 import csv
+import zipfile
 import sys
 
 # ===== DETECTAR ENTORNO (PythonAnywhere vs Local) =====
@@ -42,9 +43,51 @@ app.config.from_object(Config)
 mysql = MySQL(app)
 
 # ===== IMPORTS DE MÓDULOS LOCALES =====
-from db import conexion_db
+from db import conexion_db, conexion_aparte, init_app as init_db_pool, metricas_pool
+from precios_pt import calcular_precios_pt, costos_pt, cargar_reglas_markup, version_catalogo_pt, subir_version_catalogo_pt
+from saldos_inventario import aplicar_movimiento, snapshot_activo, leer_saldos, init_app as init_saldos_inventario
+from valuacion_fifo import inventario_almacen, init_app as init_valuacion_fifo
+from cierres_inventario import (costear_desde_cierre, cierre_producto_base, costo_promedio_cierre,
+                                invalidar_cierres, init_app as init_cierres_inventario)
+from badges_header import contadores_header, invalidar_badges, metricas_badges, CEROS as BADGES_CEROS
+from carrito_pos import carrito_actual, init_app as init_carrito_pos
+from corte_turno import conteo_desde_form, corte_turno, diferencias, guardar_inventario_final
+from capas_peps import salida_peps as salida_peps_capas, agregar_capa, agregar_capas, consumir, costo_unitario_consumo, init_app as init_capas_peps
+from kardex import pagina_kardex, texto_a_clave, filas_exportacion, exportar_csv, exportar_xlsx, init_app as init_kardex
+from compras_lote import renglones_desde_form, resolver_mercancias, validar_renglones, insertar_renglones
+from importar_compras import MAX_DETALLE_SESION, Reporte, bloques_validos, filas_archivo, renglones_archivo
+from busqueda_mercancias import (buscar as buscar_mercancias, resolver as resolver_indice, indice_empresa,
+                                 invalidar_indice, metricas_indice)
+from busqueda import buscar as busqueda_unificada, ids_seccion, condicion_seccion, condicion_tickets, metricas_busqueda, invalidar as invalidar_busqueda, TIPOS as TIPOS_BUSQUEDA
+from arbol_cuentas import (tipo_from_code, naturaleza_from_tipo, nivel_from_code, parent_code_of,
+                           arbol_cuentas, cargar_arbol, sincronizar_cuentas, invalidar_arbol, metricas_arbol)
+from folios import siguiente_folio, metricas_folios, init_app as init_folios
+from pronostico_demanda import init_app as init_pronostico_demanda
+from contabilidad import (AsientoInvalido, registrar_asientos, asiento_compra, balanza, mayor, balance_general,
+                          init_app as init_contabilidad)
 from utils.decorators import require_login, require_role
 
+# Una conexión del pool por petición (se libera en el teardown)
+init_db_pool(app)
+# Comandos flask saldos-inventario reconstruir|verificar
+init_saldos_inventario(app)
+# Comando flask valuacion-fifo benchmark
+init_valuacion_fifo(app)
+# Comandos flask capas-peps reconstruir|verificar
+init_capas_peps(app)
+# Comandos flask cierres-inventario cerrar|verificar
+init_cierres_inventario(app)
+# Comando flask kardex checkpoints
+init_kardex(app)
+# Comandos flask contabilidad reconstruir-saldos|verificar
+init_contabilidad(app)
+# Comando flask folios estres
+init_folios(app)
+# Comando flask pronostico actualizar (corrida nocturna)
+init_pronostico_demanda(app)
+# Carrito del POS en el servidor (se guarda al final de cada petición)
+init_carrito_pos(app)
+
 # Importar blueprints del sistema multi-tenant
 try:
     from routes import auth, onboarding, dashboard, admin
@@ -335,23 +378,24 @@ def _totales(carrito, aplica_iva=True):
         "total": total
     }
 
-@app.post("/caja/agregar")
-@require_login
-def caja_agregar():
-    # Asegura estructuras en sesión
-    session.setdefault("carrito", [])
-
-    # Datos desde el form
-    mercancia_id = request.form.get("mercancia_id", type=int)
-    nombre       = (request.form.get("nombre") or "").strip()
-    cant_raw     = request.form.get("cant", "1")
-    pu_raw       = request.form.get("pu")               # puede venir vacío o "0.00"
-    iva_raw      = request.form.get("iva_rate", "0")
-    desc_raw     = request.form.get("desc", "0")
+def _item_caja(datos):
+    """
+    Construye el renglón del carrito desde el form (o el JSON del API).
+    Regresa None si falta el nombre del producto.
+    """
+    mercancia_id = datos.get("mercancia_id")
+    try:
+        mercancia_id = int(mercancia_id) if mercancia_id not in (None, "") else None
+    except (TypeError, ValueError):
+        mercancia_id = None
+    nombre       = (datos.get("nombre") or "").strip()
+    cant_raw     = datos.get("cant", "1")
+    pu_raw       = datos.get("pu")               # puede venir vacío o "0.00"
+    iva_raw      = datos.get("iva_rate", "0")
+    desc_raw     = datos.get("desc", "0")
 
     if not nombre:
-        flash("Producto requerido", "warning")
-        return redirect(url_for("caja"))
+        return None
 
     # Normalización a Decimal (evita floats)
     from decimal import Decimal, InvalidOperation
@@ -366,21 +410,14 @@ def caja_agregar():
     if cant <= 0:
         cant = Decimal("1")
 
-    # Precio: si no viene o es 0, calcular según configuración PT de esta empresa
-    pu = None
-    try:
-        pu_tmp = d(pu_raw, None) if pu_raw not in (None, "") else None
-        if pu_tmp is not None and pu_tmp > 0:
-            pu = pu_tmp
-    except Exception:
-        pu = None
-
-    if pu is None:
-        if mercancia_id:
-            # Debes tener implementada esta función con empresa:
-            # def precio_pt(mercancia_id: int, empresa_id: int) -> Decimal
-            pu = precio_pt(mercancia_id, g.empresa_id)
-        else:
+    # Precio: los productos del catálogo siempre se cotizan en el servidor (el pu del
+    # navegador puede venir de un catálogo en caché ya viejo); el pu enviado solo
+    # aplica a renglones libres sin mercancía
+    if mercancia_id:
+        pu = precio_pt(mercancia_id, g.empresa_id)
+    else:
+        pu = d(pu_raw, "0") if pu_raw not in (None, "") else Decimal("0.00")
+        if pu < 0:
             pu = Decimal("0.00")
 
     iva  = d(iva_raw, "0")
@@ -389,7 +426,7 @@ def caja_agregar():
         desc = Decimal("0")
 
     # Construir renglón con claves compatibles con tu _totales() y templates
-    item = {
+    return {
         "id": mercancia_id,              # usa "id" si tu flujo lo espera así
         "mercancia_id": mercancia_id,    # mantén ambos por compatibilidad
         "nombre": nombre,
@@ -399,22 +436,27 @@ def caja_agregar():
         "desc": str(desc),
     }
 
-    session["carrito"].append(item)
-    session.modified = True
+@app.post("/caja/agregar")
+@require_login
+def caja_agregar():
+    item = _item_caja(request.form)
+    if item is None:
+        flash("Producto requerido", "warning")
+        return redirect(url_for("caja"))
+
+    carrito_actual().agregar(item)
     return redirect(url_for("caja"))
 
-@app.post("/caja/eliminar/<int:idx>")
-def caja_eliminar(idx):
-    session.setdefault("carrito", [])
-    if 0 <= idx < len(session["carrito"]):
-        session["carrito"].pop(idx)
-        session.modified = True
+@app.post("/caja/eliminar/<int:linea_id>")
+@require_login
+def caja_eliminar(linea_id):
+    carrito_actual().eliminar(linea_id)
     return redirect(url_for("caja"))
 
 @app.post("/caja/vaciar")
+@require_login
 def caja_vaciar():
-    session["carrito"] = []
-    session.modified = True
+    carrito_actual().vaciar()
     return redirect(url_for("caja"))
 
 from decimal import Decimal
@@ -425,8 +467,9 @@ def caja_cobrar():
     eid = g.empresa_id
     uid = g.usuario_id
 
-    carrito = session.get("carrito", [])
-    aplica_iva = session.get("caja_aplica_iva", True)
+    pos = carrito_actual()
+    carrito = pos.items
+    aplica_iva = pos.aplica_iva
     totals = _totales(carrito, aplica_iva)
 
     if not carrito:
@@ -453,6 +496,9 @@ def caja_cobrar():
         cambio = Decimal("0.00")
     cambio = cambio.quantize(Decimal("0.01"))
 
+    detalle = _detalle_venta(carrito)
+    fecha = datetime.now().replace(microsecond=0)
+
     conn = None
     cur = None
     try:
@@ -463,44 +509,27 @@ def caja_cobrar():
         cur.execute(
             """
             INSERT INTO caja_ventas (fecha, usuario_id, total, empresa_id)
-            VALUES (NOW(), %s, %s, %s)
+            VALUES (%s, %s, %s, %s)
             """,
-            (uid, total, eid)
+            (fecha, uid, total, eid)
         )
         venta_id = cur.lastrowid
 
-        # Detalle (incluye empresa)
-        for r in carrito:
-            mercancia_id = r.get("id") or r.get("mercancia_id")
-            if not mercancia_id:
-                continue
-
-            cant = Decimal(str(r.get("cant", 1) or 1))
-            pu   = Decimal(str(r.get("pu", 0) or 0))
-            desc = Decimal(str(r.get("desc", 0) or 0))
-
-            if cant <= 0:
-                cant = Decimal("1")
-            if pu   < 0:
-                pu = Decimal("0.00")
-            if desc < 0:
-                desc = Decimal("0.00")
-
-            subtotal = (cant * pu - desc)
-            if subtotal < Decimal("0"):
-                subtotal = Decimal("0.00")
-            subtotal = subtotal.quantize(Decimal("0.01"))
-            pu = pu.quantize(Decimal("0.01"))
-
-            cur.execute(
+        # Detalle (incluye empresa) en un solo INSERT multi-renglón
+        if detalle:
+            cur.executemany(
                 """
                 INSERT INTO caja_ventas_detalle
                   (venta_id, mercancia_id, cantidad, precio_unitario, subtotal, empresa_id)
                 VALUES (%s, %s, %s, %s, %s, %s)
                 """,
-                (venta_id, mercancia_id, cant, pu, subtotal, eid)
+                [(venta_id, r["mercancia_id"], r["cantidad"], r["precio_unitario"], r["subtotal"], eid)
+                 for r in detalle]
             )
 
+        # Salidas de inventario PT en la misma transacción
+        _salidas_pt_venta(cur, eid, uid, venta_id, fecha, detalle)
+
         conn.commit()
 
     finally:
@@ -514,67 +543,123 @@ def caja_cobrar():
             pass
 
     # Limpiar carrito
-    session["carrito"] = []
+    pos.vaciar()
 
-    # Redirigir a ticket con cobro/cambio formateados
-    return redirect(url_for(
-        "caja_ticket",
-        venta_id=venta_id,
+    # Ticket directo con lo que ya está en memoria (sin releer la venta en caja_ticket)
+    venta = {"id": venta_id, "fecha": fecha, "usuario_id": uid, "total": total}
+    return render_template(
+        "cobranza/caja_ticket.html",
+        venta=venta,
+        detalle=detalle,
         cobro=f"{cobro}",
         cambio=f"{cambio}"
-    ))
+    )
+
+def _detalle_venta(carrito):
+    """Renglones de caja_ventas_detalle normalizados en una sola pasada"""
+    cero = Decimal("0.00")
+    centavo = Decimal("0.01")
+    detalle = []
+    for r in carrito:
+        mercancia_id = r.get("id") or r.get("mercancia_id")
+        if not mercancia_id:
+            continue
+
+        cant = Decimal(str(r.get("cant", 1) or 1))
+        pu   = Decimal(str(r.get("pu", 0) or 0))
+        desc = Decimal(str(r.get("desc", 0) or 0))
+
+        if cant <= 0:
+            cant = Decimal("1")
+        if pu < 0:
+            pu = cero
+        if desc < 0:
+            desc = cero
+
+        subtotal = max(cant * pu - desc, cero).quantize(centavo)
+        detalle.append({
+            "mercancia_id": int(mercancia_id),
+            "producto": r.get("nombre"),
+            "cantidad": cant,
+            "precio_unitario": pu.quantize(centavo),
+            "subtotal": subtotal,
+        })
+    return detalle
+
+def _salidas_pt_venta(cur, eid, uid, venta_id, fecha, detalle):
+    """
+    Registra la salida de PT por la venta (un movimiento por producto) con
+    un solo INSERT multi-renglón y descuenta las capas PEPS; no hace commit.
+    """
+    unidades = {}
+    for r in detalle:
+        unidades[r["mercancia_id"]] = unidades.get(r["mercancia_id"], Decimal("0")) + r["cantidad"]
+    if not unidades:
+        return
+
+    # Solo productos terminados de la empresa; costo al promedio del snapshot (si existe)
+    ids = list(unidades)
+    fmt = ",".join(["%s"] * len(ids))
+    cur.execute(f"""
+        SELECT id FROM mercancia
+        WHERE id IN ({fmt}) AND empresa_id = %s AND tipo_inventario_id = 3
+    """, ids + [eid])
+    pt_ids = [row[0] for row in cur.fetchall()]
+    if not pt_ids:
+        return
+    costos = leer_saldos(cur, eid, 3, pt_ids) if snapshot_activo(cur, eid) else {}
+    # Costo PEPS desde las capas abiertas; sin capas suficientes, el promedio del snapshot
+    peps = consumir(cur, eid, 3, {mid: unidades[mid] for mid in pt_ids})
+
+    referencia = f"Venta caja #{venta_id}"
+    filas = []
+    for mid in pt_ids:
+        pu = costo_unitario_consumo(peps.get(mid), unidades[mid],
+                                    costos.get(mid, {}).get("costo_promedio", 0.0))
+        filas.append((eid, uid, 3, mid, fecha.date(), "salida", unidades[mid], pu, referencia))
+
+    cur.executemany("""
+        INSERT INTO inventario_movimientos
+            (empresa_id, usuario_id, tipo_inventario_id, mercancia_id,
+             fecha, tipo_movimiento, unidades, precio_unitario, referencia)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, filas)
+
+    for f in filas:
+        aplicar_movimiento(cur, eid, 3, f[3], "salida", f[6], f[7])
 
 @app.post("/caja/hold")
+@require_login
 def caja_hold():
-    carrito = session.get("carrito", [])
+    pos = carrito_actual()
+    carrito = pos.items
     if not carrito:
         flash("No hay nada que poner en espera.", "warning")
         return redirect(url_for("caja"))
 
-    holds = session.get("caja_holds", [])
-
-    hold_id = (max([h["id"] for h in holds]) + 1) if holds else 1
-
     totals = _totales(carrito)
-    holds.append({
-        "id": hold_id,
-        "items": carrito,
-        "total": str(totals["total"])
-    })
-
-    session["caja_holds"] = holds
-    session["carrito"] = []
-    session.modified = True
+    hold_id = pos.poner_en_espera(totals["total"])
 
     flash(f"Venta en espera #{hold_id}", "info")
     return redirect(url_for("caja"))
 
 @app.post("/caja/hold/resume/<int:hold_id>")
+@require_login
 def caja_hold_resume(hold_id):
-    holds = session.get("caja_holds", [])
-    target = None
-    for h in holds:
-        if h["id"] == hold_id:
-            target = h
-            break
-
-    if not target:
+    # cargar carrito desde hold
+    if not carrito_actual().reanudar(hold_id):
         flash("Venta en espera no encontrada.", "warning")
         return redirect(url_for("caja"))
 
-    # cargar carrito desde hold
-    session["carrito"] = target["items"]
-    holds = [h for h in holds if h["id"] != hold_id]
-    session["caja_holds"] = holds
-    session.modified = True
-
     flash(f"Venta en espera #{hold_id} cargada.", "success")
     return redirect(url_for("caja"))
 
 @app.post("/caja/pagar")
+@require_login
 def caja_pagar():
-    carrito = session.get("carrito", [])
-    aplica_iva = session.get("caja_aplica_iva", True)
+    pos = carrito_actual()
+    carrito = pos.items
+    aplica_iva = pos.aplica_iva
     totals = _totales(carrito, aplica_iva)
 
     if not carrito:
@@ -613,7 +698,7 @@ def caja_pagar():
     conn.close()
 
     # 3) Vaciar carrito para la siguiente venta
-    session["carrito"] = []
+    pos.vaciar()
 
     # 4) Mostrar ticket o regresar a caja mostrando el folio
     return redirect(url_for("caja_ticket", venta_id=venta_id))
@@ -694,38 +779,11 @@ def caja_historial():
 def precio_pt(mercancia_id: int, empresa_id: int = None) -> Decimal:
     """Calcula precio PT - FILTRADO POR EMPRESA"""
     eid = empresa_id or getattr(g, 'empresa_id', None) or session.get('empresa_id') or 1
-    
-    conn = conexion_db()
-    cur = conn.cursor(dictionary=True)
-
-    cur.execute("""
-        SELECT 
-          COALESCE(p.modo, 'auto') AS modo,
-          COALESCE(p.markup_pct, 0.30) AS markup_pct,
-          p.precio_manual
-        FROM mercancia m
-        LEFT JOIN pt_precios p ON p.mercancia_id = m.id AND p.empresa_id = %s
-        WHERE m.id = %s AND m.empresa_id = %s
-    """, (eid, mercancia_id, eid))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
 
-    if not row:
+    items = calcular_precios_pt(eid, [mercancia_id])
+    if not items:
         return Decimal("0.00")
-
-    modo = row["modo"]
-    markup_pct = Decimal(str(row["markup_pct"]))
-    precio_manual = row["precio_manual"]
-    costo = costo_pt(mercancia_id)
-
-    if modo == "manual":
-        if precio_manual is not None:
-            return Decimal(str(precio_manual)).quantize(Decimal("0.01"))
-        return (costo * (Decimal("1") + markup_pct)).quantize(Decimal("0.01"))
-
-    pct_auto = markup_auto_para_costo(costo)
-    return (costo * (Decimal("1") + pct_auto)).quantize(Decimal("0.01"))
+    return items[0]["precio"]
 
 @app.route('/test123')
 def test123():
@@ -826,6 +884,7 @@ def registro():
             """, (nombre, correo, hashed.decode('utf-8'), empresa_id, codigo))
             
             conn.commit()
+            invalidar_busqueda(empresa_id, 'usuarios')
             
             print(f"✅ Usuario creado: {nombre} ({correo}) - Código: {codigo}")
             
@@ -1605,6 +1664,7 @@ def admin_agregar_usuario():
             """, (usuario_id, int(area_id), eid))
         
         db.commit()
+        invalidar_busqueda(eid, 'usuarios')
         
         # Link para crear contraseña
         link = url_for('completar_registro', token=token, _external=True)
@@ -1698,6 +1758,7 @@ def admin_editar_usuario(usuario_id):
     """, (nombre, puesto, usuario_id, eid))
     
     db.commit()
+    invalidar_busqueda(eid, 'usuarios')
     cursor.close()
     db.close()
     
@@ -1737,6 +1798,8 @@ def admin_eliminar_usuario(usuario_id):
         cursor.execute("DELETE FROM notificaciones_usuario WHERE usuario_destino_id = %s", (usuario_id,))
         cursor.execute("DELETE FROM usuarios WHERE id = %s", (usuario_id,))
         db.commit()
+        invalidar_busqueda(eid, 'usuarios')
+        invalidar_badges(usuario_id=usuario_id)
         flash(f'Usuario "{usuario["nombre"]}" eliminado', 'success')
     else:
         # Desactivar (tiene historial en el sistema)
@@ -1747,6 +1810,7 @@ def admin_eliminar_usuario(usuario_id):
             UPDATE usuario_areas SET activo = 0 WHERE usuario_id = %s
         """, (usuario_id,))
         db.commit()
+        invalidar_busqueda(eid, 'usuarios')
         flash(f'Usuario "{usuario["nombre"]}" desactivado', 'info')
     
     cursor.close()
@@ -1798,6 +1862,7 @@ def aceptar_invitacion(token):
         """, (hashed.decode(), usuario['id']))
 
         db.commit()
+        invalidar_busqueda(seccion='usuarios')
         cursor.close()
         db.close()
 
@@ -2242,6 +2307,7 @@ def completar_registro(token):
             crear_mensaje_bienvenida_completo(cursor, usuario['empresa_id'], usuario['id'], area)
         
         db.commit()
+        invalidar_busqueda(usuario['empresa_id'], 'usuarios')
         cursor.close()
         db.close()
         
@@ -2310,6 +2376,7 @@ def crear_mensaje_bienvenida(cursor, empresa_id, usuario_id, area, rol, asignado
         f'Bienvenido al área {area["nombre"]}',
         mensajes_rol.get(rol, mensajes_rol['operador'])
     ))
+    invalidar_badges(usuario_id=usuario_id)
 
 
 def crear_mensaje_bienvenida_completo(cursor, empresa_id, usuario_id, area):
@@ -2338,6 +2405,7 @@ def crear_mensaje_bienvenida_completo(cursor, empresa_id, usuario_id, area):
         <p>¡Éxito en tu nuevo rol!</p>
         """
     ))
+    invalidar_badges(usuario_id=usuario_id)
 
 
 # =============================================
@@ -2392,6 +2460,7 @@ def incidencia_leer(inc_id):
     """, (inc_id, uid))
     
     db.commit()
+    invalidar_badges(usuario_id=uid)
     cursor.close()
     db.close()
     
@@ -2435,16 +2504,18 @@ def api_buscar_usuarios():
     db = conexion_db()
     cursor = db.cursor(dictionary=True)
     
-    cursor.execute("""
-        SELECT id, nombre, correo, puesto, estado_registro
-        FROM usuarios
-        WHERE empresa_id = %s AND activo = 1
-          AND (nombre LIKE %s OR correo LIKE %s)
-        ORDER BY nombre
-        LIMIT 20
-    """, (eid, f'%{q}%', f'%{q}%'))
-    
-    usuarios = cursor.fetchall()
+    if q:
+        # Búsqueda unificada (FULLTEXT nombre/correo)
+        usuarios = busqueda_unificada(cursor, eid, q, ['usuarios'], 1, 20)['usuarios']['resultados']
+    else:
+        cursor.execute("""
+            SELECT id, nombre, correo, puesto, estado_registro
+            FROM usuarios
+            WHERE empresa_id = %s AND activo = 1
+            ORDER BY nombre
+            LIMIT 20
+        """, (eid,))
+        usuarios = cursor.fetchall()
     cursor.close()
     db.close()
     
@@ -2456,23 +2527,19 @@ def api_buscar_usuarios():
 # =============================================
 
 @app.context_processor
-def inject_incidencias_count():
-    """Inyecta contador de incidencias no leídas"""
-    if hasattr(g, 'usuario_id') and g.usuario_id:
-        try:
-            db = conexion_db()
-            cursor = db.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT COUNT(*) as count FROM incidencias
-                WHERE usuario_destino_id = %s AND leida = 0
-            """, (g.usuario_id,))
-            result = cursor.fetchone()
-            cursor.close()
-            db.close()
-            return {'incidencias_count': result['count'] if result else 0}
-        except:
-            pass
-    return {'incidencias_count': 0}
+def inject_badges_header():
+    """
+    Inyecta los badges del header (incidencias, notificaciones, alertas y OC
+    pendientes) con una sola consulta, memo por petición y caché corta por usuario
+    """
+    usuario_id = g.get('usuario_id') or session.get('usuario_id')
+    empresa_id = g.get('empresa_id') or session.get('empresa_id')
+    if not usuario_id and not empresa_id:
+        return dict(BADGES_CEROS)
+    try:
+        return contadores_header(empresa_id, usuario_id)
+    except:
+        return dict(BADGES_CEROS)
 
 
 # =============================================
@@ -2785,6 +2852,7 @@ def registro_invitacion(token):
         """, (usuario_id, invitacion['id']))
         
         db.commit()
+        invalidar_busqueda(invitacion['empresa_id'], 'usuarios')
         cursor.close()
         db.close()
         
@@ -3280,6 +3348,7 @@ def notificacion_leer(notif_id):
     """, (notif_id, uid))
     
     db.commit()
+    invalidar_badges(usuario_id=uid)
     cursor.close()
     db.close()
     
@@ -3313,26 +3382,6 @@ def api_notificaciones_count():
 # CONTEXT PROCESSOR PARA NOTIFICACIONES
 # =============================================
 
-@app.context_processor
-def inject_notificaciones_count():
-    """Inyecta contador de notificaciones no leídas"""
-    if hasattr(g, 'usuario_id') and g.usuario_id:
-        try:
-            db = conexion_db()
-            cursor = db.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT COUNT(*) as count FROM notificaciones_usuario
-                WHERE usuario_destino_id = %s AND leida = 0
-            """, (g.usuario_id,))
-            result = cursor.fetchone()
-            cursor.close()
-            db.close()
-            return {'notificaciones_count': result['count'] if result else 0}
-        except:
-            pass
-    return {'notificaciones_count': 0}
-
-
 # =============================================
 # FUNCIONES HELPER PARA NOTIFICACIONES
 # =============================================
@@ -3344,6 +3393,7 @@ def crear_notificacion(cursor, empresa_id, usuario_destino_id, titulo, mensaje,
         (empresa_id, usuario_destino_id, usuario_origen_id, tipo, titulo, mensaje, importante)
         VALUES (%s, %s, %s, %s, %s, %s, %s)
     """, (empresa_id, usuario_destino_id, usuario_origen_id, tipo, titulo, mensaje, importante))
+    invalidar_badges(usuario_id=usuario_destino_id)
 
 
 def crear_mensaje_bienvenida(cursor, empresa_id, usuario_id, area, rol, asignado_por):
@@ -3536,19 +3586,20 @@ def notificar_rol_whatsapp(empresa_id, rol, mensaje):
 
 
 def registrar_whatsapp_enviado(alerta_id):
-    """Marca una alerta como notificada por WhatsApp."""
-    db = conexion_db()
+    """Marca una alerta como notificada por WhatsApp (conexión aparte: no toca la transacción de la vista)."""
+    db = conexion_aparte()
     cursor = db.cursor()
     
-    cursor.execute("""
-        UPDATE alertas_b2b 
-        SET whatsapp_enviado = 1, whatsapp_fecha = NOW()
-        WHERE id = %s
-    """, (alerta_id,))
-    
-    db.commit()
-    cursor.close()
-    db.close()
+    try:
+        cursor.execute("""
+            UPDATE alertas_b2b 
+            SET whatsapp_enviado = 1, whatsapp_fecha = NOW()
+            WHERE id = %s
+        """, (alerta_id,))
+        db.commit()
+    finally:
+        cursor.close()
+        db.close()
 
 
 # =============================================
@@ -3556,12 +3607,16 @@ def registrar_whatsapp_enviado(alerta_id):
 # =============================================
 # Reemplaza tu función crear_alerta_b2b existente con esta:
 
-def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_tipo=None, referencia_id=None, usuario_id=None, enviar_whatsapp_notif=True):
+def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_tipo=None, referencia_id=None, usuario_id=None, enviar_whatsapp_notif=True, cursor=None):
     """
     Crea una alerta B2B y opcionalmente envía notificación por WhatsApp.
+    Con `cursor` se suma a la transacción del que llama (sin commit); sin él usa una
+    conexión aparte con su propio commit.
     """
-    db = conexion_db()
-    cursor = db.cursor(dictionary=True)
+    propia = cursor is None
+    if propia:
+        db = conexion_aparte()
+        cursor = db.cursor(dictionary=True)
     
     try:
         cursor.execute("""
@@ -3571,7 +3626,9 @@ def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_
         """, (empresa_id, usuario_id, rol_destino, tipo, titulo, mensaje, referencia_tipo, referencia_id))
         
         alerta_id = cursor.lastrowid
-        db.commit()
+        if propia:
+            db.commit()
+        invalidar_badges(empresa_id=empresa_id)
         
         # Enviar WhatsApp si está habilitado
         if enviar_whatsapp_notif and WHATSAPP_ENABLED:
@@ -3582,16 +3639,17 @@ def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_
                 registrar_whatsapp_enviado(alerta_id)
                 print(f"📱 WhatsApp enviado a {enviados} usuario(s) con rol {rol_destino}")
         
-        cursor.close()
-        db.close()
         return alerta_id
         
     except Exception as e:
         print(f"Error creando alerta: {e}")
-        db.rollback()
-        cursor.close()
-        db.close()
+        if propia:
+            db.rollback()
         return None
+    finally:
+        if propia:
+            cursor.close()
+            db.close()
 
 
 # =============================================
@@ -3760,26 +3818,15 @@ def d(x):
 
 def costo_pt(mercancia_id):
     conn = conexion_db(); cur = conn.cursor(dictionary=True)
-    cur.execute("""
-        SELECT SUM(cantidad*costo_unitario) imp, SUM(cantidad) qty
-        FROM movimientos_inventario
-        WHERE producto_id=%s AND UPPER(tipo) IN ('COMPRA','ENTRADA')
-    """, (mercancia_id,))
-    r = cur.fetchone() or {}
+    costos = costos_pt(cur, [mercancia_id])
     cur.close(); conn.close()
-    imp = d(r.get('imp') or 0); qty = d(r.get('qty') or 0)
-    return (imp/qty if qty>0 else d(0)).quantize(Decimal("0.01"))
+    return costos.get(mercancia_id, d(0).quantize(Decimal("0.01")))
 
 def markup_auto_para_costo(costo):
     conn = conexion_db(); cur = conn.cursor(dictionary=True)
-    cur.execute("""
-        SELECT markup_pct FROM pt_reglas_markup
-        WHERE %s BETWEEN costo_min AND costo_max
-        ORDER BY costo_min LIMIT 1
-    """, (str(costo),))
-    r = cur.fetchone()
+    reglas = cargar_reglas_markup(cur)
     cur.close(); conn.close()
-    return d(r['markup_pct']) if r else d("0.30")
+    return reglas.para_costo(costo)
 
 def precio_con_modo(costo, modo, manual_pct):
     pct = manual_pct if modo=='manual' else markup_auto_para_costo(costo)
@@ -3788,74 +3835,9 @@ def precio_con_modo(costo, modo, manual_pct):
 from decimal import Decimal
 
 def _pt_items_all():
-    """Catálogo PT de la empresa activa - CORREGIDO"""
+    """Catálogo PT de la empresa activa (costos y precios en lote, ver precios_pt.py)"""
     eid = getattr(g, "empresa_id", session.get("empresa_id"))
-
-    conn = conexion_db()
-    cur = conn.cursor(dictionary=True)
-    cur.execute("""
-        SELECT
-            m.id,
-            m.nombre,
-            COALESCE(m.orden, 9999) AS orden,
-            COALESCE(p.modo, 'auto') AS modo,
-            COALESCE(p.markup_pct, 0.30) AS markup_pct,
-            p.alias,
-            p.precio_manual
-        FROM mercancia m
-        LEFT JOIN pt_precios p ON p.mercancia_id = m.id AND p.empresa_id = %s
-        WHERE m.tipo_inventario_id = 3
-          AND m.empresa_id = %s
-          AND m.activo = 1
-        ORDER BY orden ASC, COALESCE(p.alias, m.nombre) ASC
-    """, (eid, eid))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    def D(x, fb="0"):
-        try:
-            return Decimal(str(x))
-        except Exception:
-            return Decimal(fb)
-
-    items = []
-    for r in rows:
-        mid = r["id"]
-        nombre = r["nombre"]
-        modo = r["modo"]
-        alias = r.get("alias")
-        markup_pct = D(r.get("markup_pct") or "0")
-        precio_manual = r.get("precio_manual")
-        label = alias or nombre
-
-        costo = D(costo_pt(mid))
-
-        if modo == "manual" and precio_manual is not None:
-            precio = D(precio_manual).quantize(Decimal("0.01"))
-            pct_usado = (precio / costo - Decimal("1")) if costo > 0 else Decimal("0")
-        else:
-            if modo == "manual":
-                pct = markup_pct
-            else:
-                pct = D(markup_auto_para_costo(costo))
-            precio = (costo * (Decimal("1") + pct)).quantize(Decimal("0.01"))
-            pct_usado = pct
-
-        items.append({
-            "id": mid,
-            "nombre": nombre,
-            "alias": alias,
-            "label": label,
-            "modo": modo,
-            "costo": costo,
-            "precio": precio,
-            "pct_usado": pct_usado,
-            "markup_pct": markup_pct,
-            "precio_manual": precio_manual,
-        })
-
-    return items
+    return calcular_precios_pt(eid)
 
 @app.route('/test_apertura')
 def test_apertura():
@@ -4043,15 +4025,11 @@ def caja():
             flash('⚠️ Debes abrir un turno antes de usar la caja', 'warning')
             return redirect(url_for('apertura_turno'))
 
-        # Sesión POS
-        print("✅ Inicializando sesión...")
-        session.setdefault("carrito", [])
-        session.setdefault("pos_sel", [])
-        session.setdefault("caja_holds", [])
-        aplica_iva = session.get("caja_aplica_iva", True)
+        # Carrito POS (en el servidor; la cookie solo lleva pos_id)
+        pos = carrito_actual(turno_abierto['id'])
+        aplica_iva = pos.aplica_iva
 
-        carrito = session["carrito"]
-        print(f"✅ Carrito: {len(carrito)} items")
+        carrito = pos.items
 
         print("✅ Calculando totales...")
         totals = _totales(carrito, aplica_iva)
@@ -4060,8 +4038,7 @@ def caja():
         items_all = _pt_items_all()  # esta función debe usar g.empresa_id internamente
         print(f"✅ Items disponibles: {len(items_all)}")
 
-        sel_ids = set(int(x) for x in session.get("pos_sel", []))
-        print(f"✅ Items seleccionados en sesión: {len(sel_ids)}")
+        sel_ids = set(int(x) for x in pos.pos_sel)
 
         items_pos = [it for it in items_all if it["id"] in sel_ids]
         print(f"✅ Items POS finales: {len(items_pos)}")
@@ -4078,8 +4055,9 @@ def caja():
             items_pos=items_pos,
             items_all=items_all,
             sel_ids=sel_ids,
-            holds=session.get("caja_holds", []),
-            aplica_iva=aplica_iva
+            holds=pos.lista_holds(),
+            aplica_iva=aplica_iva,
+            catalogo_version=version_catalogo_pt(eid, turno_abierto['id'])
         )
 
     except Exception as e:
@@ -4100,21 +4078,118 @@ def caja():
         except: pass
 
 @app.post("/caja/iva_toggle")
+@require_login
 def caja_iva_toggle():
-    aplica = session.get("caja_aplica_iva", True)
-    session["caja_aplica_iva"] = not aplica
-    session.modified = True
+    carrito_actual().toggle_iva()
     return redirect(url_for("caja"))
 
 @app.route('/caja/pos_config', methods=['POST'])
+@require_login
 def caja_pos_config():
-    """Guardar selección de artículos en sesión"""
+    """Guardar selección de artículos del POS"""
     sel = request.form.getlist('sel[]')
-    session['pos_sel'] = sel
-    session.modified = True
+    carrito_actual().set_pos_sel(sel)
     flash(f'✅ Configuración guardada: {len(sel)} artículos', 'success')
     return redirect(url_for('caja'))
 
+
+# =============================================
+# API JSON DEL POS (captura sin recargar /caja)
+# =============================================
+
+def _carrito_json(pos):
+    """Carrito + _totales() listos para el front"""
+    totals = _totales(pos.items, pos.aplica_iva)
+    return jsonify({
+        "ok": True,
+        "items": pos.items,
+        "totals": {k: str(v) for k, v in totals.items()},
+        "aplica_iva": pos.aplica_iva,
+        "holds": pos.lista_holds(),
+    })
+
+def _datos_api():
+    return request.get_json(silent=True) or request.form
+
+@app.get("/caja/api/carrito")
+@require_login
+def caja_api_carrito():
+    return _carrito_json(carrito_actual())
+
+@app.post("/caja/api/agregar")
+@require_login
+def caja_api_agregar():
+    item = _item_caja(_datos_api())
+    if item is None:
+        return jsonify({"ok": False, "error": "Producto requerido"}), 400
+    pos = carrito_actual()
+    pos.agregar(item)
+    return _carrito_json(pos)
+
+@app.post("/caja/api/eliminar/<int:linea_id>")
+@require_login
+def caja_api_eliminar(linea_id):
+    pos = carrito_actual()
+    if not pos.eliminar(linea_id):
+        return jsonify({"ok": False, "error": "Renglón no encontrado"}), 404
+    return _carrito_json(pos)
+
+@app.post("/caja/api/cantidad/<int:linea_id>")
+@require_login
+def caja_api_cantidad(linea_id):
+    try:
+        cant = Decimal(str(_datos_api().get("cant")))
+    except Exception:
+        return jsonify({"ok": False, "error": "Cantidad inválida"}), 400
+    pos = carrito_actual()
+    if cant <= 0:
+        pos.eliminar(linea_id)
+    elif not pos.actualizar_cantidad(linea_id, cant):
+        return jsonify({"ok": False, "error": "Renglón no encontrado"}), 404
+    return _carrito_json(pos)
+
+@app.post("/caja/api/vaciar")
+@require_login
+def caja_api_vaciar():
+    pos = carrito_actual()
+    pos.vaciar()
+    return _carrito_json(pos)
+
+@app.post("/caja/api/iva_toggle")
+@require_login
+def caja_api_iva_toggle():
+    pos = carrito_actual()
+    pos.toggle_iva()
+    return _carrito_json(pos)
+
+@app.get("/caja/api/catalogo")
+@require_login
+def caja_api_catalogo():
+    """
+    Catálogo PT para el POS con etiqueta de versión (turno + revisión de precios).
+    El front lo guarda en localStorage y solo lo vuelve a pedir si cambia la versión;
+    con If-None-Match igual responde 304 sin recalcular precios.
+    """
+    eid = g.empresa_id
+    pos_id = session.get("pos_id", "")
+    turno_id = pos_id.rsplit(":", 1)[-1] if pos_id else (session.get("turno_actual") or 0)
+    version = version_catalogo_pt(eid, turno_id)
+
+    if request.if_none_match.contains(version):
+        return "", 304
+
+    items = calcular_precios_pt(eid)
+    resp = jsonify({
+        "version": version,
+        "items": [
+            {"id": it["id"], "label": it["label"], "precio": str(it["precio"])}
+            for it in items
+        ],
+    })
+    resp.set_etag(version)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
 @app.route('/agregar_consumo', methods=['POST'])
 @require_login
 def agregar_consumo():
@@ -4459,8 +4534,10 @@ def historial_tickets():
             params.append(fecha_filtro)
         
         if buscar:
-            query += " AND (folio LIKE %s OR id LIKE %s)"
-            params.extend([f'%{buscar}%', f'%{buscar}%'])
+            # Id exacto o folio por prefijo, en la misma consulta que el filtro de fecha
+            condicion, params_buscar = condicion_tickets(buscar)
+            query += f" AND {condicion}"
+            params.extend(params_buscar)
         
         query += " ORDER BY fecha DESC LIMIT 100"
         
@@ -4796,56 +4873,14 @@ def cerrar_turno():
         # POST - Procesar
         ya_validado = session.get(f'turno_{turno["id"]}_validado', False)
         
+        conteo = conteo_desde_form(request.form)
+        corte = corte_turno(cursor, turno['id'], eid, conteo)
+        
         if not ya_validado:
-            diferencias_inventario = []
-            producto_ids = request.form.getlist('producto_id[]')
-            producto_nombres = request.form.getlist('producto_nombre[]')
-            producto_precios = request.form.getlist('producto_precio[]')
-            cantidades_finales = request.form.getlist('cantidad_final[]')
-            
-            for pid, pnombre, pprecio, cant_final in zip(producto_ids, producto_nombres, producto_precios, cantidades_finales):
-                if not cant_final or not cant_final.strip():
-                    continue
-                
-                pid = int(pid)
-                cant_final = float(cant_final)
-                pprecio = float(pprecio)
-                
-                cursor.execute("""
-                    SELECT cantidad_inicial FROM turno_inventario
-                    WHERE turno_id = %s AND producto_id = %s AND empresa_id = %s
-                """, (turno['id'], pid, eid))
-                inicial = cursor.fetchone()
-                cant_inicial = float(inicial['cantidad_inicial']) if inicial else 0
-                
-                cursor.execute("""
-                    SELECT COALESCE(SUM(cantidad), 0) as total_consumos
-                    FROM consumos_propios
-                    WHERE turno_id = %s AND producto_id = %s AND empresa_id = %s
-                """, (turno['id'], pid, eid))
-                consumos = cursor.fetchone()
-                cant_consumos = float(consumos['total_consumos'])
-                
-                cursor.execute("""
-                    SELECT COALESCE(SUM(cantidad), 0) as total_mermas
-                    FROM turno_mermas
-                    WHERE turno_id = %s AND producto_id = %s AND empresa_id = %s
-                """, (turno['id'], pid, eid))
-                mermas_prod = cursor.fetchone()
-                cant_mermas = float(mermas_prod['total_mermas'])
-                
-                ventas_teoricas = cant_inicial - cant_consumos - cant_mermas - cant_final
-                valor_diferencia = abs(ventas_teoricas) * pprecio
-                
-                if valor_diferencia > 70:
-                    diferencias_inventario.append({
-                        'producto': pnombre,
-                        'diferencia': ventas_teoricas,
-                        'valor': valor_diferencia
-                    })
+            diferencias_inventario = diferencias(corte)
+            session[f'turno_{turno["id"]}_validado'] = True
             
             if diferencias_inventario:
-                session[f'turno_{turno["id"]}_validado'] = True
                 flash('⚠️ ATENCIÓN: Favor de verificar el conteo.', 'warning')
                 for dif in diferencias_inventario:
                     flash(f"• {dif['producto']}: Diferencia de {dif['diferencia']:.2f} unidades (${dif['valor']:.2f})", 'warning')
@@ -4853,71 +4888,12 @@ def cerrar_turno():
                 cursor.close()
                 db.close()
                 return redirect(url_for('cerrar_turno'))
-            else:
-                session[f'turno_{turno["id"]}_validado'] = True
         
         # CERRAR DEFINITIVAMENTE
-        producto_ids = request.form.getlist('producto_id[]')
-        producto_nombres = request.form.getlist('producto_nombre[]')
-        producto_precios = request.form.getlist('producto_precio[]')
-        cantidades_finales = request.form.getlist('cantidad_final[]')
+        guardar_inventario_final(cursor, eid, turno['id'], corte)
         
-        ventas_por_producto = []
-        total_ventas_calculado = 0
-        
-        for pid, pnombre, pprecio, cant_final in zip(producto_ids, producto_nombres, producto_precios, cantidades_finales):
-            if not cant_final or not cant_final.strip():
-                continue
-            
-            pid = int(pid)
-            cant_final = float(cant_final)
-            pprecio = float(pprecio)
-            
-            # Guardar inventario final CON EMPRESA
-            cursor.execute("""
-                INSERT INTO turno_inventario_final 
-                (empresa_id, turno_id, producto_id, producto_nombre, cantidad_final)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (eid, turno['id'], pid, pnombre, cant_final))
-            
-            cursor.execute("""
-                SELECT cantidad_inicial FROM turno_inventario
-                WHERE turno_id = %s AND producto_id = %s AND empresa_id = %s
-            """, (turno['id'], pid, eid))
-            inicial = cursor.fetchone()
-            cant_inicial = float(inicial['cantidad_inicial']) if inicial else 0
-            
-            cursor.execute("""
-                SELECT COALESCE(SUM(cantidad), 0) as total
-                FROM consumos_propios
-                WHERE turno_id = %s AND producto_id = %s AND empresa_id = %s
-            """, (turno['id'], pid, eid))
-            consumos = cursor.fetchone()
-            cant_consumos = float(consumos['total'])
-            
-            cursor.execute("""
-                SELECT COALESCE(SUM(cantidad), 0) as total
-                FROM turno_mermas
-                WHERE turno_id = %s AND producto_id = %s AND empresa_id = %s
-            """, (turno['id'], pid, eid))
-            mermas = cursor.fetchone()
-            cant_mermas = float(mermas['total'])
-            
-            unidades_vendidas = cant_inicial - cant_consumos - cant_mermas - cant_final
-            importe_venta = unidades_vendidas * pprecio
-            total_ventas_calculado += importe_venta
-            
-            if unidades_vendidas != 0:
-                ventas_por_producto.append({
-                    'producto': pnombre,
-                    'inicial': cant_inicial,
-                    'consumos': cant_consumos,
-                    'mermas': cant_mermas,
-                    'final': cant_final,
-                    'vendidas': unidades_vendidas,
-                    'precio': pprecio,
-                    'importe': importe_venta
-                })
+        total_ventas_calculado = sum(r['importe'] for r in corte)
+        ventas_por_producto = [r for r in corte if r['vendidas'] != 0]
         
         # Arqueo CON EMPRESA
         billetes_20 = int(request.form.get('billetes_20', 0))
@@ -5184,6 +5160,7 @@ def pt_catalogo_guardar():
             alias
         ))
 
+    subir_version_catalogo_pt(cur, eid)
     conn.commit()
     cur.close(); conn.close()
 
@@ -5252,8 +5229,10 @@ def pt_nuevo():
                   modo = VALUES(modo),
                   markup_pct = VALUES(markup_pct)
             """, (eid, mid))
+            subir_version_catalogo_pt(cursor, eid)
 
             db.commit()
+            invalidar_indice(eid)
             flash(f'✅ Producto "{nombre}" creado correctamente', 'success')
             return redirect(url_for('pt_catalogo'))
 
@@ -5292,46 +5271,11 @@ def inventario_movimientos_api(mercancia_id):
 def r2(x):
     return Decimal(str(x)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
-def tipo_from_code(code: str) -> str:
-    a = int(code.split('-')[0])
-    if 100 <= a < 200:
-        return 'Activo'
-    if 200 <= a < 300:
-        return 'Pasivo'
-    if 300 <= a < 400:
-        return 'Patrimonio'
-    if 400 <= a < 500:
-        return 'Ingresos'
-    # 500 y 600 los tratamos como Gastos (no hay 'Costos' en el enum)
-    if 500 <= a < 700:
-        return 'Gastos'
-    return 'Gastos'
-
-def naturaleza_from_tipo(tipo: str) -> str:
-    # regla contable estándar
-    if tipo in ('Activo', 'Gastos'):
-        return 'Deudora'
-    # Pasivo, Patrimonio, Ingresos
-    return 'Acreedora'
-
-def nivel_from_code(code: str) -> int:
-    _, b, c = code.split('-')
-    if b == '000' and c == '000':
-        return 1
-    if c == '000':
-        return 2
-    return 3
-
-def parent_code_of(code: str) -> str | None:
-    a, b, c = code.split('-')
-    n = nivel_from_code(code)
-    if n == 1:
-        return None
-    if n == 2:
-        return f"{a}-000-000"
-    return f"{a}-{b}-000"
-
 def get_id_by_code(cursor, code: str) -> int | None:
+    # Árbol en caché; si no está (otro proceso la creó hace poco) se confirma en la tabla
+    cid = arbol_cuentas(cursor).id_por_codigo(code)
+    if cid is not None:
+        return cid
     cursor.execute("SELECT id FROM cuentas_contables WHERE codigo=%s", (code,))
     row = cursor.fetchone()
     return row["id"] if row else None
@@ -5340,11 +5284,8 @@ def ensure_account(cursor, conn, code: str, name: str, permite_sub: bool = False
     """
     Crea o actualiza una cuenta. Asigna tipo/naturaleza/nivel/padre automáticamente.
     parent_override permite forzar el código del padre.
-    Retorna id.
+    Retorna id. Para muchas cuentas a la vez usar sincronizar_cuentas (un solo commit).
     """
-    cursor.execute("SELECT id, nombre FROM cuentas_contables WHERE codigo=%s", (code,))
-    row = cursor.fetchone()
-
     tipo = tipo_from_code(code)
     naturaleza = naturaleza_from_tipo(tipo)
     n = nivel_from_code(code)
@@ -5354,23 +5295,27 @@ def ensure_account(cursor, conn, code: str, name: str, permite_sub: bool = False
         pcode = parent_override
     pid = get_id_by_code(cursor, pcode) if pcode else None
 
+    arbol = arbol_cuentas(cursor)
+    row = arbol.por_codigo.get(code)
+    if row is None:
+        cursor.execute("SELECT id, nombre, tipo, naturaleza, nivel, padre_id, permite_subcuentas "
+                       "FROM cuentas_contables WHERE codigo=%s", (code,))
+        row = cursor.fetchone()
+
     if row:
         # 🚨 No actualizar nombre si está en el bloque 600-001-001 … 600-001-026
-        if code.startswith("600-001-"):
-            cursor.execute(
-                "UPDATE cuentas_contables "
-                "SET tipo=%s, naturaleza=%s, nivel=%s, padre_id=%s, permite_subcuentas=%s "
-                "WHERE id=%s",
-                (tipo, naturaleza, n, pid, 1 if permite_sub else 0, row["id"])
-            )
-        else:
+        nombre = row["nombre"] if code.startswith("600-001-") else name
+        actual = (row["nombre"], row["tipo"], row["naturaleza"], row["nivel"],
+                  row["padre_id"], int(row["permite_subcuentas"] or 0))
+        if actual != (nombre, tipo, naturaleza, n, pid, 1 if permite_sub else 0):
             cursor.execute(
                 "UPDATE cuentas_contables "
                 "SET nombre=%s, tipo=%s, naturaleza=%s, nivel=%s, padre_id=%s, permite_subcuentas=%s "
                 "WHERE id=%s",
-                (name, tipo, naturaleza, n, pid, 1 if permite_sub else 0, row["id"])
+                (nombre, tipo, naturaleza, n, pid, 1 if permite_sub else 0, row["id"])
             )
-        conn.commit()
+            conn.commit()
+            invalidar_arbol()
         return row["id"]
 
     # Insertar por primera vez con el nombre fijo
@@ -5379,34 +5324,25 @@ def ensure_account(cursor, conn, code: str, name: str, permite_sub: bool = False
         "VALUES (%s, %s, %s, %s, %s, %s, %s)",
         (code, name, tipo, naturaleza, n, pid, 1 if permite_sub else 0)
     )
+    nuevo_id = cursor.lastrowid
     conn.commit()
-    return cursor.lastrowid
+    invalidar_arbol()
+    return nuevo_id
 
 def next_lvl3_code(cursor, parent_id: int) -> str:
-    cursor.execute(
-        "SELECT codigo FROM cuentas_contables WHERE id=%s", (parent_id,))
-    padre = cursor.fetchone()
-    if not padre:
-        raise ValueError("Padre inexistente")
-    a, b, _ = padre["codigo"].split('-')
-
-    cursor.execute(
-        "SELECT codigo FROM cuentas_contables WHERE padre_id=%s AND nivel=3 ORDER BY codigo DESC LIMIT 1",
-        (parent_id,)
-    )
-    row = cursor.fetchone()
-    nxt = f"{int(row['codigo'].split('-')[2]) + 1:03d}" if row else "001"
-    return f"{a}-{b}-{nxt}"
+    return arbol_cuentas(cursor).siguiente_nivel3(parent_id)
 
 def create_lvl3_account_for_product(cursor, conn, nombre_producto: str, parent_id: int) -> tuple[int, str]:
     """
     Crea (o reutiliza si ya existe con mismo nombre bajo el padre) una subcuenta nivel 3
     para el producto. Retorna (id, codigo).
     """
+    # Antes de crear se relee el árbol: el código siguiente no puede salir de una caché vieja
+    invalidar_arbol()
+    arbol = arbol_cuentas(cursor)
+
     # validar que el padre permita subcuentas
-    cursor.execute(
-        "SELECT codigo, permite_subcuentas FROM cuentas_contables WHERE id=%s", (parent_id,))
-    row = cursor.fetchone()
+    row = arbol.por_id.get(parent_id)
     if not row:
         raise ValueError("Cuenta padre inexistente")
     if not row["permite_subcuentas"]:
@@ -5414,21 +5350,14 @@ def create_lvl3_account_for_product(cursor, conn, nombre_producto: str, parent_i
 
     nombre_up = nombre_producto.strip().upper()
 
-    cursor.execute(
-        "SELECT id, codigo FROM cuentas_contables WHERE nivel=3 AND padre_id=%s AND UPPER(nombre)=%s",
-        (parent_id, nombre_up)
-    )
-    ex = cursor.fetchone()
+    ex = arbol.hijo_por_nombre(parent_id, nombre_up)
     if ex:
         return ex["id"], ex["codigo"]
 
-    new_code = next_lvl3_code(cursor, parent_id)
+    new_code = arbol.siguiente_nivel3(parent_id)
     ensure_id = ensure_account(
         cursor, conn, code=new_code, name=nombre_up, permite_sub=False)
-    cursor.execute(
-        "SELECT codigo FROM cuentas_contables WHERE id=%s", (ensure_id,))
-    new_row = cursor.fetchone()
-    return ensure_id, new_row["codigo"]
+    return ensure_id, new_code
 
 def get_default_inventory_parent(cursor, conn) -> int:
     """
@@ -5442,18 +5371,12 @@ def get_default_inventory_parent(cursor, conn) -> int:
     #3) Devuelve el id de 112-001-000.
     """
     # 1) ¿Ya existe algún padre válido?
-    cursor.execute("""
-        SELECT id
-        FROM cuentas_contables
-        WHERE nivel = 2
-          AND permite_subcuentas = 1
-          AND codigo LIKE '112-%-000'
-        ORDER BY codigo
-        LIMIT 1
-    """)
-    row = cursor.fetchone()
-    if row:
-        return row["id"]
+    arbol = arbol_cuentas(cursor)
+    for codigo in sorted(arbol.por_codigo):
+        nodo = arbol.por_codigo[codigo]
+        if (nodo["nivel"] == 2 and nodo["permite_subcuentas"]
+                and codigo.startswith("112-") and codigo.endswith("-000")):
+            return nodo["id"]
 
     # 2) Garantizar cadena mínima
     ensure_account(cursor, conn, code="100-000-000",
@@ -5465,13 +5388,11 @@ def get_default_inventory_parent(cursor, conn) -> int:
     ensure_account(cursor, conn, code="112-001-000", name="MERCANCÍAS",
                    permite_sub=True, parent_override="112-000-000")
 
-    cursor.execute(
-        "SELECT id FROM cuentas_contables WHERE codigo=%s", ("112-001-000",))
-    row = cursor.fetchone()
-    if not row:
+    pid = get_id_by_code(cursor, "112-001-000")
+    if not pid:
         raise RuntimeError(
             "No se pudo crear/obtener 112-001-000 como padre por defecto.")
-    return row["id"]
+    return pid
 
 import uuid
 
@@ -5482,20 +5403,44 @@ def registrar_movimiento(
     unidades,
     precio_unitario=0,
     referencia=None,
-    fecha=None
+    fecha=None,
+    usuario_id=None,
+    cursor=None
 ):
-    """Registra un movimiento de inventario CON EMPRESA"""
+    """
+    Registra un movimiento de inventario CON EMPRESA (y actualiza su saldo materializado).
+    Con `cursor` se suma a la transacción del que llama; sin él usa una conexión
+    aparte con su propio commit.
+    """
     from datetime import date as _date
     
     eid = getattr(g, "empresa_id", None) or session.get("empresa_id") or 1
-    uid = getattr(g, "usuario_id", None) or session.get("usuario_id")
+    uid = usuario_id or getattr(g, "usuario_id", None) or session.get("usuario_id")
 
     if fecha is None:
         fecha = _date.today()
 
-    conn = conexion_db()
+    if cursor is not None:
+        return _registrar_movimiento(cursor, eid, uid, mercancia_id, tipo_inventario_id,
+                                     tipo_movimiento, unidades, precio_unitario, referencia, fecha)
+
+    conn = conexion_aparte()
     cur = conn.cursor()
+    try:
+        mov_id = _registrar_movimiento(cur, eid, uid, mercancia_id, tipo_inventario_id,
+                                       tipo_movimiento, unidades, precio_unitario, referencia, fecha)
+        conn.commit()
+        return mov_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
 
+def _registrar_movimiento(cur, eid, uid, mercancia_id, tipo_inventario_id, tipo_movimiento,
+                          unidades, precio_unitario, referencia, fecha):
     cur.execute("""
         INSERT INTO inventario_movimientos
             (empresa_id, usuario_id, tipo_inventario_id, mercancia_id,
@@ -5504,9 +5449,18 @@ def registrar_movimiento(
     """, (eid, uid, tipo_inventario_id, mercancia_id, fecha,
           tipo_movimiento, unidades, precio_unitario, referencia))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    mov_id = cur.lastrowid
+    aplicar_movimiento(cur, eid, tipo_inventario_id, mercancia_id, tipo_movimiento,
+                       unidades, precio_unitario, mov_id)
+
+    # Capas PEPS: las entradas abren capa, las salidas la consumen
+    tipo = (tipo_movimiento or '').strip().lower()
+    if tipo in ('entrada', 'compra'):
+        agregar_capa(cur, eid, tipo_inventario_id, mercancia_id, unidades, precio_unitario,
+                     origen=tipo, referencia=referencia, fecha=fecha, movimiento_id=mov_id)
+    elif tipo == 'salida':
+        consumir(cur, eid, tipo_inventario_id, {mercancia_id: unidades})
+    return mov_id
 
 def get_or_create_catalogo(cur, conn, nombre: str, tipo: str = 'MP') -> int:
     nombre = (nombre or '').strip()
@@ -5530,55 +5484,29 @@ def get_or_create_catalogo(cur, conn, nombre: str, tipo: str = 'MP') -> int:
     conn.commit()
     return cur.lastrowid
 
-def salida_peps(tipo_inventario_id: int, mercancia_id: int, unidades_salida, referencia: str):
-    conn = conexion_db()
-    cursor = conn.cursor(dictionary=True)
-
-    try:
-        # Tomar primero las entradas más antiguas (PEPS)
-        cursor.execute("""
-            SELECT id, unidades, precio_unitario
-            FROM inventario_movimientos
-            WHERE tipo_inventario_id = %s
-              AND mercancia_id = %s
-              AND LOWER(tipo_movimiento) IN ('entrada','compra')
-              AND unidades > 0
-            ORDER BY fecha ASC, id ASC
-        """, (tipo_inventario_id, mercancia_id))
-
-        lotes = cursor.fetchall()
-        unidades_restantes = float(unidades_salida)
-        costo_total = 0.0
-
-        for lote in lotes:
-            if unidades_restantes <= 0:
-                break
-
-            disponibles = float(lote['unidades'])
-            usar = min(disponibles, unidades_restantes)
-            costo_total += usar * float(lote['precio_unitario'])
-
-            # Restar del lote de entrada
-            cursor.execute(
-                "UPDATE inventario SET unidades = unidades - %s WHERE id = %s",
-                (usar, lote['id'])
-            )
-
-            # Registrar la salida como movimiento
-            registrar_movimiento(
-                tipo_inventario_id=tipo_inventario_id,
-                mercancia_id=mercancia_id,
-                tipo_movimiento='salida',
-                unidades=usar,
-                precio_unitario=float(lote['precio_unitario']),
-                referencia=referencia
-            )
+def salida_peps(tipo_inventario_id: int, mercancia_id: int, unidades_salida, referencia: str, cursor=None):
+    """
+    Salida PEPS con costo (ver capas_peps.py).
+    Con `cursor` se suma a la transacción del que llama; sin él usa una conexión
+    aparte y hace un solo commit (o rollback completo).
+    """
+    eid = getattr(g, "empresa_id", None) or session.get("empresa_id") or 1
+    uid = getattr(g, "usuario_id", None) or session.get("usuario_id")
 
-            unidades_restantes -= usar
+    if cursor is not None:
+        return salida_peps_capas(cursor, eid, tipo_inventario_id, mercancia_id,
+                                 unidades_salida, referencia, usuario_id=uid)
 
+    conn = conexion_aparte()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        costo_total = salida_peps_capas(cursor, eid, tipo_inventario_id, mercancia_id,
+                                        unidades_salida, referencia, usuario_id=uid)
         conn.commit()
         return costo_total
-
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         cursor.close()
         conn.close()
@@ -5594,97 +5522,12 @@ def _render_inventario_por_almacen(almacen_id, tipo_merc, titulo):
     if tipo_inventario_id is None:
         raise ValueError(f"tipo_merc inválido: {tipo_merc}")
 
+    # 2) Base + valuación PEPS de todo el tipo en una pasada (ver valuacion_fifo.py)
     conn = conexion_db()
-    cur = conn.cursor(dictionary=True)
     try:
-        # 2) Base filtrada por tipo; filtra inventario por almacén
-        cur.execute("""
-            SELECT 
-                COALESCE(i.id, 0)               AS id,
-                m.id                             AS mercancia_id,
-                m.nombre                         AS producto,
-                COALESCE(i.inventario_inicial,0) AS inventario_inicial,
-                COALESCE(i.entradas,0)           AS entradas,
-                COALESCE(i.salidas,0)            AS salidas,
-                COALESCE(i.aprobado,0)           AS aprobado
-            FROM mercancia m
-            LEFT JOIN inventario i 
-                   ON i.mercancia_id = m.id
-                  
-            WHERE m.tipo_inventario_id = %s
-                AND (
-                        EXISTS (
-                        SELECT 1 FROM movimientos_inventario mi
-                        WHERE mi.producto_id = m.id        -- ✅ solo esto
-                        )
-                        OR i.id IS NOT NULL
-                    )
-            ORDER BY m.nombre ASC
-        """, (tipo_inventario_id,))
-        inventario_base = cur.fetchall()
-
-        inventario_final = []
-        for prod in inventario_base:
-            mercancia_id = prod['mercancia_id']
-
-            # Entradas
-            cur.execute("""
-                SELECT COALESCE(SUM(cantidad),0) AS total_entradas
-                FROM movimientos_inventario
-                WHERE producto_id = %s
-                    AND UPPER(tipo) IN ('COMPRA','ENTRADA')
-
-            """, (mercancia_id,))
-            total_entradas = float(cur.fetchone()['total_entradas'] or 0)
-
-            # Salidas #
-            cur.execute("""
-                SELECT COALESCE(SUM(cantidad),0) AS total_salidas
-                FROM movimientos_inventario
-                WHERE producto_id = %s
-                    AND UPPER(tipo) = 'SALIDA'
-
-            """, (mercancia_id,))
-            total_salidas = float(cur.fetchone()['total_salidas'] or 0)
-
-            # Disponible
-            disponible = float(prod['inventario_inicial'] or 0) + total_entradas - total_salidas
-
-            # FIFO
-            cur.execute("""
-                SELECT cantidad, costo_unitario
-                FROM movimientos_inventario
-                WHERE producto_id = %s
-                  AND UPPER(tipo) IN ('COMPRA','ENTRADA')
-                ORDER BY fecha ASC, id ASC
-
-            """, (mercancia_id,))
-            entradas_fifo = cur.fetchall()
-
-            unidades_pendientes = disponible
-            valor_inventario = 0.0
-            for entrada in entradas_fifo:
-                if unidades_pendientes <= 0:
-                    break
-                u = float(entrada['cantidad'] or 0)
-                pu = float(entrada['costo_unitario'] or 0)
-                usa = min(u, unidades_pendientes)
-                valor_inventario += usa * pu
-                unidades_pendientes -= usa
-
-            inventario_final.append({
-                'id': prod['id'],
-                'mercancia_id': mercancia_id,
-                'producto': prod['producto'],
-                'inventario_inicial': prod['inventario_inicial'],
-                'entradas': total_entradas,
-                'salidas': total_salidas,
-                'disponible': disponible,
-                'valor_inventario': valor_inventario,
-                'aprobado': prod['aprobado']
-            })
+        inventario_final = inventario_almacen(conn, tipo_inventario_id)
     finally:
-        cur.close(); conn.close()
+        conn.close()
 
     return render_template('inventarios/pt/inventario.html',
                            inventario=inventario_final,
@@ -5775,7 +5618,8 @@ def calcular_precio_promedio_periodo(mercancia_id, dias=60, metodo='promedio_pon
         metodo: 'promedio_ponderado', 'promedio_simple', 'ultima_compra'
     
     Returns:
-        float: Precio promedio calculado
+        float: Precio promedio calculado (si no hubo compras en el periodo,
+        el costo promedio del último cierre de inventario)
     """
     from datetime import date, timedelta
     
@@ -5836,6 +5680,10 @@ def calcular_precio_promedio_periodo(mercancia_id, dias=60, metodo='promedio_pon
         
         else:
             precio = 0
+
+        # Sin compras en la ventana: costo promedio del último cierre de periodo
+        if not precio:
+            precio = costo_promedio_cierre(cur, mercancia_id) or 0
         
         return precio
     
@@ -6487,6 +6335,43 @@ def _routes():
     return jsonify(rutas)
 
 
+@app.route('/_db_pool')
+@require_login
+def _db_pool():
+    """Métricas del pool de conexiones MySQL (para dimensionar DB_POOL_SIZE)"""
+    return jsonify(metricas_pool())
+
+@app.route('/_badges')
+@require_login
+def _badges():
+    """Métricas de la caché de badges del header (tasa de aciertos)"""
+    return jsonify(metricas_badges())
+
+@app.route('/_indice_mercancias')
+@require_login
+def _indice_mercancias():
+    """Métricas del índice de nombres de mercancía (construcciones vs aciertos)"""
+    return jsonify(metricas_indice())
+
+@app.route('/_busqueda')
+@require_login
+def _busqueda():
+    """Métricas de la búsqueda unificada (FULLTEXT vs índice en memoria)"""
+    return jsonify(metricas_busqueda())
+
+@app.route('/_folios')
+@require_login
+def _folios():
+    """Métricas de las secuencias de folios (transaccionales vs por bloque)"""
+    return jsonify(metricas_folios())
+
+@app.route('/_catalogo_cuentas')
+@require_login
+def _catalogo_cuentas():
+    """Métricas de la caché del catálogo de cuentas (cargas vs aciertos)"""
+    return jsonify(metricas_arbol())
+
+
 @app.route('/_debug_listado')
 def _debug_listado():
     conn = conexion_db()
@@ -6515,16 +6400,20 @@ def _debug_listado():
 # FUNCIONES AUXILIARES DE ALERTAS
 # =============================================
 
-def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_tipo=None, referencia_id=None, usuario_id=None):
+def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_tipo=None, referencia_id=None, usuario_id=None, cursor=None):
     """
     Crea una alerta B2B (ON)
     
     Roles: supervisor, ventas, cxc, cxp, almacen, reparto
     Tipos: orden_compra, factura, preparacion, entrega, recepcion, pago
+    Con `cursor` se suma a la transacción del que llama (sin commit); sin él usa una
+    conexión aparte con su propio commit.
     """
+    propia, db = cursor is None, None
     try:
-        db = conexion_db()
-        cursor = db.cursor()
+        if propia:
+            db = conexion_aparte()
+            cursor = db.cursor()
         
         cursor.execute("""
             INSERT INTO alertas_b2b 
@@ -6533,9 +6422,9 @@ def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_
         """, (empresa_id, usuario_id, rol_destino, tipo, titulo, mensaje, referencia_tipo, referencia_id))
         
         alerta_id = cursor.lastrowid
-        db.commit()
-        cursor.close()
-        db.close()
+        if propia:
+            db.commit()
+        invalidar_badges(empresa_id=empresa_id)
         
         print(f"✅ ALERTA CREADA: {rol_destino} - {titulo}")
         return alerta_id
@@ -6543,15 +6432,23 @@ def crear_alerta_b2b(empresa_id, rol_destino, tipo, titulo, mensaje, referencia_
     except Exception as e:
         print(f"❌ Error crear alerta: {e}")
         return None
+    finally:
+        if db is not None:
+            cursor.close()
+            db.close()
 
 
-def cerrar_alerta_b2b(referencia_tipo, referencia_id, rol_destino=None, empresa_id=None):
+def cerrar_alerta_b2b(referencia_tipo, referencia_id, rol_destino=None, empresa_id=None, cursor=None):
     """
     Cierra alertas relacionadas a un documento (OFF)
+    Con `cursor` se suma a la transacción del que llama (sin commit); sin él usa una
+    conexión aparte con su propio commit.
     """
+    propia, db = cursor is None, None
     try:
-        db = conexion_db()
-        cursor = db.cursor()
+        if propia:
+            db = conexion_aparte()
+            cursor = db.cursor()
         
         sql = """
             UPDATE alertas_b2b 
@@ -6569,11 +6466,10 @@ def cerrar_alerta_b2b(referencia_tipo, referencia_id, rol_destino=None, empresa_
             params.append(empresa_id)
         
         cursor.execute(sql, params)
-        db.commit()
-        
         filas = cursor.rowcount
-        cursor.close()
-        db.close()
+        if propia:
+            db.commit()
+        invalidar_badges(empresa_id=empresa_id)
         
         print(f"✅ ALERTAS CERRADAS: {filas} alertas para {referencia_tipo} #{referencia_id}")
         return filas
@@ -6581,6 +6477,10 @@ def cerrar_alerta_b2b(referencia_tipo, referencia_id, rol_destino=None, empresa_
     except Exception as e:
         print(f"❌ Error cerrar alerta: {e}")
         return 0
+    finally:
+        if db is not None:
+            cursor.close()
+            db.close()
 
 
 def obtener_alertas_usuario(empresa_id, usuario_id):
@@ -6700,18 +6600,6 @@ def contar_alertas_activas(empresa_id, usuario_id):
 # INYECTAR CONTADOR DE ALERTAS EN TODAS LAS PÁGINAS
 # =============================================
 
-@app.context_processor
-def inject_alertas():
-    """Inyecta el contador de alertas en todas las plantillas"""
-    if 'usuario_id' in session and 'empresa_id' in session:
-        try:
-            total = contar_alertas_activas(session['empresa_id'], session['usuario_id'])
-            return {'alertas_count': total}
-        except:
-            return {'alertas_count': 0}
-    return {'alertas_count': 0}
-
-
 # =============================================
 # RUTAS DE ALERTAS
 # =============================================
@@ -6758,6 +6646,7 @@ def marcar_alerta_leida(alerta_id):
         """, (alerta_id, eid))
         
         db.commit()
+        invalidar_badges(empresa_id=eid)
         cursor.close()
         db.close()
         
@@ -6807,6 +6696,7 @@ def marcar_todas_leidas():
                 """, [eid] + roles_activos)
         
         db.commit()
+        invalidar_badges(empresa_id=eid)
         cursor.close()
         db.close()
         
@@ -6978,27 +6868,9 @@ def relaciones_b2b():
 # Agregar a app.py
 # =============================================
 
-def generar_folio_oc(empresa_id):
-    """Genera folio único para orden de compra: OC-EMP-YYYYMMDD-###"""
-    db = conexion_db()
-    cursor = db.cursor(dictionary=True)
-    
-    fecha = datetime.now().strftime('%Y%m%d')
-    prefijo = f"OC-{empresa_id}-{fecha}"
-    
-    cursor.execute("""
-        SELECT COUNT(*) + 1 as siguiente
-        FROM ordenes_compra_b2b 
-        WHERE folio LIKE %s
-    """, (f"{prefijo}%",))
-    
-    resultado = cursor.fetchone()
-    siguiente = resultado['siguiente'] if resultado else 1
-    
-    cursor.close()
-    db.close()
-    
-    return f"{prefijo}-{siguiente:03d}"
+def generar_folio_oc(cursor, empresa_id):
+    """Folio de orden de compra OC-EMP-YYYYMMDD-### (en la transacción de `cursor`)"""
+    return siguiente_folio(cursor, empresa_id, 'OC')
 
 
 @app.route('/b2b/ordenes_compra')
@@ -7066,7 +6938,7 @@ def nueva_orden_compra_b2b():
             return redirect(url_for('nueva_orden_compra_b2b'))
         
         # Crear orden
-        folio = generar_folio_oc(eid)
+        folio = generar_folio_oc(cursor, eid)
         
         cursor.execute("""
             INSERT INTO ordenes_compra_b2b 
@@ -7116,6 +6988,7 @@ def nueva_orden_compra_b2b():
         """, (subtotal, iva, total, orden_id))
         
         db.commit()
+        invalidar_badges(empresa_id=eid)
         
         flash(f'✅ Orden de compra {folio} creada', 'success')
         return redirect(url_for('ver_orden_compra_b2b', orden_id=orden_id))
@@ -7234,7 +7107,7 @@ def enviar_orden_compra_b2b(orden_id):
     """, (uid, orden_id))
     
     # Cerrar alerta del supervisor (cliente)
-    cerrar_alerta_b2b('orden_compra_b2b', orden_id, 'supervisor', eid)
+    cerrar_alerta_b2b('orden_compra_b2b', orden_id, 'supervisor', eid, cursor=cursor)
     
     # Crear alerta para VENTAS del proveedor
     crear_alerta_b2b(
@@ -7244,10 +7117,12 @@ def enviar_orden_compra_b2b(orden_id):
         titulo=f'Nueva Orden de Compra {orden["folio"]}',
         mensaje=f'Pedido por ${orden["total"]:.2f}',
         referencia_tipo='orden_compra_b2b',
-        referencia_id=orden_id
+        referencia_id=orden_id,
+        cursor=cursor
     )
     
     db.commit()
+    invalidar_badges(empresa_id=eid)
     cursor.close()
     db.close()
     
@@ -7271,9 +7146,10 @@ def cancelar_orden_compra_b2b(orden_id):
     """, (orden_id, eid))
     
     # Cerrar alertas relacionadas
-    cerrar_alerta_b2b('orden_compra_b2b', orden_id)
+    cerrar_alerta_b2b('orden_compra_b2b', orden_id, cursor=cursor)
     
     db.commit()
+    invalidar_badges(empresa_id=eid)
     cursor.close()
     db.close()
     
@@ -7343,7 +7219,7 @@ def procesar_pedido_b2b(orden_id):
     """, (orden_id,))
     
     # Cerrar alerta de VENTAS
-    cerrar_alerta_b2b('orden_compra_b2b', orden_id, 'ventas', eid)
+    cerrar_alerta_b2b('orden_compra_b2b', orden_id, 'ventas', eid, cursor=cursor)
     
     # Crear alerta para CxC (emitir factura)
     crear_alerta_b2b(
@@ -7353,7 +7229,8 @@ def procesar_pedido_b2b(orden_id):
         titulo=f'Emitir Factura para OC {orden["folio"]}',
         mensaje=f'Cliente solicita ${orden["total"]:.2f}',
         referencia_tipo='orden_compra_b2b',
-        referencia_id=orden_id
+        referencia_id=orden_id,
+        cursor=cursor
     )
     
     db.commit()
@@ -7398,7 +7275,7 @@ def generar_orden_compra_desde_turno(turno_id, empresa_cliente_id, usuario_id, p
         proveedor_id = relacion['empresa_proveedor_id']
         
         # Crear orden
-        folio = generar_folio_oc(empresa_cliente_id)
+        folio = generar_folio_oc(cursor, empresa_cliente_id)
         
         cursor.execute("""
             INSERT INTO ordenes_compra_b2b 
@@ -7453,10 +7330,12 @@ def generar_orden_compra_desde_turno(turno_id, empresa_cliente_id, usuario_id, p
             titulo=f'Aprobar Orden de Compra {folio}',
             mensaje=f'Generada desde cierre de turno - ${total:.2f}',
             referencia_tipo='orden_compra_b2b',
-            referencia_id=orden_id
+            referencia_id=orden_id,
+            cursor=cursor
         )
         
         db.commit()
+        invalidar_badges(empresa_id=empresa_cliente_id)
         cursor.close()
         db.close()
         
@@ -7475,27 +7354,9 @@ def generar_orden_compra_desde_turno(turno_id, empresa_cliente_id, usuario_id, p
 # Agregar a app.py
 # =============================================
 
-def generar_folio_factura_b2b(empresa_id):
-    """Genera folio único para factura B2B: FB-EMP-YYYYMMDD-###"""
-    db = conexion_db()
-    cursor = db.cursor(dictionary=True)
-    
-    fecha = datetime.now().strftime('%Y%m%d')
-    prefijo = f"FB-{empresa_id}-{fecha}"
-    
-    cursor.execute("""
-        SELECT COUNT(*) + 1 as siguiente
-        FROM facturas_b2b 
-        WHERE folio LIKE %s
-    """, (f"{prefijo}%",))
-    
-    resultado = cursor.fetchone()
-    siguiente = resultado['siguiente'] if resultado else 1
-    
-    cursor.close()
-    db.close()
-    
-    return f"{prefijo}-{siguiente:03d}"
+def generar_folio_factura_b2b(cursor, empresa_id):
+    """Folio de factura B2B FB-EMP-YYYYMMDD-### (en la transacción de `cursor`)"""
+    return siguiente_folio(cursor, empresa_id, 'FB')
 
 
 @app.route('/b2b/facturas_emitidas')
@@ -7585,7 +7446,7 @@ def emitir_factura_b2b(orden_id):
     
     if request.method == 'POST':
         # Crear factura
-        folio = generar_folio_factura_b2b(eid)
+        folio = generar_folio_factura_b2b(cursor, eid)
         dias_credito = int(request.form.get('dias_credito', 0))
         fecha_vencimiento = datetime.now() + timedelta(days=dias_credito) if dias_credito > 0 else None
         notas = request.form.get('notas', '')
@@ -7636,7 +7497,7 @@ def emitir_factura_b2b(orden_id):
         """, (factura_id, uid, g.usuario_nombre, eid))
         
         # Cerrar alerta de CxC
-        cerrar_alerta_b2b('orden_compra_b2b', orden_id, 'cxc', eid)
+        cerrar_alerta_b2b('orden_compra_b2b', orden_id, 'cxc', eid, cursor=cursor)
         
         # Crear alerta para ALMACÉN (preparar mercancía)
         crear_alerta_b2b(
@@ -7646,7 +7507,8 @@ def emitir_factura_b2b(orden_id):
             titulo=f'Preparar Factura {folio}',
             mensaje=f'Cliente: {orden["cliente_nombre"]} - ${orden["total"]:.2f}',
             referencia_tipo='factura_b2b',
-            referencia_id=factura_id
+            referencia_id=factura_id,
+            cursor=cursor
         )
         
         # Notificar al cliente (SUPERVISOR)
@@ -7657,7 +7519,8 @@ def emitir_factura_b2b(orden_id):
             titulo=f'Factura Recibida {folio}',
             mensaje=f'Proveedor ha emitido factura por ${orden["total"]:.2f}',
             referencia_tipo='factura_b2b',
-            referencia_id=factura_id
+            referencia_id=factura_id,
+            cursor=cursor
         )
         
         db.commit()
@@ -7855,10 +7718,16 @@ def cuentas_por_pagar_b2b():
     )
 
 
-def registrar_cuenta_por_cobrar(factura_id, empresa_proveedor_id, empresa_cliente_id, total, fecha_vencimiento):
-    """Registra automáticamente en CxC al confirmar entrega"""
-    db = conexion_db()
-    cursor = db.cursor(dictionary=True)
+def registrar_cuenta_por_cobrar(factura_id, empresa_proveedor_id, empresa_cliente_id, total, fecha_vencimiento, cursor=None):
+    """
+    Registra automáticamente en CxC al confirmar entrega.
+    Con `cursor` se suma a la transacción del que llama (sin commit); sin él usa una
+    conexión aparte con su propio commit.
+    """
+    propia = cursor is None
+    if propia:
+        db = conexion_aparte()
+        cursor = db.cursor(dictionary=True)
     
     try:
         # Obtener nombre del cliente
@@ -7873,19 +7742,28 @@ def registrar_cuenta_por_cobrar(factura_id, empresa_proveedor_id, empresa_client
         """, (empresa_proveedor_id, factura_id, empresa_cliente_id, 
               cliente['nombre'] if cliente else '', total, total, fecha_vencimiento))
         
-        db.commit()
-        cursor.close()
-        db.close()
+        if propia:
+            db.commit()
         return True
     except Exception as e:
         print(f"Error registrando CxC: {e}")
         return False
+    finally:
+        if propia:
+            cursor.close()
+            db.close()
 
 
-def registrar_cuenta_por_pagar(factura_id, empresa_cliente_id, empresa_proveedor_id, total, fecha_vencimiento):
-    """Registra automáticamente en CxP al confirmar recepción"""
-    db = conexion_db()
-    cursor = db.cursor(dictionary=True)
+def registrar_cuenta_por_pagar(factura_id, empresa_cliente_id, empresa_proveedor_id, total, fecha_vencimiento, cursor=None):
+    """
+    Registra automáticamente en CxP al confirmar recepción.
+    Con `cursor` se suma a la transacción del que llama (sin commit); sin él usa una
+    conexión aparte con su propio commit.
+    """
+    propia = cursor is None
+    if propia:
+        db = conexion_aparte()
+        cursor = db.cursor(dictionary=True)
     
     try:
         # Obtener nombre del proveedor
@@ -7900,13 +7778,16 @@ def registrar_cuenta_por_pagar(factura_id, empresa_cliente_id, empresa_proveedor
         """, (empresa_cliente_id, factura_id, empresa_proveedor_id,
               proveedor['nombre'] if proveedor else '', total, total, fecha_vencimiento))
         
-        db.commit()
-        cursor.close()
-        db.close()
+        if propia:
+            db.commit()
         return True
     except Exception as e:
         print(f"Error registrando CxP: {e}")
         return False
+    finally:
+        if propia:
+            cursor.close()
+            db.close()
 
 # =============================================
 # ALMACÉN Y REPARTO B2B
@@ -8014,7 +7895,7 @@ def almacen_preparar_factura(factura_id):
                 """, (factura_id, uid, g.usuario_nombre, eid))
                 
                 # Cerrar alerta de almacén
-                cerrar_alerta_b2b('factura_b2b', factura_id, 'almacen', eid)
+                cerrar_alerta_b2b('factura_b2b', factura_id, 'almacen', eid, cursor=cursor)
                 
                 # Crear alerta para REPARTO
                 crear_alerta_b2b(
@@ -8024,7 +7905,8 @@ def almacen_preparar_factura(factura_id):
                     titulo=f'Recoger Factura {factura["folio"]}',
                     mensaje=f'Cliente: {factura["cliente_nombre"]} - Listo para envío',
                     referencia_tipo='factura_b2b',
-                    referencia_id=factura_id
+                    referencia_id=factura_id,
+                    cursor=cursor
                 )
                 
                 db.commit()
@@ -8177,7 +8059,8 @@ def reparto_iniciar(factura_id):
         titulo=f'Mercancía en camino - {factura["folio"]}',
         mensaje='Prepárese para recibir la entrega',
         referencia_tipo='factura_b2b',
-        referencia_id=factura_id
+        referencia_id=factura_id,
+        cursor=cursor
     )
     
     db.commit()
@@ -8255,7 +8138,7 @@ def reparto_entregar(factura_id):
                 """, (factura_id, uid, g.usuario_nombre, eid))
                 
                 # Cerrar alerta de reparto
-                cerrar_alerta_b2b('factura_b2b', factura_id, 'reparto', eid)
+                cerrar_alerta_b2b('factura_b2b', factura_id, 'reparto', eid, cursor=cursor)
                 
                 db.commit()
                 flash('✅ Entrega completada', 'success')
@@ -8403,19 +8286,21 @@ def recepcion_verificar(factura_id):
                 """, (factura_id, estado_final, uid, g.usuario_nombre, eid))
                 
                 # Cerrar alertas del cliente
-                cerrar_alerta_b2b('factura_b2b', factura_id, 'almacen', eid)
-                cerrar_alerta_b2b('factura_b2b', factura_id, 'supervisor', eid)
+                cerrar_alerta_b2b('factura_b2b', factura_id, 'almacen', eid, cursor=cursor)
+                cerrar_alerta_b2b('factura_b2b', factura_id, 'supervisor', eid, cursor=cursor)
                 
                 # Registrar en CxP del cliente
                 registrar_cuenta_por_pagar(
                     factura_id, eid, factura['empresa_emisora_id'],
-                    float(factura['total']), factura['fecha_vencimiento']
+                    float(factura['total']), factura['fecha_vencimiento'],
+                    cursor=cursor
                 )
                 
                 # Registrar en CxC del proveedor
                 registrar_cuenta_por_cobrar(
                     factura_id, factura['empresa_emisora_id'], eid,
-                    float(factura['total']), factura['fecha_vencimiento']
+                    float(factura['total']), factura['fecha_vencimiento'],
+                    cursor=cursor
                 )
                 
                 # Notificar al proveedor (CxC)
@@ -8426,7 +8311,8 @@ def recepcion_verificar(factura_id):
                     titulo=f'Factura {factura["folio"]} confirmada',
                     mensaje='El cliente confirmó la recepción. Factura agregada a cartera.',
                     referencia_tipo='factura_b2b',
-                    referencia_id=factura_id
+                    referencia_id=factura_id,
+                    cursor=cursor
                 )
                 
                 # Notificar a CxP del cliente
@@ -8437,7 +8323,8 @@ def recepcion_verificar(factura_id):
                     titulo=f'Nueva cuenta por pagar - {factura["folio"]}',
                     mensaje=f'Programar pago por ${factura["total"]:.2f}',
                     referencia_tipo='factura_b2b',
-                    referencia_id=factura_id
+                    referencia_id=factura_id,
+                    cursor=cursor
                 )
                 
                 db.commit()
@@ -8486,11 +8373,14 @@ def cuentas_contables_bootstrap():
     conn = conexion_db()
     cursor = conn.cursor(dictionary=True)
     try:
+        # Todo el catálogo en una transacción: árbol leído una vez, UPDATE solo de lo
+        # que cambió e INSERT de varios renglones por nivel (sincronizar_cuentas)
+        cuentas = []
+
         # 1) Base
         for code, name, ok_sub in CATALOGO_BASE:
             parent_override = AGRUPACIONES_NIVEL1.get(code)
-            ensure_account(cursor, conn, code=code, name=name,
-                           permite_sub=ok_sub, parent_override=parent_override)
+            cuentas.append((code, name, ok_sub, parent_override))
 
         # 2) Subcuentas específicas
         # Diccionario con nombres fijos para las cuentas de gasto
@@ -8525,22 +8415,25 @@ def cuentas_contables_bootstrap():
 
         # Generar las cuentas de gasto con nombres fijos
         for code, nombre in NOMBRES_FIJOS_600.items():
-            ensure_account(cursor, conn, code=code, name=nombre, permite_sub=False)
+            cuentas.append((code, nombre, False, None))
 
         
         for code in SUBS_212_002:
-            ensure_account(cursor, conn, code=code,
-                           name=f"OTRO PASIVO {code[-3:]}", permite_sub=False)
+            cuentas.append((code, f"OTRO PASIVO {code[-3:]}", False, None))
 
         for code in SUBS_301_003:
-            ensure_account(cursor, conn, code=code,
-                           name="RESULTADOS ACUMULADOS DETALLE", permite_sub=False)
+            cuentas.append((code, "RESULTADOS ACUMULADOS DETALLE", False, None))
 
         for code in SUBS_301_004:
-            ensure_account(cursor, conn, code=code,
-                           name=f"RESULTADO {code[-3:]}", permite_sub=False)
+            cuentas.append((code, f"RESULTADO {code[-3:]}", False, None))
+
+        insertadas, actualizadas = sincronizar_cuentas(cursor, cargar_arbol(cursor), cuentas)
+        conn.commit()
+        invalidar_arbol()
+        invalidar_busqueda(seccion='cuentas')
 
-        flash('Catálogo contable generado/actualizado con éxito.', 'success')
+        flash(f'Catálogo contable generado/actualizado con éxito '
+              f'({insertadas} nuevas, {actualizadas} actualizadas).', 'success')
     except Exception as e:
         conn.rollback()
         flash(f'Error al generar catálogo: {e}', 'danger')
@@ -8559,64 +8452,105 @@ def catalogo_cuentas():
     conn = conexion_db()
     cursor = conn.cursor(dictionary=True)
 
-    # Nota: Si cuentas_contables tiene empresa_id, agregar filtro
-    sql = """
-        SELECT
-          id, codigo, nombre, tipo, naturaleza, nivel,
-          permite_subcuentas, padre_id, padre_codigo, padre_nombre, hijos
-        FROM vw_cuentas_contables
-        WHERE empresa_id = %s
-    """
-    params = [eid]
-    if q:
-        sql += " AND (codigo LIKE %s OR nombre LIKE %s OR padre_codigo LIKE %s OR padre_nombre LIKE %s)"
-        like = f"%{q}%"
-        params.extend([like, like, like, like])
-    sql += " ORDER BY codigo"
+    # Árbol de la empresa en caché (columnas por nivel ya calculadas)
+    try:
+        ids = None
+        if q:
+            # Cuentas que coinciden (FULLTEXT código/nombre) y sus subcuentas directas
+            ids = ids_seccion(cursor, eid, 'cuentas', q)
+        filas = arbol_cuentas(cursor, eid).filas_catalogo(ids)
+    finally:
+        cursor.close()
+        conn.close()
 
-    cursor.execute(sql, params)
-    cuentas = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    return render_template('catalogo_cuentas.html', filas=filas, q=q)
 
-    def _nivel_from_codigo(code):
-        if not code:
-            return None
-        try:
-            _, b, c = code.split('-')
-        except ValueError:
-            return None
-        if b == '000' and c == '000':
-            return 1
-        if c == '000':
-            return 2
-        return 3
 
-    filas = []
-    for r in cuentas:
-        col_cuenta = col_mayor = col_sub = col_subsub = ''
-        parent_level = _nivel_from_codigo(r.get('padre_codigo'))
-
-        if r['nivel'] == 1:
-            col_cuenta = r['nombre']
-        elif r['nivel'] == 2:
-            if parent_level == 1 or parent_level is None:
-                col_mayor = r['nombre']
-            else:
-                col_sub = r['nombre']
-        else:
-            col_subsub = r['nombre']
-
-        filas.append({
-            'id': r['id'],
-            'codigo': r['codigo'],
-            'cuenta': col_cuenta,
-            'cuenta_mayor': col_mayor,
-            'subcuenta': col_sub,
-            'subsubcuenta': col_subsub
-        })
+def _periodo_param(nombre, default):
+    """'YYYY-MM' del query string como primer día del mes"""
+    valor = (request.args.get(nombre) or '').strip()
+    try:
+        return datetime.strptime(valor, '%Y-%m').date() if valor else default
+    except ValueError:
+        return default
+
+def _json_contable(dato):
+    """Decimal / date a tipos JSON"""
+    if isinstance(dato, dict):
+        return {k: _json_contable(v) for k, v in dato.items()}
+    if isinstance(dato, list):
+        return [_json_contable(v) for v in dato]
+    if isinstance(dato, Decimal):
+        return float(dato)
+    if isinstance(dato, (date, datetime)):
+        return dato.isoformat()
+    return dato
+
+@app.route('/contabilidad/balanza')
+@require_login
+def balanza_comprobacion():
+    """Balanza de comprobación por periodo (desde saldos_contables)"""
+    eid = g.empresa_id
+    mes = date.today().replace(day=1)
+    desde = _periodo_param('desde', mes)
+    hasta = max(_periodo_param('hasta', desde), desde)
 
-    return render_template('catalogo_cuentas.html', filas=filas, q=q)
+    conn = conexion_db()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        datos = balanza(cursor, eid, desde, hasta, AGRUPACIONES_NIVEL1)
+    finally:
+        cursor.close()
+        conn.close()
+
+    if request.args.get('formato') == 'json':
+        return jsonify(_json_contable(datos))
+    return render_template('contabilidad/balanza.html', datos=datos, desde=desde, hasta=hasta)
+
+@app.route('/contabilidad/mayor/<int:cuenta_id>')
+@require_login
+def libro_mayor(cuenta_id):
+    """Movimientos de una cuenta (y sus subcuentas) con saldo inicial y acumulado"""
+    eid = g.empresa_id
+    mes = date.today().replace(day=1)
+    desde = _periodo_param('desde', mes)
+    hasta = max(_periodo_param('hasta', desde), desde)
+
+    conn = conexion_db()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        datos = mayor(cursor, eid, cuenta_id, desde, hasta)
+    finally:
+        cursor.close()
+        conn.close()
+
+    if datos is None:
+        if request.args.get('formato') == 'json':
+            return jsonify({'error': 'Cuenta no encontrada'}), 404
+        flash('Cuenta no encontrada.', 'warning')
+        return redirect(url_for('balanza_comprobacion'))
+    if request.args.get('formato') == 'json':
+        return jsonify(_json_contable(datos))
+    return render_template('contabilidad/mayor.html', datos=datos, desde=desde, hasta=hasta)
+
+@app.route('/contabilidad/balance')
+@require_login
+def balance_general_contable():
+    """Balance general al cierre del mes (Activo = Pasivo + Patrimonio + resultado)"""
+    eid = g.empresa_id
+    al = _periodo_param('al', date.today().replace(day=1))
+
+    conn = conexion_db()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        datos = balance_general(cursor, eid, al, AGRUPACIONES_NIVEL1)
+    finally:
+        cursor.close()
+        conn.close()
+
+    if request.args.get('formato') == 'json':
+        return jsonify(_json_contable(datos))
+    return render_template('contabilidad/balance.html', datos=datos, al=al)
 
 @app.route('/editar_cuenta_contable/<int:id>', methods=['GET', 'POST'])
 def editar_cuenta_contable(id):
@@ -8745,6 +8679,8 @@ def editar_cuenta_contable(id):
                 WHERE id=%s
             """, (nombre, numero_cuenta, tipo, id))
             conn.commit()
+            invalidar_arbol()
+            invalidar_busqueda(seccion='cuentas')
             flash('Cuenta contable actualizada con éxito', 'success')
         except Exception as e:
             conn.rollback()
@@ -8875,6 +8811,8 @@ def subcuentas_contables():
                 VALUES ( %s, %s, %s, %s, %s)
             """, (nombre, numero_cuenta, tipo, nivel, padre_id))
             conn.commit()
+            invalidar_arbol()
+            invalidar_busqueda(seccion='cuentas')
             flash('Subcuenta creada con éxito.', 'success')
         except Exception as e:
             conn.rollback()
@@ -9166,141 +9104,38 @@ def mostrar_inventario():
 
 
 @app.route('/inventarios/movimientos/<int:mercancia_id>')
+@require_login
 def inventario_movimientos(mercancia_id):
-    # ... checks ...
+    eid = g.empresa_id
 
     conn = conexion_db()
     cursor = conn.cursor(dictionary=True)
 
-    # 1) nombre
-    cursor.execute("SELECT nombre FROM mercancia WHERE id=%s", (mercancia_id,))
+    # 1) nombre (FILTRADO)
+    cursor.execute("SELECT nombre FROM mercancia WHERE id=%s AND empresa_id=%s", (mercancia_id, eid))
     row = cursor.fetchone()
     if not row:
-        cursor.close(); conn.close()
-        flash('Mercancía no encontrada.', 'warning')
-        return redirect(url_for('mostrar_inventario_mp'))
-    producto = row['nombre']
-
-    almacen_s = (request.args.get('almacen') or '').strip()
-    almacen_id = int(almacen_s) if almacen_s.isdigit() else None
-
-    # 2) query por almacén
-    if almacen_id == 1:
-        sql = """
-        SELECT * FROM (
-            SELECT lc.fecha AS fecha_raw, DATE_FORMAT(lc.fecha,'%d/%b/%y') AS fecha_fmt,
-                   lc.numero_factura AS documento, lc.proveedor AS fuente,
-                   dc.unidades, dc.contenido_neto_total,
-                   CASE WHEN dc.contenido_neto_total>0
-                        THEN dc.precio_total/dc.contenido_neto_total ELSE NULL END AS precio_unitario,
-                   dc.precio_total AS importe, dc.producto AS detalle, dc.compra_id,
-                   'compra' AS tipo_movimiento
-            FROM detalle_compra dc
-            JOIN listado_compras lc ON dc.compra_id = lc.id
-            WHERE dc.mercancia_id = %s
-            UNION ALL
-            SELECT im.fecha AS fecha_raw, DATE_FORMAT(im.fecha,'%d/%b/%y') AS fecha_fmt,
-                im.referencia AS documento, '' AS fuente, im.unidades,
-                NULL AS contenido_neto_total, im.precio_unitario,
-                (im.unidades*im.precio_unitario) AS importe,
-                NULL AS detalle, NULL AS compra_id, im.tipo_movimiento
-            FROM inventario_movimientos im
-            WHERE im.mercancia_id = %s 
-            AND im.tipo_inventario_id = 1
-            AND UPPER(im.tipo_movimiento) <> 'COMPRA'
-            AND im.unidades > 0
-            AND im.tipo_movimiento IS NOT NULL
-            AND im.tipo_movimiento <> ''
-        ) t
-        ORDER BY t.fecha_raw ASC, t.documento ASC
-        """
-        cursor.execute(sql, (mercancia_id, mercancia_id))
-        movimientos = cursor.fetchall()
-
-    elif almacen_id in (2, 3):
-        cursor.execute("""
-            SELECT im.fecha AS fecha_raw, DATE_FORMAT(im.fecha,'%d/%b/%y') AS fecha_fmt,
-                   im.referencia AS documento, '' AS fuente, im.unidades,
-                   NULL AS contenido_neto_total, im.precio_unitario,
-                   (im.unidades*im.precio_unitario) AS importe, im.tipo_movimiento
-            FROM inventario_movimientos im
-            WHERE im.mercancia_id = %s AND im.tipo_inventario_id = %s
-            ORDER BY im.fecha ASC, im.id ASC
-        """, (mercancia_id, almacen_id))
-        movimientos = cursor.fetchall()
+        cursor.close(); conn.close()
+        flash('Mercancía no encontrada.', 'warning')
+        return redirect(url_for('mostrar_inventario_mp'))
+    producto = row['nombre']
 
-    else:
-        sql = """
-        SELECT * FROM (
-            SELECT lc.fecha AS fecha_raw, DATE_FORMAT(lc.fecha,'%d/%b/%y') AS fecha_fmt,
-                   lc.numero_factura AS documento, lc.proveedor AS fuente,
-                   dc.unidades, dc.contenido_neto_total,
-                   CASE WHEN dc.contenido_neto_total>0
-                        THEN dc.precio_total/dc.contenido_neto_total ELSE NULL END AS precio_unitario,
-                   dc.precio_total AS importe, dc.producto AS detalle, dc.compra_id,
-                   'compra' AS tipo_movimiento
-            FROM detalle_compra dc
-            JOIN listado_compras lc ON dc.compra_id = lc.id
-            WHERE dc.mercancia_id = %s
-            UNION ALL
-            SELECT im.fecha AS fecha_raw, DATE_FORMAT(im.fecha,'%d/%b/%y') AS fecha_fmt,
-                   im.referencia AS documento, '' AS fuente, im.unidades,
-                   NULL AS contenido_neto_total, im.precio_unitario,
-                   (im.unidades*im.precio_unitario) AS importe,
-                   NULL AS detalle, NULL AS compra_id, im.tipo_movimiento
-            FROM inventario_movimientos im
-            WHERE im.mercancia_id = %s
-              AND UPPER(im.tipo_movimiento) <> 'COMPRA'
-        ) t
-        ORDER BY t.fecha_raw ASC, t.documento ASC
-        """
-        cursor.execute(sql, (mercancia_id, mercancia_id))
-        movimientos = cursor.fetchall()
+    almacen_s = (request.args.get('almacen') or '').strip()
+    almacen_id = int(almacen_s) if almacen_s.isdigit() else None
 
-    # 3) construir tablas
-    rows = []
-    saldo_u = 0.0
-    saldo_mx = 0.0
-    for m in movimientos:
-        tipo = (m.get('tipo_movimiento') or '').strip().lower()
-        es_entrada = tipo in ('entrada','compra')
-        contenido = m.get('contenido_neto_total')
-        entrada_u = float(contenido) if (es_entrada and contenido and float(contenido)>0) else (float(m.get('unidades') or 0.0) if es_entrada else 0.0)
-        salida_u  = float(m.get('unidades') or 0.0) if tipo == 'salida' else 0.0
-        entrada_mx = float(m.get('importe') or 0.0) if es_entrada else 0.0
-        salida_mx  = float(m.get('importe') or 0.0) if tipo == 'salida' else 0.0
-        saldo_u  += entrada_u - salida_u
-        saldo_mx += entrada_mx - salida_mx
-        if es_entrada and entrada_u>0:
-            pu = entrada_mx/entrada_u
-        elif tipo=='salida':
-            pu = float(m.get('precio_unitario') or 0.0)
-        else:
-            pu = 0.0
-        rows.append({
-            "fecha": m.get("fecha_fmt"),
-            "documento": m.get("documento"),
-            "fuente": m.get("fuente"),
-            "entrada_u": entrada_u, "salida_u": salida_u, "saldo_u": saldo_u,
-            "entrada_mx": entrada_mx, "salida_mx": salida_mx, "saldo_mx": saldo_mx,
-            "pu": pu,
-        })
+    # 2) solo la página visible; saldo inicial desde el checkpoint más cercano (ver kardex.py)
+    pagina = pagina_kardex(
+        conn, eid, mercancia_id, almacen_id,
+        despues=texto_a_clave(request.args.get('despues')),
+        antes=texto_a_clave(request.args.get('antes')),
+    )
+    rows = pagina['rows']
 
     tabla_unidades = [{"fecha": r["fecha"], "documento": r["documento"], "fuente": r["fuente"],
                        "entrada": r["entrada_u"], "salida": r["salida_u"], "saldo": r["saldo_u"]} for r in rows]
     tabla_pesos    = [{"fecha": r["fecha"], "documento": r["documento"], "fuente": r["fuente"],
                        "entrada": r["entrada_mx"], "salida": r["salida_mx"], "saldo": r["saldo_mx"], "pu": r["pu"]} for r in rows]
 
-    # ✅ CALCULAR TOTALES
-    total_entradas_u = sum(r["entrada_u"] for r in rows)
-    total_salidas_u = sum(r["salida_u"] for r in rows)
-    total_entradas_mx = sum(r["entrada_mx"] for r in rows)
-    total_salidas_mx = sum(r["salida_mx"] for r in rows)
-    
-    saldo_final_u = rows[-1]["saldo_u"] if rows else 0.0
-    saldo_final_mx = rows[-1]["saldo_mx"] if rows else 0.0
-    pu_final = rows[-1]["pu"] if rows else 0.0
-
     cursor.close()
     conn.close()
 
@@ -9308,16 +9143,76 @@ def inventario_movimientos(mercancia_id):
                            producto=producto,
                            tabla_unidades=tabla_unidades,
                            tabla_pesos=tabla_pesos,
-                           total_entradas_u=total_entradas_u,
-                           total_salidas_u=total_salidas_u,
-                           saldo_final_u=saldo_final_u,
-                           total_entradas_mx=total_entradas_mx,
-                           total_salidas_mx=total_salidas_mx,
-                           saldo_final_mx=saldo_final_mx,
-                           pu_final=pu_final,
+                           total_entradas_u=pagina['total_entradas_u'],
+                           total_salidas_u=pagina['total_salidas_u'],
+                           saldo_final_u=pagina['saldo_final_u'],
+                           total_entradas_mx=pagina['total_entradas_mx'],
+                           total_salidas_mx=pagina['total_salidas_mx'],
+                           saldo_final_mx=pagina['saldo_final_mx'],
+                           pu_final=pagina['pu_final'],
+                           paginacion=pagina['paginacion'],
+                           mercancia_id=mercancia_id,
+                           almacen_id=almacen_id,
                            back_endpoint='mostrar_inventario_mp')
 
 
+@app.route('/inventarios/movimientos/<int:mercancia_id>/exportar')
+@require_login
+def inventario_movimientos_exportar(mercancia_id):
+    """Kardex completo en CSV o XLSX, generado en streaming (solo lectura, FILTRADO POR EMPRESA)"""
+    eid = g.empresa_id
+    formato = (request.args.get('formato') or 'csv').lower()
+    almacen_s = (request.args.get('almacen') or '').strip()
+    almacen_id = int(almacen_s) if almacen_s.isdigit() else None
+
+    conn = conexion_db()
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM mercancia WHERE id=%s AND empresa_id=%s", (mercancia_id, eid))
+    existe = cur.fetchone()
+    cur.close()
+    if not existe:
+        flash('Mercancía no encontrada.', 'warning')
+        return redirect(url_for('mostrar_inventario_mp'))
+
+    filas = filas_exportacion(conn, eid, mercancia_id, almacen_id)
+    if formato == 'xlsx':
+        cuerpo, mimetype = exportar_xlsx(filas), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        formato = 'csv'
+        cuerpo, mimetype = exportar_csv(filas), 'text/csv; charset=utf-8'
+
+    return Response(
+        stream_with_context(cuerpo),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=kardex_{mercancia_id}.{formato}'}
+    )
+
+
+def _arrancar_de_cierre(rows, cierre, estado):
+    """Primera fila del kardex con el saldo al cierre; regresa (pu, saldo_u, saldo_mx)"""
+    pu, saldo_u, saldo_mx = estado['costo_promedio'], estado['unidades'], estado['valor']
+    rows.append({
+        "fecha": cierre['periodo'].strftime('%d/%b/%Y'),
+        "documento": "Saldo al cierre",
+        "fuente": "",
+        "entrada_u": 0.0, "salida_u": 0.0, "saldo_u": saldo_u,
+        "entrada_mx": 0.0, "salida_mx": 0.0, "saldo_mx": saldo_mx,
+        "pu": pu,
+    })
+    return pu, saldo_u, saldo_mx
+
+
+def _aviso_cierre(cierre, estado, endpoint, **args):
+    """Datos para el aviso 'N movimientos omitidos' con liga a la historia completa"""
+    if not cierre:
+        return None
+    return {
+        'periodo': cierre['periodo'],
+        'omitidos': estado['movimientos'],
+        'url_completo': url_for(endpoint, completo=1, **args),
+    }
+
+
 @app.route('/inventarios/movimientos-producto-base/<int:producto_base_id>')
 @require_login
 def inventario_movimientos_producto_base(producto_base_id):
@@ -9354,6 +9249,14 @@ def inventario_movimientos_producto_base(producto_base_id):
     almacen_s = (request.args.get('almacen') or '').strip()
     almacen_id = int(almacen_s) if almacen_s.isdigit() else None
 
+    # Último cierre de periodo: solo se leen los movimientos posteriores (?completo=1 = toda la historia)
+    cierre = estado_cierre = None
+    if almacen_id in (1, 2) and request.args.get('completo') != '1':
+        cierre, estado_cierre = cierre_producto_base(cursor, eid, almacen_id, producto_base_id)
+    desde_dc = "AND lc.fecha >= %s" if cierre else ""
+    desde_im = "AND im.fecha >= %s" if cierre else ""
+    desde = [cierre['corte']] if cierre else []
+
     # 2) Query FILTRADO POR EMPRESA
     if almacen_id == 1:
         placeholders = ','.join(['%s'] * len(mercancia_ids))
@@ -9365,18 +9268,19 @@ def inventario_movimientos_producto_base(producto_base_id):
                    CASE WHEN dc.contenido_neto_total>0
                         THEN dc.precio_total/dc.contenido_neto_total ELSE NULL END AS precio_unitario,
                    dc.precio_total AS importe, dc.producto AS detalle, dc.compra_id,
-                   'compra' AS tipo_movimiento
+                   'compra' AS tipo_movimiento, 0 AS orden, dc.id AS mov_id
             FROM detalle_compra dc
             JOIN listado_compras lc ON dc.compra_id = lc.id
             WHERE dc.mercancia_id IN ({placeholders})
               AND dc.empresa_id = %s
               AND lc.empresa_id = %s
+              {desde_dc}
             UNION ALL
             SELECT im.fecha AS fecha_raw, DATE_FORMAT(im.fecha,'%d/%b/%Y') AS fecha_fmt,
                 im.referencia AS documento, '' AS fuente, im.unidades,
                 NULL AS contenido_neto_total, im.precio_unitario,
                 (im.unidades*im.precio_unitario) AS importe,
-                NULL AS detalle, NULL AS compra_id, im.tipo_movimiento
+                NULL AS detalle, NULL AS compra_id, im.tipo_movimiento, 1 AS orden, im.id AS mov_id
             FROM inventario_movimientos im
             WHERE im.mercancia_id IN ({placeholders})
             AND im.tipo_inventario_id = 1
@@ -9385,10 +9289,11 @@ def inventario_movimientos_producto_base(producto_base_id):
             AND im.unidades > 0
             AND im.tipo_movimiento IS NOT NULL
             AND im.tipo_movimiento <> ''
+            {desde_im}
         ) t
-        ORDER BY t.fecha_raw ASC, t.documento ASC
+        ORDER BY t.fecha_raw ASC, t.orden ASC, t.mov_id ASC
         """
-        cursor.execute(sql, mercancia_ids + [eid, eid] + mercancia_ids + [eid])
+        cursor.execute(sql, mercancia_ids + [eid, eid] + desde + mercancia_ids + [eid] + desde)
         movimientos = cursor.fetchall()
 
     elif almacen_id in (2, 3):
@@ -9402,8 +9307,9 @@ def inventario_movimientos_producto_base(producto_base_id):
             WHERE im.mercancia_id IN ({placeholders}) 
               AND im.tipo_inventario_id = %s
               AND im.empresa_id = %s
+              {desde_im}
             ORDER BY im.fecha ASC, im.id ASC
-        """, mercancia_ids + [almacen_id, eid])
+        """, mercancia_ids + [almacen_id, eid] + desde)
         movimientos = cursor.fetchall()
 
     else:
@@ -9443,6 +9349,8 @@ def inventario_movimientos_producto_base(producto_base_id):
     pu = 0.0
     saldo_u = 0.0
     saldo_mx = 0.0
+    if cierre:
+        pu, saldo_u, saldo_mx = _arrancar_de_cierre(rows, cierre, estado_cierre)
     for m in movimientos:
         tipo = (m.get('tipo_movimiento') or '').strip().lower()
         es_entrada = tipo in ('entrada','compra')
@@ -9509,6 +9417,8 @@ def inventario_movimientos_producto_base(producto_base_id):
                            total_salidas_mx=total_salidas_mx,
                            saldo_final_mx=saldo_final_mx,
                            pu_final=pu_final,
+                           cierre=_aviso_cierre(cierre, estado_cierre, 'inventario_movimientos_producto_base',
+                                                producto_base_id=producto_base_id, almacen=almacen_id),
                            back_endpoint='mostrar_inventario_mp')
 
 @app.route('/inventarios/comprar_mp', methods=['GET', 'POST'])
@@ -9651,7 +9561,6 @@ def mostrar_inventario_mp():
                 pb.id AS id,
                 pb.nombre AS producto,
                 MIN(m.id) AS mercancia_id,
-                GROUP_CONCAT(m.id) AS mercancia_ids,
                 COALESCE(MAX(i.inventario_inicial), 0) AS inventario_inicial,
                 MAX(i.aprobado) AS aprobado
             FROM producto_base pb
@@ -9665,84 +9574,15 @@ def mostrar_inventario_mp():
         """, (eid, eid))
         inventario = cur.fetchall()
         
-        # ✅ CALCULAR SALDO FINAL CON COSTEO PROMEDIO PONDERADO (FILTRADO)
-        for item in inventario:
-            mercancia_ids = [int(x) for x in item['mercancia_ids'].split(',')]
-            placeholders = ','.join(['%s'] * len(mercancia_ids))
-            
-            # Query con filtro de empresa
-            sql = f"""
-            SELECT * FROM (
-                SELECT lc.fecha AS fecha_raw,
-                       dc.contenido_neto_total,
-                       CASE WHEN dc.contenido_neto_total>0
-                            THEN dc.precio_total/dc.contenido_neto_total ELSE NULL END AS precio_unitario,
-                       'compra' AS tipo_movimiento
-                FROM detalle_compra dc
-                JOIN listado_compras lc ON dc.compra_id = lc.id
-                WHERE dc.mercancia_id IN ({placeholders})
-                  AND dc.empresa_id = %s
-                  AND lc.empresa_id = %s
-                UNION ALL
-                SELECT im.fecha AS fecha_raw,
-                    im.unidades,
-                    im.precio_unitario,
-                    im.tipo_movimiento
-                FROM inventario_movimientos im
-                WHERE im.mercancia_id IN ({placeholders})
-                AND im.tipo_inventario_id = 1
-                AND im.empresa_id = %s
-                AND UPPER(im.tipo_movimiento) <> 'COMPRA'
-                AND im.unidades > 0
-                AND im.tipo_movimiento IS NOT NULL
-                AND im.tipo_movimiento <> ''
-            ) t
-            ORDER BY t.fecha_raw ASC
-            """
-            cur.execute(sql, mercancia_ids + [eid, eid] + mercancia_ids + [eid])
-            movimientos = cur.fetchall()
-            
-            # ✅ COSTEO PROMEDIO PONDERADO
-            pu = 0.0
-            saldo_u = float(item['inventario_inicial'])
-            saldo_mx = 0.0
-            entradas_total = 0.0
-            salidas_total = 0.0
-            
-            for m in movimientos:
-                tipo = (m.get('tipo_movimiento') or '').strip().lower()
-                es_entrada = tipo in ('entrada', 'compra')
-                contenido = m.get('contenido_neto_total')
-                
-                if es_entrada:
-                    entrada_u = float(contenido) if (contenido and float(contenido) > 0) else float(m.get('unidades') or 0.0)
-                    pu_entrada = float(m.get('precio_unitario') or 0.0)
-                    entrada_mx = entrada_u * pu_entrada
-                    
-                    saldo_u += entrada_u
-                    saldo_mx += entrada_mx
-                    entradas_total += entrada_u
-                    
-                    pu = saldo_mx / saldo_u if saldo_u > 0 else 0.0
-                    
-                elif tipo == 'salida':
-                    salida_u = float(m.get('unidades') or 0.0)
-                    salida_mx = salida_u * pu
-                    
-                    saldo_u -= salida_u
-                    saldo_mx -= salida_mx
-                    salidas_total += salida_u
-            
-            item['entradas'] = entradas_total
-            item['salidas'] = salidas_total
-            item['disponible'] = saldo_u
-            item['valor_inventario'] = saldo_mx
-            
+        # ✅ COSTEO PROMEDIO PONDERADO por producto base desde el último cierre
+        #    de periodo (o toda la historia) en una sola consulta
+        cierre = costear_desde_cierre(inventario, conn, eid, 1)
+
     finally:
         cur.close()
         conn.close()
 
-    return render_template('inventarios/mp/inventario.html', inventario=inventario)
+    return render_template('inventarios/mp/inventario.html', inventario=inventario, cierre=cierre)
     
 @app.route('/inventarios/produccion/listar')
 @require_login
@@ -9942,7 +9782,6 @@ def mostrar_inventario_wip():
                 pb.id AS id,
                 pb.nombre AS producto,
                 MIN(m.id) AS mercancia_id,
-                GROUP_CONCAT(m.id) AS mercancia_ids,
                 COALESCE(MAX(i.inventario_inicial), 0) AS inventario_inicial,
                 MAX(i.aprobado) AS aprobado
             FROM producto_base pb
@@ -9956,75 +9795,21 @@ def mostrar_inventario_wip():
         """, (eid, eid))
         inventario = cur.fetchall()
         
-        # ✅ CALCULAR SALDO FINAL CON COSTEO PROMEDIO PONDERADO
-        for item in inventario:
-            mercancia_ids = [int(x) for x in item['mercancia_ids'].split(',')]
-            placeholders = ','.join(['%s'] * len(mercancia_ids))
-            
-            # ✅ Query para movimientos de WIP (FILTRADO POR EMPRESA)
-            sql = f"""
-            SELECT im.fecha AS fecha_raw,
-                   im.tipo_movimiento,
-                   im.unidades,
-                   im.precio_unitario
-            FROM inventario_movimientos im
-            WHERE im.mercancia_id IN ({placeholders})
-              AND im.tipo_inventario_id = 2
-              AND im.empresa_id = %s
-              AND im.unidades > 0
-              AND im.tipo_movimiento IS NOT NULL
-              AND im.tipo_movimiento <> ''
-            ORDER BY im.fecha ASC, im.id ASC
-            """
-            cur.execute(sql, mercancia_ids + [eid])
-            movimientos = cur.fetchall()
-            
-            # ✅ APLICAR COSTEO PROMEDIO PONDERADO
-            pu = 0.0
-            saldo_u = float(item['inventario_inicial'])
-            saldo_mx = 0.0
-            entradas_total = 0.0
-            salidas_total = 0.0
-            
-            for m in movimientos:
-                tipo = (m.get('tipo_movimiento') or '').strip().lower()
-                es_entrada = tipo in ('entrada', 'compra')
-                
-                if es_entrada:
-                    entrada_u = float(m.get('unidades') or 0.0)
-                    pu_entrada = float(m.get('precio_unitario') or 0.0)
-                    entrada_mx = entrada_u * pu_entrada
-                    
-                    saldo_u += entrada_u
-                    saldo_mx += entrada_mx
-                    entradas_total += entrada_u
-                    
-                    # Recalcular precio promedio ponderado
-                    pu = saldo_mx / saldo_u if saldo_u > 0 else 0.0
-                    
-                elif tipo == 'salida':
-                    salida_u = float(m.get('unidades') or 0.0)
-                    salida_mx = salida_u * pu  # ✅ USA EL COSTO PROMEDIO
-                    
-                    saldo_u -= salida_u
-                    saldo_mx -= salida_mx
-                    salidas_total += salida_u
-            
-            # ✅ ASIGNAR VALORES FINALES
-            item['entradas'] = entradas_total
-            item['salidas'] = salidas_total
-            item['disponible'] = saldo_u
-            item['valor_inventario'] = saldo_mx
-            
+        # ✅ COSTEO PROMEDIO PONDERADO por producto base desde el último cierre
+        #    de periodo (o toda la historia) en una sola consulta
+        cierre = costear_desde_cierre(inventario, conn, eid, 2)
+
     finally:
         cur.close()
         conn.close()
 
-    return render_template('inventarios/wip/inventario.html', inventario=inventario)
+    return render_template('inventarios/wip/inventario.html', inventario=inventario, cierre=cierre)
 
 @app.route('/inventarios/movimientos-wip/<int:producto_base_id>')
+@require_login
 def inventario_movimientos_wip(producto_base_id):
     """Movimientos de WIP por producto base"""
+    eid = g.empresa_id
     if 'rol' not in session:
         return redirect('/login')
 
@@ -10053,6 +9838,13 @@ def inventario_movimientos_wip(producto_base_id):
     
     almacen_id = int(request.args.get('almacen', 2))  # Default 2 para WIP
 
+    # Último cierre de periodo: solo se leen los movimientos posteriores (?completo=1 = toda la historia)
+    cierre = estado_cierre = None
+    if almacen_id in (1, 2) and request.args.get('completo') != '1':
+        cierre, estado_cierre = cierre_producto_base(cursor, eid, almacen_id, producto_base_id)
+    desde_im = "AND im.fecha >= %s" if cierre else ""
+    desde = [cierre['corte']] if cierre else []
+
     # 2) Query movimientos WIP
     placeholders = ','.join(['%s'] * len(mercancia_ids))
     cursor.execute(f"""
@@ -10062,8 +9854,10 @@ def inventario_movimientos_wip(producto_base_id):
                (im.unidades*im.precio_unitario) AS importe, im.tipo_movimiento
         FROM inventario_movimientos im
         WHERE im.mercancia_id IN ({placeholders}) AND im.tipo_inventario_id = %s
+          AND im.empresa_id = %s
+          {desde_im}
         ORDER BY im.fecha ASC, im.id ASC
-    """, mercancia_ids + [almacen_id])
+    """, mercancia_ids + [almacen_id, eid] + desde)
     movimientos = cursor.fetchall()
 
     # 3) Construir tablas con costeo promedio
@@ -10071,6 +9865,8 @@ def inventario_movimientos_wip(producto_base_id):
     pu = 0.0
     saldo_u = 0.0
     saldo_mx = 0.0
+    if cierre:
+        pu, saldo_u, saldo_mx = _arrancar_de_cierre(rows, cierre, estado_cierre)
     
     for m in movimientos:
         tipo = (m.get('tipo_movimiento') or '').strip().lower()
@@ -10139,6 +9935,8 @@ def inventario_movimientos_wip(producto_base_id):
                            total_salidas_mx=total_salidas_mx,
                            saldo_final_mx=saldo_final_mx,
                            pu_final=pu_final,
+                           cierre=_aviso_cierre(cierre, estado_cierre, 'inventario_movimientos_wip',
+                                                producto_base_id=producto_base_id, almacen=almacen_id),
                            back_endpoint='mostrar_inventario_wip')
 
 @app.route('/inventarios/produccion', methods=['GET', 'POST'])
@@ -10538,12 +10336,14 @@ def cerrar_orden_produccion(orden_id):
         cantidad_final = float(orden['cantidad_programada'])
         pu_pt = (costo_wip / cantidad_final) if cantidad_final > 0 else 0
 
-        # Salida WIP
+        # Salida WIP (saldo materializado y capas PEPS en la misma transacción)
         cur.execute("""
             INSERT INTO inventario_movimientos
             (empresa_id, tipo_inventario_id, mercancia_id, tipo_movimiento, unidades, precio_unitario, referencia, fecha)
             VALUES (%s, 2, %s, 'SALIDA', %s, %s, %s, NOW())
         """, (eid, orden['producto_id'], cantidad_final, pu_pt, f"OP{orden_id}-CIERRE"))
+        aplicar_movimiento(cur, eid, 2, orden['producto_id'], 'SALIDA', cantidad_final, pu_pt, cur.lastrowid)
+        consumir(cur, eid, 2, {orden['producto_id']: cantidad_final})
 
         # Entrada PT
         cur.execute("""
@@ -10551,6 +10351,10 @@ def cerrar_orden_produccion(orden_id):
             (empresa_id, tipo_inventario_id, mercancia_id, tipo_movimiento, unidades, precio_unitario, referencia, fecha)
             VALUES (%s, 3, %s, 'ENTRADA', %s, %s, %s, NOW())
         """, (eid, orden['producto_id'], cantidad_final, pu_pt, f"OP{orden_id}-CIERRE"))
+        mov_id = cur.lastrowid
+        aplicar_movimiento(cur, eid, 3, orden['producto_id'], 'ENTRADA', cantidad_final, pu_pt, mov_id)
+        agregar_capa(cur, eid, 3, orden['producto_id'], cantidad_final, pu_pt, origen='produccion',
+                     referencia=f"OP{orden_id}-CIERRE", movimiento_id=mov_id)
 
         # Cerrar orden
         cur.execute("UPDATE orden_produccion SET estado='cerrada' WHERE id=%s", (orden_id,))
@@ -11475,8 +11279,10 @@ def productos_terminados():
                 INSERT INTO pt_precios (mercancia_id, modo, markup_pct)
                 VALUES (%s, 'auto', 0.30)
             """, (mid,))
+            subir_version_catalogo_pt(cursor, eid)
             
             conn.commit()
+            invalidar_indice(eid)
             flash(f"✅ Producto '{nombre}' agregado correctamente", "success")
             
         except Exception as e:
@@ -11548,6 +11354,8 @@ def pt_set_modo_masivo():
         LEFT JOIN pt_precios p ON p.mercancia_id = m.id
         WHERE m.id IN ({fmt}) AND p.mercancia_id IS NULL
     """, (modo, *ids_int))
+    # Sin empresa en sesión: sube la versión de todas
+    subir_version_catalogo_pt(cur)
 
     conn.commit()
     cur.close()
@@ -11616,6 +11424,7 @@ def pt_catalogo_reordenar():
             SET orden_pos = %s
             WHERE mercancia_id = %s AND empresa_id = %s
         """, (int(row["orden_pos"]), int(row["id"]), eid))
+    subir_version_catalogo_pt(cur, eid)
     conn.commit()
     cur.close()
     conn.close()
@@ -11660,21 +11469,19 @@ def datetimeformat(value, format='%d %B %Y'):
 
 
 
-def registrar_asiento_compra(cursor, conn, concepto, movimientos):
-    cursor.execute("""
-        INSERT INTO asientos_contables (fecha, concepto)
-        VALUES (NOW(), %s)
-    """, (concepto,))
-    asiento_id = cursor.lastrowid
-
-    for mov in movimientos:
-        cursor.execute("""
-            INSERT INTO asientos_detalle (asiento_id, cuenta_id, debe, haber)
-            VALUES (%s, %s, %s, %s)
-        """, (asiento_id, mov["cuenta_id"], mov["debe"], mov["haber"]))
+def registrar_pago_compra(cur, conn, eid, uid, compra_id, proveedor, fecha, numero_factura,
+                          metodo_pago, subtotal, iva, total_general):
+    """Crédito (si aplica) y asiento contable de una compra; va en la transacción de la compra"""
+    if metodo_pago == 'credito':
+        cur.execute("""
+            INSERT INTO compras_credito
+            (empresa_id, usuario_id, compra_id, fecha, numero_documento, proveedor, importe, iva, total)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (eid, uid, compra_id, fecha, numero_factura, proveedor, subtotal, iva, total_general))
 
-    # NO hacer commit aquí
-    return asiento_id
+    # ✅ ASIENTO CONTABLE: si no cuadra o falta una cuenta, AsientoInvalido revierte la compra
+    registrar_asientos(cur, eid, [asiento_compra(numero_factura, fecha, metodo_pago,
+                                                 subtotal, iva, total_general)])
 
 @app.route('/nueva_compra', methods=['GET', 'POST'])
 @require_login
@@ -11696,11 +11503,7 @@ def nueva_compra():
         metodo_pago    = (request.form.get('metodo_pago') or 'efectivo').strip()
         observaciones  = (request.form.get('observaciones') or '').strip()
 
-        nombres  = request.form.getlist('mercancia_nombre[]')
-        mids     = request.form.getlist('mercancia_id[]')
-        unidades = request.form.getlist('unidades[]')
-        precios  = request.form.getlist('precio_unitario[]')
-        totales  = request.form.getlist('precio_total[]')
+        renglones = renglones_desde_form(request.form)
 
         if not proveedor or not fecha or not numero_factura:
             flash('Proveedor, fecha y número de factura son obligatorios.', 'danger')
@@ -11710,9 +11513,6 @@ def nueva_compra():
         cur = conn.cursor(dictionary=True)
         
         try:
-            items = []
-            productos_fallidos = []
-
             # ✅ VALIDAR PROVEEDOR PERTENECE A LA EMPRESA
             cur.execute("""
                 SELECT id, nombre 
@@ -11724,83 +11524,9 @@ def nueva_compra():
                 flash(f'⚠️ El proveedor "{proveedor}" no existe en tu empresa. Regístralo primero.', 'warning')
                 return redirect(url_for('nueva_compra'))
 
-            # ✅ PROCESAR ITEMS
-            for i in range(max(len(nombres), len(unidades), len(precios), len(totales))):
-                nom  = (nombres[i]  if i < len(nombres)  else "").strip()
-                midS = (mids[i]     if i < len(mids)     else "").strip()
-                undS = (unidades[i] if i < len(unidades) else "").strip()
-                puS  = (precios[i]  if i < len(precios)  else "").strip()
-                ptS  = (totales[i]  if i < len(totales)  else "").strip()
-
-                # Saltar filas vacías
-                if not nom and not undS and not puS and not ptS:
-                    continue
-
-                # ✅ RESOLVER MERCANCÍA CON VALIDACIÓN DE EMPRESA
-                try:
-                    if midS and midS.isdigit():
-                        mercancia_id = int(midS)
-                    else:
-                        # Buscar por nombre en esta empresa
-                        cur.execute("""
-                            SELECT id FROM mercancia 
-                            WHERE nombre = %s AND empresa_id = %s AND tipo = 'MP' AND activo = 1
-                            LIMIT 1
-                        """, (nom, eid))
-                        m = cur.fetchone()
-                        if not m:
-                            productos_fallidos.append(f"'{nom}': No encontrado en catálogo")
-                            continue
-                        mercancia_id = m['id']
-
-                    # ✅ VALIDAR PERTENENCIA A EMPRESA Y PRODUCTO_BASE
-                    cur.execute("""
-                        SELECT m.id, m.nombre, m.producto_base_id, m.cont_neto, pb.nombre AS pb_nombre
-                        FROM mercancia m
-                        LEFT JOIN producto_base pb ON pb.id = m.producto_base_id
-                        WHERE m.id = %s AND m.empresa_id = %s AND m.tipo = 'MP'
-                    """, (mercancia_id, eid))
-                    merc = cur.fetchone()
-                    
-                    if not merc:
-                        productos_fallidos.append(f"'{nom}': No pertenece a tu empresa")
-                        continue
-                    if not merc['producto_base_id']:
-                        productos_fallidos.append(f"'{nom}': Sin producto base asignado")
-                        continue
-
-                except Exception as e:
-                    productos_fallidos.append(f"'{nom}': {str(e)}")
-                    continue
-
-                # ✅ CALCULAR CANTIDADES
-                try:
-                    cont_neto = float(merc['cont_neto'] or 1)
-                    if cont_neto <= 0:
-                        cont_neto = 1
-                except:
-                    cont_neto = 1
-
-                try:
-                    und = float(undS or 0)
-                    pu  = float(puS or 0)
-                    pt  = float(ptS or (und * pu))
-                except ValueError:
-                    productos_fallidos.append(f"'{nom}': Valores numéricos inválidos")
-                    continue
-
-                if und <= 0 or pu <= 0:
-                    productos_fallidos.append(f"'{nom}': Unidades y precio deben ser mayores a 0")
-                    continue
-
-                items.append({
-                    "mercancia_id": mercancia_id,
-                    "nombre": merc['nombre'],
-                    "unidades_base": und,
-                    "contenido_neto_total": und * cont_neto,
-                    "precio_unitario": pu,
-                    "precio_total": pt
-                })
+            # ✅ RESOLVER TODOS LOS RENGLONES EN UNA CONSULTA Y VALIDAR EN MEMORIA
+            resueltos = resolver_mercancias(cur, eid, renglones)
+            items, productos_fallidos = validar_renglones(renglones, resueltos)
 
             # ✅ VALIDAR QUE HAY ITEMS
             if productos_fallidos:
@@ -11824,58 +11550,23 @@ def nueva_compra():
             """, (eid, uid, proveedor, fecha, numero_factura, subtotal, iva, total_general, observaciones))
             compra_id = cur.lastrowid
 
-            # ✅ REGISTRAR CRÉDITO SI APLICA
-            if metodo_pago == 'credito':
-                cur.execute("""
-                    INSERT INTO compras_credito
-                    (empresa_id, usuario_id, compra_id, fecha, numero_documento, proveedor, importe, iva, total)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (eid, uid, compra_id, fecha, numero_factura, proveedor, subtotal, iva, total_general))
-
-            # ✅ ASIENTO CONTABLE (si la función lo soporta)
-            try:
-                cuenta_pago = 30 if metodo_pago == "efectivo" else 40 if metodo_pago == "banco" else 30
-                movimientos = [
-                    {"cuenta_id": 10, "debe": float(total_general), "haber": 0},
-                    {"cuenta_id": cuenta_pago, "debe": 0, "haber": float(total_general)}
-                ]
-                registrar_asiento_compra(cur, conn, f"Compra {numero_factura}", movimientos)
-            except Exception as e:
-                print(f"⚠️ Advertencia asiento contable: {e}")
-
-            # ✅ INSERTAR DETALLE + ACTUALIZAR INVENTARIO
-            for x in items:
-                # Detalle de compra
-                cur.execute("""
-                    INSERT INTO detalle_compra
-                    (empresa_id, usuario_id, compra_id, mercancia_id, producto, unidades, 
-                     contenido_neto_total, precio_unitario, precio_total)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (eid, uid, compra_id, x["mercancia_id"], x["nombre"], x["unidades_base"],
-                      x["contenido_neto_total"], x["precio_unitario"], x["precio_total"]))
+            # ✅ CRÉDITO SI APLICA + ASIENTO CONTABLE
+            registrar_pago_compra(cur, conn, eid, uid, compra_id, proveedor, fecha, numero_factura,
+                                  metodo_pago, subtotal, iva, total_general)
 
-                # Actualizar stock (tabla inventario)
-                cur.execute("""
-                    INSERT INTO inventario
-                    (empresa_id, mercancia_id, inventario_inicial, entradas, salidas, aprobado)
-                    VALUES (%s, %s, 0, %s, 0, 0)
-                    ON DUPLICATE KEY UPDATE
-                    entradas = entradas + VALUES(entradas)
-                """, (eid, x["mercancia_id"], x["contenido_neto_total"]))
-
-                # Movimiento de inventario (MP = tipo_inventario_id=1)
-                cur.execute("""
-                    INSERT INTO inventario_movimientos
-                    (empresa_id, usuario_id, tipo_inventario_id, mercancia_id, tipo_movimiento, 
-                     unidades, precio_unitario, referencia, fecha)
-                    VALUES (%s, %s, 1, %s, 'COMPRA', %s, %s, %s, %s)
-                """, (eid, uid, x["mercancia_id"], x["contenido_neto_total"], 
-                      x["precio_unitario"], f"Compra {numero_factura}", fecha))
+            # ✅ INSERTAR DETALLE + ACTUALIZAR INVENTARIO (un INSERT por tabla)
+            insertar_renglones(cur, eid, uid, compra_id, numero_factura, fecha, items)
 
             conn.commit()
             flash(f"✅ Compra #{compra_id} registrada exitosamente. Stock actualizado.", "success")
             return redirect(url_for('detalle_compra', id=compra_id))
 
+        except AsientoInvalido as e:
+            # Catálogo contable incompleto o asiento que no cuadra: la compra no se registra
+            conn.rollback()
+            flash(f"⚠️ Compra no registrada: {e}", "warning")
+            return redirect(url_for('nueva_compra'))
+
         except Exception as e:
             conn.rollback()
             print(f"[ERROR] /nueva_compra POST: {e}")
@@ -11907,18 +11598,7 @@ def nueva_compra():
             ORDER BY nombre
         """, (eid,))
         proveedores = cur.fetchall()
-        
-        cur.execute("""
-            SELECT m.id, m.nombre, pb.nombre as producto_base_nombre
-            FROM mercancia m
-            JOIN producto_base pb ON pb.id = m.producto_base_id
-            WHERE m.empresa_id = %s
-              AND m.tipo = 'MP'
-              AND m.producto_base_id IS NOT NULL
-              AND m.activo = 1
-            ORDER BY m.nombre
-        """, (eid,))
-        productos = cur.fetchall()
+        # Mercancías: el formulario las pide a /api/mercancia/autocompletar (índice en memoria)
         
     finally:
         try:
@@ -11930,7 +11610,138 @@ def nueva_compra():
         except:
             pass
 
-    return render_template('nueva_compra.html', proveedores=proveedores, productos=productos)
+    return render_template('nueva_compra.html', proveedores=proveedores)
+
+
+@app.route('/compras/importar', methods=['GET', 'POST'])
+@require_login
+def importar_compra():
+    """Importar una factura de proveedor desde CSV/XLSX - MULTIEMPRESA"""
+    if session.get('rol') != 'admin':
+        flash('Acceso denegado. Solo el administrador puede registrar compras.', 'danger')
+        return redirect('/login')
+
+    eid = g.empresa_id
+    uid = g.usuario_id
+    como_json = request.args.get('formato') == 'json'
+
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        cur.execute("""
+            SELECT nombre FROM proveedores
+            WHERE empresa_id = %s AND activo = 1
+            ORDER BY nombre
+        """, (eid,))
+        proveedores = cur.fetchall()
+
+        if request.method == 'GET':
+            # Reporte de la última importación registrada (POST → redirect → GET)
+            return render_template('compras/importar.html', proveedores=proveedores,
+                                   reporte=session.pop('reporte_importacion', None))
+
+        proveedor      = (request.form.get('proveedor') or '').strip()
+        fecha          = (request.form.get('fecha') or '').strip()
+        numero_factura = (request.form.get('numero_factura') or '').strip()
+        metodo_pago    = (request.form.get('metodo_pago') or 'efectivo').strip()
+        observaciones  = (request.form.get('observaciones') or '').strip()
+        simular        = request.form.get('simular') == '1'
+        archivo        = request.files.get('archivo')
+
+        def responder(reporte, error=None, status=200):
+            reporte = dict(reporte or {}, success=error is None, error=error)
+            if como_json:
+                return jsonify(reporte), status
+            if error:
+                flash(f"❌ {error}", 'danger')
+            return render_template('compras/importar.html', proveedores=proveedores, reporte=reporte)
+
+        if not proveedor or not fecha or not numero_factura or not archivo or not archivo.filename:
+            return responder(None, 'Proveedor, fecha, número de factura y archivo son obligatorios.', 400)
+
+        cur.execute("SELECT id FROM proveedores WHERE nombre = %s AND empresa_id = %s", (proveedor, eid))
+        if not cur.fetchone():
+            return responder(None, f'El proveedor "{proveedor}" no existe en tu empresa. Regístralo primero.', 400)
+
+        # ✅ UNA FACTURA SE REGISTRA UNA SOLA VEZ POR PROVEEDOR
+        cur.execute("""
+            SELECT id FROM listado_compras
+            WHERE empresa_id = %s AND proveedor = %s AND numero_factura = %s
+            LIMIT 1
+        """, (eid, proveedor, numero_factura))
+        previa = cur.fetchone()
+        if previa and not simular:
+            return responder(None, f'La factura {numero_factura} de "{proveedor}" ya está registrada '
+                                   f'(compra #{previa["id"]}).', 409)
+
+        # ✅ CATÁLOGO UNA VEZ; FILAS EN STREAMING; ESCRITURA POR BLOQUES EN UNA TRANSACCIÓN
+        indice = indice_empresa(eid)
+        reporte = Reporte()
+        compra_id = None
+        try:
+            renglones = renglones_archivo(filas_archivo(archivo))
+            for items in bloques_validos(cur, eid, renglones, indice, reporte):
+                if simular:
+                    continue
+                if compra_id is None:
+                    cur.execute("""
+                        INSERT INTO listado_compras
+                        (empresa_id, usuario_id, proveedor, fecha, numero_factura, subtotal, iva, total, observaciones)
+                        VALUES (%s, %s, %s, %s, %s, 0, 0, 0, %s)
+                    """, (eid, uid, proveedor, fecha, numero_factura, observaciones))
+                    compra_id = cur.lastrowid
+                insertar_renglones(cur, eid, uid, compra_id, numero_factura, fecha, items)
+        except (ValueError, zipfile.BadZipFile, csv.Error) as e:
+            conn.rollback()
+            return responder(reporte.como_dict(), f'No se pudo leer el archivo: {e}', 400)
+
+        resultado = reporte.como_dict()
+        subtotal = reporte.subtotal
+        iva = subtotal * 0.16  # Igual que nueva_compra
+        total_general = subtotal + iva
+        resultado.update({'simulado': simular, 'compra_id': compra_id,
+                          'iva': round(iva, 2), 'total': round(total_general, 2)})
+
+        if simular:
+            conn.rollback()
+            return responder(resultado)
+        if compra_id is None:
+            conn.rollback()
+            return responder(resultado, 'No hay productos válidos para registrar.', 400)
+
+        cur.execute("""
+            UPDATE listado_compras SET subtotal = %s, iva = %s, total = %s
+            WHERE id = %s AND empresa_id = %s
+        """, (subtotal, iva, total_general, compra_id, eid))
+        registrar_pago_compra(cur, conn, eid, uid, compra_id, proveedor, fecha, numero_factura,
+                              metodo_pago, subtotal, iva, total_general)
+        conn.commit()
+        if como_json:
+            return responder(resultado)
+        flash(f"✅ Compra #{compra_id} importada: {reporte.importadas} renglones, "
+              f"{reporte.omitidas} omitidos.", 'success')
+        session['reporte_importacion'] = dict(reporte.como_dict(MAX_DETALLE_SESION), **{
+            k: resultado[k] for k in ('simulado', 'compra_id', 'iva', 'total')})
+        return redirect(url_for('importar_compra'))
+
+    except AsientoInvalido as e:
+        # Catálogo contable incompleto o asiento que no cuadra: la compra no se registra
+        conn.rollback()
+        if como_json:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        flash(f"⚠️ Compra no registrada: {e}", "warning")
+        return redirect(url_for('importar_compra'))
+
+    except Exception as e:
+        conn.rollback()
+        print(f"[ERROR] /compras/importar POST: {e}")
+        if como_json:
+            return jsonify({'success': False, 'error': str(e)}), 500
+        flash(f"❌ Error al importar compra: {e}", "danger")
+        return redirect(url_for('importar_compra'))
+    finally:
+        cur.close()
+        conn.close()
     
 @app.route('/detalle_compra/<int:id>')
 @require_login
@@ -12071,12 +11882,19 @@ def editar_compra(id):
         numero_factura = request.form['numero_factura']
         total = request.form['total']
 
+        cursor.execute("SELECT fecha FROM listado_compras WHERE id=%s AND empresa_id=%s", (id, eid))
+        anterior = cursor.fetchone()
+
         cursor.execute("""
             UPDATE listado_compras
             SET proveedor=%s, fecha=%s, numero_factura=%s, total=%s
             WHERE id=%s AND empresa_id=%s
         """, (proveedor, fecha, numero_factura, total, id, eid))
 
+        # La compra puede moverse a un periodo ya cerrado (o salir de él)
+        if anterior:
+            invalidar_cierres(cursor, eid, min(str(anterior['fecha'])[:10], fecha[:10]))
+
         conn.commit()
         cursor.close()
         conn.close()
@@ -12108,7 +11926,7 @@ def eliminar_compra(id):
     try:
         # Verificar pertenencia
         cursor.execute("""
-            SELECT numero_factura FROM listado_compras 
+            SELECT numero_factura, fecha FROM listado_compras 
             WHERE id = %s AND empresa_id = %s
         """, (id, eid))
         compra = cursor.fetchone()
@@ -12153,6 +11971,8 @@ def eliminar_compra(id):
             WHERE id = %s AND empresa_id = %s
         """, (id, eid))
 
+        invalidar_cierres(cursor, eid, compra['fecha'])
+
         conn.commit()
         flash('✅ Compra eliminada completamente.', 'success')
         
@@ -12199,6 +12019,11 @@ def check_producto_api(nombre):
     if not n:
         return jsonify({"existe": False})
 
+    # Con sesión: índice en memoria de la empresa (exacto → tokens en orden)
+    eid = session.get('empresa_id')
+    if eid:
+        return jsonify({"existe": resolver_indice(eid, n) is not None})
+
     conn = conexion_db(); cur = conn.cursor(dictionary=True)
     try:
         # exacto
@@ -12215,6 +12040,43 @@ def check_producto_api(nombre):
         cur.close(); conn.close()
 
 
+@app.route("/api/search", methods=["GET"])
+@require_login
+def api_search():
+    """
+    Búsqueda unificada de la empresa: ?q=texto&tipos=mercancia,proveedores&pagina=1&por_pagina=10
+    Regresa una sección por tipo con sus resultados y si hay más páginas
+    """
+    q = (request.args.get('q') or '').strip()
+    tipos = [t.strip() for t in (request.args.get('tipos') or '').split(',') if t.strip() in TIPOS_BUSQUEDA]
+    pagina = request.args.get('pagina', 1, type=int) or 1
+    por_pagina = request.args.get('por_pagina', 10, type=int) or 10
+
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        secciones = busqueda_unificada(cur, g.empresa_id, q, tipos or None, pagina, por_pagina)
+    finally:
+        cur.close()
+        conn.close()
+
+    for r in secciones.get('cfdi', {}).get('resultados', []):
+        r['url'] = url_for('cfdi_ver', id=r['id'])
+    for r in secciones.get('tickets', {}).get('resultados', []):
+        r['url'] = url_for('ver_ticket', ticket_id=r['id'])
+    return jsonify({"q": q, "secciones": secciones})
+
+
+@app.route("/api/mercancia/autocompletar", methods=["GET"])
+@require_login
+def autocompletar_mercancia():
+    """Sugerencias por nombre con ranking (exacto, empieza con, palabras, tokens)"""
+    q = (request.args.get('q') or '').strip()
+    tipo = (request.args.get('tipo') or '').strip().upper() or None
+    limite = min(max(request.args.get('limite', 10, type=int) or 10, 1), 50)
+    if not q:
+        return jsonify({"resultados": []})
+    return jsonify({"resultados": buscar_mercancias(g.empresa_id, q, limite=limite, tipo=tipo)})
 
 
 
@@ -12339,6 +12201,7 @@ def mercancia():
             """, (eid, mid, desc, str(cont_neto), unidad_nombre, str(cont_neto)))
 
             conn.commit()
+            invalidar_indice(eid)
             flash(f'✅ Producto registrado correctamente.', 'success')
         except Exception as e:
             conn.rollback()
@@ -12509,8 +12372,10 @@ def actualizar_mercancia(id):
                 (empresa_id, mercancia_id, descripcion, contenido_neto, unidad, factor_conversion)
             VALUES (%s, %s, %s, %s, %s, %s)
         """, (eid, id, desc, str(cont_neto), unidad_nombre, str(cont_neto)))
+        subir_version_catalogo_pt(cur, eid)
 
         conn.commit()
+        invalidar_indice(eid)
         flash('✅ Mercancía actualizada correctamente.', 'success')
     except Exception as e:
         conn.rollback()
@@ -12539,8 +12404,11 @@ def eliminar_mercancia(id):
         cur.execute("DELETE FROM presentaciones WHERE mercancia_id=%s AND empresa_id=%s", (id, eid))
         cur.execute("DELETE FROM inventario WHERE mercancia_id=%s AND empresa_id=%s", (id, eid))
         cur.execute("DELETE FROM mercancia WHERE id=%s AND empresa_id=%s", (id, eid))
+        invalidar_cierres(cur, eid)
+        subir_version_catalogo_pt(cur, eid)
 
         conn.commit()
+        invalidar_indice(eid)
         flash('Producto eliminado.', 'success')
     except Exception as e:
         conn.rollback()
@@ -12574,6 +12442,7 @@ def registrar_proveedor():
             VALUES (%s, %s, %s, %s, %s, 1)
         """, (nombre, direccion, ciudad, telefono, eid))
         conn.commit()
+        invalidar_busqueda(eid, 'proveedores')
         flash('Proveedor registrado correctamente.', 'success')
         cursor.close()
         conn.close()
@@ -12583,8 +12452,10 @@ def registrar_proveedor():
     params = [eid]
     
     if buscar:
-        query += " AND (nombre LIKE %s OR ciudad LIKE %s OR telefono LIKE %s)"
-        params.extend([f'%{buscar}%', f'%{buscar}%', f'%{buscar}%'])
+        # Búsqueda unificada (FULLTEXT nombre/ciudad/teléfono) dentro de la misma consulta
+        condicion, params_buscar = condicion_seccion(cursor, eid, 'proveedores', buscar)
+        query += f" AND {condicion}"
+        params.extend(params_buscar)
     
     query += " ORDER BY nombre ASC"
     
@@ -12617,6 +12488,7 @@ def editar_proveedor(id):
         WHERE id = %s AND empresa_id = %s
     """, (nombre, direccion, ciudad, telefono, id, eid))
     conn.commit()
+    invalidar_busqueda(eid, 'proveedores')
     cursor.close()
     conn.close()
     
@@ -12632,6 +12504,7 @@ def eliminar_proveedor(id):
     cursor = conn.cursor()
     cursor.execute("UPDATE proveedores SET activo = 0 WHERE id = %s AND empresa_id = %s", (id, eid))
     conn.commit()
+    invalidar_busqueda(eid, 'proveedores')
     cursor.close()
     conn.close()
     
@@ -12652,15 +12525,17 @@ def catalogo_mp():
     q = request.args.get('q', '').strip()
     
     if q:
-        cur.execute("""
+        # Índice en memoria de nombres (busqueda_mercancias)
+        ids = [r['id'] for r in buscar_mercancias(eid, q, limite=1000, solo_activos=False)] or [0]
+        cur.execute(f"""
             SELECT m.*, u.nombre AS unidad_nombre
             FROM mercancia m
             LEFT JOIN unidades_medida u ON u.id = m.unidad_id
             WHERE m.tipo_inventario_id = 1
               AND m.empresa_id = %s
-              AND m.nombre LIKE %s
+              AND m.id IN ({','.join(['%s'] * len(ids))})
             ORDER BY m.nombre
-        """, (eid, f'%{q}%'))
+        """, (eid, *ids))
     else:
         cur.execute("""
             SELECT m.*, u.nombre AS unidad_nombre
@@ -14244,7 +14119,8 @@ def facturacion_b2b_recibir(id):
                 
                 # Crear entrada al inventario MP por cada item recibido
                 cur.execute("""
-                    SELECT d.mercancia_id, d.cantidad_recibida, d.descripcion
+                    SELECT d.mercancia_id, d.cantidad_recibida, d.descripcion, d.precio_unitario, d.descuento,
+                           d.cantidad_facturada
                     FROM facturas_b2b_detalle d
                     WHERE d.factura_id = %s AND d.verificado = 1 AND d.cantidad_recibida > 0
                 """, (id,))
@@ -14280,6 +14156,20 @@ def facturacion_b2b_recibir(id):
                     """, (eid, item['mercancia_id'], item['cantidad_recibida'], 
                           f'Factura B2B: {factura["folio"]}', uid))
                 
+                # Capas de costo PEPS de lo recibido (precio neto de descuento)
+                agregar_capas(cur, eid, [{
+                    'tipo_inventario_id': 1,
+                    'mercancia_id': item['mercancia_id'],
+                    'unidades': item['cantidad_recibida'],
+                    'costo_unitario': float(item['precio_unitario'] or 0) - (
+                        float(item['descuento'] or 0) / float(item['cantidad_facturada'])
+                        if item['cantidad_facturada'] else 0),
+                    'origen': 'b2b',
+                    'referencia': f'Factura B2B: {factura["folio"]}',
+                } for item in items_recibidos if item['mercancia_id']])
+                # Entradas en movimientos_inventario: cambian el costo de los PT
+                subir_version_catalogo_pt(cur, eid)
+                
                 # Notificar al emisor
                 cur.execute("""
                     INSERT INTO facturas_notificaciones 
@@ -14529,6 +14419,7 @@ def cfdi_importar():
                     errores += 1
         
         conn.commit()
+        invalidar_busqueda(eid, 'cfdi')
         
         if importados > 0:
             flash(f'✅ {importados} CFDI importados correctamente', 'success')
@@ -14700,6 +14591,7 @@ def cfdi_conciliar(id):
             """, (documento_id, id, eid))
         
         conn.commit()
+        invalidar_busqueda(eid, 'cfdi')
         flash('✅ CFDI conciliado correctamente', 'success')
         
     except Exception as e:
@@ -16007,7 +15899,8 @@ def registrar_pago_cxp(cuenta_id):
             titulo='Pago Recibido',
             mensaje=f'Cobro de ${monto:.2f} - {metodo}',
             referencia_tipo='pago_b2b',
-            referencia_id=pago_id
+            referencia_id=pago_id,
+            cursor=cursor
         )
         
         db.commit()
@@ -16301,26 +16194,6 @@ def dashboard_b2b():
 # =============================================
 # Agrega este context processor para mostrar OC pendientes
 
-@app.context_processor
-def inject_oc_pendientes():
-    """Inyecta cantidad de OC pendientes de aprobar"""
-    if hasattr(g, 'empresa_id') and g.empresa_id:
-        try:
-            db = conexion_db()
-            cursor = db.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT COUNT(*) as pendientes
-                FROM ordenes_compra_b2b
-                WHERE empresa_cliente_id = %s AND estado = 'borrador'
-            """, (g.empresa_id,))
-            result = cursor.fetchone()
-            cursor.close()
-            db.close()
-            return {'oc_pendientes': result['pendientes'] if result else 0}
-        except:
-            pass
-    return {'oc_pendientes': 0}
-
 # ===== REGISTRO DE BLUEPRINTS =====
 from inventarios.WIP import bp as wip_bp
 
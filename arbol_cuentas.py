@@ -0,0 +1,327 @@
+"""
+Catálogo de cuentas contables en memoria (árbol por empresa)
+Antes catalogo_cuentas leía vw_cuentas_contables (subconsulta de hijos por fila) y
+armaba las columnas por nivel en cada petición; ensure_account / get_id_by_code /
+next_lvl3_code hacían una consulta por código y el bootstrap un commit por cuenta.
+Ahora:
+1. ArbolCuentas: código → nodo, padre / hijos, siguiente código de nivel 3 y las filas
+   del catálogo (columnas cuenta / mayor / subcuenta) calculadas una vez al cargar
+2. arbol_cuentas(cur, empresa_id): caché por empresa (None = tabla completa, que es
+   donde los códigos son únicos) con TTL CATALOGO_CUENTAS_TTL
+3. sincronizar_cuentas(): el bootstrap en una transacción; UPDATE solo de las cuentas
+   que cambian (executemany) e INSERT de varios renglones por oleada (padres primero)
+4. invalidar_arbol() después de cada commit que toca cuentas_contables
+"""
+
+import os
+import threading
+import time
+
+CATALOGO_CUENTAS_TTL = float(os.environ.get('CATALOGO_CUENTAS_TTL', 600))
+
+_arboles = {}
+_lock = threading.Lock()
+_metricas = {'cargas': 0, 'hits': 0, 'invalidaciones': 0}
+
+_CAMPOS = "c.id, c.codigo, c.nombre, c.tipo, c.naturaleza, c.nivel, c.permite_subcuentas, c.padre_id, c.empresa_id"
+
+
+# -------------------- Reglas por código --------------------
+
+def tipo_from_code(code: str) -> str:
+    a = int(code.split('-')[0])
+    if 100 <= a < 200:
+        return 'Activo'
+    if 200 <= a < 300:
+        return 'Pasivo'
+    if 300 <= a < 400:
+        return 'Patrimonio'
+    if 400 <= a < 500:
+        return 'Ingresos'
+    # 500 y 600 los tratamos como Gastos (no hay 'Costos' en el enum)
+    if 500 <= a < 700:
+        return 'Gastos'
+    return 'Gastos'
+
+def naturaleza_from_tipo(tipo: str) -> str:
+    # regla contable estándar
+    if tipo in ('Activo', 'Gastos'):
+        return 'Deudora'
+    # Pasivo, Patrimonio, Ingresos
+    return 'Acreedora'
+
+def nivel_from_code(code: str) -> int:
+    _, b, c = code.split('-')
+    if b == '000' and c == '000':
+        return 1
+    if c == '000':
+        return 2
+    return 3
+
+def parent_code_of(code: str) -> str | None:
+    a, b, c = code.split('-')
+    n = nivel_from_code(code)
+    if n == 1:
+        return None
+    if n == 2:
+        return f"{a}-000-000"
+    return f"{a}-{b}-000"
+
+
+def _nivel_seguro(code):
+    try:
+        return nivel_from_code(code) if code else None
+    except ValueError:
+        return None
+
+
+# -------------------- Árbol --------------------
+
+class ArbolCuentas:
+    """Cuentas indexadas por id y por código, con hijos ordenados por código"""
+
+    def __init__(self, filas, empresa_id=None):
+        self.empresa_id = empresa_id
+        self.por_id = {}
+        self.por_codigo = {}
+        self.hijos = {}
+        for f in filas:
+            self.agregar(dict(f))
+        self._filas = None
+        self.creado = time.monotonic()
+
+    def agregar(self, nodo):
+        self.por_id[nodo['id']] = nodo
+        self.por_codigo[nodo['codigo']] = nodo
+        if nodo.get('padre_id'):
+            hermanos = self.hijos.setdefault(nodo['padre_id'], [])
+            hermanos.append(nodo)
+            hermanos.sort(key=lambda n: n['codigo'])
+        self._filas = None
+
+    def actualizar(self, nodo, **campos):
+        """Cambia campos de un nodo (re-indexa hijos si cambia el padre)"""
+        if 'padre_id' in campos and campos['padre_id'] != nodo.get('padre_id'):
+            if nodo.get('padre_id'):
+                self.hijos[nodo['padre_id']].remove(nodo)
+            nodo.update(campos)
+            del self.por_id[nodo['id']]
+            self.agregar(nodo)
+        else:
+            nodo.update(campos)
+        self._filas = None
+
+    def id_por_codigo(self, code):
+        nodo = self.por_codigo.get(code)
+        return nodo['id'] if nodo else None
+
+    def padre(self, nodo):
+        return self.por_id.get(nodo.get('padre_id'))
+
+    def hijo_por_nombre(self, padre_id, nombre_up, nivel=3):
+        for h in self.hijos.get(padre_id, ()):
+            if h['nivel'] == nivel and (h['nombre'] or '').upper() == nombre_up:
+                return h
+        return None
+
+    def siguiente_nivel3(self, padre_id):
+        """Código AAA-BBB-CCC libre después del último hijo de nivel 3 del padre"""
+        padre = self.por_id.get(padre_id)
+        if not padre:
+            raise ValueError("Padre inexistente")
+        a, b, _ = padre['codigo'].split('-')
+        ultimos = [h['codigo'] for h in self.hijos.get(padre_id, ()) if h['nivel'] == 3]
+        nxt = f"{int(max(ultimos).split('-')[2]) + 1:03d}" if ultimos else "001"
+        return f"{a}-{b}-{nxt}"
+
+    def _fila_catalogo(self, nodo):
+        col_cuenta = col_mayor = col_sub = col_subsub = ''
+        padre = self.padre(nodo)
+        parent_level = _nivel_seguro(padre['codigo']) if padre else None
+        if nodo['nivel'] == 1:
+            col_cuenta = nodo['nombre']
+        elif nodo['nivel'] == 2:
+            if parent_level == 1 or parent_level is None:
+                col_mayor = nodo['nombre']
+            else:
+                col_sub = nodo['nombre']
+        else:
+            col_subsub = nodo['nombre']
+        return {
+            'id': nodo['id'],
+            'codigo': nodo['codigo'],
+            'cuenta': col_cuenta,
+            'cuenta_mayor': col_mayor,
+            'subcuenta': col_sub,
+            'subsubcuenta': col_subsub,
+        }
+
+    def filas_catalogo(self, ids=None):
+        """Filas de catalogo_cuentas (de la empresa del árbol) ordenadas por código"""
+        if self._filas is None:
+            propias = [n for n in self.por_id.values()
+                       if self.empresa_id is None or n.get('empresa_id') == self.empresa_id]
+            self._filas = [(n, self._fila_catalogo(n)) for n in sorted(propias, key=lambda n: n['codigo'])]
+        if ids is None:
+            return [f for _n, f in self._filas]
+        ids = set(ids)
+        return [f for n, f in self._filas if n['id'] in ids or n.get('padre_id') in ids]
+
+
+def cargar_arbol(cur, empresa_id=None):
+    """Árbol recién leído (sin caché); con empresa incluye los padres de sus cuentas"""
+    if empresa_id is None:
+        cur.execute(f"SELECT {_CAMPOS} FROM cuentas_contables c")
+    else:
+        cur.execute(f"""
+            SELECT {_CAMPOS} FROM cuentas_contables c
+            WHERE c.empresa_id = %s
+               OR c.id IN (SELECT h.padre_id FROM cuentas_contables h WHERE h.empresa_id = %s)
+        """, (empresa_id, empresa_id))
+    filas = cur.fetchall()
+    if filas and not isinstance(filas[0], dict):
+        filas = [dict(zip(cur.column_names, f)) for f in filas]
+    return ArbolCuentas(filas, empresa_id)
+
+
+def arbol_cuentas(cur, empresa_id=None, recargar=False):
+    """
+    Árbol vigente de la caché (lo carga con `cur` si no existe o venció).
+    recargar=True lo vuelve a leer aunque siga vigente: cuentas creadas por otro
+    worker no se ven en su caché hasta que vence.
+    """
+    ahora = time.monotonic()
+    with _lock:
+        arbol = _arboles.get(empresa_id)
+        if not recargar and arbol is not None and ahora - arbol.creado < CATALOGO_CUENTAS_TTL:
+            _metricas['hits'] += 1
+            return arbol
+
+    arbol = cargar_arbol(cur, empresa_id)
+    with _lock:
+        _arboles[empresa_id] = arbol
+        _metricas['cargas'] += 1
+    return arbol
+
+
+def invalidar_arbol(empresa_id=None):
+    """
+    Descarta árboles de la caché. El árbol global (None) contiene todas las cuentas,
+    así que siempre se descarta.
+    """
+    with _lock:
+        _metricas['invalidaciones'] += 1
+        if empresa_id is None:
+            _arboles.clear()
+        else:
+            _arboles.pop(empresa_id, None)
+            _arboles.pop(None, None)
+
+
+def metricas_arbol():
+    with _lock:
+        m = dict(_metricas)
+        m['arboles'] = len(_arboles)
+        m['cuentas'] = sum(len(a.por_id) for a in _arboles.values())
+    m['ttl_s'] = CATALOGO_CUENTAS_TTL
+    return m
+
+
+# -------------------- Bootstrap en lote --------------------
+
+def _deseada(code, name, permite_sub, parent_override):
+    tipo = tipo_from_code(code)
+    return {
+        'codigo': code,
+        'nombre': name,
+        'tipo': tipo,
+        'naturaleza': naturaleza_from_tipo(tipo),
+        'nivel': nivel_from_code(code),
+        'padre_codigo': parent_override or parent_code_of(code),
+        'permite_subcuentas': 1 if permite_sub else 0,
+    }
+
+
+def sincronizar_cuentas(cur, arbol, cuentas, conservar_nombre=("600-001-",)):
+    """
+    Crea o actualiza `cuentas` [(codigo, nombre, permite_sub, parent_override)] con las
+    mismas reglas que ensure_account. No hace commit. Regresa (insertadas, actualizadas).
+    `arbol` debe estar recién cargado (cargar_arbol) y se actualiza con las nuevas cuentas.
+    """
+    deseadas = {}
+    for code, name, permite_sub, parent_override in cuentas:
+        deseadas[code] = _deseada(code, name, permite_sub, parent_override)
+
+    # Existentes: UPDATE solo si algo cambió
+    cambios = []
+    pendientes = {}
+    for code, d in deseadas.items():
+        nodo = arbol.por_codigo.get(code)
+        if nodo is None:
+            pendientes[code] = d
+            continue
+        pid = arbol.id_por_codigo(d['padre_codigo']) if d['padre_codigo'] else None
+        if pid is None and d['padre_codigo'] in deseadas:
+            pendientes[code] = d      # el padre se crea en esta misma corrida
+            continue
+        # 🚨 No actualizar nombre si está en el bloque 600-001-001 … 600-001-026
+        nombre = nodo['nombre'] if code.startswith(conservar_nombre) else d['nombre']
+        nuevo = (nombre, d['tipo'], d['naturaleza'], d['nivel'], pid, d['permite_subcuentas'])
+        actual = (nodo['nombre'], nodo['tipo'], nodo['naturaleza'], nodo['nivel'],
+                  nodo['padre_id'], int(nodo['permite_subcuentas'] or 0))
+        if nuevo != actual:
+            cambios.append(nuevo + (nodo['id'],))
+            arbol.actualizar(nodo, nombre=nombre, tipo=d['tipo'], naturaleza=d['naturaleza'],
+                             nivel=d['nivel'], padre_id=pid, permite_subcuentas=d['permite_subcuentas'])
+
+    # Nuevas: por oleadas; una cuenta espera mientras su padre esté pendiente de crear
+    insertadas = 0
+    while pendientes:
+        oleada = [d for d in pendientes.values() if d['padre_codigo'] not in pendientes]
+        if not oleada:
+            raise ValueError("Ciclo de padres en el catálogo: " + ', '.join(sorted(pendientes)))
+        nuevas = [d for d in oleada if d['codigo'] not in arbol.por_codigo]
+        if nuevas:
+            valores = []
+            for d in nuevas:
+                d['padre_id'] = arbol.id_por_codigo(d['padre_codigo']) if d['padre_codigo'] else None
+                valores += [d['codigo'], d['nombre'], d['tipo'], d['naturaleza'], d['nivel'],
+                            d['padre_id'], d['permite_subcuentas']]
+            cur.execute(
+                "INSERT INTO cuentas_contables (codigo, nombre, tipo, naturaleza, nivel, padre_id, permite_subcuentas) "
+                "VALUES " + ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(nuevas)),
+                valores)
+            # Ids releídos por código (UNIQUE): los de un INSERT de varios renglones no
+            # son consecutivos con innodb_autoinc_lock_mode=2 o auto_increment_increment > 1
+            cur.execute(
+                "SELECT id, codigo FROM cuentas_contables WHERE codigo IN ("
+                + ', '.join(['%s'] * len(nuevas)) + ")", [d['codigo'] for d in nuevas])
+            ids = {}
+            for r in cur.fetchall():
+                r = r if isinstance(r, dict) else dict(zip(cur.column_names, r))
+                ids[r['codigo']] = r['id']
+            for d in nuevas:
+                arbol.agregar({'id': ids[d['codigo']], 'codigo': d['codigo'], 'nombre': d['nombre'],
+                               'tipo': d['tipo'], 'naturaleza': d['naturaleza'], 'nivel': d['nivel'],
+                               'padre_id': d['padre_id'], 'permite_subcuentas': d['permite_subcuentas'],
+                               'empresa_id': None})
+            insertadas += len(nuevas)
+        # Las existentes que esperaban a su padre ya pueden actualizarse
+        codigos_nuevos = {d['codigo'] for d in nuevas}
+        for d in oleada:
+            pendientes.pop(d['codigo'])
+            if d['codigo'] not in codigos_nuevos:
+                nodo = arbol.por_codigo[d['codigo']]
+                pid = arbol.id_por_codigo(d['padre_codigo']) if d['padre_codigo'] else None
+                nombre = nodo['nombre'] if d['codigo'].startswith(conservar_nombre) else d['nombre']
+                cambios.append((nombre, d['tipo'], d['naturaleza'], d['nivel'], pid,
+                                d['permite_subcuentas'], nodo['id']))
+                arbol.actualizar(nodo, nombre=nombre, tipo=d['tipo'], naturaleza=d['naturaleza'],
+                                 nivel=d['nivel'], padre_id=pid, permite_subcuentas=d['permite_subcuentas'])
+
+    if cambios:
+        cur.executemany(
+            "UPDATE cuentas_contables "
+            "SET nombre=%s, tipo=%s, naturaleza=%s, nivel=%s, padre_id=%s, permite_subcuentas=%s "
+            "WHERE id=%s", cambios)
+    return insertadas, len(cambios)
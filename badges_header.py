@@ -0,0 +1,163 @@
+"""
+Contadores del header (badges) en una sola consulta
+Antes cada context processor abría su propia conexión en cada render_template
+(incidencias, notificaciones, alertas B2B con 2 consultas y OC pendientes).
+Ahora:
+1. Una consulta con los 4 conteos como subconsultas escalares
+2. Memo por petición (flask.g): varios render_template en la misma petición no repiten
+3. Caché por (empresa, usuario) con TTL corto (BADGES_TTL, segundos)
+4. invalidar_badges() se llama donde se escriben alertas, notificaciones,
+   incidencias u órdenes de compra B2B
+5. metricas_badges(): hits/misses para ver la tasa de aciertos
+"""
+
+import os
+import threading
+import time
+
+from flask import g, has_app_context
+from db import conexion_db
+
+BADGES_TTL = float(os.environ.get('BADGES_TTL', 15))
+MAX_ENTRADAS = 5000
+
+CEROS = {
+    'incidencias_count': 0,
+    'notificaciones_count': 0,
+    'alertas_count': 0,
+    'oc_pendientes': 0,
+}
+
+# Un conteo por badge; se combinan en un solo SELECT
+_SUBCONSULTAS = {
+    'incidencias_count': """
+        SELECT COUNT(*) FROM incidencias
+        WHERE usuario_destino_id = %(uid)s AND leida = 0
+    """,
+    'notificaciones_count': """
+        SELECT COUNT(*) FROM notificaciones_usuario
+        WHERE usuario_destino_id = %(uid)s AND leida = 0
+    """,
+    'alertas_count': """
+        SELECT COUNT(*) FROM alertas_b2b a
+        WHERE a.empresa_id = %(eid)s
+          AND a.activa = 1
+          AND a.leida = 0
+          AND EXISTS (
+              SELECT 1 FROM roles_b2b_empresa r
+              WHERE r.empresa_id = a.empresa_id
+                AND r.usuario_id = %(uid)s
+                AND r.activo = 1
+                AND (   (a.rol_destino = 'supervisor' AND r.es_supervisor = 1)
+                     OR (a.rol_destino = 'ventas'     AND r.es_ventas = 1)
+                     OR (a.rol_destino = 'cxc'        AND r.es_cxc = 1)
+                     OR (a.rol_destino = 'cxp'        AND r.es_cxp = 1)
+                     OR (a.rol_destino = 'almacen'    AND r.es_almacen = 1)
+                     OR (a.rol_destino = 'reparto'    AND r.es_reparto = 1))
+          )
+    """,
+    'oc_pendientes': """
+        SELECT COUNT(*) FROM ordenes_compra_b2b
+        WHERE empresa_cliente_id = %(eid)s AND estado = 'borrador'
+    """,
+}
+
+_cache = {}
+_lock = threading.Lock()
+_metricas = {
+    'memo_request': 0,
+    'cache_hits': 0,
+    'cache_misses': 0,
+    'invalidaciones': 0,
+    'errores': 0,
+}
+
+
+def _contar(empresa_id, usuario_id):
+    params = {'eid': empresa_id, 'uid': usuario_id}
+    db = conexion_db()
+    cursor = db.cursor()
+    try:
+        try:
+            columnas = ",\n".join(f"({sql}) AS {k}" for k, sql in _SUBCONSULTAS.items())
+            cursor.execute(f"SELECT {columnas}", params)
+            row = cursor.fetchone()
+            return {k: int(v or 0) for k, v in zip(_SUBCONSULTAS, row)}
+        except Exception:
+            # Alguna tabla no existe en esta instalación: cada badge por separado
+            with _lock:
+                _metricas['errores'] += 1
+            conteos = dict(CEROS)
+            for k, sql in _SUBCONSULTAS.items():
+                try:
+                    cursor.execute(sql, params)
+                    conteos[k] = int(cursor.fetchone()[0] or 0)
+                except Exception:
+                    pass
+            return conteos
+    finally:
+        cursor.close()
+        db.close()
+
+
+def contadores_header(empresa_id, usuario_id):
+    """Los 4 badges del header para (empresa, usuario)"""
+    if not usuario_id and not empresa_id:
+        return dict(CEROS)
+
+    clave = (empresa_id, usuario_id)
+    memo = g.get('_badges_header')
+    if memo is not None and memo[0] == clave:
+        with _lock:
+            _metricas['memo_request'] += 1
+        return memo[1]
+
+    ahora = time.monotonic()
+    with _lock:
+        en_cache = _cache.get(clave)
+        if en_cache and en_cache[0] > ahora:
+            _metricas['cache_hits'] += 1
+            conteos = en_cache[1]
+        else:
+            _metricas['cache_misses'] += 1
+            conteos = None
+
+    if conteos is None:
+        conteos = _contar(empresa_id, usuario_id)
+        with _lock:
+            if len(_cache) >= MAX_ENTRADAS:
+                for k in [k for k, (expira, _) in _cache.items() if expira <= ahora]:
+                    del _cache[k]
+            _cache[clave] = (time.monotonic() + BADGES_TTL, conteos)
+
+    g._badges_header = (clave, conteos)
+    return conteos
+
+
+def invalidar_badges(empresa_id=None, usuario_id=None):
+    """
+    Descarta los badges en caché de la empresa y/o del usuario indicados.
+    Sin argumentos descarta todo.
+    """
+    with _lock:
+        _metricas['invalidaciones'] += 1
+        if empresa_id is None and usuario_id is None:
+            _cache.clear()
+        else:
+            for clave in [c for c in _cache
+                          if (empresa_id is not None and c[0] == empresa_id)
+                          or (usuario_id is not None and c[1] == usuario_id)]:
+                del _cache[clave]
+
+    if has_app_context():
+        g.pop('_badges_header', None)
+
+
+def metricas_badges():
+    with _lock:
+        m = dict(_metricas)
+        m['entradas'] = len(_cache)
+    consultas = m['cache_hits'] + m['cache_misses']
+    m['tasa_aciertos'] = round(m['cache_hits'] / consultas, 4) if consultas else 0.0
+    m['ttl_s'] = BADGES_TTL
+    return m
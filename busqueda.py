@@ -0,0 +1,333 @@
+"""
+Búsqueda unificada por empresa (/api/search y los buscadores de las pantallas)
+Antes cada pantalla armaba su propio LIKE '%texto%' (recorrido completo de la tabla).
+Ahora:
+1. Secciones tipadas (mercancia, proveedores, usuarios, cuentas, cfdi, tickets) con
+   paginación por sección (pagina, por_pagina, hay_mas)
+2. proveedores / usuarios / cuentas / cfdi: MATCH ... AGAINST en modo booleano sobre los
+   índices FULLTEXT de migrations/006 (cada palabra como prefijo obligatorio: +pal*)
+3. Sin índice FULLTEXT (migración pendiente) o con solo palabras cortas: índice invertido
+   en memoria por empresa (busqueda_mercancias.IndiceNombres) con TTL BUSQUEDA_INDICE_TTL
+   (las rutas que escriben proveedores / usuarios / cuentas / cfdi llaman invalidar())
+4. mercancia: índice en memoria de busqueda_mercancias (ya se invalida al editar)
+5. tickets: id exacto o folio por prefijo (idx_caja_ventas_empresa_folio)
+6. Listados de las pantallas: condicion_seccion() / condicion_tickets() dan el filtro
+   para su propia consulta y ids_seccion() todos los ids; ninguno se trunca
+"""
+
+import os
+import re
+import threading
+import time
+
+import mysql.connector
+
+import busqueda_mercancias
+from busqueda_mercancias import IndiceNombres
+
+BUSQUEDA_INDICE_TTL = float(os.environ.get('BUSQUEDA_INDICE_TTL', 120))
+MIN_TOKEN_FULLTEXT = 3      # innodb_ft_min_token_size
+MAX_POR_PAGINA = 50
+
+ER_NO_SUCH_TABLE = 1146
+ER_FT_MATCHING_KEY_NOT_FOUND = 1191
+
+SECCIONES = {
+    'proveedores': {
+        'tabla': 'proveedores',
+        'columnas': ('nombre', 'ciudad', 'telefono'),
+        'campos': 'id, nombre, ciudad, telefono',
+        'filtro': 'activo = 1',
+        'orden': 'nombre',
+        'titulo': 'nombre', 'detalle': ('ciudad', 'telefono'),
+    },
+    'usuarios': {
+        'tabla': 'usuarios',
+        'columnas': ('nombre', 'correo'),
+        'campos': 'id, nombre, correo, puesto, estado_registro',
+        'filtro': 'activo = 1',
+        'orden': 'nombre',
+        'titulo': 'nombre', 'detalle': ('correo', 'puesto'),
+    },
+    'cuentas': {
+        'tabla': 'cuentas_contables',
+        'columnas': ('codigo', 'nombre'),
+        'campos': 'id, codigo, nombre, nivel, padre_id',
+        'filtro': None,
+        'orden': 'codigo',
+        'titulo': 'nombre', 'detalle': ('codigo',),
+    },
+    'cfdi': {
+        'tabla': 'cfdi_importados',
+        'columnas': ('uuid', 'rfc_emisor', 'nombre_emisor', 'rfc_receptor', 'nombre_receptor'),
+        'campos': 'id, uuid, es_emitido, rfc_emisor, nombre_emisor, rfc_receptor, nombre_receptor, fecha_emision, total',
+        'filtro': None,
+        'orden': 'fecha_emision DESC',
+        'titulo': 'nombre_emisor', 'detalle': ('rfc_emisor', 'uuid'),
+    },
+}
+TIPOS = ('mercancia', 'proveedores', 'usuarios', 'cuentas', 'cfdi', 'tickets')
+
+_indices = {}
+_sin_fulltext = {}          # seccion -> momento en que faltó el índice FULLTEXT
+_con_fulltext = set()       # secciones cuyo índice FULLTEXT ya se confirmó
+_lock = threading.Lock()
+_metricas = {'fulltext': 0, 'memoria': 0, 'construcciones': 0}
+
+
+def _fila(cur, row):
+    if row is None or isinstance(row, dict):
+        return row
+    return dict(zip(cur.column_names, row))
+
+
+def palabras(texto):
+    """Palabras como las separa el parser FULLTEXT (letras y dígitos)"""
+    return [p for p in re.split(r'[\W_]+', (texto or '').lower()) if p]
+
+
+def consulta_booleana(texto):
+    """('+pal1* +pal2*', [palabras cortas]) para MATCH ... AGAINST IN BOOLEAN MODE"""
+    largas, cortas = [], []
+    for p in palabras(texto):
+        (largas if len(p) >= MIN_TOKEN_FULLTEXT else cortas).append(p)
+    return ' '.join(f'+{p}*' for p in largas), cortas
+
+
+def _resultado(seccion, fila):
+    spec = SECCIONES[seccion]
+    r = {k: v for k, v in fila.items() if k not in ('clave', 'texto', 'relevancia')}
+    r['tipo'] = seccion
+    r['titulo'] = fila.get(spec['titulo']) or fila.get('nombre_receptor') or ''
+    r['detalle'] = ' · '.join(str(fila[c]) for c in spec['detalle'] if fila.get(c))
+    return r
+
+
+# -------------------- FULLTEXT --------------------
+
+def _condicion_fulltext(seccion, texto):
+    """(sql, params) de MATCH ... AGAINST sobre las columnas de la sección"""
+    booleana, cortas = consulta_booleana(texto)
+    columnas = ', '.join(SECCIONES[seccion]['columnas'])
+    sql = f"MATCH({columnas}) AGAINST (%s IN BOOLEAN MODE)"
+    params = [booleana]
+    # Palabras cortas: se filtran solo sobre las filas que ya encontró el FULLTEXT
+    for p in cortas:
+        sql += f" AND CONCAT_WS(' ', {columnas}) LIKE %s"
+        params.append(f'%{p}%')
+    return f"({sql})", params
+
+
+def _fulltext(cur, empresa_id, seccion, texto, limite, desplazamiento):
+    """Filas por MATCH ... AGAINST; None si la tabla no tiene el índice FULLTEXT"""
+    spec = SECCIONES[seccion]
+    booleana = consulta_booleana(texto)[0]
+    condicion, params_condicion = _condicion_fulltext(seccion, texto)
+    sql = f"""
+        SELECT {spec['campos']}, MATCH({', '.join(spec['columnas'])}) AGAINST (%s IN BOOLEAN MODE) AS relevancia
+        FROM {spec['tabla']}
+        WHERE empresa_id = %s
+          AND {condicion}
+    """
+    params = [booleana, empresa_id] + params_condicion
+    if spec['filtro']:
+        sql += f" AND {spec['filtro']}"
+    sql += f" ORDER BY relevancia DESC, {spec['orden']} LIMIT %s OFFSET %s"
+    params += [limite, desplazamiento]
+    try:
+        cur.execute(sql, params)
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) == ER_FT_MATCHING_KEY_NOT_FOUND:
+            with _lock:
+                _sin_fulltext[seccion] = time.monotonic()
+            return None
+        raise
+    return [_fila(cur, r) for r in cur.fetchall()]
+
+
+def _usar_fulltext(seccion, texto):
+    if not consulta_booleana(texto)[0]:
+        return False
+    with _lock:
+        desde = _sin_fulltext.get(seccion)
+        if desde is not None and time.monotonic() - desde < BUSQUEDA_INDICE_TTL:
+            return False
+        _sin_fulltext.pop(seccion, None)
+    return True
+
+
+def _tiene_fulltext(cur, seccion):
+    """True si la tabla de la sección ya tiene el índice FULLTEXT (migrations/006)"""
+    with _lock:
+        if seccion in _con_fulltext:
+            return True
+    cur.execute("""
+        SELECT 1 AS hay FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_TYPE = 'FULLTEXT'
+        LIMIT 1
+    """, (SECCIONES[seccion]['tabla'],))
+    hay = cur.fetchone() is not None
+    with _lock:
+        if hay:
+            _con_fulltext.add(seccion)
+        else:
+            _sin_fulltext[seccion] = time.monotonic()
+    return hay
+
+
+# -------------------- Índice en memoria --------------------
+
+def _indice(cur, empresa_id, seccion):
+    clave = (empresa_id, seccion)
+    ahora = time.monotonic()
+    with _lock:
+        indice = _indices.get(clave)
+        if indice is not None and ahora - indice.creado < BUSQUEDA_INDICE_TTL:
+            return indice
+
+    spec = SECCIONES[seccion]
+    sql = f"SELECT {spec['campos']} FROM {spec['tabla']} WHERE empresa_id = %s"
+    if spec['filtro']:
+        sql += f" AND {spec['filtro']}"
+    cur.execute(sql + " ORDER BY id", (empresa_id,))
+    filas = []
+    for r in cur.fetchall():
+        r = _fila(cur, r)
+        r['texto'] = ' '.join(str(r.get(c) or '') for c in spec['columnas'])
+        filas.append(r)
+    indice = IndiceNombres(filas, campo='texto')
+    with _lock:
+        _indices[clave] = indice
+        _metricas['construcciones'] += 1
+    return indice
+
+
+def invalidar(empresa_id=None, seccion=None):
+    """Descarta los índices en memoria (de una empresa y/o sección)"""
+    with _lock:
+        for clave in list(_indices):
+            if (empresa_id is None or clave[0] == empresa_id) and (seccion is None or clave[1] == seccion):
+                del _indices[clave]
+
+
+# -------------------- Secciones --------------------
+
+def condicion_tickets(texto):
+    """(sql, params) de folio por prefijo o id exacto, para combinarla con otros filtros"""
+    t = (texto or '').strip()
+    sql = "(folio LIKE %s"
+    params = [t.replace('%', r'\%').replace('_', r'\_') + '%']
+    if t.isdigit():
+        sql += " OR id = %s"
+        params.append(int(t))
+    return sql + ")", params
+
+
+def _tickets(cur, empresa_id, texto, limite, desplazamiento):
+    condicion, params = condicion_tickets(texto)
+    sql = f"""
+        SELECT id, folio, fecha, total, metodo_pago
+        FROM caja_ventas
+        WHERE empresa_id = %s AND {condicion}
+        ORDER BY fecha DESC LIMIT %s OFFSET %s
+    """
+    cur.execute(sql, [empresa_id] + params + [limite, desplazamiento])
+    filas = []
+    for r in cur.fetchall():
+        r = _fila(cur, r)
+        r['tipo'] = 'tickets'
+        r['titulo'] = f"Ticket {r['folio'] or r['id']}"
+        r['detalle'] = str(r['fecha'] or '')
+        filas.append(r)
+    return filas
+
+
+def _mercancia(empresa_id, texto, limite, desplazamiento):
+    filas = busqueda_mercancias.buscar(empresa_id, texto, limite=limite + desplazamiento)
+    return [dict(r, tipo='mercancia', tipo_mercancia=r['tipo'], titulo=r['nombre'], detalle=r['tipo'] or '')
+            for r in filas[desplazamiento:]]
+
+
+def _filas(cur, empresa_id, seccion, texto, limite, desplazamiento):
+    """(resultados, motor) de una sección; tabla inexistente = sin resultados"""
+    try:
+        if seccion == 'mercancia':
+            return _mercancia(empresa_id, texto, limite, desplazamiento), 'memoria'
+        if seccion == 'tickets':
+            return _tickets(cur, empresa_id, texto, limite, desplazamiento), 'indice'
+        if _usar_fulltext(seccion, texto):
+            filas = _fulltext(cur, empresa_id, seccion, texto, limite, desplazamiento)
+            if filas is not None:
+                return [_resultado(seccion, f) for f in filas], 'fulltext'
+        encontrados = _indice(cur, empresa_id, seccion).buscar(texto, limite + desplazamiento)
+        return [_resultado(seccion, f) for _rango, f in encontrados[desplazamiento:]], 'memoria'
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) != ER_NO_SUCH_TABLE:
+            raise
+        return [], None
+
+
+def buscar_seccion(cur, empresa_id, seccion, texto, pagina=1, por_pagina=10):
+    """{'resultados', 'pagina', 'por_pagina', 'hay_mas', 'motor'} de una sección"""
+    por_pagina = min(max(int(por_pagina or 10), 1), MAX_POR_PAGINA)
+    pagina = max(int(pagina or 1), 1)
+    # Una fila de más para saber si hay otra página (sin COUNT)
+    filas, motor = _filas(cur, empresa_id, seccion, texto, por_pagina + 1, (pagina - 1) * por_pagina)
+    if motor:
+        with _lock:
+            _metricas['fulltext' if motor == 'fulltext' else 'memoria'] += 1
+    return {
+        'resultados': filas[:por_pagina],
+        'pagina': pagina,
+        'por_pagina': por_pagina,
+        'hay_mas': len(filas) > por_pagina,
+        'motor': motor,
+    }
+
+
+def buscar(cur, empresa_id, texto, tipos=None, pagina=1, por_pagina=10):
+    """Secciones pedidas (todas por default) para el texto, en el orden de TIPOS"""
+    tipos = [t for t in TIPOS if t in tipos] if tipos else list(TIPOS)
+    if not (texto or '').strip():
+        return {t: {'resultados': [], 'pagina': 1, 'por_pagina': por_pagina,
+                    'hay_mas': False, 'motor': None} for t in tipos}
+    return {t: buscar_seccion(cur, empresa_id, t, texto, pagina, por_pagina) for t in tipos}
+
+
+def _ids_memoria(cur, empresa_id, seccion, texto):
+    indice = _indice(cur, empresa_id, seccion)
+    return [f['id'] for _rango, f in indice.buscar(texto, len(indice.filas))]
+
+
+def condicion_seccion(cur, empresa_id, seccion, texto):
+    """
+    (sql, params) de las filas que coinciden, para combinarla con la consulta del
+    listado de la sección (como condicion_tickets): MATCH ... AGAINST si la tabla tiene
+    el índice FULLTEXT; si no, id IN (...) con todas las coincidencias en memoria
+    """
+    if _usar_fulltext(seccion, texto) and _tiene_fulltext(cur, seccion):
+        return _condicion_fulltext(seccion, texto)
+    ids = _ids_memoria(cur, empresa_id, seccion, texto) or [0]
+    return f"id IN ({','.join(['%s'] * len(ids))})", ids
+
+
+def ids_seccion(cur, empresa_id, seccion, texto):
+    """Todos los ids que coinciden (sin tope), para listados que se filtran en memoria"""
+    if not (_usar_fulltext(seccion, texto) and _tiene_fulltext(cur, seccion)):
+        return _ids_memoria(cur, empresa_id, seccion, texto)
+    spec = SECCIONES[seccion]
+    condicion, params = _condicion_fulltext(seccion, texto)
+    sql = f"SELECT id FROM {spec['tabla']} WHERE empresa_id = %s AND {condicion}"
+    if spec['filtro']:
+        sql += f" AND {spec['filtro']}"
+    cur.execute(sql, [empresa_id] + params)
+    return [_fila(cur, r)['id'] for r in cur.fetchall()]
+
+
+def metricas_busqueda():
+    with _lock:
+        m = dict(_metricas)
+        m['indices_memoria'] = len(_indices)
+        m['sin_fulltext'] = sorted(_sin_fulltext)
+    m['ttl_s'] = BUSQUEDA_INDICE_TTL
+    return m
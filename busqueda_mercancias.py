@@ -0,0 +1,238 @@
+"""
+Índice de nombres de mercancía por empresa, en memoria del proceso
+Antes resolver_mercancia y /check_producto caían a LOWER(nombre) LIKE '%a%b%'
+(recorrido completo de mercancia) en cada renglón o tecla.
+Ahora:
+1. Una consulta por empresa arma el índice: nombres normalizados (sin acentos ni
+   mayúsculas), mapa de prefijos de cada palabra y mapa de trigramas
+2. buscar(): candidatos por prefijo / trigrama e intersección por token, con ranking
+   (exacto → empieza con → palabras por prefijo → tokens en orden → tokens en
+   cualquier orden) y desempate por nombre más corto
+3. resolver(): los mismos niveles que resolver_mercancia (id → exacto → tokens en orden);
+   la importación de compras solo toma de aquí el candidato aproximado y lo relee en MySQL
+4. invalidar_indice() se llama donde se inserta, edita o borra mercancía; el TTL
+   (INDICE_MERCANCIAS_TTL, segundos) cubre los cambios hechos por otros procesos
+"""
+
+import os
+import threading
+import time
+import unicodedata
+
+from db import conexion_db
+
+INDICE_MERCANCIAS_TTL = float(os.environ.get('INDICE_MERCANCIAS_TTL', 300))
+MAX_PREFIJO = 12
+
+_indices = {}
+_lock = threading.Lock()
+_metricas = {'construcciones': 0, 'hits': 0, 'invalidaciones': 0}
+
+
+def normalizar(texto):
+    """Minúsculas, sin acentos y con espacios simples (como compara *_general_ci)"""
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(c for c in texto if not unicodedata.combining(c)).lower()
+    return ' '.join(texto.split())
+
+
+def _trigramas(palabra):
+    return {palabra[i:i + 3] for i in range(len(palabra) - 2)}
+
+
+class IndiceNombres:
+    """
+    Filas con mapas de prefijos y trigramas sobre el texto normalizado de `campo`
+    (mercancías por nombre; busqueda.py lo usa con otros catálogos)
+    """
+
+    def __init__(self, filas, campo='nombre'):
+        self.campo = campo
+        self.filas = []
+        self.por_id = {}
+        self.exactos = {}
+        self.prefijos = {}
+        self.trigramas = {}
+        for f in filas:
+            n = len(self.filas)
+            clave = normalizar(f[campo])
+            entrada = dict(f, clave=clave)
+            self.filas.append(entrada)
+            self.por_id[f['id']] = entrada
+            self.exactos.setdefault(clave, []).append(n)
+            for palabra in set(clave.split()):
+                for i in range(1, min(len(palabra), MAX_PREFIJO) + 1):
+                    self.prefijos.setdefault(palabra[:i], set()).add(n)
+            for tri in _trigramas(clave):
+                self.trigramas.setdefault(tri, set()).add(n)
+        self.creado = time.monotonic()
+
+    def _con_subcadena(self, token):
+        """Filas cuyo nombre contiene `token` en cualquier parte"""
+        if len(token) < 3:
+            # Menos de un trigrama: recorrido en memoria (sigue siendo más barato que el LIKE)
+            return {n for n, f in enumerate(self.filas) if token in f['clave']}
+        candidatos = None
+        for tri in _trigramas(token):
+            ids = self.trigramas.get(tri, set())
+            candidatos = set(ids) if candidatos is None else candidatos & ids
+            if not candidatos:
+                return set()
+        return {n for n in candidatos if token in self.filas[n]['clave']}
+
+    def _palabras_por_prefijo(self, tokens):
+        candidatos = None
+        for t in tokens:
+            ids = self.prefijos.get(t[:MAX_PREFIJO], set())
+            if len(t) > MAX_PREFIJO:
+                ids = {n for n in ids if any(p.startswith(t) for p in self.filas[n]['clave'].split())}
+            candidatos = set(ids) if candidatos is None else candidatos & ids
+            if not candidatos:
+                return set()
+        return candidatos or set()
+
+    @staticmethod
+    def _en_orden(clave, tokens):
+        pos = 0
+        for t in tokens:
+            pos = clave.find(t, pos)
+            if pos < 0:
+                return False
+            pos += len(t)
+        return True
+
+    def buscar(self, texto, limite=10, filtro=None):
+        """[(rango, fila)] ordenados; rango 0 = exacto ... 4 = tokens en cualquier orden"""
+        q = normalizar(texto)
+        tokens = q.split()
+        if not tokens:
+            return []
+
+        rangos = {}
+
+        def anotar(ids, rango):
+            for n in ids:
+                if n not in rangos or rango < rangos[n]:
+                    rangos[n] = rango
+
+        anotar(self.exactos.get(q, []), 0)
+        por_prefijo = self._palabras_por_prefijo(tokens)
+        anotar((n for n in por_prefijo if self.filas[n]['clave'].startswith(q)), 1)
+        anotar(por_prefijo, 2)
+        if len(rangos) < limite:
+            subcadena = None
+            for t in sorted(set(tokens), key=len, reverse=True):
+                ids = self._con_subcadena(t)
+                subcadena = ids if subcadena is None else subcadena & ids
+                if not subcadena:
+                    break
+            for n in subcadena or ():
+                anotar([n], 3 if self._en_orden(self.filas[n]['clave'], tokens) else 4)
+
+        resultados = [(r, self.filas[n]) for n, r in rangos.items()
+                      if filtro is None or filtro(self.filas[n])]
+        resultados.sort(key=lambda x: (x[0], len(x[1]['clave']), x[1]['clave'], x[1]['id']))
+        return resultados[:limite]
+
+    def resolver(self, nombre, mid_s=None, filtro=None):
+        """Fila por id, nombre exacto o tokens en orden (el nombre más corto); None si no hay"""
+        return self.resolver_nivel(nombre, mid_s, filtro)[0]
+
+    def resolver_nivel(self, nombre, mid_s=None, filtro=None, aproximado=True):
+        """(fila, nivel) con nivel 'id', 'exacto' o 'aproximado'; (None, None) si no hay"""
+        if mid_s and str(mid_s).isdigit():
+            f = self.por_id.get(int(mid_s))
+            if f and (filtro is None or filtro(f)):
+                return f, 'id'
+        q = normalizar(nombre)
+        if not q:
+            return None, None
+        exactos = [self.filas[n] for n in self.exactos.get(q, [])
+                   if filtro is None or filtro(self.filas[n])]
+        if exactos:
+            return exactos[0], 'exacto'
+        if not aproximado:
+            return None, None
+        tokens = q.split()
+        candidatos = None
+        for t in sorted(set(tokens), key=len, reverse=True):
+            ids = self._con_subcadena(t)
+            candidatos = ids if candidatos is None else candidatos & ids
+            if not candidatos:
+                return None, None
+        en_orden = [self.filas[n] for n in candidatos
+                    if self._en_orden(self.filas[n]['clave'], tokens)
+                    and (filtro is None or filtro(self.filas[n]))]
+        if not en_orden:
+            return None, None
+        return min(en_orden, key=lambda f: (len(f[self.campo] or ''), f['id'])), 'aproximado'
+
+
+def _cargar(empresa_id):
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        cur.execute("""
+            SELECT id, nombre, tipo, activo, producto_base_id
+            FROM mercancia
+            WHERE empresa_id = %s
+            ORDER BY id
+        """, (empresa_id,))
+        return IndiceNombres(cur.fetchall())
+    finally:
+        cur.close()
+        conn.close()
+
+
+def indice_empresa(empresa_id):
+    """Índice vigente de la empresa (lo construye si no existe o venció)"""
+    ahora = time.monotonic()
+    with _lock:
+        indice = _indices.get(empresa_id)
+        if indice is not None and ahora - indice.creado < INDICE_MERCANCIAS_TTL:
+            _metricas['hits'] += 1
+            return indice
+
+    indice = _cargar(empresa_id)
+    with _lock:
+        _indices[empresa_id] = indice
+        _metricas['construcciones'] += 1
+    return indice
+
+
+def invalidar_indice(empresa_id=None):
+    """Descarta el índice de la empresa (empresa_id=None: todos)"""
+    with _lock:
+        _metricas['invalidaciones'] += 1
+        if empresa_id is None:
+            _indices.clear()
+        else:
+            _indices.pop(empresa_id, None)
+
+
+def buscar(empresa_id, texto, limite=10, tipo=None, solo_activos=True):
+    """Autocompletado: [{id, nombre, tipo, producto_base_id, rango}]"""
+    def filtro(f):
+        return (tipo is None or f['tipo'] == tipo) and (not solo_activos or f['activo'] == 1)
+
+    return [
+        {'id': f['id'], 'nombre': f['nombre'], 'tipo': f['tipo'],
+         'producto_base_id': f['producto_base_id'], 'rango': rango}
+        for rango, f in indice_empresa(empresa_id).buscar(texto, limite, filtro)
+    ]
+
+
+def resolver(empresa_id, nombre, mid_s=None, tipo=None):
+    """id de la mercancía por id → nombre exacto → tokens en orden, o None"""
+    f = indice_empresa(empresa_id).resolver(
+        nombre, mid_s, None if tipo is None else (lambda f: f['tipo'] == tipo))
+    return f['id'] if f else None
+
+
+def metricas_indice():
+    with _lock:
+        m = dict(_metricas)
+        m['empresas'] = len(_indices)
+        m['mercancias'] = sum(len(i.filas) for i in _indices.values())
+    m['ttl_s'] = INDICE_MERCANCIAS_TTL
+    return m
@@ -0,0 +1,423 @@
+"""
+Capas de costo PEPS (FIFO)
+Antes cada cálculo PEPS (salida_peps, valuaciones) releía TODAS las entradas
+históricas del producto en orden fecha, id y las recorría desde la más antigua;
+salida_peps además abría una conexión y hacía commit por cada capa consumida.
+
+Ahora la tabla capas_costo (migrations/003_capas_costo.sql) guarda una fila por
+entrada con sus unidades restantes; el índice sobre `abierta` deja fuera las agotadas.
+- Alimentan capas: nueva_compra, orden_cerrar (WIP), recepción B2B y
+  registrar_movimiento ('entrada') con agregar_capa()/agregar_capas()
+- Consumen capas: ventas de caja, inicio de producción y salida_peps con consumir()
+  o salida_peps(); bloquean solo las capas abiertas que tocan (SELECT ... FOR UPDATE
+  por lotes) y descuentan con un executemany
+- Nada de esto hace commit: va en la transacción del que llama
+- Si la tabla aún no existe (migración pendiente) agregar/consumir no hacen nada
+
+flask capas-peps reconstruir|verificar [--empresa N]: re-crea las capas desde
+inventario_movimientos y las compara contra el libro.
+"""
+
+from datetime import date
+from decimal import Decimal
+
+import mysql.connector
+from db import conexion_db
+from saldos_inventario import aplicar_movimiento
+
+LOTE_CAPAS = 20          # capas bloqueadas por lectura
+LOTE_ESCRITURA = 1000    # filas por executemany al reconstruir
+
+ER_NO_SUCH_TABLE = 1146
+
+TIPOS_ENTRADA = ('entrada', 'compra')
+
+
+def _fila(cur, row):
+    if row is None or isinstance(row, dict):
+        return row
+    return dict(zip(cur.column_names, row))
+
+
+def _sin_tabla(err):
+    return getattr(err, 'errno', None) == ER_NO_SUCH_TABLE
+
+
+def _d(valor):
+    return Decimal(str(valor or 0))
+
+
+# =============================================
+# ALTA DE CAPAS
+# =============================================
+
+def agregar_capas(cur, empresa_id, capas):
+    """
+    Inserta capas nuevas en un solo executemany. Cada capa es un dict con
+    tipo_inventario_id, mercancia_id, unidades, costo_unitario y opcionales
+    fecha, origen, referencia, movimiento_id.
+    """
+    filas = [
+        (empresa_id, int(c.get('tipo_inventario_id') or 1), c['mercancia_id'], c.get('movimiento_id'),
+         c.get('origen') or 'entrada', c.get('referencia'), c.get('fecha') or date.today(),
+         _d(c['unidades']), _d(c['unidades']), _d(c.get('costo_unitario')))
+        for c in capas if _d(c.get('unidades')) > 0
+    ]
+    if not filas:
+        return
+    try:
+        cur.executemany("""
+            INSERT INTO capas_costo
+                (empresa_id, tipo_inventario_id, mercancia_id, movimiento_id, origen,
+                 referencia, fecha, unidades, unidades_restantes, costo_unitario)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, filas)
+    except mysql.connector.Error as err:
+        if not _sin_tabla(err):
+            raise
+
+
+def agregar_capa(cur, empresa_id, tipo_inventario_id, mercancia_id, unidades, costo_unitario,
+                 origen='entrada', referencia=None, fecha=None, movimiento_id=None):
+    agregar_capas(cur, empresa_id, [{
+        'tipo_inventario_id': tipo_inventario_id,
+        'mercancia_id': mercancia_id,
+        'unidades': unidades,
+        'costo_unitario': costo_unitario,
+        'origen': origen,
+        'referencia': referencia,
+        'fecha': fecha,
+        'movimiento_id': movimiento_id,
+    }])
+
+
+# =============================================
+# CONSUMO PEPS
+# =============================================
+
+def _capas_abiertas(cur, empresa_id, tipo_inventario_id, mercancia_id, despues_de=None):
+    """Siguiente lote de capas abiertas en orden PEPS, bloqueadas para esta transacción"""
+    params = [empresa_id, tipo_inventario_id, mercancia_id]
+    filtro = ""
+    if despues_de is not None:
+        filtro = "AND (fecha > %s OR (fecha = %s AND id > %s))"
+        params += [despues_de[0], despues_de[0], despues_de[1]]
+    cur.execute(f"""
+        SELECT id, fecha, unidades_restantes, costo_unitario
+        FROM capas_costo
+        WHERE empresa_id = %s AND tipo_inventario_id = %s AND mercancia_id = %s
+          AND abierta = 1
+          {filtro}
+        ORDER BY fecha ASC, id ASC
+        LIMIT {LOTE_CAPAS}
+        FOR UPDATE
+    """, params)
+    return [_fila(cur, r) for r in cur.fetchall()]
+
+
+def consumir_capas(cur, empresa_id, tipo_inventario_id, mercancia_id, unidades):
+    """
+    Recorre las capas abiertas hasta cubrir `unidades` (sin escribir).
+    Regresa [(capa_id, restantes_nuevas, unidades_usadas, costo_unitario)] y lo que faltó.
+    """
+    pendiente = _d(unidades)
+    consumo = []
+    ultima = None
+    while pendiente > 0:
+        capas = _capas_abiertas(cur, empresa_id, tipo_inventario_id, mercancia_id, ultima)
+        for capa in capas:
+            restantes = _d(capa['unidades_restantes'])
+            usa = min(restantes, pendiente)
+            consumo.append((capa['id'], restantes - usa, usa, _d(capa['costo_unitario'])))
+            pendiente -= usa
+            if pendiente <= 0:
+                break
+        if len(capas) < LOTE_CAPAS:
+            break
+        ultima = (capas[-1]['fecha'], capas[-1]['id'])
+    return consumo, max(pendiente, Decimal(0))
+
+
+def _guardar_consumo(cur, consumo):
+    if consumo:
+        cur.executemany(
+            "UPDATE capas_costo SET unidades_restantes = %s WHERE id = %s",
+            [(restantes, capa_id) for capa_id, restantes, _u, _c in consumo]
+        )
+
+
+def consumir(cur, empresa_id, tipo_inventario_id, pedidos):
+    """
+    Descuenta de las capas varias mercancías a la vez: pedidos = {mercancia_id: unidades}.
+    Regresa {mercancia_id: (unidades_cubiertas, costo_total)}; vacío si no hay capas.
+    """
+    resultado = {}
+    todo = []
+    try:
+        for mercancia_id, unidades in pedidos.items():
+            consumo, _faltante = consumir_capas(cur, empresa_id, tipo_inventario_id, mercancia_id, unidades)
+            if consumo:
+                resultado[mercancia_id] = (
+                    float(sum(u for _id, _r, u, _c in consumo)),
+                    float(sum(u * c for _id, _r, u, c in consumo)),
+                )
+                todo.extend(consumo)
+    except mysql.connector.Error as err:
+        if _sin_tabla(err):
+            return {}
+        raise
+    _guardar_consumo(cur, todo)
+    return resultado
+
+
+def costo_unitario_consumo(consumido, unidades, respaldo=0.0):
+    """Costo unitario PEPS si las capas cubrieron toda la salida; si no, el de respaldo"""
+    if consumido and consumido[0] + 1e-9 >= float(unidades) and consumido[0] > 0:
+        return consumido[1] / consumido[0]
+    return respaldo
+
+
+def salida_peps(cur, empresa_id, tipo_inventario_id, mercancia_id, unidades, referencia,
+                usuario_id=None, fecha=None):
+    """
+    Salida PEPS de `unidades` en la transacción del cursor (no hace commit).
+    Un movimiento 'salida' por capa consumida, al costo de esa capa.
+    Regresa el costo total de lo que sí había en existencia.
+    """
+    fecha = fecha or date.today()
+    try:
+        consumo, _faltante = consumir_capas(cur, empresa_id, tipo_inventario_id, mercancia_id, unidades)
+    except mysql.connector.Error as err:
+        if not _sin_tabla(err):
+            raise
+        raise RuntimeError("Falta migrations/003_capas_costo.sql (tabla capas_costo)") from err
+    if not consumo:
+        return 0.0
+
+    _guardar_consumo(cur, consumo)
+    cur.executemany("""
+        INSERT INTO inventario_movimientos
+            (empresa_id, usuario_id, tipo_inventario_id, mercancia_id,
+             fecha, tipo_movimiento, unidades, precio_unitario, referencia)
+        VALUES (%s, %s, %s, %s, %s, 'salida', %s, %s, %s)
+    """, [(empresa_id, usuario_id, tipo_inventario_id, mercancia_id, fecha, u, c, referencia)
+          for _id, _r, u, c in consumo])
+
+    total_u = sum(u for _id, _r, u, _c in consumo)
+    costo_total = sum(u * c for _id, _r, u, c in consumo)
+    aplicar_movimiento(cur, empresa_id, tipo_inventario_id, mercancia_id, 'salida',
+                       total_u, costo_total / total_u if total_u else 0)
+    return float(costo_total)
+
+
+# =============================================
+# RECONSTRUCCIÓN Y VERIFICACIÓN
+# =============================================
+
+# Compras MP: costo por unidad de contenido desde detalle_compra (igual que el kardex)
+_SQL_HISTORIA = """
+    SELECT im.tipo_inventario_id, im.mercancia_id, im.id, im.tipo_movimiento,
+           im.unidades, im.fecha, im.referencia,
+           CASE WHEN im.tipo_inventario_id = 1 AND UPPER(im.tipo_movimiento) = 'COMPRA'
+                THEN COALESCE((
+                    SELECT SUM(dc.precio_total) / NULLIF(SUM(dc.contenido_neto_total), 0)
+                    FROM listado_compras lc
+                    JOIN detalle_compra dc ON dc.compra_id = lc.id
+                    WHERE lc.empresa_id = im.empresa_id
+                      AND im.referencia = CONCAT('Compra ', lc.numero_factura)
+                      AND dc.mercancia_id = im.mercancia_id
+                ), im.precio_unitario)
+                ELSE im.precio_unitario END AS costo_unitario
+    FROM inventario_movimientos im
+    WHERE im.empresa_id = %s AND im.unidades > 0
+      AND LOWER(im.tipo_movimiento) IN ('entrada','compra','salida')
+    ORDER BY im.tipo_inventario_id, im.mercancia_id, im.fecha, im.id
+"""
+
+
+def capas_desde_historia(movimientos):
+    """
+    movimientos ordenados por (tipo, mercancía, fecha, id) como dicts de _SQL_HISTORIA.
+    Genera las capas de cada entrada con sus unidades restantes, repartiendo las
+    salidas acumuladas en PEPS.
+    """
+    actual = None
+    capas = []
+    salidas = Decimal(0)
+
+    def cerrar():
+        pendiente = salidas
+        for capa in capas:
+            usa = min(capa['unidades'], pendiente)
+            pendiente -= usa
+            capa['unidades_restantes'] = capa['unidades'] - usa
+            yield capa
+
+    for m in movimientos:
+        clave = (int(m['tipo_inventario_id'] or 1), m['mercancia_id'])
+        if clave != actual:
+            if actual is not None:
+                yield from cerrar()
+            actual, capas, salidas = clave, [], Decimal(0)
+        u = _d(m['unidades'])
+        tipo = (m['tipo_movimiento'] or '').strip().lower()
+        if tipo in TIPOS_ENTRADA:
+            capas.append({
+                'tipo_inventario_id': clave[0],
+                'mercancia_id': clave[1],
+                'movimiento_id': m['id'],
+                'origen': 'compra' if tipo == 'compra' else 'entrada',
+                'referencia': m['referencia'],
+                'fecha': m['fecha'],
+                'unidades': u,
+                'costo_unitario': _d(m['costo_unitario']),
+            })
+        elif tipo == 'salida':
+            salidas += u
+
+    if actual is not None:
+        yield from cerrar()
+
+
+def reconstruir_capas(empresa_id):
+    """
+    Re-crea (una transacción) las capas que vienen de inventario_movimientos.
+    Las capas de recepciones B2B (sin movimiento_id) se conservan tal cual.
+    """
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        cur.execute("DELETE FROM capas_costo WHERE empresa_id = %s AND movimiento_id IS NOT NULL",
+                    (empresa_id,))
+        cur.execute(_SQL_HISTORIA, (empresa_id,))
+        movimientos = cur.fetchall()
+
+        n = 0
+        lote = []
+        for capa in capas_desde_historia(movimientos):
+            lote.append((empresa_id, capa['tipo_inventario_id'], capa['mercancia_id'], capa['movimiento_id'],
+                         capa['origen'], capa['referencia'], capa['fecha'], capa['unidades'],
+                         capa['unidades_restantes'], capa['costo_unitario']))
+            if len(lote) >= LOTE_ESCRITURA:
+                n += _insertar_lote(cur, lote)
+                lote = []
+        if lote:
+            n += _insertar_lote(cur, lote)
+        conn.commit()
+        return n
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _insertar_lote(cur, lote):
+    cur.executemany("""
+        INSERT INTO capas_costo
+            (empresa_id, tipo_inventario_id, mercancia_id, movimiento_id, origen,
+             referencia, fecha, unidades, unidades_restantes, costo_unitario)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, lote)
+    return len(lote)
+
+
+def verificar_capas(empresa_id, tolerancia=0.0001):
+    """
+    Compara por (tipo, mercancía) las capas contra inventario_movimientos:
+    - entradas del libro = unidades de las capas con movimiento
+    - salidas del libro  = unidades consumidas de las capas (hasta lo que hubo)
+    Regresa la lista de diferencias.
+    """
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        cur.execute("""
+            SELECT tipo_inventario_id, mercancia_id,
+                   SUM(CASE WHEN LOWER(tipo_movimiento) IN ('entrada','compra') THEN unidades ELSE 0 END) AS entradas,
+                   SUM(CASE WHEN LOWER(tipo_movimiento) = 'salida' THEN unidades ELSE 0 END) AS salidas
+            FROM inventario_movimientos
+            WHERE empresa_id = %s AND unidades > 0
+            GROUP BY tipo_inventario_id, mercancia_id
+        """, (empresa_id,))
+        libro = {(int(r['tipo_inventario_id'] or 1), r['mercancia_id']): r for r in cur.fetchall()}
+
+        cur.execute("""
+            SELECT tipo_inventario_id, mercancia_id,
+                   SUM(CASE WHEN movimiento_id IS NOT NULL THEN unidades ELSE 0 END) AS entradas,
+                   SUM(unidades) AS capas_total,
+                   SUM(unidades - unidades_restantes) AS consumido
+            FROM capas_costo
+            WHERE empresa_id = %s
+            GROUP BY tipo_inventario_id, mercancia_id
+        """, (empresa_id,))
+        capas = {(int(r['tipo_inventario_id']), r['mercancia_id']): r for r in cur.fetchall()}
+    finally:
+        cur.close()
+        conn.close()
+
+    diferencias = []
+    for clave in sorted(set(libro) | set(capas), key=lambda k: (k[0], k[1] or 0)):
+        l = libro.get(clave) or {}
+        c = capas.get(clave) or {}
+        entradas_libro = float(l.get('entradas') or 0)
+        entradas_capas = float(c.get('entradas') or 0)
+        salidas_esperadas = min(float(l.get('salidas') or 0), float(c.get('capas_total') or 0))
+        consumido = float(c.get('consumido') or 0)
+        if abs(entradas_libro - entradas_capas) > tolerancia or abs(salidas_esperadas - consumido) > tolerancia:
+            diferencias.append({
+                'tipo_inventario_id': clave[0],
+                'mercancia_id': clave[1],
+                'entradas_libro': entradas_libro,
+                'entradas_capas': entradas_capas,
+                'salidas_libro': float(l.get('salidas') or 0),
+                'consumido_capas': consumido,
+            })
+    return diferencias
+
+
+def _empresas_con_movimientos():
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT DISTINCT empresa_id FROM inventario_movimientos WHERE empresa_id IS NOT NULL")
+        return [r[0] for r in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def init_app(app):
+    """Registra los comandos: flask capas-peps reconstruir|verificar [--empresa N]"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('capas-peps', help='Capas de costo PEPS')
+
+    @grupo.command('reconstruir')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def reconstruir_cmd(empresa):
+        for eid in ([empresa] if empresa else _empresas_con_movimientos()):
+            n = reconstruir_capas(eid)
+            click.echo(f"✅ Empresa {eid}: {n} capas reconstruidas")
+
+    @grupo.command('verificar')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def verificar_cmd(empresa):
+        total = 0
+        for eid in ([empresa] if empresa else _empresas_con_movimientos()):
+            diferencias = verificar_capas(eid)
+            total += len(diferencias)
+            for d in diferencias:
+                click.echo(
+                    f"❌ Empresa {eid} tipo {d['tipo_inventario_id']} mercancía {d['mercancia_id']}: "
+                    f"entradas libro {d['entradas_libro']:.4f} / capas {d['entradas_capas']:.4f} — "
+                    f"salidas libro {d['salidas_libro']:.4f} / consumido {d['consumido_capas']:.4f}"
+                )
+            if not diferencias:
+                click.echo(f"✅ Empresa {eid}: capas consistentes")
+        if total:
+            raise SystemExit(1)
+
+    app.cli.add_command(grupo)
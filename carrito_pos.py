@@ -0,0 +1,329 @@
+"""
+Carrito del POS (/caja) guardado en el servidor
+Antes el carrito, las ventas en espera (caja_holds), la selección de artículos
+(pos_sel) y el switch de IVA vivían en la cookie firmada de Flask: se
+re-serializaban y viajaban en cada /caja/agregar, /caja/eliminar y /caja/hold,
+y con carritos grandes se rebasaba el límite de tamaño de la cookie.
+
+Ahora la cookie solo lleva session['pos_id'] (empresa:usuario:turno) y el estado
+vive en un almacén intercambiable (POS_CART_BACKEND):
+- 'sql':     tabla pos_carritos (migrations/002_pos_carritos.sql), compartida entre
+             workers (default)
+- 'memoria': LRU en el proceso (POS_CART_MAX carritos); solo con un worker, init_app
+             la rechaza si WEB_CONCURRENCY indica varios
+Los carritos sin actividad por POS_CART_TTL segundos expiran solos.
+
+Uso en las vistas:
+    carrito = carrito_actual()
+    carrito.agregar(item) / carrito.eliminar(linea_id) / carrito.poner_en_espera(total)
+Los cambios se guardan al final de la petición (after_request), como session.modified,
+salvo si la respuesta es un error (4xx/5xx): el carrito queda como estaba.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, session
+from db import conexion_db, conexion_aparte
+
+POS_CART_BACKEND = os.environ.get('POS_CART_BACKEND', 'sql')
+POS_CART_TTL = int(os.environ.get('POS_CART_TTL', 8 * 3600))   # un turno
+POS_CART_MAX = int(os.environ.get('POS_CART_MAX', 1000))
+
+
+class CarritoPOS:
+    """
+    Estado del POS de un usuario en un turno.
+    Renglones y ventas en espera se indexan por id (dict con orden de inserción),
+    así agregar, eliminar y reanudar son O(1).
+    """
+
+    def __init__(self, datos=None):
+        datos = datos or {}
+        self.seq = int(datos.get('seq', 0))
+        self.hold_seq = int(datos.get('hold_seq', 0))
+        self.lineas = dict(datos.get('lineas') or {})
+        self.holds = dict(datos.get('holds') or {})
+        self.pos_sel = list(datos.get('pos_sel') or [])
+        self.aplica_iva = bool(datos.get('aplica_iva', True))
+        self.modificado = False
+
+    def a_dict(self):
+        return {
+            'seq': self.seq,
+            'hold_seq': self.hold_seq,
+            'lineas': self.lineas,
+            'holds': self.holds,
+            'pos_sel': self.pos_sel,
+            'aplica_iva': self.aplica_iva,
+        }
+
+    # ----- renglones -----
+
+    @property
+    def items(self):
+        """Renglones en orden de captura (lo que antes era session['carrito'])"""
+        return list(self.lineas.values())
+
+    def agregar(self, item):
+        self.seq += 1
+        linea = str(self.seq)
+        self.lineas[linea] = dict(item, linea=self.seq)
+        self.modificado = True
+        return self.seq
+
+    def eliminar(self, linea_id):
+        if self.lineas.pop(str(linea_id), None) is None:
+            return False
+        self.modificado = True
+        return True
+
+    def actualizar_cantidad(self, linea_id, cant):
+        linea = self.lineas.get(str(linea_id))
+        if linea is None:
+            return False
+        linea['cant'] = str(cant)
+        self.modificado = True
+        return True
+
+    def vaciar(self):
+        if self.lineas:
+            self.lineas = {}
+            self.modificado = True
+
+    # ----- ventas en espera -----
+
+    def lista_holds(self):
+        return list(self.holds.values())
+
+    def poner_en_espera(self, total):
+        self.hold_seq += 1
+        self.holds[str(self.hold_seq)] = {
+            'id': self.hold_seq,
+            'items': self.items,
+            'total': str(total),
+        }
+        self.lineas = {}
+        self.modificado = True
+        return self.hold_seq
+
+    def reanudar(self, hold_id):
+        hold = self.holds.pop(str(hold_id), None)
+        if hold is None:
+            return False
+        self.lineas = {}
+        for item in hold['items']:
+            self.agregar(item)
+        self.modificado = True
+        return True
+
+    # ----- configuración -----
+
+    def set_pos_sel(self, sel):
+        self.pos_sel = list(sel)
+        self.modificado = True
+
+    def toggle_iva(self):
+        self.aplica_iva = not self.aplica_iva
+        self.modificado = True
+
+
+# =============================================
+# ALMACENES
+# =============================================
+
+class AlmacenMemoria:
+    """LRU en el proceso con expiración por inactividad"""
+
+    def __init__(self, capacidad=POS_CART_MAX, ttl=POS_CART_TTL):
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            if entrada[0] + self.ttl < time.monotonic():
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return json.loads(entrada[1])
+
+    def guardar(self, clave, datos):
+        serializado = json.dumps(datos, default=str)
+        with self._lock:
+            self._datos[clave] = (time.monotonic(), serializado)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.capacidad:
+                self._datos.popitem(last=False)
+
+    def borrar(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def purgar(self):
+        limite = time.monotonic() - self.ttl
+        with self._lock:
+            viejas = [k for k, (t, _) in self._datos.items() if t < limite]
+            for k in viejas:
+                del self._datos[k]
+        return len(viejas)
+
+
+class AlmacenSQL:
+    """
+    Tabla pos_carritos (clave, datos JSON, actualizado).
+    Las escrituras van por una conexión aparte: su commit no confirma (ni deshace)
+    la transacción de la vista que modificó el carrito.
+    """
+
+    PURGAR_CADA = 200   # escrituras entre purgas de carritos abandonados
+
+    def __init__(self, ttl=POS_CART_TTL):
+        self.ttl = ttl
+        self._escrituras = 0
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        conn = conexion_db()
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                SELECT datos FROM pos_carritos
+                WHERE clave = %s
+                  AND actualizado >= NOW() - INTERVAL %s SECOND
+            """, (clave, self.ttl))
+            row = cur.fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            cur.close()
+            conn.close()
+
+    def guardar(self, clave, datos):
+        conn = conexion_aparte()
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                INSERT INTO pos_carritos (clave, datos, actualizado)
+                VALUES (%s, %s, NOW())
+                ON DUPLICATE KEY UPDATE datos = VALUES(datos), actualizado = NOW()
+            """, (clave, json.dumps(datos, default=str)))
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+        with self._lock:
+            self._escrituras += 1
+            toca_purgar = self._escrituras % self.PURGAR_CADA == 0
+        if toca_purgar:
+            self.purgar()
+
+    def borrar(self, clave):
+        conn = conexion_aparte()
+        cur = conn.cursor()
+        try:
+            cur.execute("DELETE FROM pos_carritos WHERE clave = %s", (clave,))
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+    def purgar(self):
+        conn = conexion_aparte()
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                DELETE FROM pos_carritos
+                WHERE actualizado < NOW() - INTERVAL %s SECOND
+            """, (self.ttl,))
+            conn.commit()
+            return cur.rowcount
+        finally:
+            cur.close()
+            conn.close()
+
+
+ALMACENES = {
+    'memoria': AlmacenMemoria,
+    'sql': AlmacenSQL,
+}
+
+_almacen = None
+
+
+def obtener_almacen():
+    global _almacen
+    if _almacen is None:
+        _almacen = ALMACENES[POS_CART_BACKEND]()
+    return _almacen
+
+
+# =============================================
+# CARRITO DE LA PETICIÓN
+# =============================================
+
+def clave_carrito(empresa_id, usuario_id, turno_id=None):
+    """
+    Clave empresa:usuario:turno; la cookie solo guarda esto.
+    Regresa (clave, clave_anterior) para heredar la configuración al cambiar de turno.
+    """
+    prefijo = f"{empresa_id}:{usuario_id}:"
+    anterior = str(session.get('pos_id', ''))
+    if turno_id is not None:
+        session['pos_id'] = f"{prefijo}{turno_id}"
+    elif not anterior.startswith(prefijo):
+        session['pos_id'] = f"{prefijo}{session.get('turno_actual') or 0}"
+    clave = session['pos_id']
+    return clave, (anterior if anterior.startswith(prefijo) and anterior != clave else None)
+
+
+def carrito_actual(turno_id=None):
+    """Carrito del usuario/turno actual (se carga una vez por petición)"""
+    clave, anterior = clave_carrito(g.empresa_id, g.usuario_id, turno_id)
+    actual = g.get('_carrito_pos')
+    if actual is not None and actual[0] == clave:
+        return actual[1]
+
+    almacen = obtener_almacen()
+    datos = almacen.obtener(clave)
+    if datos is None and anterior:
+        # Turno nuevo: conserva la selección de artículos y el IVA, no los renglones
+        previo = almacen.obtener(anterior) or {}
+        datos = {k: previo[k] for k in ('pos_sel', 'aplica_iva') if k in previo}
+    carrito = CarritoPOS(datos)
+    g._carrito_pos = (clave, carrito)
+    return carrito
+
+
+def _guardar_carrito(response):
+    if response.status_code >= 400:
+        return response
+    actual = g.get('_carrito_pos')
+    if actual is not None and actual[1].modificado:
+        obtener_almacen().guardar(actual[0], actual[1].a_dict())
+        actual[1].modificado = False
+    return response
+
+
+def _workers():
+    try:
+        return int(os.environ.get('WEB_CONCURRENCY', 1))
+    except ValueError:
+        return 1
+
+
+def init_app(app):
+    """Guarda el carrito modificado al terminar cada petición"""
+    if POS_CART_BACKEND not in ALMACENES:
+        raise RuntimeError(f"POS_CART_BACKEND desconocido: {POS_CART_BACKEND!r} (usa 'sql' o 'memoria')")
+    if POS_CART_BACKEND == 'memoria' and _workers() > 1:
+        raise RuntimeError("POS_CART_BACKEND='memoria' no se comparte entre workers "
+                           f"(WEB_CONCURRENCY={_workers()}); usa 'sql'")
+    app.after_request(_guardar_carrito)
@@ -0,0 +1,497 @@
+"""
+Cierres periódicos de inventario (checkpoints de saldo por producto base)
+Tabla inventario_cierres: una fila por (empresa, tipo_inventario, producto base, periodo)
+con unidades, valor, costo promedio, entradas y salidas acumuladas al cierre y cuántos
+movimientos resume. inventario_cierres_control: un renglón por periodo cerrado con los
+ids más altos de inventario_movimientos / detalle_compra al momento de cerrar.
+
+- cerrar_periodos(): job idempotente (flask cierres-inventario cerrar). Parte del último
+  cierre y solo recorre los movimientos posteriores; --desde borra y recalcula los
+  periodos a partir de esa fecha (ediciones o bajas de movimientos viejos).
+- cierre_vigente(): último cierre confiable. Si después de cerrar se capturó un movimiento
+  con fecha anterior al corte, se descarta hasta volver a correr el job.
+- invalidar_cierres(): lo llaman las rutas que editan o borran movimientos ya cerrados.
+- Las vistas arrancan del cierre (saldo al cierre + movimientos posteriores) y reportan
+  cuántos movimientos dejaron de recorrer.
+
+Criterio: el de costeo_promedio (promedio ponderado por producto base, MP con compras de
+detalle_compra) sin inventario_inicial, que cada pantalla suma por su cuenta.
+Duración del periodo: INVENTARIO_CIERRE_MESES (1 = mensual, 3 = trimestral, ...).
+"""
+
+import os
+from datetime import date, datetime, timedelta
+
+import mysql.connector
+from db import conexion_db
+from costeo_promedio import (_movimientos_ordenados, aplicar, estado_inicial,
+                             llenar_inventario, promedio_ponderado, costear_productos_base)
+
+INVENTARIO_CIERRE_MESES = max(1, int(os.environ.get('INVENTARIO_CIERRE_MESES', 1)))
+
+TIPOS_CIERRE = (1, 2)  # MP, WIP
+TIPO_POR_MERCANCIA = {'MP': 1, 'WIP': 2}
+
+ER_NO_SUCH_TABLE = 1146
+
+
+def _fila(cur, row):
+    """Normaliza la fila a dict sin importar si el cursor es dictionary o tupla"""
+    if row is None or isinstance(row, dict):
+        return row
+    return dict(zip(cur.column_names, row))
+
+
+def _como_fecha(valor):
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, str):
+        return date.fromisoformat(valor[:10])
+    return valor
+
+
+# -------------------- Periodos --------------------
+
+def _inicio_periodo(fecha, meses):
+    indice = (fecha.year * 12 + fecha.month - 1) // meses * meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def fin_periodo(fecha, meses=None):
+    """Último día del periodo que contiene `fecha` (periodos alineados a enero)"""
+    meses = meses or INVENTARIO_CIERRE_MESES
+    inicio = _inicio_periodo(_como_fecha(fecha), meses)
+    indice = inicio.year * 12 + inicio.month - 1 + meses
+    return date(indice // 12, indice % 12 + 1, 1) - timedelta(days=1)
+
+
+def ultimo_periodo_completo(hoy=None, meses=None):
+    """Fin del último periodo que ya terminó"""
+    meses = meses or INVENTARIO_CIERRE_MESES
+    return _inicio_periodo(_como_fecha(hoy or date.today()), meses) - timedelta(days=1)
+
+
+def periodos_entre(primero, ultimo, meses=None):
+    """Fines de periodo desde el que contiene `primero` hasta `ultimo` (inclusive)"""
+    periodos = []
+    periodo = fin_periodo(primero, meses)
+    while periodo <= ultimo:
+        periodos.append(periodo)
+        periodo = fin_periodo(periodo + timedelta(days=1), meses)
+    return periodos
+
+
+# -------------------- Lectura --------------------
+
+def _fecha_atrasada(cur, empresa_id, control):
+    """Fecha más antigua capturada después del cierre con fecha anterior al corte (o None)"""
+    corte = control['periodo'] + timedelta(days=1)
+    cur.execute("""
+        SELECT MIN(fecha) AS fecha FROM inventario_movimientos
+        WHERE empresa_id = %s AND id > %s AND fecha < %s
+    """, (empresa_id, control['max_im_id'], corte))
+    fechas = [_fila(cur, cur.fetchone())['fecha']]
+    cur.execute("""
+        SELECT MIN(lc.fecha) AS fecha
+        FROM detalle_compra dc
+        JOIN listado_compras lc ON lc.id = dc.compra_id
+        WHERE dc.empresa_id = %s AND dc.id > %s AND lc.fecha < %s
+    """, (empresa_id, control['max_dc_id'], corte))
+    fechas.append(_fila(cur, cur.fetchone())['fecha'])
+    fechas = [_como_fecha(f) for f in fechas if f is not None]
+    return min(fechas) if fechas else None
+
+
+def _ultimo_control(cur, empresa_id):
+    try:
+        cur.execute("""
+            SELECT periodo, max_dc_id, max_im_id, movimientos
+            FROM inventario_cierres_control
+            WHERE empresa_id = %s
+            ORDER BY periodo DESC
+            LIMIT 1
+        """, (empresa_id,))
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) == ER_NO_SUCH_TABLE:
+            return None
+        raise
+    control = _fila(cur, cur.fetchone())
+    if control:
+        control['periodo'] = _como_fecha(control['periodo'])
+    return control
+
+
+def cierre_vigente(cur, empresa_id):
+    """
+    Último cierre de la empresa: {'periodo', 'corte', 'movimientos'} o None si no hay
+    o si quedó desfasado por una captura con fecha atrasada.
+    """
+    control = _ultimo_control(cur, empresa_id)
+    if control is None or _fecha_atrasada(cur, empresa_id, control) is not None:
+        return None
+    return {
+        'periodo': control['periodo'],
+        'corte': control['periodo'] + timedelta(days=1),
+        'movimientos': int(control['movimientos'] or 0),
+    }
+
+
+def leer_cierre(cur, empresa_id, tipo_inventario_id, periodo, producto_base_ids=None):
+    """{producto_base_id: {unidades, valor, costo_promedio, entradas, salidas, movimientos}}"""
+    params = [empresa_id, tipo_inventario_id, periodo]
+    filtro = ""
+    if producto_base_ids is not None:
+        ids = [int(x) for x in producto_base_ids]
+        if not ids:
+            return {}
+        filtro = f"AND producto_base_id IN ({','.join(['%s'] * len(ids))})"
+        params += ids
+
+    cur.execute(f"""
+        SELECT producto_base_id, unidades, valor, costo_promedio, entradas, salidas, movimientos
+        FROM inventario_cierres
+        WHERE empresa_id = %s AND tipo_inventario_id = %s AND periodo = %s
+          {filtro}
+    """, params)
+    estados = {}
+    for row in cur.fetchall():
+        r = _fila(cur, row)
+        estados[r['producto_base_id']] = {
+            'unidades': float(r['unidades'] or 0),
+            'valor': float(r['valor'] or 0),
+            'costo_promedio': float(r['costo_promedio'] or 0),
+            'entradas': float(r['entradas'] or 0),
+            'salidas': float(r['salidas'] or 0),
+            'movimientos': int(r['movimientos'] or 0),
+        }
+    return estados
+
+
+def cierre_producto_base(cur, empresa_id, tipo_inventario_id, producto_base_id):
+    """(cierre, estado) del producto base en el último cierre vigente, o (None, None)"""
+    cierre = cierre_vigente(cur, empresa_id)
+    if cierre is None:
+        return None, None
+    estado = leer_cierre(cur, empresa_id, tipo_inventario_id, cierre['periodo'],
+                         [producto_base_id]).get(producto_base_id)
+    if estado is None:
+        # Sin historia antes del corte: la vista completa cuesta lo mismo
+        return None, None
+    return cierre, estado
+
+
+def costo_promedio_cierre(cur, mercancia_id):
+    """Costo promedio del producto base de la mercancía en el último cierre vigente (o None)"""
+    cur.execute("SELECT empresa_id, producto_base_id, tipo FROM mercancia WHERE id = %s",
+                (mercancia_id,))
+    m = _fila(cur, cur.fetchone())
+    tipo_id = TIPO_POR_MERCANCIA.get((m or {}).get('tipo'))
+    if not m or not tipo_id or not m['producto_base_id']:
+        return None
+    cierre, estado = cierre_producto_base(cur, m['empresa_id'], tipo_id, m['producto_base_id'])
+    return estado['costo_promedio'] if estado else None
+
+
+def costear_desde_cierre(inventario, conn, empresa_id, tipo_inventario_id):
+    """
+    Igual que costeo_promedio.costear_productos_base() pero partiendo del último cierre:
+    solo lee los movimientos posteriores al corte. Los productos con inventario_inicial
+    distinto de cero se recorren completos (el inicial cambia el promedio desde el origen).
+    Regresa {'periodo', 'omitidos'} o None si no hay cierre vigente.
+    """
+    cur = conn.cursor(dictionary=True)
+    try:
+        cierre = cierre_vigente(cur, empresa_id)
+        estados = leer_cierre(cur, empresa_id, tipo_inventario_id, cierre['periodo']) if cierre else {}
+    finally:
+        cur.close()
+
+    if cierre is None:
+        costear_productos_base(inventario, conn, empresa_id, tipo_inventario_id)
+        return None
+
+    iniciales = {item['producto_base_id']: item['inventario_inicial'] for item in inventario}
+    con_inicial = [pb for pb, ini in iniciales.items() if float(ini or 0) != 0]
+    estados = {pb: e for pb, e in estados.items() if pb in iniciales and pb not in con_inicial}
+
+    costeo = promedio_ponderado(
+        _movimientos_ordenados(conn, empresa_id, tipo_inventario_id, desde=cierre['corte']),
+        {}, estados
+    )
+    costeo = {pb: r for pb, r in costeo.items() if pb not in con_inicial}
+    costeo.update(promedio_ponderado(
+        _movimientos_ordenados(conn, empresa_id, tipo_inventario_id, producto_base_ids=con_inicial),
+        iniciales
+    ))
+    llenar_inventario(inventario, costeo)
+    return {'periodo': cierre['periodo'],
+            'omitidos': sum(e['movimientos'] for e in estados.values())}
+
+
+# -------------------- Escritura --------------------
+
+def invalidar_cierres(cur, empresa_id, desde_fecha=None):
+    """
+    Borra los cierres que incluyen `desde_fecha` o posteriores (todos si es None).
+    Va en la misma transacción que la edición; el siguiente job los recalcula.
+    """
+    condicion, params = "", [empresa_id]
+    if desde_fecha is not None:
+        condicion = "AND periodo >= %s"
+        params.append(_como_fecha(desde_fecha))
+    try:
+        cur.execute(f"DELETE FROM inventario_cierres_control WHERE empresa_id = %s {condicion}", params)
+        cur.execute(f"DELETE FROM inventario_cierres WHERE empresa_id = %s {condicion}", params)
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) != ER_NO_SUCH_TABLE:
+            raise
+
+
+def _primera_fecha(cur, empresa_id):
+    cur.execute("""
+        SELECT MIN(fecha) AS fecha FROM inventario_movimientos WHERE empresa_id = %s
+        UNION ALL
+        SELECT MIN(lc.fecha) FROM detalle_compra dc
+        JOIN listado_compras lc ON lc.id = dc.compra_id
+        WHERE dc.empresa_id = %s
+    """, (empresa_id, empresa_id))
+    fechas = [_como_fecha(_fila(cur, r)['fecha']) for r in cur.fetchall()]
+    fechas = [f for f in fechas if f is not None]
+    return min(fechas) if fechas else None
+
+
+def _ids_maximos(cur, empresa_id):
+    cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM inventario_movimientos WHERE empresa_id = %s",
+                (empresa_id,))
+    max_im = _fila(cur, cur.fetchone())['id']
+    cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM detalle_compra WHERE empresa_id = %s",
+                (empresa_id,))
+    max_dc = _fila(cur, cur.fetchone())['id']
+    return int(max_dc), int(max_im)
+
+
+def calcular_cierres(movimientos, estados, periodos):
+    """
+    Recorre movimientos ordenados por producto base (a partir del cierre anterior) y regresa
+    {(producto_base_id, periodo): estado} para cada periodo en que el producto ya tiene historia.
+    """
+    cortes = [p + timedelta(days=1) for p in periodos]
+    estados = dict(estados)
+    cierres = {}
+    actual = estado = None
+    i = previos = 0
+
+    def emitir(hasta):
+        nonlocal i, previos
+        while i < hasta:
+            if estado['movimientos']:
+                cierres[(actual, periodos[i])] = dict(
+                    estado, movimientos_periodo=estado['movimientos'] - previos)
+            previos = estado['movimientos']
+            i += 1
+
+    for producto_base_id, fecha, tipo, unidades, precio in movimientos:
+        if producto_base_id != actual:
+            if actual is not None:
+                emitir(len(periodos))
+            actual = producto_base_id
+            estado = estado_inicial(estado=estados.pop(actual, None))
+            i, previos = 0, estado['movimientos']
+        fecha = _como_fecha(fecha)
+        while i < len(periodos) and fecha >= cortes[i]:
+            emitir(i + 1)
+        aplicar(estado, tipo, unidades, precio)
+
+    if actual is not None:
+        emitir(len(periodos))
+
+    # Productos con cierre anterior y sin movimientos en los periodos nuevos
+    for actual, previo in estados.items():
+        estado = estado_inicial(estado=previo)
+        i, previos = 0, estado['movimientos']
+        emitir(len(periodos))
+    return cierres
+
+
+def cerrar_periodos(empresa_id, hasta=None, desde=None):
+    """
+    Cierra los periodos completos pendientes hasta `hasta` (default: el último que ya terminó).
+    desde: recalcula a partir del periodo que contiene esa fecha.
+    Idempotente: volver a correrlo sin cambios no altera nada.
+    Regresa [(periodo, productos, movimientos_del_periodo)].
+    """
+    ultimo = ultimo_periodo_completo()
+    hasta = min(fin_periodo(hasta), ultimo) if hasta else ultimo
+
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        if desde:
+            invalidar_cierres(cur, empresa_id, fin_periodo(desde))
+
+        # Un cierre desfasado por capturas atrasadas se recalcula desde esa fecha
+        control = _ultimo_control(cur, empresa_id)
+        while control is not None:
+            atrasada = _fecha_atrasada(cur, empresa_id, control)
+            if atrasada is None:
+                break
+            invalidar_cierres(cur, empresa_id, atrasada)
+            control = _ultimo_control(cur, empresa_id)
+
+        if control is not None:
+            primero = control['periodo'] + timedelta(days=1)
+        else:
+            primero = _primera_fecha(cur, empresa_id)
+        periodos = periodos_entre(primero, hasta) if primero else []
+        if not periodos:
+            conn.commit()
+            return []
+
+        max_dc, max_im = _ids_maximos(cur, empresa_id)
+        desde_corte = control['periodo'] + timedelta(days=1) if control else None
+        previos = {tipo: (leer_cierre(cur, empresa_id, tipo, control['periodo']) if control else {})
+                   for tipo in TIPOS_CIERRE}
+
+        filas = []
+        for tipo in TIPOS_CIERRE:
+            movimientos = _movimientos_ordenados(conn, empresa_id, tipo, desde=desde_corte,
+                                                 hasta=periodos[-1] + timedelta(days=1))
+            for (producto_base_id, periodo), e in calcular_cierres(movimientos, previos[tipo], periodos).items():
+                filas.append((empresa_id, tipo, producto_base_id, periodo,
+                              round(e['saldo_u'], 6), round(e['saldo_mx'], 6), round(e['pu'], 8),
+                              round(e['entradas'], 6), round(e['salidas'], 6),
+                              e['movimientos'], e['movimientos_periodo']))
+
+        if filas:
+            cur.executemany("""
+                INSERT INTO inventario_cierres
+                    (empresa_id, tipo_inventario_id, producto_base_id, periodo, unidades, valor,
+                     costo_promedio, entradas, salidas, movimientos, movimientos_periodo, generado)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
+                ON DUPLICATE KEY UPDATE
+                    unidades = VALUES(unidades), valor = VALUES(valor),
+                    costo_promedio = VALUES(costo_promedio),
+                    entradas = VALUES(entradas), salidas = VALUES(salidas),
+                    movimientos = VALUES(movimientos),
+                    movimientos_periodo = VALUES(movimientos_periodo),
+                    generado = NOW()
+            """, filas)
+
+        resumen = []
+        for periodo in periodos:
+            del_periodo = [f for f in filas if f[3] == periodo]
+            resumen.append((periodo, len(del_periodo), sum(f[10] for f in del_periodo),
+                            sum(f[9] for f in del_periodo)))
+        cur.executemany("""
+            INSERT INTO inventario_cierres_control
+                (empresa_id, periodo, max_dc_id, max_im_id, productos, movimientos, generado)
+            VALUES (%s, %s, %s, %s, %s, %s, NOW())
+            ON DUPLICATE KEY UPDATE
+                max_dc_id = VALUES(max_dc_id), max_im_id = VALUES(max_im_id),
+                productos = VALUES(productos), movimientos = VALUES(movimientos),
+                generado = NOW()
+        """, [(empresa_id, p, max_dc, max_im, n, total) for p, n, _, total in resumen])
+
+        conn.commit()
+        return [(p, n, movs) for p, n, movs, _ in resumen]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def verificar_cierre(empresa_id, tolerancia=0.01):
+    """Compara el último cierre contra el costeo de toda la historia hasta el corte"""
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        cierre = cierre_vigente(cur, empresa_id)
+        if cierre is None:
+            return None, []
+        guardado = {tipo: leer_cierre(cur, empresa_id, tipo, cierre['periodo']) for tipo in TIPOS_CIERRE}
+    finally:
+        cur.close()
+
+    diferencias = []
+    try:
+        for tipo in TIPOS_CIERRE:
+            esperado = promedio_ponderado(
+                _movimientos_ordenados(conn, empresa_id, tipo, hasta=cierre['corte']), {}
+            )
+            for pb in set(esperado) | set(guardado[tipo]):
+                e = esperado.get(pb, {})
+                a = guardado[tipo].get(pb, {})
+                eu, ev = float(e.get('disponible') or 0), float(e.get('valor_inventario') or 0)
+                au, av = float(a.get('unidades') or 0), float(a.get('valor') or 0)
+                if abs(eu - au) > tolerancia or abs(ev - av) > tolerancia:
+                    diferencias.append({
+                        'tipo_inventario_id': tipo, 'producto_base_id': pb,
+                        'unidades_cierre': au, 'unidades_historia': eu,
+                        'valor_cierre': av, 'valor_historia': ev,
+                    })
+    finally:
+        conn.close()
+    return cierre, sorted(diferencias, key=lambda x: (x['tipo_inventario_id'], x['producto_base_id']))
+
+
+def _empresas_con_movimientos():
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT DISTINCT empresa_id FROM inventario_movimientos WHERE empresa_id IS NOT NULL
+            UNION
+            SELECT DISTINCT empresa_id FROM detalle_compra WHERE empresa_id IS NOT NULL
+        """)
+        return [r[0] for r in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def init_app(app):
+    """Registra los comandos: flask cierres-inventario cerrar|verificar [--empresa N]"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('cierres-inventario', help='Cierres periódicos de saldos de inventario')
+
+    @grupo.command('cerrar')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    @click.option('--hasta', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+                  help='Cerrar hasta el periodo que contiene esta fecha')
+    @click.option('--desde', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+                  help='Recalcular desde el periodo que contiene esta fecha')
+    def cerrar_cmd(empresa, hasta, desde):
+        for eid in ([empresa] if empresa else _empresas_con_movimientos()):
+            cerrados = cerrar_periodos(eid, hasta=hasta and hasta.date(), desde=desde and desde.date())
+            if not cerrados:
+                click.echo(f"✅ Empresa {eid}: sin periodos pendientes")
+            for periodo, productos, movimientos in cerrados:
+                click.echo(f"✅ Empresa {eid}: cierre {periodo} — {productos} productos, "
+                           f"{movimientos} movimientos en el periodo")
+
+    @grupo.command('verificar')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def verificar_cmd(empresa):
+        total = 0
+        for eid in ([empresa] if empresa else _empresas_con_movimientos()):
+            cierre, diferencias = verificar_cierre(eid)
+            if cierre is None:
+                click.echo(f"⚠️ Empresa {eid}: sin cierre vigente")
+                continue
+            total += len(diferencias)
+            for d in diferencias:
+                click.echo(
+                    f"❌ Empresa {eid} tipo {d['tipo_inventario_id']} producto base {d['producto_base_id']}: "
+                    f"cierre {d['unidades_cierre']:.4f} u / ${d['valor_cierre']:.2f} — "
+                    f"historia {d['unidades_historia']:.4f} u / ${d['valor_historia']:.2f}"
+                )
+            if not diferencias:
+                click.echo(f"✅ Empresa {eid}: cierre {cierre['periodo']} consistente")
+        if total:
+            raise SystemExit(1)
+
+    app.cli.add_command(grupo)
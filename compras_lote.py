@@ -0,0 +1,229 @@
+"""
+Registro de compras en lote (nueva_compra)
+Antes: por cada renglón una búsqueda por nombre, una validación contra producto_base
+y tres INSERT (detalle_compra, inventario, inventario_movimientos).
+Ahora, para toda la factura:
+1. resolver_mercancias(): una sola consulta IN (...) con los ids y nombres capturados;
+   la compra valida y escribe con el catálogo vigente en MySQL (activo, tipo, cont_neto)
+   aunque otro worker lo haya cambiado. El índice en memoria (busqueda_mercancias) solo
+   propone candidatos para los nombres aproximados de la importación, y esos también
+   se releen en la misma consulta
+2. validar_renglones(): validación en memoria con los mismos mensajes por renglón
+3. insertar_renglones(): un INSERT de varios renglones para detalle_compra e inventario,
+   en la transacción del encabezado (el que llama hace commit o rollback). Los
+   movimientos van uno por uno: saldo y capas PEPS necesitan el id de cada uno y un
+   INSERT de varios renglones no garantiza ids consecutivos
+   (innodb_autoinc_lock_mode=2, auto_increment_increment > 1)
+"""
+
+from busqueda_mercancias import normalizar
+from saldos_inventario import aplicar_movimiento
+from capas_peps import agregar_capas
+
+
+def renglones_desde_form(form):
+    """Renglones capturados (sin los vacíos) como dicts de texto"""
+    nombres = form.getlist('mercancia_nombre[]')
+    mids = form.getlist('mercancia_id[]')
+    unidades = form.getlist('unidades[]')
+    precios = form.getlist('precio_unitario[]')
+    totales = form.getlist('precio_total[]')
+
+    renglones = []
+    for i in range(max(len(nombres), len(unidades), len(precios), len(totales))):
+        r = {
+            'nombre': (nombres[i] if i < len(nombres) else "").strip(),
+            'mercancia_id': (mids[i] if i < len(mids) else "").strip(),
+            'unidades': (unidades[i] if i < len(unidades) else "").strip(),
+            'precio_unitario': (precios[i] if i < len(precios) else "").strip(),
+            'precio_total': (totales[i] if i < len(totales) else "").strip(),
+        }
+        # Saltar filas vacías
+        if not r['nombre'] and not r['unidades'] and not r['precio_unitario'] and not r['precio_total']:
+            continue
+        renglones.append(r)
+    return renglones
+
+
+def _mp_activa(m):
+    return (m['tipo'] or '').upper() == 'MP' and m['activo'] == 1
+
+
+def resolver_mercancias(cur, empresa_id, renglones, indice=None):
+    """
+    Una consulta para todos los renglones. Regresa [(mercancía, nivel)] en el orden de
+    `renglones`, con nivel 'id', 'exacto' o 'aproximado' ((None, None) si no se resuelve):
+    - por id: MP de la empresa (sin importar si está activa, igual que antes)
+    - por nombre exacto: MP activa (el id más bajo si hay repetidos)
+    - con `indice` (IndiceNombres de la empresa): tokens en orden; el candidato del
+      índice se relee aquí y solo cuenta si sigue siendo MP activa
+    """
+    ids, nombres, candidatos = set(), set(), {}
+    for n, r in enumerate(renglones):
+        if r['mercancia_id'].isdigit():
+            ids.add(int(r['mercancia_id']))
+        elif r['nombre']:
+            nombres.add(r['nombre'])
+            if indice is not None:
+                f, nivel = indice.resolver_nivel(r['nombre'], filtro=_mp_activa)
+                if nivel == 'aproximado':
+                    candidatos[n] = f['id']
+    ids |= set(candidatos.values())
+    if not ids and not nombres:
+        return [(None, None)] * len(renglones)
+
+    condiciones, params = [], [empresa_id]
+    if ids:
+        condiciones.append(f"m.id IN ({','.join(['%s'] * len(ids))})")
+        params += sorted(ids)
+    if nombres:
+        condiciones.append(f"(m.nombre IN ({','.join(['%s'] * len(nombres))}) AND m.activo = 1)")
+        params += sorted(nombres)
+
+    cur.execute(f"""
+        SELECT m.id, m.nombre, m.tipo, m.activo, m.producto_base_id, m.cont_neto
+        FROM mercancia m
+        WHERE m.empresa_id = %s AND m.tipo = 'MP'
+          AND ({' OR '.join(condiciones)})
+        ORDER BY m.id
+    """, params)
+
+    por_id, por_nombre = {}, {}
+    for m in cur.fetchall():
+        por_id[m['id']] = m
+        if m['activo'] == 1:
+            por_nombre.setdefault(normalizar(m['nombre']), m)
+
+    resueltos = []
+    for n, r in enumerate(renglones):
+        if r['mercancia_id'].isdigit():
+            merc = por_id.get(int(r['mercancia_id']))
+            resueltos.append((merc, 'id') if merc else (None, None))
+            continue
+        merc = por_nombre.get(normalizar(r['nombre']))
+        if merc:
+            resueltos.append((merc, 'exacto'))
+            continue
+        merc = por_id.get(candidatos.get(n))
+        resueltos.append((merc, 'aproximado') if merc and merc['activo'] == 1 else (None, None))
+    return resueltos
+
+
+def validar_renglones(renglones, resueltos):
+    """
+    Regresa (items, fallidos) con los mismos mensajes que la captura renglón por renglón.
+    resueltos: salida de resolver_mercancias. Cada item lleva su nivel ('id', 'exacto'
+    o 'aproximado').
+    """
+    items, fallidos = [], []
+    for r, (merc, nivel) in zip(renglones, resueltos):
+        nom = r['nombre']
+
+        # ✅ MERCANCÍA VALIDADA CONTRA EL CATÁLOGO DE LA EMPRESA
+        if not merc:
+            if r['mercancia_id'].isdigit():
+                fallidos.append(f"'{nom}': No pertenece a tu empresa")
+            else:
+                fallidos.append(f"'{nom}': No encontrado en catálogo")
+            continue
+        if not merc['producto_base_id']:
+            fallidos.append(f"'{nom}': Sin producto base asignado")
+            continue
+
+        # ✅ CALCULAR CANTIDADES
+        try:
+            cont_neto = float(merc['cont_neto'] or 1)
+            if cont_neto <= 0:
+                cont_neto = 1
+        except (TypeError, ValueError):
+            cont_neto = 1
+
+        try:
+            und = float(r['unidades'] or 0)
+            pu = float(r['precio_unitario'] or 0)
+            pt = float(r['precio_total'] or (und * pu))
+        except ValueError:
+            fallidos.append(f"'{nom}': Valores numéricos inválidos")
+            continue
+
+        if und <= 0 or pu <= 0:
+            fallidos.append(f"'{nom}': Unidades y precio deben ser mayores a 0")
+            continue
+
+        items.append({
+            "mercancia_id": merc['id'],
+            "nombre": merc['nombre'],
+            "unidades_base": und,
+            "contenido_neto_total": und * cont_neto,
+            "precio_unitario": pu,
+            "precio_total": pt,
+            "nivel": nivel,
+        })
+    return items, fallidos
+
+
+def _valores(n, columnas):
+    return ', '.join(['(' + ', '.join(['%s'] * columnas) + ')'] * n)
+
+
+def insertar_renglones(cur, empresa_id, usuario_id, compra_id, numero_factura, fecha, items):
+    """
+    detalle_compra e inventario con un INSERT de varios renglones cada uno,
+    inventario_movimientos renglón por renglón (su id va a saldo y capas PEPS);
+    después saldo materializado y capas PEPS. No hace commit.
+    """
+    if not items:
+        return
+    referencia = f"Compra {numero_factura}"
+
+    # Detalle de compra
+    cur.execute(f"""
+        INSERT INTO detalle_compra
+        (empresa_id, usuario_id, compra_id, mercancia_id, producto, unidades,
+         contenido_neto_total, precio_unitario, precio_total)
+        VALUES {_valores(len(items), 9)}
+    """, [v for x in items for v in (
+        empresa_id, usuario_id, compra_id, x["mercancia_id"], x["nombre"], x["unidades_base"],
+        x["contenido_neto_total"], x["precio_unitario"], x["precio_total"])])
+
+    # Stock (tabla inventario): una fila por mercancía aunque se repita en la factura
+    entradas = {}
+    for x in items:
+        entradas[x["mercancia_id"]] = entradas.get(x["mercancia_id"], 0) + x["contenido_neto_total"]
+    cur.execute(f"""
+        INSERT INTO inventario
+        (empresa_id, mercancia_id, inventario_inicial, entradas, salidas, aprobado)
+        VALUES {', '.join(['(%s, %s, 0, %s, 0, 0)'] * len(entradas))}
+        ON DUPLICATE KEY UPDATE
+        entradas = entradas + VALUES(entradas)
+    """, [v for mid, u in entradas.items() for v in (empresa_id, mid, u)])
+
+    # Movimientos de inventario (MP = tipo_inventario_id=1); cada uno con su lastrowid
+    mov_ids = []
+    for x in items:
+        cur.execute("""
+            INSERT INTO inventario_movimientos
+            (empresa_id, usuario_id, tipo_inventario_id, mercancia_id, tipo_movimiento,
+             unidades, precio_unitario, referencia, fecha)
+            VALUES (%s, %s, 1, %s, 'COMPRA', %s, %s, %s, %s)
+        """, (empresa_id, usuario_id, x["mercancia_id"], x["contenido_neto_total"],
+              x["precio_unitario"], referencia, fecha))
+        mov_ids.append(cur.lastrowid)
+
+    # Saldo materializado (una vez por mercancía) y capas PEPS (costo por unidad de
+    # contenido, igual que el kardex)
+    capas, saldos = [], {}
+    for mov_id, x in zip(mov_ids, items):
+        costo_contenido = x["precio_total"] / x["contenido_neto_total"] if x["contenido_neto_total"] else 0
+        capas.append({'tipo_inventario_id': 1, 'mercancia_id': x["mercancia_id"],
+                      'unidades': x["contenido_neto_total"], 'costo_unitario': costo_contenido,
+                      'origen': 'compra', 'referencia': referencia, 'fecha': fecha,
+                      'movimiento_id': mov_id})
+        s = saldos.setdefault(x["mercancia_id"], {'unidades': 0.0, 'valor': 0.0, 'mov_id': mov_id})
+        s['unidades'] += x["contenido_neto_total"]
+        s['valor'] += x["precio_total"]
+
+    for mid, s in saldos.items():
+        costo = s['valor'] / s['unidades'] if s['unidades'] else 0
+        aplicar_movimiento(cur, empresa_id, 1, mid, 'COMPRA', s['unidades'], costo, s['mov_id'])
+    agregar_capas(cur, empresa_id, capas)
@@ -0,0 +1,431 @@
+"""
+Pólizas contables (partida doble) y saldos por cuenta / periodo
+Antes registrar_asiento_compra insertaba un renglón por movimiento con ids de cuenta
+fijos (10/30/40) y sin empresa, y el error se imprimía y se ignoraba.
+Ahora:
+1. registrar_asientos(): valida partida doble y cuentas (árbol de arbol_cuentas) y
+   escribe renglones y saldos con un INSERT de varios renglones cada uno (encabezados
+   uno por uno, por su id), dentro de la transacción del que llama (no hace commit)
+2. saldos_contables (migrations/007): debe / haber por empresa, cuenta y mes,
+   actualizado al registrar
+3. balanza(), mayor(), balance_general(): leen los saldos (una fila por cuenta y mes)
+   y acumulan hacia los padres del árbol y AGRUPACIONES_NIVEL1
+4. CLI: flask contabilidad reconstruir-saldos | verificar [--empresa N]
+"""
+
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+import mysql.connector
+
+from db import conexion_db
+from arbol_cuentas import arbol_cuentas
+
+ER_NO_SUCH_TABLE = 1146
+CENTAVO = Decimal('0.01')
+CERO = Decimal('0.00')
+
+# Cuentas de una compra de materia prima (por código del catálogo base)
+CUENTAS_COMPRA = {
+    'inventario': '112-002-000',   # MATERIAS PRIMAS
+    'iva': '114-002-000',          # IMPUESTOS A FAVOR (IVA acreditable)
+    'efectivo': '111-001-000',     # CAJA
+    'banco': '111-002-000',        # BANCOS
+    'credito': '211-001-000',      # PROVEEDORES
+}
+PAGO_COMPRA = {'efectivo': 'efectivo', 'banco': 'banco', 'cheque': 'banco',
+               'deposito': 'banco', 'credito': 'credito'}
+
+
+class AsientoInvalido(ValueError):
+    """Asiento que no cuadra o con cuentas que no existen en el catálogo"""
+
+
+class CuentaInexistente(AsientoInvalido):
+    """Cuenta que no está en el árbol con el que se validó"""
+
+
+def _d(valor):
+    return Decimal(str(valor or 0)).quantize(CENTAVO, rounding=ROUND_HALF_UP)
+
+
+def _sin_tabla(err):
+    return getattr(err, 'errno', None) == ER_NO_SUCH_TABLE
+
+
+def como_fecha(valor):
+    if valor is None:
+        return date.today()
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    return datetime.strptime(str(valor)[:10], '%Y-%m-%d').date()
+
+
+def periodo_de(valor):
+    """Primer día del mes de la fecha"""
+    return como_fecha(valor).replace(day=1)
+
+
+def siguiente_periodo(periodo):
+    return date(periodo.year + (periodo.month == 12), periodo.month % 12 + 1, 1)
+
+
+# -------------------- Registro --------------------
+
+def _validar(asiento, arbol):
+    """Renglones con cuenta_id resuelta y montos en centavos; lanza AsientoInvalido"""
+    concepto = asiento.get('concepto') or ''
+    lineas = []
+    for ln in asiento.get('lineas') or ():
+        cuenta_id = ln.get('cuenta_id')
+        if cuenta_id is None and ln.get('codigo'):
+            cuenta_id = arbol.id_por_codigo(ln['codigo'])
+            if cuenta_id is None:
+                raise CuentaInexistente(
+                    f"{concepto}: la cuenta {ln['codigo']} no existe; genera el catálogo contable")
+        if cuenta_id not in arbol.por_id:
+            raise CuentaInexistente(f"{concepto}: la cuenta {cuenta_id} no existe")
+        debe, haber = _d(ln.get('debe')), _d(ln.get('haber'))
+        if debe < 0 or haber < 0:
+            raise AsientoInvalido(f"{concepto}: montos negativos")
+        if debe == 0 and haber == 0:
+            continue
+        lineas.append({'cuenta_id': cuenta_id, 'debe': debe, 'haber': haber})
+
+    total_debe = sum((ln['debe'] for ln in lineas), CERO)
+    total_haber = sum((ln['haber'] for ln in lineas), CERO)
+    if len(lineas) < 2 or total_debe == 0:
+        raise AsientoInvalido(f"{concepto}: el asiento necesita al menos un cargo y un abono")
+    if total_debe != total_haber:
+        raise AsientoInvalido(f"{concepto}: no cuadra (debe {total_debe} / haber {total_haber})")
+    return lineas, total_debe
+
+
+def registrar_asientos(cur, empresa_id, asientos, arbol=None):
+    """
+    asientos: [{'fecha', 'concepto', 'descripcion'?, 'lineas': [{'codigo' | 'cuenta_id',
+    'debe', 'haber'}]}]. Valida todo antes de escribir. No hace commit. Regresa los ids.
+    """
+    if not asientos:
+        return []
+    arbol = arbol or arbol_cuentas(cur)
+    try:
+        validados = [(a, como_fecha(a.get('fecha')),) + _validar(a, arbol) for a in asientos]
+    except CuentaInexistente:
+        # El árbol en caché puede ser anterior al catálogo creado en otro worker:
+        # se confirma contra la tabla antes de rechazar el asiento
+        arbol = arbol_cuentas(cur, recargar=True)
+        validados = [(a, como_fecha(a.get('fecha')),) + _validar(a, arbol) for a in asientos]
+
+    # Encabezados uno por uno: los renglones necesitan el id de cada asiento y un INSERT
+    # de varios renglones no garantiza ids consecutivos (innodb_autoinc_lock_mode=2)
+    ids = []
+    for a, fecha, _lineas, monto in validados:
+        cur.execute(
+            "INSERT INTO asientos_contables (empresa_id, fecha, concepto, descripcion, monto) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            (empresa_id, fecha, a['concepto'], a.get('descripcion'), monto))
+        ids.append(cur.lastrowid)
+
+    detalle, saldos = [], {}
+    for asiento_id, (_a, fecha, lineas, _monto) in zip(ids, validados):
+        periodo = fecha.replace(day=1)
+        for ln in lineas:
+            detalle += [empresa_id, asiento_id, ln['cuenta_id'], ln['debe'], ln['haber']]
+            s = saldos.setdefault((ln['cuenta_id'], periodo), [CERO, CERO, 0])
+            s[0] += ln['debe']
+            s[1] += ln['haber']
+            s[2] += 1
+    cur.execute(
+        "INSERT INTO asientos_detalle (empresa_id, asiento_id, cuenta_id, debe, haber) VALUES "
+        + ', '.join(['(%s, %s, %s, %s, %s)'] * (len(detalle) // 5)), detalle)
+
+    try:
+        cur.execute(f"""
+            INSERT INTO saldos_contables (empresa_id, cuenta_id, periodo, debe, haber, movimientos)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(saldos))}
+            ON DUPLICATE KEY UPDATE
+                debe = debe + VALUES(debe),
+                haber = haber + VALUES(haber),
+                movimientos = movimientos + VALUES(movimientos)
+        """, [v for (cuenta_id, periodo), (debe, haber, n) in saldos.items()
+              for v in (empresa_id, cuenta_id, periodo, debe, haber, n)])
+    except mysql.connector.Error as err:
+        # Sin migración 007 el asiento se registra igual; reconstruir-saldos lo recupera
+        if not _sin_tabla(err):
+            raise
+    return ids
+
+
+def asiento_compra(numero_factura, fecha, metodo_pago, subtotal, iva, total):
+    """Cargo a materias primas e IVA acreditable, abono a caja / bancos / proveedores"""
+    subtotal, iva, total = _d(subtotal), _d(iva), _d(total)
+    # El total manda: lo que no es IVA se carga al inventario
+    inventario = total - iva if iva else total
+    pago = CUENTAS_COMPRA[PAGO_COMPRA.get(metodo_pago, 'efectivo')]
+    return {
+        'fecha': fecha,
+        'concepto': f"Compra {numero_factura}",
+        'descripcion': f"Subtotal {subtotal}, IVA {iva}, pago {metodo_pago}",
+        'lineas': [
+            {'codigo': CUENTAS_COMPRA['inventario'], 'debe': inventario, 'haber': 0},
+            {'codigo': CUENTAS_COMPRA['iva'], 'debe': iva, 'haber': 0},
+            {'codigo': pago, 'debe': 0, 'haber': total},
+        ],
+    }
+
+
+# -------------------- Reportes --------------------
+
+def saldos_por_cuenta(cur, empresa_id, desde, hasta, cuentas=None):
+    """{cuenta_id: {'inicial', 'debe', 'haber'}} de los periodos [desde, hasta]"""
+    sql = """
+        SELECT cuenta_id,
+               COALESCE(SUM(CASE WHEN periodo < %s THEN debe - haber ELSE 0 END), 0) AS inicial,
+               COALESCE(SUM(CASE WHEN periodo >= %s THEN debe ELSE 0 END), 0) AS debe,
+               COALESCE(SUM(CASE WHEN periodo >= %s THEN haber ELSE 0 END), 0) AS haber
+        FROM saldos_contables
+        WHERE empresa_id = %s AND periodo <= %s
+    """
+    params = [desde, desde, desde, empresa_id, hasta]
+    if cuentas:
+        sql += f" AND cuenta_id IN ({','.join(['%s'] * len(cuentas))})"
+        params += list(cuentas)
+    cur.execute(sql + " GROUP BY cuenta_id", params)
+    return {r['cuenta_id']: {'inicial': _d(r['inicial']), 'debe': _d(r['debe']), 'haber': _d(r['haber'])}
+            for r in cur.fetchall()}
+
+
+def _padre(arbol, nodo, agrupaciones):
+    padre = arbol.por_id.get(nodo.get('padre_id'))
+    if padre is None and agrupaciones:
+        padre = arbol.por_codigo.get(agrupaciones.get(nodo['codigo']))
+    return padre
+
+
+def _ancestros(arbol, nodo, agrupaciones):
+    vistos = {nodo['id']}
+    padre = _padre(arbol, nodo, agrupaciones)
+    while padre is not None and padre['id'] not in vistos:
+        yield padre
+        vistos.add(padre['id'])
+        padre = _padre(arbol, padre, agrupaciones)
+
+
+def balanza(cur, empresa_id, desde, hasta, agrupaciones=None):
+    """
+    Balanza de comprobación de los periodos [desde, hasta]: cada cuenta con su saldo
+    inicial, cargos, abonos y saldo final (debe - haber), acumulando hacia los padres.
+    Regresa {'filas', 'totales', 'cuadra'}.
+    """
+    arbol = arbol_cuentas(cur)
+    propios = saldos_por_cuenta(cur, empresa_id, periodo_de(desde), periodo_de(hasta))
+
+    acumulado = {}
+    for cuenta_id, s in propios.items():
+        nodo = arbol.por_id.get(cuenta_id)
+        if nodo is None:
+            continue
+        for n in [nodo, *_ancestros(arbol, nodo, agrupaciones)]:
+            a = acumulado.setdefault(n['id'], {'inicial': CERO, 'debe': CERO, 'haber': CERO})
+            a['inicial'] += s['inicial']
+            a['debe'] += s['debe']
+            a['haber'] += s['haber']
+
+    filas = []
+    for cuenta_id, a in acumulado.items():
+        nodo = arbol.por_id[cuenta_id]
+        final = a['inicial'] + a['debe'] - a['haber']
+        if not (a['inicial'] or a['debe'] or a['haber'] or final):
+            continue
+        filas.append({
+            'id': cuenta_id, 'codigo': nodo['codigo'], 'nombre': nodo['nombre'],
+            'nivel': nodo['nivel'], 'tipo': nodo['tipo'], 'naturaleza': nodo['naturaleza'],
+            'profundidad': sum(1 for _ in _ancestros(arbol, nodo, agrupaciones)),
+            'inicial': a['inicial'], 'debe': a['debe'], 'haber': a['haber'], 'final': final,
+            'propia': cuenta_id in propios,
+        })
+    filas.sort(key=lambda f: f['codigo'])
+
+    # Totales con las cuentas que tienen renglones propios (sin doble conteo de padres)
+    totales = {'inicial': CERO, 'debe': CERO, 'haber': CERO, 'final': CERO}
+    for s in propios.values():
+        totales['inicial'] += s['inicial']
+        totales['debe'] += s['debe']
+        totales['haber'] += s['haber']
+    totales['final'] = totales['inicial'] + totales['debe'] - totales['haber']
+    return {'filas': filas, 'totales': totales,
+            'cuadra': totales['debe'] == totales['haber'] and totales['final'] == 0}
+
+
+def mayor(cur, empresa_id, cuenta_id, desde, hasta):
+    """
+    Libro mayor de la cuenta (y sus subcuentas) en [desde, hasta]: saldo inicial de
+    saldos_contables y solo los renglones del rango
+    """
+    arbol = arbol_cuentas(cur)
+    cuenta = arbol.por_id.get(cuenta_id)
+    if cuenta is None:
+        return None
+    ids, pendientes = [], [cuenta]
+    while pendientes:
+        n = pendientes.pop()
+        ids.append(n['id'])
+        pendientes.extend(arbol.hijos.get(n['id'], ()))
+
+    desde, hasta = periodo_de(desde), periodo_de(hasta)
+    saldos = saldos_por_cuenta(cur, empresa_id, desde, desde, ids)
+    saldo = sum((s['inicial'] for s in saldos.values()), CERO)
+    inicial = saldo
+
+    cur.execute(f"""
+        SELECT a.id AS asiento_id, a.fecha, a.concepto, d.cuenta_id, d.debe, d.haber
+        FROM asientos_detalle d
+        JOIN asientos_contables a ON a.id = d.asiento_id
+        WHERE a.empresa_id = %s
+          AND d.cuenta_id IN ({','.join(['%s'] * len(ids))})
+          AND a.fecha >= %s AND a.fecha < %s
+        ORDER BY a.fecha, a.id, d.id
+    """, [empresa_id, *ids, desde, siguiente_periodo(hasta)])
+    renglones = []
+    for r in cur.fetchall():
+        debe, haber = _d(r['debe']), _d(r['haber'])
+        saldo += debe - haber
+        sub = arbol.por_id.get(r['cuenta_id'])
+        renglones.append({'asiento_id': r['asiento_id'], 'fecha': r['fecha'], 'concepto': r['concepto'],
+                          'cuenta': sub['codigo'] if sub else r['cuenta_id'],
+                          'debe': debe, 'haber': haber, 'saldo': saldo})
+    return {'cuenta': cuenta, 'inicial': inicial, 'renglones': renglones, 'final': saldo,
+            'debe': sum((r['debe'] for r in renglones), CERO),
+            'haber': sum((r['haber'] for r in renglones), CERO)}
+
+
+def balance_general(cur, empresa_id, al, agrupaciones=None, max_nivel=2):
+    """
+    Activo = Pasivo + Patrimonio + resultado del ejercicio, con saldos acumulados al
+    cierre del periodo de `al`. Cada sección lista las cuentas hasta `max_nivel`.
+    """
+    periodo = periodo_de(al)
+    b = balanza(cur, empresa_id, periodo, periodo, agrupaciones)
+    secciones = {'Activo': [], 'Pasivo': [], 'Patrimonio': []}
+    totales = {'Activo': CERO, 'Pasivo': CERO, 'Patrimonio': CERO}
+    resultado = CERO
+    for f in b['filas']:
+        # Saldo con el signo de la naturaleza (deudora: debe - haber)
+        saldo = f['final'] if f['naturaleza'] == 'Deudora' else -f['final']
+        if f['tipo'] in secciones:
+            if f['nivel'] <= max_nivel:
+                secciones[f['tipo']].append(dict(f, saldo=saldo))
+            if f['profundidad'] == 0:
+                totales[f['tipo']] += saldo
+        elif f['profundidad'] == 0:
+            # Ingresos (acreedora) menos costos y gastos (deudora)
+            resultado -= f['final']
+    pasivo_capital = totales['Pasivo'] + totales['Patrimonio'] + resultado
+    return {'periodo': periodo, 'secciones': secciones, 'totales': totales,
+            'resultado': resultado, 'pasivo_capital': pasivo_capital,
+            'cuadra': totales['Activo'] == pasivo_capital}
+
+
+# -------------------- Mantenimiento --------------------
+
+def reconstruir_saldos(empresa_id):
+    """Recalcula saldos_contables de la empresa desde asientos_detalle; regresa filas"""
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM saldos_contables WHERE empresa_id = %s", (empresa_id,))
+        cur.execute("""
+            INSERT INTO saldos_contables (empresa_id, cuenta_id, periodo, debe, haber, movimientos)
+            SELECT a.empresa_id, d.cuenta_id, DATE_FORMAT(a.fecha, '%%Y-%%m-01'),
+                   COALESCE(SUM(d.debe), 0), COALESCE(SUM(d.haber), 0), COUNT(*)
+            FROM asientos_detalle d
+            JOIN asientos_contables a ON a.id = d.asiento_id
+            WHERE a.empresa_id = %s
+            GROUP BY a.empresa_id, d.cuenta_id, DATE_FORMAT(a.fecha, '%%Y-%%m-01')
+        """, (empresa_id,))
+        filas = cur.rowcount
+        conn.commit()
+        return filas
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def verificar_saldos(empresa_id):
+    """[(cuenta_id, periodo, saldos_debe, saldos_haber, detalle_debe, detalle_haber)] que difieren"""
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT d.cuenta_id, DATE_FORMAT(a.fecha, '%%Y-%%m-01') AS periodo,
+                   COALESCE(SUM(d.debe), 0), COALESCE(SUM(d.haber), 0)
+            FROM asientos_detalle d
+            JOIN asientos_contables a ON a.id = d.asiento_id
+            WHERE a.empresa_id = %s
+            GROUP BY d.cuenta_id, periodo
+        """, (empresa_id,))
+        historia = {(c, str(p)): (_d(db), _d(hb)) for c, p, db, hb in cur.fetchall()}
+        cur.execute("""
+            SELECT cuenta_id, periodo, debe, haber FROM saldos_contables WHERE empresa_id = %s
+        """, (empresa_id,))
+        tabla = {(c, str(p)): (_d(db), _d(hb)) for c, p, db, hb in cur.fetchall()}
+    finally:
+        cur.close()
+        conn.close()
+
+    diferencias = []
+    for clave in sorted(set(historia) | set(tabla)):
+        t = tabla.get(clave, (CERO, CERO))
+        h = historia.get(clave, (CERO, CERO))
+        if t != h:
+            diferencias.append((clave[0], clave[1], t[0], t[1], h[0], h[1]))
+    return diferencias
+
+
+def _empresas_con_asientos():
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT DISTINCT empresa_id FROM asientos_contables WHERE empresa_id IS NOT NULL")
+        return [r[0] for r in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def init_app(app):
+    """Registra los comandos: flask contabilidad reconstruir-saldos|verificar [--empresa N]"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('contabilidad', help='Saldos contables por cuenta y periodo')
+
+    @grupo.command('reconstruir-saldos')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def reconstruir_cmd(empresa):
+        for eid in ([empresa] if empresa else _empresas_con_asientos()):
+            filas = reconstruir_saldos(eid)
+            click.echo(f"✅ Empresa {eid}: {filas} saldos por cuenta y periodo")
+
+    @grupo.command('verificar')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def verificar_cmd(empresa):
+        total = 0
+        for eid in ([empresa] if empresa else _empresas_con_asientos()):
+            diferencias = verificar_saldos(eid)
+            total += len(diferencias)
+            for cuenta_id, periodo, td, th, hd, hh in diferencias:
+                click.echo(f"❌ Empresa {eid} cuenta {cuenta_id} {periodo}: "
+                           f"saldos {td}/{th} — asientos {hd}/{hh}")
+            if not diferencias:
+                click.echo(f"✅ Empresa {eid}: saldos consistentes")
+        if total:
+            raise SystemExit(1)
+
+    app.cli.add_command(grupo)
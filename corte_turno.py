@@ -0,0 +1,116 @@
+"""
+Corte de turno (cierre de caja) con agregados agrupados
+Antes cerrar_turno hacía 3 consultas por producto PT (inventario inicial,
+consumos propios y mermas) al validar y las repetía al cerrar, más un INSERT
+por renglón en turno_inventario_final (~900 consultas para 150 productos).
+
+Ahora:
+1. cargar_base_turno(): 3 consultas GROUP BY para todo el turno → dicts por producto
+2. calcular_corte(): ventas teóricas y diferencias en memoria
+3. guardar_inventario_final(): un solo executemany
+El corte se recalcula en cada POST (validación y confirmación) para que las
+mermas y consumos propios registrados entre ambos entren en las ventas.
+"""
+
+UMBRAL_DIFERENCIA = 70   # pesos; arriba de esto se pide verificar el conteo
+
+
+def _sumas(cur, sql, params, columna):
+    cur.execute(sql, params)
+    return {int(r['producto_id']): float(r[columna] or 0) for r in cur.fetchall()}
+
+
+def cargar_base_turno(cur, turno_id, empresa_id):
+    """Inventario inicial, consumos propios y mermas del turno: {producto_id: cantidad}"""
+    params = (turno_id, empresa_id)
+    cur.execute("""
+        SELECT producto_id, cantidad_inicial
+        FROM turno_inventario
+        WHERE turno_id = %s AND empresa_id = %s
+        ORDER BY id
+    """, params)
+    iniciales = {}
+    for r in cur.fetchall():
+        # Igual que el fetchone() por producto: cuenta el primer registro
+        iniciales.setdefault(int(r['producto_id']), float(r['cantidad_inicial'] or 0))
+    consumos = _sumas(cur, """
+        SELECT producto_id, COALESCE(SUM(cantidad), 0) AS cantidad
+        FROM consumos_propios
+        WHERE turno_id = %s AND empresa_id = %s
+        GROUP BY producto_id
+    """, params, 'cantidad')
+    mermas = _sumas(cur, """
+        SELECT producto_id, COALESCE(SUM(cantidad), 0) AS cantidad
+        FROM turno_mermas
+        WHERE turno_id = %s AND empresa_id = %s
+        GROUP BY producto_id
+    """, params, 'cantidad')
+    return iniciales, consumos, mermas
+
+
+def conteo_desde_form(form):
+    """Renglones capturados (solo los que traen cantidad final)"""
+    conteo = []
+    for pid, pnombre, pprecio, cant_final in zip(
+        form.getlist('producto_id[]'),
+        form.getlist('producto_nombre[]'),
+        form.getlist('producto_precio[]'),
+        form.getlist('cantidad_final[]'),
+    ):
+        if not cant_final or not cant_final.strip():
+            continue
+        conteo.append({
+            'producto_id': int(pid),
+            'producto': pnombre,
+            'precio': float(pprecio),
+            'final': float(cant_final),
+        })
+    return conteo
+
+
+def calcular_corte(conteo, base):
+    """Ventas teóricas por producto = inicial - consumos - mermas - final"""
+    iniciales, consumos, mermas = base
+    renglones = []
+    for c in conteo:
+        pid = c['producto_id']
+        inicial = iniciales.get(pid, 0.0)
+        cons = consumos.get(pid, 0.0)
+        merm = mermas.get(pid, 0.0)
+        vendidas = inicial - cons - merm - c['final']
+        renglones.append({
+            'producto_id': pid,
+            'producto': c['producto'],
+            'inicial': inicial,
+            'consumos': cons,
+            'mermas': merm,
+            'final': c['final'],
+            'vendidas': vendidas,
+            'precio': c['precio'],
+            'importe': vendidas * c['precio'],
+            'valor_diferencia': abs(vendidas) * c['precio'],
+        })
+    return renglones
+
+
+def diferencias(renglones, umbral=UMBRAL_DIFERENCIA):
+    return [
+        {'producto': r['producto'], 'diferencia': r['vendidas'], 'valor': r['valor_diferencia']}
+        for r in renglones if r['valor_diferencia'] > umbral
+    ]
+
+
+def corte_turno(cur, turno_id, empresa_id, conteo):
+    """Corte del turno para el conteo capturado (3 consultas agrupadas)"""
+    return calcular_corte(conteo, cargar_base_turno(cur, turno_id, empresa_id))
+
+
+def guardar_inventario_final(cur, empresa_id, turno_id, renglones):
+    """Conteo final del turno en un solo INSERT multi-renglón (no hace commit)"""
+    if not renglones:
+        return
+    cur.executemany("""
+        INSERT INTO turno_inventario_final
+        (empresa_id, turno_id, producto_id, producto_nombre, cantidad_final)
+        VALUES (%s, %s, %s, %s, %s)
+    """, [(empresa_id, turno_id, r['producto_id'], r['producto'], r['final']) for r in renglones])
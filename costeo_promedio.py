@@ -0,0 +1,244 @@
+"""
+Costeo promedio ponderado de MP y WIP por producto base en una sola pasada
+Antes: un GROUP_CONCAT(m.id) por producto base (se trunca en silencio al pasar
+group_concat_max_len) y una consulta UNION por cada producto base (N+1).
+Ahora, para toda la empresa:
+1. mercancias_por_producto_base(): relación producto_base → mercancías sin GROUP_CONCAT
+2. Una consulta de movimientos ordenada por producto_base_id, fecha, id, leída en
+   lotes y costeada al vuelo (solo se guarda el acumulado del producto en curso)
+3. La consulta se puede acotar por fecha y producto base para continuar desde un
+   cierre de periodo (ver cierres_inventario.py)
+
+Criterio (igual que las pantallas):
+- Entradas ('entrada', 'compra') suman unidades y valor y recalculan el promedio
+- Salidas descuentan unidades al costo promedio vigente
+- En MP las compras salen de detalle_compra (precio_total / contenido neto) y de
+  inventario_movimientos se ignoran las filas 'compra' para no duplicarlas
+"""
+
+TAMANO_LOTE = 2000
+
+TIPO_MERC = {1: 'MP', 2: 'WIP'}
+
+_SQL_MOVIMIENTOS = {
+    # MP: compras desde detalle_compra + movimientos que no sean compra
+    1: """
+        SELECT * FROM (
+            SELECT m.producto_base_id AS producto_base_id,
+                   lc.fecha AS fecha_raw,
+                   0 AS fuente,
+                   dc.id AS mov_id,
+                   'compra' AS tipo_movimiento,
+                   dc.contenido_neto_total AS unidades,
+                   CASE WHEN dc.contenido_neto_total>0
+                        THEN dc.precio_total/dc.contenido_neto_total ELSE NULL END AS precio_unitario
+            FROM detalle_compra dc
+            JOIN listado_compras lc ON dc.compra_id = lc.id
+            JOIN mercancia m ON m.id = dc.mercancia_id
+            JOIN producto_base pb ON pb.id = m.producto_base_id AND pb.activo = 1
+            WHERE m.tipo = 'MP'
+              AND m.empresa_id = %(eid)s
+              AND dc.empresa_id = %(eid)s
+              AND lc.empresa_id = %(eid)s
+              {filtro_dc}
+            UNION ALL
+            SELECT m.producto_base_id,
+                   im.fecha,
+                   1,
+                   im.id,
+                   im.tipo_movimiento,
+                   im.unidades,
+                   im.precio_unitario
+            FROM inventario_movimientos im
+            JOIN mercancia m ON m.id = im.mercancia_id
+            JOIN producto_base pb ON pb.id = m.producto_base_id AND pb.activo = 1
+            WHERE m.tipo = 'MP'
+              AND m.empresa_id = %(eid)s
+              AND im.tipo_inventario_id = 1
+              AND im.empresa_id = %(eid)s
+              AND UPPER(im.tipo_movimiento) <> 'COMPRA'
+              AND im.unidades > 0
+              AND im.tipo_movimiento IS NOT NULL
+              AND im.tipo_movimiento <> ''
+              {filtro_im}
+        ) t
+        ORDER BY t.producto_base_id ASC, t.fecha_raw ASC, t.fuente ASC, t.mov_id ASC
+    """,
+    # WIP: solo inventario_movimientos
+    2: """
+        SELECT m.producto_base_id AS producto_base_id,
+               im.fecha AS fecha_raw,
+               1 AS fuente,
+               im.id AS mov_id,
+               im.tipo_movimiento,
+               im.unidades,
+               im.precio_unitario
+        FROM inventario_movimientos im
+        JOIN mercancia m ON m.id = im.mercancia_id
+        JOIN producto_base pb ON pb.id = m.producto_base_id AND pb.activo = 1
+        WHERE m.tipo = 'WIP'
+          AND m.empresa_id = %(eid)s
+          AND im.tipo_inventario_id = 2
+          AND im.empresa_id = %(eid)s
+          AND im.unidades > 0
+          AND im.tipo_movimiento IS NOT NULL
+          AND im.tipo_movimiento <> ''
+          {filtro_im}
+        ORDER BY m.producto_base_id ASC, im.fecha ASC, im.id ASC
+    """,
+}
+
+
+def mercancias_por_producto_base(cur, empresa_id, tipo_inventario_id):
+    """{producto_base_id: [mercancia_id, ...]} de los productos base activos"""
+    cur.execute("""
+        SELECT m.producto_base_id, m.id
+        FROM mercancia m
+        JOIN producto_base pb ON pb.id = m.producto_base_id
+        WHERE pb.activo = 1
+          AND m.tipo = %s
+          AND m.empresa_id = %s
+        ORDER BY m.producto_base_id, m.id
+    """, (TIPO_MERC[tipo_inventario_id], empresa_id))
+
+    ids = {}
+    for r in cur.fetchall():
+        r = r if isinstance(r, dict) else {'producto_base_id': r[0], 'id': r[1]}
+        ids.setdefault(r['producto_base_id'], []).append(r['id'])
+    return ids
+
+
+def _filtros(desde=None, hasta=None, producto_base_ids=None):
+    """Condiciones extra (detalle_compra, inventario_movimientos) y sus parámetros"""
+    dc, im, params = [], [], {}
+    if desde is not None:
+        dc.append("lc.fecha >= %(desde)s")
+        im.append("im.fecha >= %(desde)s")
+        params['desde'] = desde
+    if hasta is not None:
+        dc.append("lc.fecha < %(hasta)s")
+        im.append("im.fecha < %(hasta)s")
+        params['hasta'] = hasta
+    if producto_base_ids is not None:
+        marcas = ','.join(f'%(pb{i})s' for i in range(len(producto_base_ids)))
+        dc.append(f"m.producto_base_id IN ({marcas})")
+        im.append(f"m.producto_base_id IN ({marcas})")
+        params.update({f'pb{i}': int(x) for i, x in enumerate(producto_base_ids)})
+    return ''.join(' AND ' + c for c in dc), ''.join(' AND ' + c for c in im), params
+
+
+def _movimientos_ordenados(conn, empresa_id, tipo_inventario_id, tamano_lote=TAMANO_LOTE,
+                           desde=None, hasta=None, producto_base_ids=None):
+    """
+    Genera (producto_base_id, fecha, tipo_movimiento, unidades, precio_unitario) en orden.
+    desde (inclusive) / hasta (exclusiva) acotan por fecha; producto_base_ids por producto.
+    """
+    if producto_base_ids is not None and not producto_base_ids:
+        return
+    filtro_dc, filtro_im, params = _filtros(desde, hasta, producto_base_ids)
+    sql = _SQL_MOVIMIENTOS[tipo_inventario_id].format(filtro_dc=filtro_dc, filtro_im=filtro_im)
+    params['eid'] = empresa_id
+
+    cur = conn.cursor(buffered=False)
+    try:
+        cur.execute(sql, params)
+        while True:
+            lote = cur.fetchmany(tamano_lote)
+            if not lote:
+                break
+            for producto_base_id, fecha, _fuente, _id, tipo, unidades, precio in lote:
+                yield producto_base_id, fecha, tipo, unidades, precio
+    finally:
+        cur.close()
+
+
+def estado_inicial(unidades=0.0, estado=None):
+    """Acumulado de un producto base; `estado` (p. ej. un cierre) lo continúa donde quedó"""
+    estado = estado or {}
+    return {
+        'pu': float(estado.get('costo_promedio') or 0),
+        'saldo_u': float(unidades or 0) + float(estado.get('unidades') or 0),
+        'saldo_mx': float(estado.get('valor') or 0),
+        'entradas': float(estado.get('entradas') or 0),
+        'salidas': float(estado.get('salidas') or 0),
+        'movimientos': int(estado.get('movimientos') or 0),
+    }
+
+
+def aplicar(estado, tipo, unidades, precio_unitario):
+    """Aplica un movimiento al acumulado (entradas recalculan el promedio, salidas a costo vigente)"""
+    tipo = (tipo or '').strip().lower()
+    if tipo in ('entrada', 'compra'):
+        entrada_u = float(unidades or 0.0)
+        estado['saldo_u'] += entrada_u
+        estado['saldo_mx'] += entrada_u * float(precio_unitario or 0.0)
+        estado['entradas'] += entrada_u
+        estado['pu'] = estado['saldo_mx'] / estado['saldo_u'] if estado['saldo_u'] > 0 else 0.0
+
+    elif tipo == 'salida':
+        salida_u = float(unidades or 0.0)
+        estado['saldo_u'] -= salida_u
+        estado['saldo_mx'] -= salida_u * estado['pu']
+        estado['salidas'] += salida_u
+    estado['movimientos'] += 1
+
+
+def promedio_ponderado(movimientos, saldos_iniciales, estados=None):
+    """
+    Recorre movimientos ya ordenados por producto base y regresa
+    {producto_base_id: {'entradas', 'salidas', 'disponible', 'valor_inventario'}}
+    estados: {producto_base_id: cierre} para continuar desde un cierre en vez de cero
+    """
+    estados = estados or {}
+    resultado = {}
+    actual = None
+    estado = None
+
+    def cerrar():
+        resultado[actual] = {
+            'entradas': estado['entradas'],
+            'salidas': estado['salidas'],
+            'disponible': estado['saldo_u'],
+            'valor_inventario': estado['saldo_mx'],
+        }
+
+    for producto_base_id, _fecha, tipo, unidades, precio_unitario in movimientos:
+        if producto_base_id != actual:
+            if actual is not None:
+                cerrar()
+            actual = producto_base_id
+            estado = estado_inicial(saldos_iniciales.get(actual), estados.get(actual))
+        aplicar(estado, tipo, unidades, precio_unitario)
+
+    if actual is not None:
+        cerrar()
+
+    # Productos con cierre y sin movimientos posteriores
+    for actual in set(estados) - set(resultado):
+        estado = estado_inicial(saldos_iniciales.get(actual), estados[actual])
+        cerrar()
+    return resultado
+
+
+def costear_productos_base(inventario, conn, empresa_id, tipo_inventario_id):
+    """
+    Llena entradas/salidas/disponible/valor_inventario de cada producto base
+    (filas con 'producto_base_id' e 'inventario_inicial') con una sola consulta.
+    """
+    iniciales = {item['producto_base_id']: item['inventario_inicial'] for item in inventario}
+    costeo = promedio_ponderado(
+        _movimientos_ordenados(conn, empresa_id, tipo_inventario_id), iniciales
+    )
+    llenar_inventario(inventario, costeo)
+    return inventario
+
+
+def llenar_inventario(inventario, costeo):
+    """Copia el costeo a las filas del inventario (sin movimientos: solo el inicial)"""
+    for item in inventario:
+        r = costeo.get(item['producto_base_id'])
+        if r is None:
+            r = {'entradas': 0.0, 'salidas': 0.0,
+                 'disponible': float(item['inventario_inicial']), 'valor_inventario': 0.0}
+        item.update(r)
+    return inventario
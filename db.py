@@ -1,12 +1,21 @@
 import mysql.connector
-from mysql.connector import pooling
 import os
+import queue
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def conexion_db():
-    """Conexión sin pool para evitar problemas de conexiones agotadas"""
+# ===== CONFIGURACIÓN DEL POOL (LEE DESDE .env) =====
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))              # conexiones que se conservan abiertas
+DB_POOL_MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))  # extra temporales en picos
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))     # segundos esperando una conexión libre
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))     # segundos antes de reciclar una conexión
+
+
+def _nueva_conexion():
+    """Abre una conexión física nueva (la usa el pool internamente)"""
     try:
         return mysql.connector.connect(
             host=os.environ.get('DB_HOST', 'localhost'),
@@ -22,4 +31,258 @@ def conexion_db():
         print(f"   Host: {os.environ.get('DB_HOST', 'localhost')}")
         print(f"   User: {os.environ.get('DB_USER', 'root')}")
         print(f"   Database: {os.environ.get('DB_NAME', 'miapp')}")
-        raise
\ No newline at end of file
+        raise
+
+
+class PoolAgotado(Exception):
+    """No se obtuvo conexión libre dentro de DB_POOL_TIMEOUT"""
+
+
+class PoolConexiones:
+    """
+    Pool acotado de conexiones MySQL.
+    - Conserva hasta `tamano` conexiones abiertas y permite `max_overflow` extra
+      que se cierran al devolverse.
+    - Verifica la conexión (ping) antes de entregarla y recicla las que superan
+      `reciclar` segundos de vida.
+    - Lleva métricas para dimensionar el pool (checkouts, espera, agotamientos).
+    """
+
+    def __init__(self, fabrica, tamano=DB_POOL_SIZE, max_overflow=DB_POOL_MAX_OVERFLOW,
+                 timeout=DB_POOL_TIMEOUT, reciclar=DB_POOL_RECYCLE):
+        self._fabrica = fabrica
+        self.tamano = tamano
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.reciclar = reciclar
+
+        self._libres = queue.LifoQueue(maxsize=tamano)
+        self._lock = threading.Lock()
+        self._abiertas = 0
+        self._creada_en = {}
+
+        self._metricas = {
+            "checkouts": 0,
+            "en_uso": 0,
+            "max_en_uso": 0,
+            "creadas": 0,
+            "recicladas": 0,
+            "descartadas": 0,
+            "agotamientos": 0,
+            "espera_total_ms": 0.0,
+            "espera_max_ms": 0.0,
+        }
+
+    # ----- internos -----
+
+    def _crear(self):
+        raw = self._fabrica()
+        with self._lock:
+            self._creada_en[id(raw)] = time.monotonic()
+            self._metricas["creadas"] += 1
+        return raw
+
+    def _descartar(self, raw):
+        with self._lock:
+            self._abiertas -= 1
+            self._creada_en.pop(id(raw), None)
+            self._metricas["descartadas"] += 1
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _sana(self, raw):
+        """Health check: edad máxima + ping al servidor"""
+        creada = self._creada_en.get(id(raw), 0)
+        if self.reciclar and time.monotonic() - creada > self.reciclar:
+            with self._lock:
+                self._metricas["recicladas"] += 1
+            return False
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    # ----- API -----
+
+    def obtener(self):
+        """Entrega una conexión cruda sana; espera hasta `timeout` si el pool está lleno"""
+        inicio = time.monotonic()
+        raw = None
+
+        while raw is None:
+            try:
+                raw = self._libres.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    puede_abrir = self._abiertas < self.tamano + self.max_overflow
+                    if puede_abrir:
+                        self._abiertas += 1
+                if puede_abrir:
+                    try:
+                        raw = self._crear()
+                    except Exception:
+                        with self._lock:
+                            self._abiertas -= 1
+                        raise
+                    break
+
+                restante = self.timeout - (time.monotonic() - inicio)
+                try:
+                    raw = self._libres.get(timeout=max(restante, 0))
+                except queue.Empty:
+                    with self._lock:
+                        self._metricas["agotamientos"] += 1
+                    raise PoolAgotado(
+                        f"Pool MySQL agotado ({self.tamano}+{self.max_overflow} conexiones en uso)"
+                    )
+
+            if not self._sana(raw):
+                self._descartar(raw)
+                raw = None
+                with self._lock:
+                    self._abiertas += 1
+                try:
+                    raw = self._crear()
+                except Exception:
+                    with self._lock:
+                        self._abiertas -= 1
+                    raise
+
+        espera_ms = (time.monotonic() - inicio) * 1000
+        with self._lock:
+            m = self._metricas
+            m["checkouts"] += 1
+            m["en_uso"] += 1
+            m["max_en_uso"] = max(m["max_en_uso"], m["en_uso"])
+            m["espera_total_ms"] += espera_ms
+            m["espera_max_ms"] = max(m["espera_max_ms"], espera_ms)
+        return raw
+
+    def devolver(self, raw):
+        """Regresa la conexión al pool descartando cualquier transacción pendiente"""
+        with self._lock:
+            self._metricas["en_uso"] -= 1
+        try:
+            raw.rollback()
+        except Exception:
+            self._descartar(raw)
+            return
+        try:
+            self._libres.put_nowait(raw)
+        except queue.Full:
+            # Conexión de overflow: se cierra
+            self._descartar(raw)
+
+    def metricas(self):
+        with self._lock:
+            m = dict(self._metricas)
+            m["abiertas"] = self._abiertas
+        m["libres"] = self._libres.qsize()
+        m["tamano"] = self.tamano
+        m["max_overflow"] = self.max_overflow
+        m["espera_promedio_ms"] = round(m["espera_total_ms"] / m["checkouts"], 3) if m["checkouts"] else 0.0
+        m["espera_total_ms"] = round(m["espera_total_ms"], 3)
+        m["espera_max_ms"] = round(m["espera_max_ms"], 3)
+        return m
+
+
+class ConexionPool:
+    """
+    Envoltura de una conexión prestada por el pool.
+    Se comporta como la conexión de mysql.connector, pero:
+    - cursor() es buffered por defecto (varios helpers comparten la conexión
+      y un resultado sin leer bloquearía al siguiente).
+    - close() devuelve la conexión al pool; si pertenece a la petición actual
+      (flask.g) no hace nada y se libera en el teardown.
+    """
+
+    def __init__(self, pool, raw, de_request=False):
+        self._pool = pool
+        self._raw = raw
+        self._de_request = de_request
+
+    def cursor(self, *args, **kwargs):
+        if not args and "cursor_class" not in kwargs and "prepared" not in kwargs:
+            kwargs.setdefault("buffered", True)
+        return self._raw.cursor(*args, **kwargs)
+
+    def close(self):
+        if self._de_request:
+            return
+        self._liberar()
+
+    def _liberar(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.devolver(raw)
+
+    def __getattr__(self, nombre):
+        if self._raw is None:
+            raise mysql.connector.errors.OperationalError("La conexión ya fue devuelta al pool")
+        return getattr(self._raw, nombre)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PoolConexiones(_nueva_conexion)
+    return _pool
+
+
+def conexion_db():
+    """
+    Conexión desde el pool.
+    Dentro de una petición Flask se reutiliza la misma conexión (guardada en g)
+    para la vista y todos los helpers; fuera de petición se presta una del pool
+    que vuelve a él con close().
+    Por eso un helper llamado desde una vista no hace commit()/rollback() sobre
+    ella: recibe el cursor del que llama (y deja el commit a la vista) o escribe
+    por conexion_aparte().
+    """
+    from flask import g, has_app_context
+
+    pool = obtener_pool()
+    if not has_app_context():
+        return ConexionPool(pool, pool.obtener())
+
+    conn = g.get("_db_conn")
+    if conn is None or conn._raw is None:
+        conn = ConexionPool(pool, pool.obtener(), de_request=True)
+        g._db_conn = conn
+    return conn
+
+
+def conexion_aparte():
+    """
+    Conexión del pool independiente de la de la petición: su commit / rollback no
+    toca la transacción de la vista. Se devuelve al pool con close().
+    """
+    pool = obtener_pool()
+    return ConexionPool(pool, pool.obtener())
+
+
+def liberar_conexion_request(exc=None):
+    """Teardown: devuelve al pool la conexión de la petición (con rollback de lo no confirmado)"""
+    from flask import g
+
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        conn._liberar()
+
+
+def metricas_pool():
+    return obtener_pool().metricas()
+
+
+def init_app(app):
+    """Registra la liberación de la conexión por petición en la app Flask"""
+    app.teardown_appcontext(liberar_conexion_request)
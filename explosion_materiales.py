@@ -0,0 +1,328 @@
+"""
+Explosión de materiales (MRP) de las órdenes de producción abiertas
+Antes nada sumaba lo que van a consumir las órdenes pendientes; orden_iniciar leía
+los insumos de una orden a la vez (cantidad / LOTE_BASE por paso).
+Ahora:
+1. Consultas fijas por empresa (no por orden ni por paso): órdenes abiertas sin
+   iniciar, procesos activos, insumos por proceso (proceso_pasos → paso_insumos,
+   sumados) y existencias
+2. Recetas: componentes por unidad de cada proceso, cargados una vez y memorizados
+3. explotar(): recorre el grafo de recetas en orden topológico (padres antes que
+   hijos). Cada insumo se neta contra su existencia en orden de fecha y solo el
+   faltante de un intermedio (insumo con proceso propio) se explota al siguiente nivel
+4. Resultado por materia prima: bruto, neto, primera fecha con faltante y neto por fecha
+   (criterio "proyeccion_produccion" de orden_compra_auto)
+5. Consumo al iniciar una orden (wip.orden_iniciar): insumos, existencias y precios de
+   60 días en consultas agrupadas para todos los insumos; las filas de mercancia de los
+   insumos se bloquean (FOR UPDATE, en orden de id) antes de leer existencias para que
+   dos órdenes simultáneas no consuman el mismo stock
+"""
+
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from saldos_inventario import snapshot_activo, leer_existencias
+from cierres_inventario import TIPO_POR_MERCANCIA, cierre_vigente, leer_cierre
+
+LOTE_BASE = 12.0        # las cantidades de paso_insumos son por lote de 12 unidades
+REFERENCIA_INICIO = "Orden #{} - Inicio producción"
+DIAS_PRECIO = 60        # ventana del precio promedio ponderado de compras
+
+
+def _dia(valor):
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    return datetime.strptime(str(valor)[:10], '%Y-%m-%d').date()
+
+
+class Recetas:
+    """Proceso activo por producto y sus insumos por lote, de toda la empresa"""
+
+    def __init__(self, procesos, insumos):
+        # procesos: [{'id', 'pt_id'}]; insumos: [{'proceso_id', 'mp_id', 'cantidad'}]
+        self.proceso_por_pt = {}
+        for p in procesos:
+            self.proceso_por_pt.setdefault(p['pt_id'], p['id'])
+        self.insumos = defaultdict(dict)
+        for r in insumos:
+            por_lote = self.insumos[r['proceso_id']]
+            por_lote[r['mp_id']] = por_lote.get(r['mp_id'], 0.0) + float(r['cantidad'] or 0)
+        self._por_unidad = {}
+
+    def tiene_proceso(self, mercancia_id):
+        return mercancia_id in self.proceso_por_pt
+
+    def por_unidad(self, mercancia_id):
+        """{insumo: cantidad por unidad producida} (memorizado por proceso)"""
+        proceso_id = self.proceso_por_pt.get(mercancia_id)
+        if proceso_id is None:
+            return {}
+        componentes = self._por_unidad.get(proceso_id)
+        if componentes is None:
+            componentes = {mp: c / LOTE_BASE for mp, c in self.insumos.get(proceso_id, {}).items()}
+            self._por_unidad[proceso_id] = componentes
+        return componentes
+
+    def orden_topologico(self, raices):
+        """Insumos alcanzables desde `raices`, cada uno después de todos los que lo usan"""
+        visitados, en_curso, salida = set(), set(), []
+
+        def visitar(item):
+            # Una receta que se usa a sí misma (ciclo) se corta en la arista de regreso
+            if item in visitados or item in en_curso:
+                return
+            en_curso.add(item)
+            for hijo in self.por_unidad(item):
+                visitar(hijo)
+            en_curso.discard(item)
+            visitados.add(item)
+            salida.append(item)
+
+        for r in raices:
+            visitar(r)
+        return salida[::-1]
+
+
+def explotar(recetas, ordenes, existencias):
+    """
+    ordenes: [(pt_id, fecha, cantidad)]; existencias: {mercancia_id: unidades}.
+    Regresa {mp_id: {'bruto', 'neto', 'fecha', 'por_fecha': {fecha: neto}}} de los
+    insumos sin proceso propio.
+    """
+    demanda = defaultdict(lambda: defaultdict(float))      # insumo -> fecha -> cantidad
+    raices = []
+    for pt_id, fecha, cantidad in ordenes:
+        for insumo, por_unidad in recetas.por_unidad(pt_id).items():
+            demanda[insumo][fecha] += cantidad * por_unidad
+            raices.append(insumo)
+
+    resultado = {}
+    for item in recetas.orden_topologico(raices):
+        fechas = demanda.get(item)
+        if not fechas:
+            continue
+        disponible = max(existencias.get(item, 0.0), 0.0)
+        bruto_total, netos = 0.0, {}
+        for fecha in sorted(fechas):
+            bruto = fechas[fecha]
+            bruto_total += bruto
+            usa = min(disponible, bruto)
+            disponible -= usa
+            if bruto - usa > 1e-9:
+                netos[fecha] = bruto - usa
+
+        if recetas.tiene_proceso(item):
+            # Intermedio: solo lo que falta se produce y baja al siguiente nivel
+            for fecha, neto in netos.items():
+                for hijo, por_unidad in recetas.por_unidad(item).items():
+                    demanda[hijo][fecha] += neto * por_unidad
+        else:
+            resultado[item] = {
+                'bruto': bruto_total,
+                'neto': sum(netos.values()),
+                'fecha': min(netos) if netos else None,
+                'por_fecha': netos,
+            }
+    return resultado
+
+
+# -------------------- Carga --------------------
+
+def ordenes_abiertas(cur, empresa_id):
+    """[(pt_id, fecha, cantidad)] de las órdenes abiertas que aún no consumen insumos"""
+    cur.execute("""
+        SELECT id, pt_mercancia_id, fecha, cantidad
+        FROM orden_produccion
+        WHERE empresa_id = %s AND estado = 'abierta'
+    """, (empresa_id,))
+    ordenes = cur.fetchall()
+    if not ordenes:
+        return []
+    # orden_iniciar deja la orden 'abierta'; las iniciadas se reconocen por su salida
+    referencias = [REFERENCIA_INICIO.format(o['id']) for o in ordenes]
+    cur.execute(f"""
+        SELECT DISTINCT referencia
+        FROM inventario_movimientos
+        WHERE empresa_id = %s AND referencia IN ({','.join(['%s'] * len(referencias))})
+    """, [empresa_id] + referencias)
+    iniciadas = {r['referencia'] for r in cur.fetchall()}
+    return [(o['pt_mercancia_id'], _dia(o['fecha']), float(o['cantidad'] or 0))
+            for o, ref in zip(ordenes, referencias) if ref not in iniciadas]
+
+
+def cargar_recetas(cur, empresa_id):
+    cur.execute("""
+        SELECT MIN(id) AS id, pt_id
+        FROM procesos
+        WHERE empresa_id = %s AND activo = 1
+        GROUP BY pt_id
+    """, (empresa_id,))
+    procesos = cur.fetchall()
+    cur.execute("""
+        SELECT pp.proceso_id, pi.mp_id, SUM(pi.cantidad_por_lote) AS cantidad
+        FROM proceso_pasos pp
+        JOIN paso_insumos pi ON pi.paso_id = pp.id
+        JOIN procesos p ON p.id = pp.proceso_id AND p.activo = 1
+        WHERE pp.empresa_id = %s
+          AND pi.cantidad_por_lote > 0
+        GROUP BY pp.proceso_id, pi.mp_id
+    """, (empresa_id,))
+    return Recetas(procesos, cur.fetchall())
+
+
+def existencias_historia(cur, empresa_id, mercancia_ids):
+    """{mercancia_id: unidades} desde inventario_movimientos (sin snapshot)"""
+    ids = list(mercancia_ids)
+    if not ids:
+        return {}
+    cur.execute(f"""
+        SELECT mercancia_id,
+               COALESCE(SUM(CASE
+                   WHEN tipo_movimiento IN ('compra','entrada') THEN unidades
+                   ELSE -unidades
+               END), 0) AS stock_actual
+        FROM inventario_movimientos
+        WHERE empresa_id = %s AND mercancia_id IN ({','.join(['%s'] * len(ids))})
+        GROUP BY mercancia_id
+    """, [empresa_id] + ids)
+    return {r['mercancia_id']: float(r['stock_actual'] or 0) for r in cur.fetchall()}
+
+
+def requerimientos_produccion(cur, empresa_id):
+    """Requerimientos netos de materia prima de las órdenes abiertas (ver explotar)"""
+    ordenes = ordenes_abiertas(cur, empresa_id)
+    if not ordenes:
+        return {}
+    recetas = cargar_recetas(cur, empresa_id)
+    insumos = recetas.orden_topologico(
+        {i for pt, _f, _c in ordenes for i in recetas.por_unidad(pt)})
+    if snapshot_activo(cur, empresa_id):
+        existencias = leer_existencias(cur, empresa_id, insumos)
+    else:
+        existencias = existencias_historia(cur, empresa_id, insumos)
+    return explotar(recetas, ordenes, existencias)
+
+
+# -------------------- Consumo de una orden --------------------
+
+def _en(ids):
+    return ','.join(['%s'] * len(ids))
+
+
+def orden_iniciada(cur, empresa_id, orden_id):
+    cur.execute("""
+        SELECT 1 FROM inventario_movimientos
+        WHERE empresa_id = %s AND referencia = %s
+        LIMIT 1
+    """, (empresa_id, REFERENCIA_INICIO.format(orden_id)))
+    return cur.fetchone() is not None
+
+
+def insumos_proceso(cur, empresa_id, proceso_id):
+    """Insumos del proceso sumados por materia prima (un insumo puede repetirse en varios pasos)"""
+    cur.execute("""
+        SELECT
+            pi.mp_id,
+            SUM(pi.cantidad_por_lote) AS cantidad_por_lote,
+            m.nombre AS mp_nombre,
+            m.tipo_inventario_id
+        FROM proceso_pasos pp
+        JOIN paso_insumos pi
+             ON pi.paso_id = pp.id
+        JOIN mercancia m
+             ON m.id = pi.mp_id
+            AND m.empresa_id = %s
+        WHERE pp.proceso_id = %s
+          AND pp.empresa_id = %s
+          AND pi.cantidad_por_lote > 0
+        GROUP BY pi.mp_id, m.nombre, m.tipo_inventario_id
+        ORDER BY pi.mp_id
+    """, (empresa_id, proceso_id, empresa_id))
+    return cur.fetchall()
+
+
+def bloquear_insumos(cur, empresa_id, mercancia_ids):
+    """
+    Bloquea las filas de mercancia de los insumos hasta el commit. Todas las órdenes
+    bloquean en orden de id: la segunda espera a la primera sin interbloqueos y lee
+    sus existencias ya descontadas.
+    """
+    ids = sorted(set(mercancia_ids))
+    if ids:
+        cur.execute(f"""
+            SELECT id FROM mercancia
+            WHERE empresa_id = %s AND id IN ({_en(ids)})
+            ORDER BY id
+            FOR UPDATE
+        """, [empresa_id] + ids)
+        cur.fetchall()
+
+
+def existencias_actuales(cur, empresa_id, mercancia_ids):
+    """{mercancia_id: unidades} del snapshot de saldos o, sin él, de la historia"""
+    if snapshot_activo(cur, empresa_id):
+        return leer_existencias(cur, empresa_id, mercancia_ids)
+    return existencias_historia(cur, empresa_id, mercancia_ids)
+
+
+def precios_promedio(cur, empresa_id, mercancia_ids, dias=DIAS_PRECIO, hoy=None):
+    """
+    {mercancia_id: precio} promedio ponderado de las compras / entradas de los últimos
+    `dias` (como calcular_precio_promedio_periodo). Sin compras en la ventana: costo
+    promedio del último cierre; si tampoco hay, 0.
+    """
+    ids = list(mercancia_ids)
+    if not ids:
+        return {}
+    desde = (hoy or date.today()) - timedelta(days=dias)
+    cur.execute(f"""
+        SELECT mercancia_id,
+               SUM(unidades * precio_unitario) AS valor_total,
+               SUM(unidades) AS unidades_total
+        FROM inventario_movimientos
+        WHERE empresa_id = %s
+          AND mercancia_id IN ({_en(ids)})
+          AND tipo_movimiento IN ('compra', 'entrada')
+          AND precio_unitario > 0
+          AND fecha >= %s
+        GROUP BY mercancia_id
+    """, [empresa_id] + ids + [desde])
+    precios = {}
+    for r in cur.fetchall():
+        unidades = float(r['unidades_total'] or 0)
+        if unidades > 0:
+            precios[r['mercancia_id']] = float(r['valor_total'] or 0) / unidades
+    faltantes = [mid for mid in ids if not precios.get(mid)]
+    precios.update(_costos_cierre(cur, empresa_id, faltantes))
+    return precios
+
+
+def _costos_cierre(cur, empresa_id, mercancia_ids):
+    """
+    {mercancia_id: costo promedio de su producto base en el último cierre vigente}
+    (0 si no hay cierre). Una consulta por tipo de inventario, no ~5 por mercancía.
+    """
+    costos = {mid: 0.0 for mid in mercancia_ids}
+    if not mercancia_ids:
+        return costos
+    cierre = cierre_vigente(cur, empresa_id)
+    if cierre is None:
+        return costos
+    cur.execute(f"""
+        SELECT id, producto_base_id, tipo
+        FROM mercancia
+        WHERE empresa_id = %s AND id IN ({_en(mercancia_ids)})
+    """, [empresa_id] + list(mercancia_ids))
+    por_tipo = defaultdict(dict)
+    for r in cur.fetchall():
+        tipo_id = TIPO_POR_MERCANCIA.get(r['tipo'])
+        if tipo_id and r['producto_base_id']:
+            por_tipo[tipo_id][r['id']] = r['producto_base_id']
+    for tipo_id, bases in por_tipo.items():
+        estados = leer_cierre(cur, empresa_id, tipo_id, cierre['periodo'], set(bases.values()))
+        for mid, pb in bases.items():
+            if pb in estados:
+                costos[mid] = estados[pb]['costo_promedio']
+    return costos
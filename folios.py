@@ -0,0 +1,235 @@
+"""
+Folios consecutivos por empresa, tipo y día (OC-, FB-, OCA-)
+Antes cada folio se calculaba con COUNT(*) + 1 ... WHERE folio LIKE 'PREFIJO%' antes
+del INSERT: recorría los registros del día y dos peticiones simultáneas obtenían el
+mismo número.
+Ahora:
+1. folio_sequences (migrations/008): un renglón por (empresa, tipo, fecha) con el
+   último número entregado
+2. siguiente_folio(cur, ...): INSERT ... ON DUPLICATE KEY UPDATE n = LAST_INSERT_ID(n + 1)
+   en la transacción del que llama. El renglón queda bloqueado hasta su commit (la
+   siguiente petición espera) y un rollback devuelve el número: folios sin huecos
+3. Por omisión todos los tipos van por transacción (bloque 1). Un tipo de mucho
+   volumen puede optar por FOLIO_BLOQUE_<TIPO>=N > 1: se reserva un bloque de números
+   en una conexión aparte (commit inmediato) y se reparte desde memoria sin tocar la
+   base; un rollback o reinicio deja huecos, nunca repetidos
+4. Sin la migración: COUNT(*) + 1 como antes, pero en la transacción del que llama
+5. CLI: flask folios estres [--hilos N] [--por-hilo N] [--bloque N]
+"""
+
+import os
+import threading
+import time
+from datetime import date, datetime
+
+import mysql.connector
+
+from db import conexion_aparte
+
+ER_NO_SUCH_TABLE = 1146
+
+# tipo -> tabla y columna de empresa (para el respaldo sin migración)
+TIPOS = {
+    'OC': ('ordenes_compra_b2b', 'empresa_cliente_id'),
+    'FB': ('facturas_b2b', 'empresa_emisora_id'),
+    'OCA': ('ordenes_compra_automaticas', 'empresa_id'),
+}
+# Todos sin huecos por omisión; FOLIO_BLOQUE_<TIPO>=N activa la reserva por bloque
+BLOQUES = {tipo: int(os.environ.get(f'FOLIO_BLOQUE_{tipo}', 1)) for tipo in TIPOS}
+
+_bloques = {}           # (empresa_id, tipo, fecha) -> [siguiente, ultimo]
+_lock = threading.Lock()
+_lock_reserva = threading.Lock()
+_metricas = {'transaccion': 0, 'bloque': 0, 'reservas': 0, 'respaldo_count': 0}
+
+
+def _sin_tabla(err):
+    return getattr(err, 'errno', None) == ER_NO_SUCH_TABLE
+
+
+def formatear(tipo, empresa_id, fecha, n):
+    return f"{tipo}-{empresa_id}-{fecha.strftime('%Y%m%d')}-{n:03d}"
+
+
+def _incrementar(cur, empresa_id, tipo, fecha, cantidad):
+    """Suma `cantidad` al contador y regresa el último número asignado"""
+    cur.execute("""
+        INSERT INTO folio_sequences (empresa_id, tipo, fecha, n)
+        VALUES (%s, %s, %s, LAST_INSERT_ID(%s))
+        ON DUPLICATE KEY UPDATE n = LAST_INSERT_ID(n + %s)
+    """, (empresa_id, tipo, fecha, cantidad, cantidad))
+    # LAST_INSERT_ID(expr) también llega como insert_id del OK del servidor
+    if cur.lastrowid:
+        return cur.lastrowid
+    cur.execute("SELECT LAST_INSERT_ID() AS n")
+    row = cur.fetchone()
+    return row['n'] if isinstance(row, dict) else row[0]
+
+
+def _por_count(cur, empresa_id, tipo, fecha):
+    tabla, columna = TIPOS[tipo]
+    cur.execute(f"""
+        SELECT COUNT(*) + 1 AS siguiente FROM {tabla}
+        WHERE {columna} = %s AND folio LIKE %s
+    """, (empresa_id, formatear(tipo, empresa_id, fecha, 0)[:-3] + '%'))
+    row = cur.fetchone()
+    return row['siguiente'] if isinstance(row, dict) else row[0]
+
+
+def _reservar_bloque(empresa_id, tipo, fecha, tamano):
+    """(primero, ultimo) reservados con commit inmediato en una conexión aparte"""
+    conn = conexion_aparte()
+    cur = conn.cursor()
+    try:
+        ultimo = _incrementar(cur, empresa_id, tipo, fecha, tamano)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    with _lock:
+        _metricas['reservas'] += 1
+    return ultimo - tamano + 1, ultimo
+
+
+def _del_bloque(empresa_id, tipo, fecha, tamano):
+    clave = (empresa_id, tipo, fecha)
+    # Un solo hilo reserva a la vez; los demás toman del bloque nuevo al soltarse
+    with _lock_reserva:
+        with _lock:
+            bloque = _bloques.get(clave)
+            if bloque and bloque[0] <= bloque[1]:
+                bloque[0] += 1
+                _metricas['bloque'] += 1
+                return bloque[0] - 1
+        primero, ultimo = _reservar_bloque(empresa_id, tipo, fecha, tamano)
+        with _lock:
+            _bloques[clave] = [primero + 1, ultimo]
+            _metricas['bloque'] += 1
+        return primero
+
+
+def siguiente_folio(cur, empresa_id, tipo, fecha=None, bloque=None):
+    """
+    Siguiente folio TIPO-EMPRESA-YYYYMMDD-### del día. Con bloque 1 (o sin config)
+    va en la transacción de `cur`: el que llama hace commit junto con su INSERT.
+    """
+    fecha = fecha or date.today()
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    tamano = bloque if bloque is not None else BLOQUES.get(tipo, 1)
+    try:
+        if tamano > 1:
+            n = _del_bloque(empresa_id, tipo, fecha, tamano)
+        else:
+            n = _incrementar(cur, empresa_id, tipo, fecha, 1)
+            with _lock:
+                _metricas['transaccion'] += 1
+    except mysql.connector.Error as err:
+        if not _sin_tabla(err) or tipo not in TIPOS:
+            raise
+        n = _por_count(cur, empresa_id, tipo, fecha)
+        with _lock:
+            _metricas['respaldo_count'] += 1
+    return formatear(tipo, empresa_id, fecha, n)
+
+
+def olvidar_bloques(empresa_id=None, tipo=None):
+    """Descarta los números reservados en memoria (quedan como huecos)"""
+    with _lock:
+        for clave in list(_bloques):
+            if (empresa_id is None or clave[0] == empresa_id) and (tipo is None or clave[1] == tipo):
+                del _bloques[clave]
+
+
+def metricas_folios():
+    with _lock:
+        m = dict(_metricas)
+        m['bloques_en_memoria'] = {formatear(t, e, f, 0)[:-4]: u - n + 1
+                                   for (e, t, f), (n, u) in _bloques.items()}
+    m['tamano_bloque'] = dict(BLOQUES)
+    return m
+
+
+# -------------------- Prueba de concurrencia --------------------
+
+def prueba_estres(hilos=8, por_hilo=50, bloque=1, empresa_id=0, tipo='TST', rollback_cada=7):
+    """
+    `hilos` conexiones pidiendo folios a la vez; cada `rollback_cada` se revierte la
+    transacción. Regresa {'folios', 'unicos', 'repetidos', 'segundos'} y limpia.
+    """
+    fecha = date.today()
+    entregados, errores = [], []
+    inicio = threading.Barrier(hilos)
+
+    def trabajador(h):
+        conn = conexion_aparte()
+        cur = conn.cursor()
+        try:
+            inicio.wait()
+            for i in range(por_hilo):
+                folio = siguiente_folio(cur, empresa_id, tipo, fecha, bloque)
+                if rollback_cada and (h * por_hilo + i) % rollback_cada == 0:
+                    conn.rollback()
+                    if bloque > 1:
+                        entregados.append(folio)   # el bloque ya estaba confirmado
+                else:
+                    conn.commit()
+                    entregados.append(folio)
+        except Exception as e:
+            errores.append(e)
+            conn.rollback()
+        finally:
+            cur.close()
+            conn.close()
+
+    t0 = time.perf_counter()
+    ts = [threading.Thread(target=trabajador, args=(h,)) for h in range(hilos)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    segundos = time.perf_counter() - t0
+
+    conn = conexion_aparte()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM folio_sequences WHERE empresa_id = %s AND tipo = %s",
+                    (empresa_id, tipo))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+    olvidar_bloques(empresa_id, tipo)
+
+    if errores:
+        raise errores[0]
+    return {'folios': len(entregados), 'unicos': len(set(entregados)),
+            'repetidos': len(entregados) - len(set(entregados)), 'segundos': segundos}
+
+
+def init_app(app):
+    """Registra el comando: flask folios estres"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('folios', help='Secuencias de folios')
+
+    @grupo.command('estres')
+    @click.option('--hilos', type=int, default=8)
+    @click.option('--por-hilo', type=int, default=50)
+    @click.option('--bloque', type=int, default=None, help='Tamaño de bloque (default: 1 y 20)')
+    def estres_cmd(hilos, por_hilo, bloque):
+        fallas = 0
+        for b in ([bloque] if bloque else [1, 20]):
+            r = prueba_estres(hilos, por_hilo, b)
+            ok = r['repetidos'] == 0
+            fallas += not ok
+            click.echo(f"{'✅' if ok else '❌'} bloque {b}: {r['folios']} folios, "
+                       f"{r['repetidos']} repetidos, {r['folios'] / r['segundos']:.0f} folios/s")
+        if fallas:
+            raise SystemExit(1)
+
+    app.cli.add_command(grupo)
@@ -0,0 +1,225 @@
+"""
+Importación de compras desde CSV / XLSX (ver /compras/importar)
+- filas_archivo(): generador de filas; el CSV se lee en streaming y el XLSX se recorre
+  con iterparse (zipfile + xml, sin dependencias), liberando cada renglón al leerlo
+- renglones_archivo(): mapea encabezados ('producto', 'cantidad', 'precio', ...) al
+  formato de compras_lote y numera las filas como en la hoja
+- bloques_validos(): resuelve cada bloque de renglones con una consulta a mercancia
+  (compras_lote.resolver_mercancias) con los niveles de resolver_mercancia (id →
+  nombre exacto → tokens en orden; el índice en memoria solo propone el candidato
+  aproximado, que se relee en la misma consulta)
+- Reporte: conciliación acotada (contadores completos, detalle de las primeras filas)
+
+Las filas válidas se escriben en bloques con compras_lote.insertar_renglones dentro de
+una sola transacción.
+"""
+
+import csv
+import io
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+from busqueda_mercancias import normalizar
+from compras_lote import resolver_mercancias, validar_renglones
+
+TAMANO_BLOQUE = 500
+MAX_DETALLE = 200  # filas con error / aproximadas que se listan en el reporte
+MAX_DETALLE_SESION = 10  # el reporte que viaja en la cookie de sesión tras el redirect
+
+_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+# Encabezados aceptados (normalizados con busqueda_mercancias.normalizar) → campo de compras_lote
+ENCABEZADOS = {
+    'mercancia_id': 'mercancia_id', 'id': 'mercancia_id', 'clave': 'mercancia_id',
+    'producto': 'nombre', 'nombre': 'nombre', 'mercancia': 'nombre',
+    'descripcion': 'nombre', 'concepto': 'nombre',
+    'unidades': 'unidades', 'cantidad': 'unidades',
+    'precio_unitario': 'precio_unitario', 'precio unitario': 'precio_unitario',
+    'precio': 'precio_unitario', 'costo': 'precio_unitario', 'costo unitario': 'precio_unitario',
+    'precio_total': 'precio_total', 'precio total': 'precio_total',
+    'total': 'precio_total', 'importe': 'precio_total',
+}
+
+
+# -------------------- Lectura --------------------
+
+def filas_csv(stream):
+    """Genera listas de celdas; detecta ',', ';' o tabulador"""
+    texto = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    muestra = texto.read(4096)
+    try:
+        dialecto = csv.Sniffer().sniff(muestra, delimiters=',;\t')
+    except csv.Error:
+        dialecto = csv.excel
+    texto.seek(0)
+    try:
+        yield from csv.reader(texto, dialecto)
+    finally:
+        texto.detach()
+
+
+def _columna(ref):
+    """'C12' → 2"""
+    n = 0
+    for c in ref:
+        if not c.isalpha():
+            break
+        n = n * 26 + ord(c.upper()) - 64
+    return n - 1
+
+
+def _textos_compartidos(zf):
+    if 'xl/sharedStrings.xml' not in zf.namelist():
+        return []
+    textos = []
+    with zf.open('xl/sharedStrings.xml') as f:
+        for _evento, el in iterparse(f):
+            if el.tag == _NS + 'si':
+                textos.append(''.join(t.text or '' for t in el.iter(_NS + 't')))
+                el.clear()
+    return textos
+
+
+def filas_xlsx(stream):
+    """Genera listas de celdas de la primera hoja (requiere un archivo con seek)"""
+    with zipfile.ZipFile(stream) as zf:
+        textos = _textos_compartidos(zf)
+        hojas = sorted(n for n in zf.namelist()
+                       if n.startswith('xl/worksheets/sheet') and n.endswith('.xml'))
+        if not hojas:
+            return
+        with zf.open(hojas[0]) as f:
+            for _evento, el in iterparse(f):
+                if el.tag != _NS + 'row':
+                    continue
+                celdas = {}
+                siguiente = 0
+                for c in el.iter(_NS + 'c'):
+                    tipo = c.get('t')
+                    if tipo == 'inlineStr':
+                        valor = ''.join(t.text or '' for t in c.iter(_NS + 't'))
+                    else:
+                        v = c.find(_NS + 'v')
+                        valor = v.text if v is not None else ''
+                        if tipo == 's' and valor:
+                            valor = textos[int(valor)]
+                    # Sin referencia (algunos generadores la omiten) va en la siguiente columna
+                    columna = _columna(c.get('r')) if c.get('r') else siguiente
+                    celdas[columna] = valor or ''
+                    siguiente = columna + 1
+                el.clear()
+                if celdas:
+                    yield [celdas.get(i, '') for i in range(max(celdas) + 1)]
+
+
+def filas_archivo(archivo):
+    """Filas de un FileStorage según su extensión"""
+    nombre = (archivo.filename or '').lower()
+    if nombre.endswith('.xlsx'):
+        return filas_xlsx(archivo.stream)
+    if nombre.endswith('.csv') or nombre.endswith('.txt'):
+        return filas_csv(archivo.stream)
+    raise ValueError('Formato no soportado (usa .csv o .xlsx)')
+
+
+def renglones_archivo(filas):
+    """Genera (numero_fila, renglon) usando la primera fila como encabezado"""
+    campos = None
+    for numero, fila in enumerate(filas, start=1):
+        if campos is None:
+            campos = [ENCABEZADOS.get(normalizar(c).replace('_', ' '),
+                                      ENCABEZADOS.get(normalizar(c))) for c in fila]
+            if 'nombre' not in campos and 'mercancia_id' not in campos:
+                raise ValueError('El archivo necesita una columna "producto" o "mercancia_id"')
+            continue
+
+        r = {'nombre': '', 'mercancia_id': '', 'unidades': '', 'precio_unitario': '', 'precio_total': ''}
+        for campo, valor in zip(campos, fila):
+            if campo and not r[campo]:
+                r[campo] = str(valor if valor is not None else '').strip()
+        if r['mercancia_id'].endswith('.0'):  # Excel guarda los ids como número
+            r['mercancia_id'] = r['mercancia_id'][:-2]
+        if not r['nombre'] and not r['unidades'] and not r['precio_unitario'] and not r['precio_total']:
+            continue
+        yield numero, r
+
+
+# -------------------- Conciliación --------------------
+
+class Reporte:
+    """Contadores de toda la importación y detalle acotado a MAX_DETALLE filas"""
+
+    def __init__(self):
+        self.filas = 0
+        self.importadas = 0
+        self.omitidas = 0
+        self.por_nivel = {'id': 0, 'exacto': 0, 'aproximado': 0}
+        self.unidades = 0.0
+        self.subtotal = 0.0
+        self.errores = []
+        self.aproximados = []
+
+    def omitir(self, numero, renglon, motivo):
+        self.omitidas += 1
+        if len(self.errores) < MAX_DETALLE:
+            self.errores.append({'fila': numero, 'producto': renglon['nombre'] or renglon['mercancia_id'],
+                                 'motivo': motivo})
+
+    def aceptar(self, numero, renglon, item, nivel):
+        self.importadas += 1
+        self.por_nivel[nivel] += 1
+        self.unidades += item['contenido_neto_total']
+        self.subtotal += item['precio_total']
+        if nivel == 'aproximado' and len(self.aproximados) < MAX_DETALLE:
+            self.aproximados.append({'fila': numero, 'capturado': renglon['nombre'],
+                                     'mercancia_id': item['mercancia_id'], 'mercancia': item['nombre']})
+
+    def como_dict(self, maximo=MAX_DETALLE):
+        """Reporte serializable; `maximo` acota las filas de detalle listadas"""
+        errores = self.errores[:maximo]
+        return {
+            'filas': self.filas,
+            'importadas': self.importadas,
+            'omitidas': self.omitidas,
+            'por_nivel': self.por_nivel,
+            'unidades': round(self.unidades, 4),
+            'subtotal': round(self.subtotal, 2),
+            'errores': errores,
+            'errores_no_listados': max(0, self.omitidas - len(errores)),
+            'aproximados': self.aproximados[:maximo],
+        }
+
+
+def _validar_bloque(cur, empresa_id, indice, leidos, reporte):
+    """Una consulta para el bloque; valida renglón por renglón y anota el reporte"""
+    resueltos = resolver_mercancias(cur, empresa_id, [r for _n, r in leidos], indice)
+    bloque = []
+    for (numero, r), resuelto in zip(leidos, resueltos):
+        reporte.filas += 1
+        items, fallidos = validar_renglones([r], [resuelto])
+        if fallidos:
+            # El mensaje viene como "'producto': motivo"
+            reporte.omitir(numero, r, fallidos[0][len(f"'{r['nombre']}': "):])
+            continue
+        reporte.aceptar(numero, r, items[0], items[0]['nivel'])
+        bloque.append(items[0])
+    return bloque
+
+
+def bloques_validos(cur, empresa_id, renglones, indice, reporte, tamano=TAMANO_BLOQUE):
+    """
+    Lee los renglones en bloques de `tamano`, los resuelve contra mercancia (una consulta
+    por bloque) y genera las listas de items válidos de cada bloque
+    """
+    leidos = []
+    for numero, r in renglones:
+        leidos.append((numero, r))
+        if len(leidos) >= tamano:
+            bloque = _validar_bloque(cur, empresa_id, indice, leidos, reporte)
+            leidos = []
+            if bloque:
+                yield bloque
+    if leidos:
+        bloque = _validar_bloque(cur, empresa_id, indice, leidos, reporte)
+        if bloque:
+            yield bloque
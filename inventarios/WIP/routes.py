@@ -6,6 +6,11 @@ from ai_helper import extraer_materiales_con_ia, validar_materiales
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from . import bp
 from db import conexion_db  # <- NO desde app
+from saldos_inventario import aplicar_movimiento
+from capas_peps import agregar_capa, consumir, costo_unitario_consumo
+from explosion_materiales import (LOTE_BASE, REFERENCIA_INICIO, requerimientos_produccion,
+                                  orden_iniciada, insumos_proceso, bloquear_insumos,
+                                  existencias_actuales, precios_promedio)
 from flask import g
 from auth_utils import require_login
 
@@ -864,6 +869,43 @@ def ordenes_list():
         try: conn.close()
         except: pass
 
+@bp.get("/ordenes/requerimientos")
+@require_login
+def ordenes_requerimientos():
+    """Materia prima que necesitan las órdenes abiertas (explosión neta por fecha)"""
+    if session.get('rol') != 'admin':
+        return jsonify({'success': False, 'mensaje': 'Acceso no autorizado.'}), 403
+
+    eid = g.empresa_id
+    conn = conexion_db(); cur = conn.cursor(dictionary=True)
+    try:
+        requerimientos = requerimientos_produccion(cur, eid)
+        nombres = {}
+        if requerimientos:
+            ids = list(requerimientos)
+            cur.execute(f"""
+                SELECT id, nombre FROM mercancia
+                WHERE empresa_id = %s AND id IN ({','.join(['%s'] * len(ids))})
+            """, [eid] + ids)
+            nombres = {r['id']: r['nombre'] for r in cur.fetchall()}
+    finally:
+        try: cur.close()
+        except: pass
+        try: conn.close()
+        except: pass
+
+    return jsonify({
+        'success': True,
+        'materiales': [{
+            'mercancia_id': mid,
+            'nombre': nombres.get(mid),
+            'bruto': round(r['bruto'], 4),
+            'neto': round(r['neto'], 4),
+            'fecha': r['fecha'].isoformat() if r['fecha'] else None,
+            'por_fecha': {f.isoformat(): round(n, 4) for f, n in sorted(r['por_fecha'].items())},
+        } for mid, r in sorted(requerimientos.items(), key=lambda kv: (kv[1]['fecha'] is None, kv[1]['fecha'] or 0, kv[0]))],
+    })
+
 @bp.route("/ordenes/nueva", methods=["GET","POST"])
 @require_login
 def orden_nueva():
@@ -1051,129 +1093,127 @@ def orden_iniciar(orden_id):
     eid = g.empresa_id
 
     try:
-        # 1. Obtener datos de la orden
+        # Transacción propia en READ COMMITTED: después de esperar los bloqueos se
+        # leen las existencias que dejó la orden que iba antes
+        conn.commit()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+
+        # 1. Obtener datos de la orden (bloqueada: dos clics no la inician dos veces)
         cur.execute("""
-            SELECT op.*, m.nombre AS producto_nombre, p.id AS proceso_id
+            SELECT op.*, m.nombre AS producto_nombre
             FROM orden_produccion op
             JOIN mercancia m 
                  ON m.id = op.pt_mercancia_id
                 AND m.empresa_id = %s
-            LEFT JOIN procesos p 
-                 ON p.pt_id = op.pt_mercancia_id
-                AND p.empresa_id = %s
             WHERE op.id = %s
               AND op.empresa_id = %s
-        """, (eid, eid, orden_id, eid))
+            FOR UPDATE
+        """, (eid, orden_id, eid))
         orden = cur.fetchone()
 
         if not orden:
+            conn.rollback()
             flash("Orden no encontrada o no pertenece a tu empresa.", "warning")
             return redirect(url_for("wip.ordenes_list"))
 
         if orden['estado'] == 'cerrada':
+            conn.rollback()
             flash("Esta orden ya está cerrada", "info")
             return redirect(url_for("wip.orden_detalle", orden_id=orden_id))
 
-        if not orden['proceso_id']:
+        if orden_iniciada(cur, eid, orden_id):
+            conn.rollback()
+            flash("Esta orden ya fue iniciada", "info")
+            return redirect(url_for("wip.orden_detalle", orden_id=orden_id))
+
+        cur.execute("""
+            SELECT id FROM procesos
+            WHERE pt_id = %s AND empresa_id = %s
+            ORDER BY id
+            LIMIT 1
+        """, (orden['pt_mercancia_id'], eid))
+        proceso = cur.fetchone()
+
+        if not proceso:
+            conn.rollback()
             flash("⚠️ Esta orden no tiene proceso asociado.", "warning")
             return redirect(url_for("wip.orden_detalle", orden_id=orden_id))
 
         # 2. Obtener insumos del proceso (solo de la empresa)
-        cur.execute("""
-            SELECT 
-                pi.mp_id,
-                pi.cantidad_por_lote,
-                m.nombre AS mp_nombre,
-                m.tipo_inventario_id
-            FROM proceso_pasos pp
-            JOIN paso_insumos pi 
-                 ON pi.paso_id = pp.id
-            JOIN mercancia m 
-                 ON m.id = pi.mp_id
-                AND m.empresa_id = %s
-            WHERE pp.proceso_id = %s
-              AND pp.empresa_id = %s
-              AND pi.cantidad_por_lote > 0
-        """, (eid, orden['proceso_id'], eid))
-        insumos = cur.fetchall()
+        insumos = insumos_proceso(cur, eid, proceso['id'])
 
         if not insumos:
+            conn.rollback()
             flash("⚠️ El proceso no tiene insumos definidos.", "warning")
             return redirect(url_for("wip.orden_detalle", orden_id=orden_id))
 
         # 3. Calcular cantidades
-        cantidad_producida = float(orden['cantidad'])
-        lote_base = 12.0
-        factor = cantidad_producida / lote_base
-
-        errores = []
-        movimientos_realizados = 0
-        costo_total_produccion = 0
-
-        # 4. Consumir materias primas
-        from app import calcular_precio_promedio_periodo
-
+        factor = float(orden['cantidad']) / LOTE_BASE
         for insumo in insumos:
-            cantidad_a_consumir = float(insumo['cantidad_por_lote']) * factor
-
-            # Calcular stock actual (solo del tenant)
-            cur.execute("""
-                SELECT 
-                    COALESCE(SUM(CASE 
-                        WHEN tipo_movimiento IN ('compra','entrada') THEN unidades 
-                        ELSE -unidades 
-                    END), 0) AS stock_actual
-                FROM inventario_movimientos
-                WHERE mercancia_id = %s
-                  AND empresa_id = %s
-            """, (insumo['mp_id'], eid))
-            result = cur.fetchone()
-            stock_actual = float(result['stock_actual']) if result else 0
-
-            # Calcular precio promedio
-            precio_unitario = calcular_precio_promedio_periodo(insumo['mp_id'])
-
-            print(f"\n{'='*60}")
-            print(f"🔍 DEBUG COSTEO - MP: {insumo['mp_nombre']} (ID: {insumo['mp_id']})")
-            print(f"{'='*60}")
-            print(f"Precio: ${precio_unitario:.2f} | Stock: {stock_actual:.2f} | "
-                  f"Consumo: {cantidad_a_consumir:.2f} | Total: ${cantidad_a_consumir * precio_unitario:.2f}")
-            print("="*60)
-
-            if stock_actual < cantidad_a_consumir:
-                errores.append(f"Stock insuficiente de {insumo['mp_nombre']} (necesitas {cantidad_a_consumir:.2f}, hay {stock_actual:.2f})")
-                continue
-
-            costo_consumo = cantidad_a_consumir * precio_unitario
-            costo_total_produccion += costo_consumo
-
-            # Registrar salida
-            cur.execute("""
-                INSERT INTO inventario_movimientos
-                    (empresa_id, tipo_inventario_id, mercancia_id, fecha,
-                     tipo_movimiento, unidades, precio_unitario, referencia)
-                VALUES (%s, %s, %s, %s, 'salida', %s, %s, %s)
-            """, (eid, insumo['tipo_inventario_id'] or 1, insumo['mp_id'], date.today(),
-                  cantidad_a_consumir, precio_unitario, f"Orden #{orden_id} - Inicio producción"))
-
-            # Actualizar inventario_mp (tenant aislado)
-            cur.execute("""
-                INSERT INTO inventario_mp
-                    (empresa_id, mercancia_id, producto, inventario_inicial, entradas, salidas, aprobado)
-                VALUES (%s, %s, %s, 0, 0, %s, 1)
-                ON DUPLICATE KEY UPDATE salidas = salidas + VALUES(salidas)
-            """, (eid, insumo['mp_id'], insumo['mp_nombre'], cantidad_a_consumir))
-
-            movimientos_realizados += 1
-
+            insumo['cantidad'] = float(insumo['cantidad_por_lote']) * factor
+            insumo['tipo_inventario_id'] = insumo['tipo_inventario_id'] or 1
+        mp_ids = [i['mp_id'] for i in insumos]
+
+        # 4. Bloquear las MP y leer existencias y precios de todas en dos consultas
+        bloquear_insumos(cur, eid, mp_ids)
+        existencias = existencias_actuales(cur, eid, mp_ids)
+        precios = precios_promedio(cur, eid, mp_ids)
+
+        errores = [
+            f"Stock insuficiente de {i['mp_nombre']} (necesitas {i['cantidad']:.2f}, "
+            f"hay {existencias.get(i['mp_id'], 0.0):.2f})"
+            for i in insumos if existencias.get(i['mp_id'], 0.0) < i['cantidad']
+        ]
         if errores:
             conn.rollback()
             for e in errores:
                 flash(f"❌ {e}", "danger")
             return redirect(url_for("wip.orden_detalle", orden_id=orden_id))
 
+        # 5. Costo PEPS desde las capas abiertas (si cubren el consumo), por tipo de inventario
+        por_tipo = {}
+        for i in insumos:
+            por_tipo.setdefault(i['tipo_inventario_id'], {})[i['mp_id']] = i['cantidad']
+        peps = {}
+        for tipo_id, pedidos in por_tipo.items():
+            peps.update(consumir(cur, eid, tipo_id, pedidos))
+        for i in insumos:
+            i['precio'] = costo_unitario_consumo(peps.get(i['mp_id']), i['cantidad'],
+                                                 precios.get(i['mp_id'], 0.0))
+        costo_total_produccion = sum(i['cantidad'] * i['precio'] for i in insumos)
+
+        # 6. Registrar salidas en un INSERT de varios renglones. Los ids no son
+        #    necesariamente consecutivos: se releen por (referencia, mercancía), única
+        #    porque la orden está bloqueada y cada MP aparece una sola vez
+        referencia = REFERENCIA_INICIO.format(orden_id)
+        hoy = date.today()
+        cur.execute(f"""
+            INSERT INTO inventario_movimientos
+                (empresa_id, tipo_inventario_id, mercancia_id, fecha,
+                 tipo_movimiento, unidades, precio_unitario, referencia)
+            VALUES {', '.join(["(%s, %s, %s, %s, 'salida', %s, %s, %s)"] * len(insumos))}
+        """, [v for i in insumos for v in (eid, i['tipo_inventario_id'], i['mp_id'], hoy,
+                                           i['cantidad'], i['precio'], referencia)])
+        cur.execute(f"""
+            SELECT id, mercancia_id FROM inventario_movimientos
+            WHERE empresa_id = %s AND fecha = %s AND referencia = %s
+              AND mercancia_id IN ({', '.join(['%s'] * len(mp_ids))})
+        """, [eid, hoy, referencia] + mp_ids)
+        mov_ids = {r['mercancia_id']: r['id'] for r in cur.fetchall()}
+        for i in insumos:
+            aplicar_movimiento(cur, eid, i['tipo_inventario_id'], i['mp_id'], 'salida',
+                               i['cantidad'], i['precio'], mov_ids[i['mp_id']])
+
+        # 7. Actualizar inventario_mp (tenant aislado)
+        cur.execute(f"""
+            INSERT INTO inventario_mp
+                (empresa_id, mercancia_id, producto, inventario_inicial, entradas, salidas, aprobado)
+            VALUES {', '.join(['(%s, %s, %s, 0, 0, %s, 1)'] * len(insumos))}
+            ON DUPLICATE KEY UPDATE salidas = salidas + VALUES(salidas)
+        """, [v for i in insumos for v in (eid, i['mp_id'], i['mp_nombre'], i['cantidad'])])
+
         conn.commit()
-        flash(f"✅ Orden #{orden_id} iniciada. {movimientos_realizados} insumos consumidos. Costo total: ${costo_total_produccion:,.2f}", "success")
+        flash(f"✅ Orden #{orden_id} iniciada. {len(insumos)} insumos consumidos. Costo total: ${costo_total_produccion:,.2f}", "success")
         return redirect(url_for("wip.orden_detalle", orden_id=orden_id))
 
     except Exception as e:
@@ -1245,7 +1285,18 @@ def orden_cerrar(orden_id):
                     (%s, %s, 0, %s, 0, 0)
             """, (eid, orden['pt_mercancia_id'], cantidad_producida))
 
-        # 3) Registrar movimiento de entrada al almacén de PT
+        # 3) Costo del lote: lo consumido al iniciar la orden
+        cur.execute("""
+            SELECT COALESCE(SUM(unidades * precio_unitario), 0) AS costo
+            FROM   inventario_movimientos
+            WHERE  empresa_id = %s
+              AND  referencia = %s
+              AND  LOWER(tipo_movimiento) = 'salida'
+        """, (eid, f"Orden #{orden_id} - Inicio producción"))
+        costo_lote = float(cur.fetchone()['costo'] or 0)
+        costo_unitario = costo_lote / cantidad_producida if cantidad_producida else 0
+
+        # 4) Registrar movimiento de entrada al almacén de PT
         cur.execute("""
             INSERT INTO inventario_movimientos
                 (empresa_id, tipo_inventario_id, mercancia_id, fecha,
@@ -1259,11 +1310,17 @@ def orden_cerrar(orden_id):
             orden['pt_mercancia_id'],
             date.today(),
             cantidad_producida,
-            0,  # si tienes costo acumulado, aquí podrías registrar el costo unitario promedio del lote
+            costo_unitario,
             f"OP{orden_id} - Producción completada"
         ))
-
-        # 4) Cerrar la orden (misma empresa)
+        mov_id = cur.lastrowid
+        aplicar_movimiento(cur, eid, orden['tipo_inventario_id'] or 3, orden['pt_mercancia_id'],
+                           'entrada', cantidad_producida, costo_unitario, mov_id)
+        agregar_capa(cur, eid, orden['tipo_inventario_id'] or 3, orden['pt_mercancia_id'],
+                     cantidad_producida, costo_unitario, origen='produccion',
+                     referencia=f"OP{orden_id} - Producción completada", movimiento_id=mov_id)
+
+        # 5) Cerrar la orden (misma empresa)
         cur.execute("""
             UPDATE orden_produccion
                SET estado = 'cerrada'
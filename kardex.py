@@ -0,0 +1,564 @@
+"""
+Kardex paginado de una mercancía (/inventarios/movimientos/<id>)
+Antes la vista traía el UNION completo de detalle_compra + inventario_movimientos y
+armaba tres listas (rows, tabla_unidades, tabla_pesos) con toda la historia.
+
+Ahora:
+1. Paginación keyset sobre (fecha, fuente, id): fuente 0 = detalle_compra,
+   1 = inventario_movimientos (los ids de cada tabla son independientes)
+2. La página solo lee sus filas; el saldo con el que abre sale del checkpoint más
+   cercano (tabla kardex_checkpoints) más una suma en SQL del tramo que falta
+3. Los checkpoints los genera `flask kardex checkpoints` (las vistas solo leen); si
+   después se captura un movimiento con fecha anterior a un checkpoint, ese checkpoint
+   se ignora hasta que el comando los vuelva a generar
+4. exportar_csv()/exportar_xlsx(): generadores para una respuesta en streaming
+   (cursor sin buffer, el XLSX se arma con zipfile sin dependencias)
+5. Todo filtra por empresa_id: filas, sumas y checkpoints
+
+Criterio por fila (igual que la vista anterior):
+- Entradas ('entrada', 'compra'): unidades = contenido neto si lo hay, pesos = importe
+- Salidas: unidades e importe del movimiento
+"""
+
+import csv
+import io
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+import mysql.connector
+
+from db import conexion_db
+
+TAMANO_PAGINA = 100
+TAMANO_LOTE = 2000
+
+ER_NO_SUCH_TABLE = 1146
+ER_BAD_FIELD_ERROR = 1054      # kardex_checkpoints sin empresa_id (migración 004 pendiente)
+
+# Columnas comunes de las dos fuentes
+_COLUMNAS = """
+    {fecha} AS fecha_raw, {fuente} AS fuente, {id} AS mov_id,
+    DATE_FORMAT({fecha},'%d/%b/%y') AS fecha_fmt,
+    {documento} AS documento, {proveedor} AS proveedor,
+    {unidades} AS unidades, {contenido} AS contenido_neto_total,
+    {precio} AS precio_unitario, {importe} AS importe,
+    {tipo} AS tipo_movimiento
+"""
+
+_COMPRAS = {
+    'fecha': 'lc.fecha', 'fuente': 0, 'id': 'dc.id',
+    'columnas': _COLUMNAS.format(
+        fecha='lc.fecha', fuente=0, id='dc.id', documento='lc.numero_factura',
+        proveedor='lc.proveedor', unidades='dc.unidades', contenido='dc.contenido_neto_total',
+        precio="CASE WHEN dc.contenido_neto_total>0 THEN dc.precio_total/dc.contenido_neto_total ELSE NULL END",
+        importe='dc.precio_total', tipo="'compra'"),
+    'desde': "detalle_compra dc JOIN listado_compras lc ON dc.compra_id = lc.id",
+    'filtro': "dc.empresa_id = %s AND dc.mercancia_id = %s",
+}
+
+_COLUMNAS_IM = _COLUMNAS.format(
+    fecha='im.fecha', fuente=1, id='im.id', documento='im.referencia', proveedor="''",
+    unidades='im.unidades', contenido='NULL', precio='im.precio_unitario',
+    importe='(im.unidades*im.precio_unitario)', tipo='im.tipo_movimiento')
+
+
+def _fuentes(almacen_id):
+    """Ramas del UNION según el almacén (mismos filtros que la vista anterior)"""
+    im = {'fecha': 'im.fecha', 'fuente': 1, 'id': 'im.id', 'columnas': _COLUMNAS_IM,
+          'desde': "inventario_movimientos im"}
+    if almacen_id == 1:
+        return [_COMPRAS, dict(im, filtro="""im.empresa_id = %s AND im.mercancia_id = %s
+            AND im.tipo_inventario_id = 1
+            AND UPPER(im.tipo_movimiento) <> 'COMPRA'
+            AND im.unidades > 0
+            AND im.tipo_movimiento IS NOT NULL
+            AND im.tipo_movimiento <> ''""")]
+    if almacen_id in (2, 3):
+        return [dict(im, filtro=f"im.empresa_id = %s AND im.mercancia_id = %s "
+                                f"AND im.tipo_inventario_id = {int(almacen_id)}")]
+    return [_COMPRAS, dict(im, filtro="im.empresa_id = %s AND im.mercancia_id = %s "
+                                      "AND UPPER(im.tipo_movimiento) <> 'COMPRA'")]
+
+
+def _cota(rama, clave, op):
+    """
+    Condición keyset de una rama contra clave = (fecha, fuente, id).
+    op: '>' (después de), '<=' (hasta, inclusive) o '<' (antes de).
+    La fuente es constante en cada rama, así la condición usa el índice (fecha, id).
+    """
+    if clave is None:
+        return "", []
+    fecha, fuente, mov_id = clave
+    f, i, s = rama['fecha'], rama['id'], rama['fuente']
+    if op == '>':
+        if s > fuente:
+            return f"AND {f} >= %s", [fecha]
+        if s < fuente:
+            return f"AND {f} > %s", [fecha]
+        return f"AND ({f} > %s OR ({f} = %s AND {i} > %s))", [fecha, fecha, mov_id]
+    if s < fuente:
+        return f"AND {f} <= %s", [fecha]
+    if s > fuente:
+        return f"AND {f} < %s", [fecha]
+    cmp = '<=' if op == '<=' else '<'
+    return f"AND ({f} < %s OR ({f} = %s AND {i} {cmp} %s))", [fecha, fecha, mov_id]
+
+
+def _union(empresa_id, mercancia_id, almacen_id, desde=None, op_desde='>', hasta=None, op_hasta='<='):
+    partes, params = [], []
+    for rama in _fuentes(almacen_id):
+        c1, p1 = _cota(rama, desde, op_desde)
+        c2, p2 = _cota(rama, hasta, op_hasta)
+        partes.append(f"SELECT {rama['columnas']} FROM {rama['desde']} WHERE {rama['filtro']} {c1} {c2}")
+        params += [empresa_id, mercancia_id] + p1 + p2
+    return "\nUNION ALL\n".join(partes), params
+
+
+def fila_kardex(m):
+    """(entrada_u, salida_u, entrada_mx, salida_mx, pu) de una fila"""
+    tipo = (m.get('tipo_movimiento') or '').strip().lower()
+    es_entrada = tipo in ('entrada', 'compra')
+    contenido = m.get('contenido_neto_total')
+    if es_entrada:
+        entrada_u = float(contenido) if (contenido and float(contenido) > 0) else float(m.get('unidades') or 0.0)
+    else:
+        entrada_u = 0.0
+    salida_u = float(m.get('unidades') or 0.0) if tipo == 'salida' else 0.0
+    entrada_mx = float(m.get('importe') or 0.0) if es_entrada else 0.0
+    salida_mx = float(m.get('importe') or 0.0) if tipo == 'salida' else 0.0
+    if es_entrada and entrada_u > 0:
+        pu = entrada_mx / entrada_u
+    elif tipo == 'salida':
+        pu = float(m.get('precio_unitario') or 0.0)
+    else:
+        pu = 0.0
+    return entrada_u, salida_u, entrada_mx, salida_mx, pu
+
+
+# La misma regla que fila_kardex, sumada en SQL
+_SQL_SUMAS = """
+    SELECT COUNT(*) AS filas,
+        COALESCE(SUM(CASE WHEN LOWER(TRIM(tipo_movimiento)) IN ('entrada','compra')
+                          THEN CASE WHEN contenido_neto_total > 0 THEN contenido_neto_total
+                                    ELSE COALESCE(unidades, 0) END
+                          ELSE 0 END), 0) AS entradas_u,
+        COALESCE(SUM(CASE WHEN LOWER(TRIM(tipo_movimiento)) = 'salida'
+                          THEN COALESCE(unidades, 0) ELSE 0 END), 0) AS salidas_u,
+        COALESCE(SUM(CASE WHEN LOWER(TRIM(tipo_movimiento)) IN ('entrada','compra')
+                          THEN COALESCE(importe, 0) ELSE 0 END), 0) AS entradas_mx,
+        COALESCE(SUM(CASE WHEN LOWER(TRIM(tipo_movimiento)) = 'salida'
+                          THEN COALESCE(importe, 0) ELSE 0 END), 0) AS salidas_mx
+    FROM ({union}) t
+"""
+
+_CEROS = {'filas': 0, 'entradas_u': 0.0, 'salidas_u': 0.0, 'entradas_mx': 0.0, 'salidas_mx': 0.0}
+
+
+# =============================================
+# CHECKPOINTS
+# =============================================
+
+def _max_ids(cur, empresa_id, mercancia_id):
+    cur.execute("""
+        SELECT (SELECT COALESCE(MAX(id), 0) FROM detalle_compra
+                WHERE empresa_id = %s AND mercancia_id = %s) AS dc,
+               (SELECT COALESCE(MAX(id), 0) FROM inventario_movimientos
+                WHERE empresa_id = %s AND mercancia_id = %s) AS im
+    """, (empresa_id, mercancia_id, empresa_id, mercancia_id))
+    r = cur.fetchone()
+    return int(r['dc']), int(r['im'])
+
+
+def _checkpoint(cur, empresa_id, mercancia_id, almacen_id, hasta, op_hasta):
+    """Checkpoint vigente más cercano antes de `hasta` (o el último); None si es obsoleto. Solo lee."""
+    params = [empresa_id, mercancia_id, almacen_id or 0]
+    filtro = ""
+    if hasta is not None:
+        cmp = '<=' if op_hasta == '<=' else '<'
+        filtro = f"AND (fecha, fuente, mov_id) {cmp} (%s, %s, %s)"
+        params += list(hasta)
+    try:
+        cur.execute(f"""
+            SELECT * FROM kardex_checkpoints
+            WHERE empresa_id = %s AND mercancia_id = %s AND almacen = %s {filtro}
+            ORDER BY fecha DESC, fuente DESC, mov_id DESC
+            LIMIT 1
+        """, params)
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) in (ER_NO_SUCH_TABLE, ER_BAD_FIELD_ERROR):
+            return None
+        raise
+    ck = cur.fetchone()
+    if ck is None:
+        return None
+
+    # ¿Hay filas nuevas con fecha anterior al checkpoint? (captura atrasada)
+    clave = (ck['fecha'], ck['fuente'], ck['mov_id'])
+    union, p = _union(empresa_id, mercancia_id, almacen_id, hasta=clave)
+    cur.execute(f"""
+        SELECT 1 FROM ({union}) t
+        WHERE (t.fuente = 0 AND t.mov_id > %s) OR (t.fuente = 1 AND t.mov_id > %s)
+        LIMIT 1
+    """, p + [ck['max_dc_id'], ck['max_im_id']])
+    if cur.fetchone():
+        return None
+    return ck
+
+
+def invalidar_checkpoints(cur, empresa_id, mercancia_id, almacen_id=None, desde_fecha=None):
+    """Borra los checkpoints de la mercancía (de un almacén / desde una fecha, si se indica). No hace commit."""
+    sql = "DELETE FROM kardex_checkpoints WHERE empresa_id = %s AND mercancia_id = %s"
+    params = [empresa_id, mercancia_id]
+    if almacen_id is not None:
+        sql += " AND almacen = %s"
+        params.append(almacen_id)
+    if desde_fecha is not None:
+        sql += " AND fecha >= %s"
+        params.append(desde_fecha)
+    try:
+        cur.execute(sql, params)
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) != ER_NO_SUCH_TABLE:
+            raise
+
+
+def acumulado(cur, empresa_id, mercancia_id, almacen_id, hasta=None, op_hasta='<='):
+    """
+    Totales acumulados hasta la clave `hasta` (None = toda la historia):
+    checkpoint más cercano + suma SQL del tramo restante.
+    Incluye 'omitidas': filas que no se tuvieron que leer gracias al checkpoint.
+    """
+    ck = _checkpoint(cur, empresa_id, mercancia_id, almacen_id, hasta, op_hasta)
+    desde = (ck['fecha'], ck['fuente'], ck['mov_id']) if ck else None
+    union, params = _union(empresa_id, mercancia_id, almacen_id, desde=desde, hasta=hasta, op_hasta=op_hasta)
+    cur.execute(_SQL_SUMAS.format(union=union), params)
+    tramo = cur.fetchone() or _CEROS
+
+    base = ck or _CEROS
+    tot = {k: float(base[k] or 0) + float(tramo[k] or 0) for k in _CEROS}
+    tot['filas'] = int(tot['filas'])
+    tot['omitidas'] = int(base['filas'] or 0)
+    return tot
+
+
+def _insertar_checkpoint(cur, empresa_id, mercancia_id, almacen_id, clave, tot, max_dc, max_im):
+    cur.execute("""
+        INSERT INTO kardex_checkpoints
+            (empresa_id, mercancia_id, almacen, fecha, fuente, mov_id, filas,
+             entradas_u, salidas_u, entradas_mx, salidas_mx, max_dc_id, max_im_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, (empresa_id, mercancia_id, almacen_id or 0, clave[0], clave[1], clave[2], tot['filas'],
+          tot['entradas_u'], tot['salidas_u'], tot['entradas_mx'], tot['salidas_mx'],
+          max_dc, max_im))
+
+
+def generar_checkpoints(empresa_id, mercancia_id, almacen_id=None, cada=TAMANO_LOTE):
+    """
+    Regenera los checkpoints de una mercancía en un almacén (None = todos): recorre su
+    historia por keyset y deja uno cada `cada` filas. Hace commit; regresa cuántos dejó.
+    """
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        max_dc, max_im = _max_ids(cur, empresa_id, mercancia_id)
+        invalidar_checkpoints(cur, empresa_id, mercancia_id, almacen_id or 0)
+        tot = dict(_CEROS)
+        despues, n = None, 0
+        while True:
+            filas, hay_mas = _filas(cur, empresa_id, mercancia_id, almacen_id, despues, limite=cada)
+            for m in filas:
+                entrada_u, salida_u, entrada_mx, salida_mx, _pu = fila_kardex(m)
+                tot['entradas_u'] += entrada_u
+                tot['salidas_u'] += salida_u
+                tot['entradas_mx'] += entrada_mx
+                tot['salidas_mx'] += salida_mx
+            tot['filas'] += len(filas)
+            if not hay_mas:
+                break
+            despues = _clave(filas[-1])
+            _insertar_checkpoint(cur, empresa_id, mercancia_id, almacen_id, despues, tot, max_dc, max_im)
+            n += 1
+        conn.commit()
+        return n
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _mercancias_con_movimientos(empresa_id=None):
+    """[(empresa_id, mercancia_id)] con historia en kardex"""
+    filtro = "WHERE mercancia_id IS NOT NULL AND " + ("empresa_id = %s" if empresa_id else "empresa_id IS NOT NULL")
+    params = [empresa_id, empresa_id] if empresa_id else []
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(f"""
+            SELECT empresa_id, mercancia_id FROM inventario_movimientos {filtro}
+            UNION
+            SELECT empresa_id, mercancia_id FROM detalle_compra {filtro}
+        """, params)
+        return sorted(cur.fetchall())
+    finally:
+        cur.close()
+        conn.close()
+
+
+# =============================================
+# PÁGINAS
+# =============================================
+
+def clave_a_texto(clave):
+    fecha, fuente, mov_id = clave
+    return f"{fecha.isoformat() if hasattr(fecha, 'isoformat') else fecha}~{fuente}~{mov_id}"
+
+
+def texto_a_clave(texto):
+    """'2025-01-31~1~345' -> (fecha, fuente, id); None si no es válido"""
+    try:
+        f, s, i = (texto or '').split('~')
+        fecha = date.fromisoformat(f) if len(f) == 10 else datetime.fromisoformat(f)
+        return fecha, int(s), int(i)
+    except ValueError:
+        return None
+
+
+def _clave(m):
+    return m['fecha_raw'], int(m['fuente']), int(m['mov_id'])
+
+
+def _filas(cur, empresa_id, mercancia_id, almacen_id, despues=None, antes=None, limite=TAMANO_PAGINA):
+    if antes is not None:
+        union, params = _union(empresa_id, mercancia_id, almacen_id, hasta=antes, op_hasta='<')
+        orden = "DESC"
+    else:
+        union, params = _union(empresa_id, mercancia_id, almacen_id, desde=despues)
+        orden = "ASC"
+    cur.execute(f"""
+        SELECT * FROM ({union}) t
+        ORDER BY t.fecha_raw {orden}, t.fuente {orden}, t.mov_id {orden}
+        LIMIT %s
+    """, params + [limite + 1])
+    filas = cur.fetchall()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    if antes is not None:
+        filas.reverse()
+    return filas, hay_mas
+
+
+def pagina_kardex(conn, empresa_id, mercancia_id, almacen_id=None, despues=None, antes=None,
+                  limite=TAMANO_PAGINA):
+    """
+    Una página del kardex con saldos corridos. Solo lee (no deja checkpoints).
+    despues/antes: clave keyset (fecha, fuente, id) de la página anterior/siguiente.
+    """
+    almacen_id = almacen_id if almacen_id in (1, 2, 3) else None
+    cur = conn.cursor(dictionary=True)
+    try:
+        movimientos, hay_mas = _filas(cur, empresa_id, mercancia_id, almacen_id, despues, antes, limite)
+
+        # Saldo con el que abre la página
+        if movimientos:
+            inicial = acumulado(cur, empresa_id, mercancia_id, almacen_id, _clave(movimientos[0]), op_hasta='<')
+        else:
+            inicial = dict(_CEROS, omitidas=0)
+        saldo_u = inicial['entradas_u'] - inicial['salidas_u']
+        saldo_mx = inicial['entradas_mx'] - inicial['salidas_mx']
+
+        rows = []
+        for m in movimientos:
+            entrada_u, salida_u, entrada_mx, salida_mx, pu = fila_kardex(m)
+            saldo_u += entrada_u - salida_u
+            saldo_mx += entrada_mx - salida_mx
+            rows.append({
+                "fecha": m.get("fecha_fmt"),
+                "documento": m.get("documento"),
+                "fuente": m.get("proveedor"),
+                "entrada_u": entrada_u, "salida_u": salida_u, "saldo_u": saldo_u,
+                "entrada_mx": entrada_mx, "salida_mx": salida_mx, "saldo_mx": saldo_mx,
+                "pu": pu,
+            })
+
+        # Totales de toda la historia y P.U. de la última fila
+        totales = acumulado(cur, empresa_id, mercancia_id, almacen_id)
+        union, params = _union(empresa_id, mercancia_id, almacen_id)
+        cur.execute(f"""
+            SELECT * FROM ({union}) t
+            ORDER BY t.fecha_raw DESC, t.fuente DESC, t.mov_id DESC
+            LIMIT 1
+        """, params)
+        ultima = cur.fetchone()
+    finally:
+        cur.close()
+
+    hay_anteriores = inicial['filas'] > 0
+    hay_siguientes = hay_mas if antes is None else True
+
+    return {
+        'rows': rows,
+        'total_entradas_u': totales['entradas_u'],
+        'total_salidas_u': totales['salidas_u'],
+        'total_entradas_mx': totales['entradas_mx'],
+        'total_salidas_mx': totales['salidas_mx'],
+        'saldo_final_u': totales['entradas_u'] - totales['salidas_u'],
+        'saldo_final_mx': totales['entradas_mx'] - totales['salidas_mx'],
+        'pu_final': fila_kardex(ultima)[4] if ultima else 0.0,
+        'paginacion': {
+            'desde_fila': inicial['filas'] + 1 if rows else 0,
+            'hasta_fila': inicial['filas'] + len(rows),
+            'total_filas': totales['filas'],
+            'filas_omitidas': inicial['omitidas'],
+            'anterior': clave_a_texto(_clave(movimientos[0])) if movimientos and hay_anteriores else None,
+            'siguiente': clave_a_texto(_clave(movimientos[-1])) if movimientos and hay_siguientes else None,
+        },
+    }
+
+
+# =============================================
+# EXPORTACIÓN EN STREAMING
+# =============================================
+
+ENCABEZADOS = ['Fecha', 'Documento', 'Fuente', 'Entrada U', 'Salida U', 'Saldo U',
+               'Entrada $', 'Salida $', 'Saldo $', 'P. Unit.']
+
+
+def filas_exportacion(conn, empresa_id, mercancia_id, almacen_id=None, tamano_lote=TAMANO_LOTE):
+    """Genera todas las filas del kardex con saldos, leyendo en lotes (cursor sin buffer)"""
+    almacen_id = almacen_id if almacen_id in (1, 2, 3) else None
+    union, params = _union(empresa_id, mercancia_id, almacen_id)
+    cur = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cur.execute(f"SELECT * FROM ({union}) t ORDER BY t.fecha_raw, t.fuente, t.mov_id", params)
+        saldo_u = saldo_mx = 0.0
+        while True:
+            lote = cur.fetchmany(tamano_lote)
+            if not lote:
+                break
+            for m in lote:
+                entrada_u, salida_u, entrada_mx, salida_mx, pu = fila_kardex(m)
+                saldo_u += entrada_u - salida_u
+                saldo_mx += entrada_mx - salida_mx
+                yield [m.get('fecha_fmt'), m.get('documento') or '', m.get('proveedor') or '',
+                       round(entrada_u, 4), round(salida_u, 4), round(saldo_u, 4),
+                       round(entrada_mx, 2), round(salida_mx, 2), round(saldo_mx, 2), round(pu, 4)]
+    finally:
+        cur.close()
+
+
+def exportar_csv(filas):
+    """Generador de bytes CSV (UTF-8 con BOM para Excel)"""
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    yield '﻿'.encode('utf-8')
+    w.writerow(ENCABEZADOS)
+    for i, fila in enumerate(filas, 1):
+        w.writerow(fila)
+        if i % 500 == 0:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+class _Tubo(io.RawIOBase):
+    """Destino de zipfile sin seek: acumula lo escrito hasta que el generador lo entrega"""
+
+    def __init__(self):
+        self.partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.partes.append(bytes(b))
+        return len(b)
+
+    def vaciar(self):
+        datos = b''.join(self.partes)
+        self.partes = []
+        return datos
+
+
+_XLSX_FIJOS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Kardex" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/></Relationships>'),
+}
+
+
+def _celda(valor):
+    if isinstance(valor, (int, float)):
+        return f'<c><v>{valor}</v></c>'
+    return f'<c t="inlineStr"><is><t>{escape(str(valor))}</t></is></c>'
+
+
+def exportar_xlsx(filas):
+    """Generador de bytes XLSX: la hoja se comprime y entrega por bloques"""
+    tubo = _Tubo()
+    with zipfile.ZipFile(tubo, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for nombre, contenido in _XLSX_FIJOS.items():
+            zf.writestr(nombre, contenido)
+        yield tubo.vaciar()
+
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as hoja:
+            hoja.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                       b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                       b'<sheetData>')
+            hoja.write(('<row>' + ''.join(_celda(v) for v in ENCABEZADOS) + '</row>').encode('utf-8'))
+            for i, fila in enumerate(filas, 1):
+                hoja.write(('<row>' + ''.join(_celda(v) for v in fila) + '</row>').encode('utf-8'))
+                if i % 500 == 0:
+                    yield tubo.vaciar()
+            hoja.write(b'</sheetData></worksheet>')
+    yield tubo.vaciar()
+
+
+def init_app(app):
+    """Registra el comando: flask kardex checkpoints [--empresa N] [--mercancia M]"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('kardex', help='Checkpoints del kardex paginado')
+
+    @grupo.command('checkpoints')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    @click.option('--mercancia', type=int, default=None, help='Solo esta mercancía (requiere --empresa)')
+    def checkpoints_cmd(empresa, mercancia):
+        if mercancia and not empresa:
+            raise click.UsageError('--mercancia requiere --empresa')
+        pares = [(empresa, mercancia)] if mercancia else _mercancias_con_movimientos(empresa)
+        total = 0
+        for eid, mid in pares:
+            for almacen_id in (None, 1, 2, 3):
+                total += generar_checkpoints(eid, mid, almacen_id)
+        click.echo(f"✅ {len(pares)} mercancías, {total} checkpoints")
+
+    app.cli.add_command(grupo)
@@ -0,0 +1,33 @@
+-- =====================================================
+-- Saldos materializados de inventario (ver saldos_inventario.py)
+-- Después de crear las tablas ejecutar:
+--   flask saldos-inventario reconstruir
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `inventario_saldos` (
+  `empresa_id` int(11) NOT NULL,
+  `tipo_inventario_id` int(11) NOT NULL DEFAULT 1,
+  `mercancia_id` int(11) NOT NULL,
+  `unidades` decimal(14,4) NOT NULL DEFAULT 0.0000,
+  `valor` decimal(16,4) NOT NULL DEFAULT 0.0000,
+  `costo_promedio` decimal(16,6) NOT NULL DEFAULT 0.000000,
+  `entradas` decimal(14,4) NOT NULL DEFAULT 0.0000,
+  `salidas` decimal(14,4) NOT NULL DEFAULT 0.0000,
+  `fifo_mov_id` int(11) DEFAULT NULL COMMENT 'inventario_movimientos.id de la capa PEPS vigente',
+  `fifo_consumido` decimal(14,4) NOT NULL DEFAULT 0.0000 COMMENT 'unidades ya consumidas de esa capa',
+  `ultimo_movimiento_id` int(11) DEFAULT NULL,
+  `actualizado` datetime DEFAULT current_timestamp(),
+  PRIMARY KEY (`empresa_id`, `tipo_inventario_id`, `mercancia_id`),
+  KEY `idx_saldos_mercancia` (`mercancia_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE IF NOT EXISTS `inventario_saldos_control` (
+  `empresa_id` int(11) NOT NULL,
+  `reconstruido_en` datetime NOT NULL,
+  `productos` int(11) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`empresa_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Índice para localizar capas PEPS y re-ejecutar la historia por producto
+CREATE INDEX `idx_movs_empresa_merc_fecha`
+  ON `inventario_movimientos` (`empresa_id`, `tipo_inventario_id`, `mercancia_id`, `fecha`, `id`);
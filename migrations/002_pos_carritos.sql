@@ -0,0 +1,10 @@
+-- Carrito del POS guardado en el servidor (carrito_pos.AlmacenSQL, POS_CART_BACKEND=sql)
+-- clave = empresa_id:usuario_id:turno_id (lo único que viaja en la cookie)
+
+CREATE TABLE IF NOT EXISTS `pos_carritos` (
+    clave       VARCHAR(100) NOT NULL,
+    datos       MEDIUMTEXT   NOT NULL,
+    actualizado DATETIME     NOT NULL,
+    PRIMARY KEY (clave),
+    KEY idx_pos_carritos_actualizado (actualizado)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
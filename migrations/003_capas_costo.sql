@@ -0,0 +1,33 @@
+-- =====================================================
+-- Capas de costo PEPS (ver capas_peps.py)
+-- Una fila por entrada (compra, cierre de producción, recepción B2B, entrada manual)
+-- con sus unidades restantes. Las salidas (ventas, inicio de producción) solo
+-- leen y descuentan capas abiertas.
+--
+-- MySQL no tiene índices parciales: `abierta` vale 1 mientras quedan unidades y
+-- NULL al agotarse, así el rango (empresa, tipo, mercancía, abierta=1) del índice
+-- solo contiene capas abiertas.
+--
+-- Después de migrar ejecutar:
+--   flask capas-peps reconstruir
+--   flask capas-peps verificar
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `capas_costo` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `empresa_id` int(11) NOT NULL,
+  `tipo_inventario_id` int(11) NOT NULL DEFAULT 1,
+  `mercancia_id` int(11) NOT NULL,
+  `movimiento_id` int(11) DEFAULT NULL COMMENT 'inventario_movimientos.id de la entrada (NULL en recepciones B2B)',
+  `origen` varchar(20) NOT NULL DEFAULT 'entrada' COMMENT 'compra | produccion | b2b | entrada',
+  `referencia` varchar(255) DEFAULT NULL,
+  `fecha` date NOT NULL,
+  `unidades` decimal(14,4) NOT NULL,
+  `unidades_restantes` decimal(14,4) NOT NULL,
+  `costo_unitario` decimal(16,6) NOT NULL DEFAULT 0.000000,
+  `abierta` tinyint(1) AS (IF(`unidades_restantes` > 0, 1, NULL)) STORED,
+  `creado` datetime NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uq_capas_movimiento` (`movimiento_id`),
+  KEY `idx_capas_abiertas` (`empresa_id`, `tipo_inventario_id`, `mercancia_id`, `abierta`, `fecha`, `id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
@@ -0,0 +1,29 @@
+-- Checkpoints del kardex paginado (ver kardex.py)
+-- Acumulados (entradas/salidas en unidades y pesos) hasta la fila (fecha, fuente, mov_id)
+-- de una mercancía de una empresa en un almacén (0 = todos).
+-- fuente: 0 = detalle_compra, 1 = inventario_movimientos.
+-- max_dc_id / max_im_id: ids más altos al crear el checkpoint; si después aparece una fila
+-- anterior al checkpoint (captura con fecha atrasada) el checkpoint se ignora.
+-- Los genera `flask kardex checkpoints`; las vistas solo los leen.
+
+CREATE TABLE IF NOT EXISTS `kardex_checkpoints` (
+    empresa_id    INT           NOT NULL,
+    mercancia_id  INT           NOT NULL,
+    almacen       TINYINT       NOT NULL DEFAULT 0,
+    fecha         DATETIME      NOT NULL,
+    fuente        TINYINT       NOT NULL,
+    mov_id        INT           NOT NULL,
+    filas         INT           NOT NULL,
+    entradas_u    DECIMAL(18,4) NOT NULL DEFAULT 0,
+    salidas_u     DECIMAL(18,4) NOT NULL DEFAULT 0,
+    entradas_mx   DECIMAL(18,4) NOT NULL DEFAULT 0,
+    salidas_mx    DECIMAL(18,4) NOT NULL DEFAULT 0,
+    max_dc_id     INT           NOT NULL DEFAULT 0,
+    max_im_id     INT           NOT NULL DEFAULT 0,
+    creado        DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (empresa_id, mercancia_id, almacen, fecha, fuente, mov_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Keyset (fecha, id) por mercancía en inventario_movimientos (detalle_compra ya tiene idx_dc_mercancia)
+CREATE INDEX `idx_movs_merc_tipo_fecha`
+  ON `inventario_movimientos` (`mercancia_id`, `tipo_inventario_id`, `fecha`, `id`);
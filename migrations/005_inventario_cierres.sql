@@ -0,0 +1,45 @@
+-- =====================================================
+-- Cierres periódicos de inventario (ver cierres_inventario.py)
+-- Saldo acumulado por producto base al final de cada periodo (mensual por default,
+-- INVENTARIO_CIERRE_MESES). Las vistas de movimientos, la valuación MP/WIP y
+-- calcular_precio_promedio_periodo parten del último cierre.
+--
+-- max_dc_id / max_im_id: ids más altos al cerrar; si después aparece un movimiento
+-- con fecha anterior al corte el cierre deja de usarse hasta recalcularlo.
+-- Después de migrar (y cada inicio de mes, p. ej. en un cron) ejecutar:
+--   flask cierres-inventario cerrar
+-- Tras editar movimientos viejos:
+--   flask cierres-inventario cerrar --desde AAAA-MM-DD
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `inventario_cierres` (
+  `empresa_id` int(11) NOT NULL,
+  `tipo_inventario_id` int(11) NOT NULL,
+  `producto_base_id` int(11) NOT NULL,
+  `periodo` date NOT NULL COMMENT 'último día del periodo',
+  `unidades` decimal(20,6) NOT NULL DEFAULT 0.000000,
+  `valor` decimal(20,6) NOT NULL DEFAULT 0.000000,
+  `costo_promedio` decimal(20,8) NOT NULL DEFAULT 0.00000000,
+  `entradas` decimal(20,6) NOT NULL DEFAULT 0.000000,
+  `salidas` decimal(20,6) NOT NULL DEFAULT 0.000000,
+  `movimientos` int(11) NOT NULL DEFAULT 0 COMMENT 'movimientos acumulados hasta el cierre',
+  `movimientos_periodo` int(11) NOT NULL DEFAULT 0,
+  `generado` datetime NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`empresa_id`, `tipo_inventario_id`, `periodo`, `producto_base_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE IF NOT EXISTS `inventario_cierres_control` (
+  `empresa_id` int(11) NOT NULL,
+  `periodo` date NOT NULL,
+  `max_dc_id` int(11) NOT NULL DEFAULT 0,
+  `max_im_id` int(11) NOT NULL DEFAULT 0,
+  `productos` int(11) NOT NULL DEFAULT 0,
+  `movimientos` int(11) NOT NULL DEFAULT 0,
+  `generado` datetime NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`empresa_id`, `periodo`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Movimientos posteriores al corte por empresa (cola de la valuación y detección de
+-- capturas atrasadas)
+CREATE INDEX `idx_movs_empresa_fecha`
+  ON `inventario_movimientos` (`empresa_id`, `fecha`);
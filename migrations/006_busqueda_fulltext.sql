@@ -0,0 +1,28 @@
+-- =====================================================
+-- Búsqueda unificada (ver busqueda.py y /api/search)
+-- Índices FULLTEXT para las búsquedas que eran LIKE '%texto%' (recorrido completo):
+-- proveedores, usuarios, catálogo de cuentas y CFDI importados. Mercancía usa el
+-- índice en memoria de busqueda_mercancias.py; los tickets buscan por folio (prefijo).
+--
+-- Mientras no se aplique esta migración busqueda.py usa un índice invertido en
+-- memoria por empresa (BUSQUEDA_INDICE_TTL) en lugar de MATCH ... AGAINST.
+-- Las palabras de menos de innodb_ft_min_token_size (3) caracteres se filtran con
+-- LIKE sobre las filas que ya encontró el FULLTEXT.
+-- =====================================================
+
+ALTER TABLE `proveedores`
+  ADD FULLTEXT INDEX `ft_proveedores_busqueda` (`nombre`, `ciudad`, `telefono`);
+
+ALTER TABLE `usuarios`
+  ADD FULLTEXT INDEX `ft_usuarios_busqueda` (`nombre`, `correo`);
+
+ALTER TABLE `cuentas_contables`
+  ADD FULLTEXT INDEX `ft_cuentas_busqueda` (`codigo`, `nombre`);
+
+ALTER TABLE `cfdi_importados`
+  ADD FULLTEXT INDEX `ft_cfdi_busqueda`
+    (`uuid`, `rfc_emisor`, `nombre_emisor`, `rfc_receptor`, `nombre_receptor`);
+
+-- Tickets: folio por prefijo dentro de la empresa
+CREATE INDEX `idx_caja_ventas_empresa_folio`
+  ON `caja_ventas` (`empresa_id`, `folio`);
@@ -0,0 +1,29 @@
+-- =====================================================
+-- Saldos contables por cuenta y periodo (ver contabilidad.py)
+-- registrar_asientos() suma aquí el debe / haber de cada renglón en la misma
+-- transacción del asiento. Balanza, mayor y balance general leen esta tabla (una
+-- fila por cuenta y mes) en lugar de sumar todo asientos_detalle en cada consulta.
+--
+-- Después de migrar (o si se editan asientos a mano) ejecutar:
+--   flask contabilidad reconstruir-saldos
+--   flask contabilidad verificar
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `saldos_contables` (
+  `empresa_id` int(11) NOT NULL,
+  `cuenta_id` int(11) NOT NULL,
+  `periodo` date NOT NULL COMMENT 'primer día del mes',
+  `debe` decimal(16,2) NOT NULL DEFAULT 0.00,
+  `haber` decimal(16,2) NOT NULL DEFAULT 0.00,
+  `movimientos` int(11) NOT NULL DEFAULT 0,
+  `actualizado` datetime NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (`empresa_id`, `periodo`, `cuenta_id`),
+  KEY `idx_saldos_cuenta` (`empresa_id`, `cuenta_id`, `periodo`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Mayor: renglones de una cuenta en un rango de fechas de la empresa
+CREATE INDEX `idx_asientos_empresa_fecha`
+  ON `asientos_contables` (`empresa_id`, `fecha`);
+
+CREATE INDEX `idx_asientos_detalle_cuenta`
+  ON `asientos_detalle` (`cuenta_id`, `asiento_id`);
@@ -0,0 +1,44 @@
+-- =====================================================
+-- Secuencias de folios por empresa, tipo y día (ver folios.py)
+-- siguiente_folio() incrementa n con LAST_INSERT_ID(n + 1) en la transacción de la
+-- orden / factura, en lugar de COUNT(*) + 1 ... WHERE folio LIKE 'PREFIJO%'.
+--
+-- Probar concurrencia después de migrar:
+--   flask folios estres
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `folio_sequences` (
+  `empresa_id` int(11) NOT NULL,
+  `tipo` varchar(10) NOT NULL COMMENT 'OC, FB, OCA',
+  `fecha` date NOT NULL,
+  `n` int(11) NOT NULL DEFAULT 0 COMMENT 'último número entregado',
+  PRIMARY KEY (`empresa_id`, `tipo`, `fecha`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Continuar desde el folio más alto ya emitido (TIPO-EMPRESA-YYYYMMDD-###)
+INSERT INTO `folio_sequences` (`empresa_id`, `tipo`, `fecha`, `n`)
+SELECT empresa_cliente_id, 'OC',
+       STR_TO_DATE(SUBSTRING_INDEX(SUBSTRING_INDEX(folio, '-', -2), '-', 1), '%Y%m%d'),
+       MAX(CAST(SUBSTRING_INDEX(folio, '-', -1) AS UNSIGNED))
+FROM `ordenes_compra_b2b`
+WHERE folio LIKE 'OC-%'
+GROUP BY 1, 3
+ON DUPLICATE KEY UPDATE `n` = GREATEST(`n`, VALUES(`n`));
+
+INSERT INTO `folio_sequences` (`empresa_id`, `tipo`, `fecha`, `n`)
+SELECT empresa_emisora_id, 'FB',
+       STR_TO_DATE(SUBSTRING_INDEX(SUBSTRING_INDEX(folio, '-', -2), '-', 1), '%Y%m%d'),
+       MAX(CAST(SUBSTRING_INDEX(folio, '-', -1) AS UNSIGNED))
+FROM `facturas_b2b`
+WHERE folio LIKE 'FB-%'
+GROUP BY 1, 3
+ON DUPLICATE KEY UPDATE `n` = GREATEST(`n`, VALUES(`n`));
+
+INSERT INTO `folio_sequences` (`empresa_id`, `tipo`, `fecha`, `n`)
+SELECT empresa_id, 'OCA',
+       STR_TO_DATE(SUBSTRING_INDEX(SUBSTRING_INDEX(folio, '-', -2), '-', 1), '%Y%m%d'),
+       MAX(CAST(SUBSTRING_INDEX(folio, '-', -1) AS UNSIGNED))
+FROM `ordenes_compra_automaticas`
+WHERE folio LIKE 'OCA-%'
+GROUP BY 1, 3
+ON DUPLICATE KEY UPDATE `n` = GREATEST(`n`, VALUES(`n`));
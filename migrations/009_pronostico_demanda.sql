@@ -0,0 +1,28 @@
+-- =====================================================
+-- Pronóstico de demanda por mercancía (ver pronostico_demanda.py)
+-- Estado del suavizado exponencial (nivel y varianza de la demanda diaria) y los
+-- parámetros de reorden que usa orden_compra_auto. Cada corrida procesa solo los
+-- días posteriores a ultimo_dia.
+--
+-- Programar cada noche (la primera corrida toma PRONOSTICO_DIAS_INICIALES días):
+--   flask pronostico actualizar
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `pronostico_demanda` (
+  `empresa_id` int(11) NOT NULL,
+  `mercancia_id` int(11) NOT NULL,
+  `nivel` double NOT NULL DEFAULT 0 COMMENT 'demanda diaria suavizada',
+  `varianza` double NOT NULL DEFAULT 0,
+  `dias` int(11) NOT NULL DEFAULT 0 COMMENT 'días procesados',
+  `ultimo_dia` date NOT NULL,
+  `stock_seguridad` decimal(14,3) NOT NULL DEFAULT 0.000,
+  `punto_reorden` decimal(14,3) NOT NULL DEFAULT 0.000,
+  `objetivo` decimal(14,3) NOT NULL DEFAULT 0.000,
+  `actualizado` datetime NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (`empresa_id`, `mercancia_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Demanda diaria: ventas del POS por empresa y fecha (las salidas ya usan el
+-- índice (empresa_id, fecha) de la migración 005)
+CREATE INDEX `idx_caja_ventas_empresa_fecha`
+  ON `caja_ventas` (`empresa_id`, `fecha`);
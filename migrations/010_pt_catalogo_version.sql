@@ -0,0 +1,16 @@
+-- =====================================================
+-- Versión del catálogo PT del POS (ver precios_pt.version_catalogo_pt)
+-- Un renglón por empresa; la sube precios_pt.subir_version_catalogo_pt en la misma
+-- transacción que escribe pt_precios, productos PT o entradas de movimientos_inventario.
+-- /caja y /caja/api/catalogo solo leen este renglón para su ETag.
+--
+-- pt_reglas_markup no tiene pantalla: después de editarla a mano ejecutar
+--   UPDATE pt_catalogo_version SET version = version + 1;
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `pt_catalogo_version` (
+  `empresa_id` int(11) NOT NULL,
+  `version` bigint(20) NOT NULL DEFAULT 1,
+  `actualizado` datetime NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (`empresa_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
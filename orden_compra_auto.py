@@ -5,45 +5,191 @@ Genera órdenes basadas en:
 2. Proyección de producción
 3. Solicitudes especiales
 4. Punto de reorden
+
+Planeación (cargar_planeacion / clasificar):
+- Tres consultas agrupadas por empresa: existencias con mínimo / máximo, último costo
+  de compra por mercancía y la solicitud pendiente más antigua por mercancía
+- Columnas paralelas (una lista por campo) y una sola pasada que clasifica
+  bajo_minimo / punto_reorden / pronostico_demanda; el detalle de la orden se inserta
+  con un INSERT de varios renglones
+- Con historia suficiente (pronostico_demanda.py) el punto de reorden y la cantidad
+  salen del pronóstico de demanda y su stock de seguridad en lugar de mínimo / máximo
+- Proyección de producción: faltantes netos de las órdenes abiertas
+  (explosion_materiales.py)
 """
 
 from decimal import Decimal
-from datetime import datetime, timedelta
 import mysql.connector
+from datetime import datetime, timedelta
+from db import conexion_db  # pool compartido con app.py
+from folios import siguiente_folio
+from pronostico_demanda import actualizar_pronostico, como_decimal, PRONOSTICO_MIN_DIAS, PLAZO_ENTREGA_DIAS
+from explosion_materiales import requerimientos_produccion
 
-def conexion_db():
-    """Conexión a la base de datos"""
-    return mysql.connector.connect(
-        host='localhost',  # Cambiar según entorno
-        user='root',
-        password='',
-        database='miapp',
-        charset='utf8mb4',
-        collation='utf8mb4_unicode_ci'
-    )
-
-def generar_folio_oc_auto(empresa_id):
-    """Genera folio único: OCA-EMP-YYYYMMDD-###"""
-    db = conexion_db()
-    cursor = db.cursor()
-    
-    hoy = datetime.now().strftime('%Y%m%d')
-    prefijo = f'OCA-{empresa_id}-{hoy}'
-    
+def generar_folio_oc_auto(cursor, empresa_id):
+    """Folio OCA-EMP-YYYYMMDD-### (en la transacción de `cursor`)"""
+    return siguiente_folio(cursor, empresa_id, 'OCA')
+
+PUNTO_REORDEN = Decimal('1.2')      # hasta 20% arriba del mínimo
+CENTAVO = Decimal('0.01')
+ESTADOS_CERRADOS = ('completado', 'cancelado')
+ER_NO_SUCH_TABLE = 1146
+
+
+def _dec(valor):
+    return valor if isinstance(valor, Decimal) else Decimal(str(valor or 0))
+
+
+def cargar_planeacion(cursor, empresa_id, produccion=None):
+    """
+    Columnas de planeación de las mercancías con mínimo cerca o debajo del punto de
+    reorden, en el punto de reorden de su pronóstico o con faltante para las órdenes
+    de producción (`produccion`, ver explosion_materiales):
+    {'mercancia_id': [...], 'nombre': [...], ...}, una posición por mercancía
+    """
+    produccion = produccion or {}
+    faltantes = [mid for mid, r in produccion.items() if r['neto'] > 0]
+    sql = """
+        SELECT m.id, m.nombre, m.producto_base_id, m.minimo_existencia, m.maximo_existencia,
+               m.precio_venta, COALESCE(i.disponible_base, 0) AS stock_actual{campos}
+        FROM mercancia m
+        LEFT JOIN inventario i ON i.mercancia_id = m.id AND i.empresa_id = %s{join}
+        WHERE m.empresa_id = %s
+          AND m.activo = 1
+          AND ((m.minimo_existencia > 0
+                AND COALESCE(i.disponible_base, 0) <= m.minimo_existencia * %s){filtro}{produccion})
+        ORDER BY m.id
+    """
+    filtro_produccion = (f"""
+               OR m.id IN ({','.join(['%s'] * len(faltantes))})""" if faltantes else "")
+    try:
+        # Con pronóstico suficiente también entra lo que está en su punto de reorden
+        cursor.execute(sql.format(
+            campos=", pd.stock_seguridad, pd.punto_reorden, pd.objetivo",
+            join="""
+        LEFT JOIN pronostico_demanda pd ON pd.empresa_id = m.empresa_id
+              AND pd.mercancia_id = m.id AND pd.dias >= %s""",
+            filtro="""
+               OR (pd.mercancia_id IS NOT NULL
+                   AND COALESCE(i.disponible_base, 0) <= pd.punto_reorden)""",
+            produccion=filtro_produccion),
+            (empresa_id, PRONOSTICO_MIN_DIAS, empresa_id, PUNTO_REORDEN, *faltantes))
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) != ER_NO_SUCH_TABLE:
+            raise
+        cursor.execute(sql.format(campos="", join="", filtro="", produccion=filtro_produccion),
+                       (empresa_id, empresa_id, PUNTO_REORDEN, *faltantes))
+    filas = cursor.fetchall()
+    cols = {
+        'mercancia_id': [r['id'] for r in filas],
+        'nombre': [r['nombre'] for r in filas],
+        'producto_base_id': [r['producto_base_id'] for r in filas],
+        'stock': [_dec(r['stock_actual']) for r in filas],
+        'minimo': [_dec(r['minimo_existencia']) for r in filas],
+        'maximo': [_dec(r['maximo_existencia']) for r in filas],
+        'precio_venta': [_dec(r['precio_venta']) for r in filas],
+        'seguridad': [como_decimal(r.get('stock_seguridad')) for r in filas],
+        'reorden': [como_decimal(r.get('punto_reorden')) for r in filas],
+        'objetivo': [como_decimal(r.get('objetivo')) for r in filas],
+        'produccion': [produccion.get(r['id']) for r in filas],
+    }
+    if not filas:
+        cols.update(costo=[], primera=[])
+        return cols
+
+    # Último costo de compra por unidad de contenido (el mismo que usan las capas PEPS)
     cursor.execute("""
-        SELECT COUNT(*) as total
-        FROM ordenes_compra_automaticas
-        WHERE folio LIKE %s
-    """, (f'{prefijo}%',))
-    
-    count = cursor.fetchone()[0]
-    numero = count + 1
-    folio = f'{prefijo}-{numero:03d}'
-    
-    cursor.close()
-    db.close()
-    
-    return folio
+        SELECT d.mercancia_id,
+               COALESCE(d.precio_total / NULLIF(d.contenido_neto_total, 0), d.precio_unitario) AS costo
+        FROM detalle_compra d
+        JOIN (
+            SELECT mercancia_id, MAX(id) AS id
+            FROM detalle_compra
+            WHERE empresa_id = %s AND mercancia_id IS NOT NULL
+            GROUP BY mercancia_id
+        ) u ON u.id = d.id
+    """, (empresa_id,))
+    costos = {r['mercancia_id']: r['costo'] for r in cursor.fetchall()}
+
+    # Solicitud abierta más antigua (para dias_pendiente)
+    cursor.execute(f"""
+        SELECT d.mercancia_id, MIN(d.fecha_primera_solicitud) AS primera
+        FROM ordenes_compra_automaticas_detalle d
+        JOIN ordenes_compra_automaticas o ON o.id = d.orden_id
+        WHERE o.empresa_id = %s
+          AND d.estado NOT IN ({', '.join(['%s'] * len(ESTADOS_CERRADOS))})
+        GROUP BY d.mercancia_id
+    """, (empresa_id, *ESTADOS_CERRADOS))
+    primeras = {r['mercancia_id']: r['primera'] for r in cursor.fetchall()}
+
+    cols['costo'] = [costos.get(mid) for mid in cols['mercancia_id']]
+    cols['primera'] = [primeras.get(mid) for mid in cols['mercancia_id']]
+    return cols
+
+
+def clasificar(cols, ahora=None):
+    """
+    Una pasada sobre las columnas:
+    - Con pronóstico: pide si stock <= punto de reorden (o bajo el mínimo) hasta el
+      objetivo del pronóstico (nunca menos que el mínimo); prioridad 1 si ya está bajo
+      el stock de seguridad o el mínimo
+    - Sin pronóstico: bajo_minimo (prioridad 1) si stock < mínimo, punto_reorden
+      (prioridad 2) si stock <= mínimo * PUNTO_REORDEN; pide hasta el máximo
+    - Órdenes de producción: si ya pide, suma el bruto que consumirán (la cantidad ya
+      descuenta el stock; sumar el neto lo descontaría dos veces); si no, pide el
+      faltante neto (proyeccion_produccion, prioridad 1 si se necesita dentro del
+      plazo de entrega)
+    Precio estimado = último costo de compra o precio_venta.
+    """
+    ahora = ahora or datetime.now()
+    necesidades = ([], [])
+    for (mid, nombre, base_id, stock, minimo, maximo, venta, costo, primera,
+         seguridad, reorden, objetivo, produccion) in zip(
+            cols['mercancia_id'], cols['nombre'], cols['producto_base_id'], cols['stock'],
+            cols['minimo'], cols['maximo'], cols['precio_venta'], cols['costo'], cols['primera'],
+            cols['seguridad'], cols['reorden'], cols['objetivo'], cols['produccion']):
+        bajo = minimo > 0 and stock < minimo
+        if reorden is not None:
+            cantidad = max(objetivo, minimo) - stock
+            pide = cantidad > 0 and (bajo or stock <= reorden)
+            criterio = 'bajo_minimo' if bajo else 'pronostico_demanda'
+            urgente = bajo or stock < seguridad
+        else:
+            pide = bajo or stock <= minimo * PUNTO_REORDEN
+            cantidad = max(maximo - stock, Decimal(0))
+            criterio = 'bajo_minimo' if bajo else 'punto_reorden'
+            urgente = bajo
+        if produccion:
+            if pide:
+                # La reposición también debe cubrir lo que consumirán las órdenes
+                # (bruto: `cantidad` ya descontó el stock una vez)
+                cantidad += como_decimal(produccion['bruto'])
+            elif produccion['neto'] > 0:
+                pide = True
+                cantidad = como_decimal(produccion['neto'])
+                criterio = 'proyeccion_produccion'
+                urgente = (produccion['fecha'] - ahora.date()).days <= PLAZO_ENTREGA_DIAS
+        if not pide:
+            continue
+        precio = _dec(costo).quantize(CENTAVO) if costo is not None else venta
+        necesidades[0 if urgente else 1].append({
+            'mercancia_id': mid,
+            'producto_base_id': base_id,
+            'descripcion': nombre,
+            'cantidad_sugerida': cantidad,
+            'stock_actual': stock,
+            'stock_minimo': minimo,
+            'stock_maximo': maximo,
+            'precio_estimado': precio,
+            'importe': (cantidad * precio).quantize(CENTAVO),
+            'fecha_primera_solicitud': primera or ahora,
+            'dias_pendiente': (ahora - primera).days if primera else 0,
+            'criterio': criterio,
+            'prioridad': 1 if urgente else 2,
+        })
+    # Ya ordenadas por prioridad (alta primero)
+    return necesidades[0] + necesidades[1]
+
 
 def calcular_necesidades_compra(empresa_id):
     """
@@ -52,89 +198,32 @@ def calcular_necesidades_compra(empresa_id):
     """
     db = conexion_db()
     cursor = db.cursor(dictionary=True)
-    
-    necesidades = []
-    
-    # ===== CRITERIO 1: Stock bajo mínimo =====
-    cursor.execute("""
-        SELECT 
-            m.id as mercancia_id,
-            m.nombre,
-            m.producto_base_id,
-            m.minimo_existencia,
-            m.maximo_existencia,
-            COALESCE(i.disponible_base, 0) as stock_actual,
-            (m.maximo_existencia - COALESCE(i.disponible_base, 0)) as cantidad_sugerida
-        FROM mercancia m
-        LEFT JOIN inventario i ON i.mercancia_id = m.id AND i.empresa_id = %s
-        WHERE m.empresa_id = %s
-          AND m.activo = 1
-          AND m.minimo_existencia > 0
-          AND COALESCE(i.disponible_base, 0) < m.minimo_existencia
-    """, (empresa_id, empresa_id))
-    
-    for row in cursor.fetchall():
-        necesidades.append({
-            'mercancia_id': row['mercancia_id'],
-            'producto_base_id': row['producto_base_id'],
-            'descripcion': row['nombre'],
-            'cantidad_sugerida': max(row['cantidad_sugerida'], 0),
-            'stock_actual': row['stock_actual'],
-            'stock_minimo': row['minimo_existencia'],
-            'stock_maximo': row['maximo_existencia'],
-            'criterio': 'bajo_minimo',
-            'prioridad': 1  # Alta prioridad
-        })
-    
-    # ===== CRITERIO 2: Proyección de producción =====
-    # TODO: Implementar análisis de órdenes de producción futuras
-    # Por ahora dejamos vacío, se implementará después
-    
-    # ===== CRITERIO 3: Solicitudes especiales =====
-    # TODO: Implementar sistema de solicitudes manuales
-    # Por ahora dejamos vacío
-    
-    # ===== CRITERIO 4: Punto de reorden (stock cercano al mínimo) =====
-    cursor.execute("""
-        SELECT 
-            m.id as mercancia_id,
-            m.nombre,
-            m.producto_base_id,
-            m.minimo_existencia,
-            m.maximo_existencia,
-            COALESCE(i.disponible_base, 0) as stock_actual,
-            (m.maximo_existencia - COALESCE(i.disponible_base, 0)) as cantidad_sugerida
-        FROM mercancia m
-        LEFT JOIN inventario i ON i.mercancia_id = m.id AND i.empresa_id = %s
-        WHERE m.empresa_id = %s
-          AND m.activo = 1
-          AND m.minimo_existencia > 0
-          AND COALESCE(i.disponible_base, 0) >= m.minimo_existencia
-          AND COALESCE(i.disponible_base, 0) <= (m.minimo_existencia * 1.2)
-    """, (empresa_id, empresa_id))
-    
-    for row in cursor.fetchall():
-        # Evitar duplicados
-        if not any(n['mercancia_id'] == row['mercancia_id'] for n in necesidades):
-            necesidades.append({
-                'mercancia_id': row['mercancia_id'],
-                'producto_base_id': row['producto_base_id'],
-                'descripcion': row['nombre'],
-                'cantidad_sugerida': max(row['cantidad_sugerida'], 0),
-                'stock_actual': row['stock_actual'],
-                'stock_minimo': row['minimo_existencia'],
-                'stock_maximo': row['maximo_existencia'],
-                'criterio': 'punto_reorden',
-                'prioridad': 2  # Prioridad media
-            })
-    
-    cursor.close()
-    db.close()
-    
-    # Ordenar por prioridad
-    necesidades.sort(key=lambda x: x['prioridad'])
-    
-    return necesidades
+    try:
+        # ===== CRITERIOS 1 y 4: bajo mínimo y punto de reorden (o pronóstico de demanda) =====
+        # ===== CRITERIO 2: Proyección de producción (explosión de órdenes abiertas) =====
+        # ===== CRITERIO 3: Solicitudes especiales (pendiente) =====
+        produccion = requerimientos_produccion(cursor, empresa_id)
+        return clasificar(cargar_planeacion(cursor, empresa_id, produccion))
+    finally:
+        cursor.close()
+        db.close()
+
+
+def insertar_detalle(cursor, orden_id, necesidades):
+    """Detalle de la orden con un INSERT de varios renglones"""
+    cursor.execute(f"""
+        INSERT INTO ordenes_compra_automaticas_detalle
+        (orden_id, mercancia_id, producto_base_id, descripcion,
+         cantidad_solicitada, precio_estimado, importe, criterio,
+         stock_actual, stock_minimo, stock_maximo,
+         fecha_primera_solicitud, dias_pendiente, estado)
+        VALUES {', '.join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'pendiente')"] * len(necesidades))}
+    """, [v for n in necesidades for v in (
+        orden_id, n['mercancia_id'], n['producto_base_id'], n['descripcion'],
+        n['cantidad_sugerida'], n['precio_estimado'], n['importe'], n['criterio'],
+        n['stock_actual'], n['stock_minimo'], n['stock_maximo'],
+        n['fecha_primera_solicitud'], n['dias_pendiente'])])
+
 
 def crear_orden_compra_automatica(empresa_id):
     """
@@ -145,15 +234,18 @@ def crear_orden_compra_automatica(empresa_id):
     cursor = db.cursor(dictionary=True)
     
     try:
-        # Calcular necesidades
-        necesidades = calcular_necesidades_compra(empresa_id)
+        # Pronóstico al día (solo los días nuevos) y necesidades con precio y
+        # solicitud pendiente ya resueltos
+        actualizar_pronostico(cursor, empresa_id)
+        produccion = requerimientos_produccion(cursor, empresa_id)
+        necesidades = clasificar(cargar_planeacion(cursor, empresa_id, produccion))
         
         if not necesidades:
             print(f"No hay necesidades de compra para empresa {empresa_id}")
             return None
         
         # Generar folio
-        folio = generar_folio_oc_auto(empresa_id)
+        folio = generar_folio_oc_auto(cursor, empresa_id)
         
         # Crear orden maestra
         cursor.execute("""
@@ -165,60 +257,10 @@ def crear_orden_compra_automatica(empresa_id):
         orden_id = cursor.lastrowid
         
         # Insertar detalles
-        subtotal = Decimal('0.00')
-        
-        for item in necesidades:
-            # Obtener precio estimado (último precio de compra o precio_venta)
-            cursor.execute("""
-                SELECT precio_venta FROM mercancia WHERE id = %s
-            """, (item['mercancia_id'],))
-            precio_row = cursor.fetchone()
-            precio_estimado = Decimal(precio_row['precio_venta'] if precio_row else '0.00')
-            
-            cantidad = Decimal(str(item['cantidad_sugerida']))
-            importe = cantidad * precio_estimado
-            subtotal += importe
-            
-            # Verificar si ya existe solicitud pendiente
-            cursor.execute("""
-                SELECT fecha_primera_solicitud
-                FROM ordenes_compra_automaticas_detalle
-                WHERE mercancia_id = %s
-                  AND estado NOT IN ('completado', 'cancelado')
-                ORDER BY fecha_primera_solicitud ASC
-                LIMIT 1
-            """, (item['mercancia_id'],))
-            
-            fecha_primera = cursor.fetchone()
-            fecha_primera_solicitud = fecha_primera['fecha_primera_solicitud'] if fecha_primera else datetime.now()
-            
-            # Calcular días pendiente
-            dias_pendiente = (datetime.now() - fecha_primera_solicitud).days if fecha_primera else 0
-            
-            cursor.execute("""
-                INSERT INTO ordenes_compra_automaticas_detalle
-                (orden_id, mercancia_id, producto_base_id, descripcion,
-                 cantidad_solicitada, precio_estimado, importe, criterio,
-                 stock_actual, stock_minimo, stock_maximo,
-                 fecha_primera_solicitud, dias_pendiente, estado)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'pendiente')
-            """, (
-                orden_id,
-                item['mercancia_id'],
-                item['producto_base_id'],
-                item['descripcion'],
-                item['cantidad_sugerida'],
-                precio_estimado,
-                importe,
-                item['criterio'],
-                item['stock_actual'],
-                item['stock_minimo'],
-                item['stock_maximo'],
-                fecha_primera_solicitud,
-                dias_pendiente
-            ))
+        insertar_detalle(cursor, orden_id, necesidades)
         
         # Actualizar totales de la orden
+        subtotal = sum((n['importe'] for n in necesidades), Decimal('0.00'))
         iva = subtotal * Decimal('0.16')
         total = subtotal + iva
         
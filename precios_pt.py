@@ -0,0 +1,230 @@
+"""
+Motor de precios PT (Productos Terminados)
+Calcula costo, regla de markup y precio final de todo el catálogo
+en un número constante de consultas:
+1. Catálogo PT + configuración de pt_precios
+2. Costos promedio de entradas (un solo SUM ... GROUP BY)
+3. Reglas de markup (se cargan una vez y se buscan en memoria)
+"""
+
+import uuid
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+import mysql.connector
+
+from db import conexion_db
+
+MARKUP_DEFAULT = Decimal("0.30")
+
+ER_NO_SUCH_TABLE = 1146
+
+
+def D(x, fb="0"):
+    try:
+        return Decimal(str(x))
+    except Exception:
+        return Decimal(fb)
+
+
+class ReglasMarkup:
+    """
+    Rangos de pt_reglas_markup ordenados por costo_min.
+    Equivale a: WHERE costo BETWEEN costo_min AND costo_max ORDER BY costo_min LIMIT 1
+    usando bisect sobre costo_min y el máximo acumulado de costo_max.
+    """
+
+    def __init__(self, reglas):
+        reglas = sorted(
+            ((D(r["costo_min"]), D(r["costo_max"]), D(r["markup_pct"])) for r in reglas),
+            key=lambda r: r[0]
+        )
+        self._mins = [r[0] for r in reglas]
+        self._pcts = [r[2] for r in reglas]
+
+        # Máximo acumulado de costo_max: es no decreciente, así que el primer
+        # índice donde alcanza el costo es la primera regla que lo contiene.
+        self._max_acum = []
+        tope = None
+        for r in reglas:
+            tope = r[1] if tope is None or r[1] > tope else tope
+            self._max_acum.append(tope)
+
+    def para_costo(self, costo):
+        costo = D(costo)
+        candidatas = bisect_right(self._mins, costo)     # reglas con costo_min <= costo
+        i = bisect_left(self._max_acum, costo, 0, candidatas)
+        if i < candidatas:
+            return self._pcts[i]
+        return MARKUP_DEFAULT
+
+
+def cargar_reglas_markup(cur):
+    cur.execute("""
+        SELECT costo_min, costo_max, markup_pct
+        FROM pt_reglas_markup
+        ORDER BY costo_min
+    """)
+    return ReglasMarkup(cur.fetchall())
+
+
+def costos_pt(cur, mercancia_ids):
+    """Costo promedio de entradas por producto: {mercancia_id: Decimal}"""
+    ids = [int(x) for x in mercancia_ids]
+    if not ids:
+        return {}
+
+    placeholders = ",".join(["%s"] * len(ids))
+    cur.execute(f"""
+        SELECT producto_id,
+               SUM(cantidad*costo_unitario) AS imp,
+               SUM(cantidad) AS qty
+        FROM movimientos_inventario
+        WHERE producto_id IN ({placeholders})
+          AND UPPER(tipo) IN ('COMPRA','ENTRADA')
+        GROUP BY producto_id
+    """, ids)
+
+    costos = {}
+    for r in cur.fetchall():
+        imp = D(r["imp"] or 0)
+        qty = D(r["qty"] or 0)
+        costos[r["producto_id"]] = (imp / qty if qty > 0 else D(0)).quantize(Decimal("0.01"))
+    return costos
+
+
+def _precio_item(r, costo, reglas):
+    modo = r["modo"]
+    markup_pct = D(r.get("markup_pct") or "0")
+    precio_manual = r.get("precio_manual")
+
+    if modo == "manual" and precio_manual is not None:
+        precio = D(precio_manual).quantize(Decimal("0.01"))
+        pct_usado = (precio / costo - Decimal("1")) if costo > 0 else Decimal("0")
+    else:
+        pct = markup_pct if modo == "manual" else reglas.para_costo(costo)
+        precio = (costo * (Decimal("1") + pct)).quantize(Decimal("0.01"))
+        pct_usado = pct
+
+    return {
+        "id": r["id"],
+        "nombre": r["nombre"],
+        "alias": r.get("alias"),
+        "label": r.get("alias") or r["nombre"],
+        "modo": modo,
+        "costo": costo,
+        "precio": precio,
+        "pct_usado": pct_usado,
+        "markup_pct": markup_pct,
+        "precio_manual": precio_manual,
+    }
+
+
+def calcular_precios_pt(empresa_id, mercancia_ids=None, cur=None):
+    """
+    Catálogo PT de la empresa con costo y precio calculados.
+    - mercancia_ids=None: todo el catálogo activo (orden del POS)
+    - mercancia_ids=[...]: solo esos productos
+    Retorna la lista de items con la misma forma que usaban _pt_items_all() / precio_pt().
+    """
+    conn = None
+    if cur is None:
+        conn = conexion_db()
+        cur = conn.cursor(dictionary=True)
+
+    try:
+        filtro_ids = ""
+        params = [empresa_id, empresa_id]
+        if mercancia_ids is not None:
+            ids = [int(x) for x in mercancia_ids]
+            if not ids:
+                return []
+            filtro_ids = f"AND m.id IN ({','.join(['%s'] * len(ids))})"
+            params += ids
+        else:
+            filtro_ids = "AND m.tipo_inventario_id = 3 AND m.activo = 1"
+
+        cur.execute(f"""
+            SELECT
+                m.id,
+                m.nombre,
+                COALESCE(m.orden, 9999) AS orden,
+                COALESCE(p.modo, 'auto') AS modo,
+                COALESCE(p.markup_pct, 0.30) AS markup_pct,
+                p.alias,
+                p.precio_manual
+            FROM mercancia m
+            LEFT JOIN pt_precios p ON p.mercancia_id = m.id AND p.empresa_id = %s
+            WHERE m.empresa_id = %s
+              {filtro_ids}
+            ORDER BY orden ASC, COALESCE(p.alias, m.nombre) ASC
+        """, params)
+        rows = cur.fetchall()
+        if not rows:
+            return []
+
+        costos = costos_pt(cur, [r["id"] for r in rows])
+        reglas = cargar_reglas_markup(cur)
+    finally:
+        if conn is not None:
+            cur.close()
+            conn.close()
+
+    return [_precio_item(r, costos.get(r["id"], D(0).quantize(Decimal("0.01"))), reglas) for r in rows]
+
+
+def precios_pt_por_id(empresa_id, mercancia_ids=None, cur=None):
+    """Igual que calcular_precios_pt pero indexado por mercancia_id"""
+    return {it["id"]: it for it in calcular_precios_pt(empresa_id, mercancia_ids, cur)}
+
+
+def subir_version_catalogo_pt(cur, empresa_id=None):
+    """
+    Sube la versión del catálogo PT (empresa_id=None: todas las empresas).
+    No hace commit: va en la transacción que cambia precios, productos PT o sus costos.
+    Sin la tabla (migración 010 pendiente) no hace nada.
+    """
+    try:
+        if empresa_id is None:
+            cur.execute("UPDATE pt_catalogo_version SET version = version + 1")
+        else:
+            cur.execute("""
+                INSERT INTO pt_catalogo_version (empresa_id, version) VALUES (%s, 1)
+                ON DUPLICATE KEY UPDATE version = version + 1
+            """, (empresa_id,))
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) != ER_NO_SUCH_TABLE:
+            raise
+
+
+def revision_catalogo_pt(cur, empresa_id):
+    """
+    Versión del catálogo PT de la empresa (un renglón de pt_catalogo_version, igual en
+    todos los workers). Sin la tabla regresa un valor único: no hay caché, pero nunca
+    se sirve un catálogo viejo.
+    """
+    try:
+        cur.execute("SELECT version FROM pt_catalogo_version WHERE empresa_id = %s", (empresa_id,))
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) == ER_NO_SUCH_TABLE:
+            return uuid.uuid4().hex[:12]
+        raise
+    r = cur.fetchone()
+    if r is None:
+        return "0"
+    return str(r['version'] if isinstance(r, dict) else r[0])
+
+
+def version_catalogo_pt(empresa_id, turno_id, cur=None):
+    """Etiqueta de versión del catálogo del POS: cambia por turno y con cualquier cambio de precio"""
+    conn = None
+    if cur is None:
+        conn = conexion_db()
+        cur = conn.cursor(dictionary=True)
+    try:
+        rev = revision_catalogo_pt(cur, empresa_id)
+    finally:
+        if conn is not None:
+            cur.close()
+            conn.close()
+    return f"pt-{empresa_id}-{turno_id}-{rev}"
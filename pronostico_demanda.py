@@ -0,0 +1,221 @@
+"""
+Pronóstico de demanda diaria por mercancía (criterio de reorden de orden_compra_auto)
+Demanda de un día = la mayor de tres fuentes (miden el mismo flujo, no se suman):
+1. Ventas del POS: caja_ventas_detalle de ventas no canceladas
+2. Turnos cerrados: turno_inventario inicial - turno_inventario_final
+3. Salidas de inventario_movimientos (consumo de producción, ajustes)
+
+Suavizado exponencial incremental (pronostico_demanda, migrations/009):
+- nivel = nivel + α·e y varianza = (1 - α)·(varianza + α·e²), con e = demanda - nivel
+- Cada corrida procesa solo los días posteriores a ultimo_dia (un día por noche);
+  los días sin movimientos cuentan como demanda 0
+- Stock de seguridad = z(NIVEL_SERVICIO)·σ·√PLAZO_ENTREGA_DIAS
+  Punto de reorden = nivel·plazo + stock de seguridad
+  Objetivo = punto de reorden + nivel·REVISION_DIAS
+
+CLI: flask pronostico actualizar [--empresa N]
+"""
+
+import math
+import os
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from statistics import NormalDist
+
+import mysql.connector
+
+from db import conexion_db
+
+PRONOSTICO_ALFA = float(os.environ.get('PRONOSTICO_ALFA', 0.2))
+NIVEL_SERVICIO = float(os.environ.get('NIVEL_SERVICIO', 0.95))
+PLAZO_ENTREGA_DIAS = float(os.environ.get('PLAZO_ENTREGA_DIAS', 3))
+REVISION_DIAS = float(os.environ.get('REVISION_DIAS', 7))
+PRONOSTICO_MIN_DIAS = int(os.environ.get('PRONOSTICO_MIN_DIAS', 14))      # historia mínima para usarlo
+PRONOSTICO_DIAS_INICIALES = int(os.environ.get('PRONOSTICO_DIAS_INICIALES', 90))
+
+ER_NO_SUCH_TABLE = 1146
+
+
+def _sin_tabla(err):
+    return getattr(err, 'errno', None) == ER_NO_SUCH_TABLE
+
+
+def _dia(valor):
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    return datetime.strptime(str(valor)[:10], '%Y-%m-%d').date()
+
+
+# -------------------- Demanda diaria --------------------
+
+def _maximos(cur, demanda, sql, params):
+    """Acumula en demanda[(mercancia_id, dia)] el máximo entre fuentes"""
+    try:
+        cur.execute(sql, params)
+    except mysql.connector.Error as err:
+        if not _sin_tabla(err):
+            raise
+        return
+    for r in cur.fetchall():
+        if r['mercancia_id'] is None or r['dia'] is None:
+            continue
+        clave = (int(r['mercancia_id']), _dia(r['dia']))
+        cantidad = max(float(r['cantidad'] or 0), 0.0)
+        if cantidad > demanda.get(clave, 0.0):
+            demanda[clave] = cantidad
+
+
+def demanda_diaria(cur, empresa_id, desde, hasta):
+    """{(mercancia_id, dia): cantidad} de los días desde..hasta (incluidos)"""
+    inicio = datetime.combine(desde, datetime.min.time())
+    fin = datetime.combine(hasta + timedelta(days=1), datetime.min.time())
+    demanda = {}
+    _maximos(cur, demanda, """
+        SELECT d.mercancia_id, DATE(v.fecha) AS dia, SUM(d.cantidad) AS cantidad
+        FROM caja_ventas v
+        JOIN caja_ventas_detalle d ON d.venta_id = v.id
+        WHERE v.empresa_id = %s AND v.fecha >= %s AND v.fecha < %s
+          AND COALESCE(v.cancelada, 0) = 0
+        GROUP BY d.mercancia_id, DATE(v.fecha)
+    """, (empresa_id, inicio, fin))
+    _maximos(cur, demanda, """
+        SELECT i.producto_id AS mercancia_id, DATE(t.fecha_cierre) AS dia,
+               SUM(i.inicial - f.final) AS cantidad
+        FROM turnos t
+        JOIN (SELECT turno_id, producto_id, MAX(cantidad_inicial) AS inicial
+              FROM turno_inventario GROUP BY turno_id, producto_id) i ON i.turno_id = t.id
+        JOIN (SELECT turno_id, producto_id, SUM(cantidad_final) AS final
+              FROM turno_inventario_final GROUP BY turno_id, producto_id) f
+          ON f.turno_id = t.id AND f.producto_id = i.producto_id
+        WHERE t.empresa_id = %s AND t.fecha_cierre >= %s AND t.fecha_cierre < %s
+        GROUP BY i.producto_id, DATE(t.fecha_cierre)
+    """, (empresa_id, inicio, fin))
+    _maximos(cur, demanda, """
+        SELECT mercancia_id, fecha AS dia, SUM(unidades) AS cantidad
+        FROM inventario_movimientos
+        WHERE empresa_id = %s AND LOWER(tipo_movimiento) = 'salida'
+          AND fecha >= %s AND fecha <= %s
+        GROUP BY mercancia_id, fecha
+    """, (empresa_id, desde, hasta))
+    return demanda
+
+
+# -------------------- Suavizado --------------------
+
+def suavizar(nivel, varianza, demanda, alfa=PRONOSTICO_ALFA):
+    """Un día de suavizado exponencial: (nivel, varianza) nuevos"""
+    e = demanda - nivel
+    return nivel + alfa * e, (1 - alfa) * (varianza + alfa * e * e)
+
+
+def parametros_reorden(nivel, varianza, plazo=PLAZO_ENTREGA_DIAS, revision=REVISION_DIAS,
+                       servicio=NIVEL_SERVICIO):
+    """(stock_seguridad, punto_reorden, objetivo) para la demanda diaria pronosticada"""
+    z = NormalDist().inv_cdf(servicio)
+    seguridad = z * math.sqrt(max(varianza, 0.0)) * math.sqrt(plazo)
+    reorden = nivel * plazo + seguridad
+    return seguridad, reorden, reorden + nivel * revision
+
+
+def actualizar_pronostico(cur, empresa_id, hasta=None):
+    """
+    Procesa los días posteriores a lo ya pronosticado hasta `hasta` (ayer por
+    default) y guarda el estado por mercancía. No hace commit. Regresa
+    (mercancias, dias) procesados; (0, 0) si ya estaba al día o falta la tabla.
+    """
+    hasta = hasta or date.today() - timedelta(days=1)
+    try:
+        cur.execute("""
+            SELECT mercancia_id, nivel, varianza, dias, ultimo_dia
+            FROM pronostico_demanda
+            WHERE empresa_id = %s
+        """, (empresa_id,))
+    except mysql.connector.Error as err:
+        if _sin_tabla(err):
+            return 0, 0
+        raise
+    estados = {r['mercancia_id']: [float(r['nivel']), float(r['varianza']), int(r['dias']),
+                                   _dia(r['ultimo_dia'])]
+               for r in cur.fetchall()}
+
+    desde = min((e[3] for e in estados.values()),
+                default=hasta - timedelta(days=PRONOSTICO_DIAS_INICIALES)) + timedelta(days=1)
+    if desde > hasta:
+        return 0, 0
+    demanda = demanda_diaria(cur, empresa_id, desde, hasta)
+
+    # Mercancías nuevas: arrancan el día anterior a su primera demanda
+    for (mid, dia) in sorted(demanda, key=lambda k: k[1]):
+        if mid not in estados:
+            estados[mid] = [demanda[(mid, dia)], 0.0, 0, dia - timedelta(days=1)]
+
+    cambios = []
+    for mid, (nivel, varianza, dias, ultimo) in estados.items():
+        if ultimo >= hasta:
+            continue
+        dia = ultimo + timedelta(days=1)
+        while dia <= hasta:
+            nivel, varianza = suavizar(nivel, varianza, demanda.get((mid, dia), 0.0))
+            dias += 1
+            dia += timedelta(days=1)
+        seguridad, reorden, objetivo = parametros_reorden(nivel, varianza)
+        cambios.append((empresa_id, mid, nivel, varianza, dias, hasta, seguridad, reorden, objetivo))
+
+    if cambios:
+        cur.execute(f"""
+            INSERT INTO pronostico_demanda
+            (empresa_id, mercancia_id, nivel, varianza, dias, ultimo_dia,
+             stock_seguridad, punto_reorden, objetivo)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(cambios))}
+            ON DUPLICATE KEY UPDATE
+                nivel = VALUES(nivel), varianza = VALUES(varianza), dias = VALUES(dias),
+                ultimo_dia = VALUES(ultimo_dia), stock_seguridad = VALUES(stock_seguridad),
+                punto_reorden = VALUES(punto_reorden), objetivo = VALUES(objetivo)
+        """, [v for c in cambios for v in c])
+    return len(cambios), (hasta - desde).days + 1
+
+
+def como_decimal(valor):
+    return None if valor is None else Decimal(str(round(float(valor), 3)))
+
+
+# -------------------- CLI --------------------
+
+def _empresas_activas():
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT DISTINCT empresa_id FROM mercancia WHERE activo = 1 AND empresa_id IS NOT NULL")
+        return [r[0] for r in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def init_app(app):
+    """Registra el comando: flask pronostico actualizar [--empresa N] (corrida nocturna)"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('pronostico', help='Pronóstico de demanda para compras automáticas')
+
+    @grupo.command('actualizar')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def actualizar_cmd(empresa):
+        for eid in ([empresa] if empresa else _empresas_activas()):
+            conn = conexion_db()
+            cur = conn.cursor(dictionary=True)
+            try:
+                mercancias, dias = actualizar_pronostico(cur, eid)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+                conn.close()
+            click.echo(f"✅ Empresa {eid}: {mercancias} mercancías, {dias} días nuevos")
+
+    app.cli.add_command(grupo)
@@ -3,6 +3,8 @@ from utils.decorators import require_login, require_rango, require_puede_crear_u
 from werkzeug.security import generate_password_hash
 import json
 
+from busqueda import invalidar as invalidar_busqueda
+
 def get_mysql():
     """Importación lazy para evitar circular imports"""
     from app_multitenant import mysql
@@ -172,6 +174,7 @@ def nuevo_usuario():
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, TRUE, %s)
     """, (g.contratante_id, empresa_id, nombre, email, hashed_password, rango, json.dumps(empresas_acceso), puede_agregar, rol))
     get_mysql().connection.commit()
+    invalidar_busqueda(seccion='usuarios')
     cur.close()
     
     flash('Usuario creado exitosamente', 'success')
@@ -196,6 +199,7 @@ def editar_usuario(usuario_id):
         WHERE id = %s AND contratante_id = %s
     """, (nombre, empresa_id, rango, json.dumps(empresas_acceso), puede_agregar, activo, usuario_id, g.contratante_id))
     get_mysql().connection.commit()
+    invalidar_busqueda(seccion='usuarios')
     cur.close()
     
     flash('Usuario actualizado exitosamente', 'success')
@@ -215,6 +219,7 @@ def eliminar_usuario(usuario_id):
         WHERE id = %s AND contratante_id = %s
     """, (usuario_id, g.contratante_id))
     mget_mysql().connection.commit()
+    invalidar_busqueda(seccion='usuarios')
     cur.close()
     
     flash('Usuario eliminado exitosamente', 'success')
@@ -471,6 +471,8 @@ def facturacion_b2b_recibir(id):
                         VALUES (%s, %s, 'entrada', %s, %s, %s, NOW())
                     """, (eid, item['mercancia_id'], item['cantidad_recibida'], 
                           f'Factura B2B: {factura["folio"]}', uid))
+                # Entradas en movimientos_inventario: cambian el costo de los PT
+                subir_version_catalogo_pt(cur, eid)
                 
                 # Notificar al emisor
                 cur.execute("""
@@ -721,6 +723,7 @@ def cfdi_importar():
                     errores += 1
         
         conn.commit()
+        invalidar_busqueda(eid, 'cfdi')
         
         if importados > 0:
             flash(f'✅ {importados} CFDI importados correctamente', 'success')
@@ -892,6 +895,7 @@ def cfdi_conciliar(id):
             """, (documento_id, id, eid))
         
         conn.commit()
+        invalidar_busqueda(eid, 'cfdi')
         flash('✅ CFDI conciliado correctamente', 'success')
         
     except Exception as e:
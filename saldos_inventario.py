@@ -0,0 +1,417 @@
+"""
+Saldos de inventario materializados (snapshot por producto)
+Tabla inventario_saldos: una fila por (empresa, tipo_inventario, mercancía) con
+unidades, valor, costo promedio ponderado y el apuntador a la capa PEPS vigente.
+
+- aplicar_movimiento(): se llama en la MISMA transacción que inserta en
+  inventario_movimientos, así el saldo nunca queda desfasado del movimiento.
+- reconstruir_saldos() / verificar_saldos(): re-ejecutan la historia completa
+  (flask saldos-inventario reconstruir|verificar).
+- Las vistas leen el saldo en O(1) por producto con leer_saldos(). Las pantallas
+  de inventario MP/WIP siguen en costeo_promedio (promedio por producto base y,
+  en MP, compras desde detalle_compra), que no es la suma por mercancía de aquí.
+
+Criterio de costeo (igual que el kardex):
+- Entradas ('entrada', 'compra') suben unidades y valor y recalculan el promedio.
+- Salidas descuentan unidades al costo promedio vigente.
+- En MP (tipo 1) las compras se valúan con detalle_compra (precio_total / contenido neto).
+"""
+
+import mysql.connector
+from db import conexion_db
+
+TIPOS_ENTRADA = ('entrada', 'compra')
+TIPOS_SALIDA = ('salida',)
+
+ER_NO_SUCH_TABLE = 1146
+
+
+def _es_entrada(tipo):
+    return (tipo or '').strip().lower() in TIPOS_ENTRADA
+
+
+def _es_salida(tipo):
+    return (tipo or '').strip().lower() in TIPOS_SALIDA
+
+
+def _fila(cur, row):
+    """Normaliza la fila a dict sin importar si el cursor es dictionary o tupla"""
+    if row is None or isinstance(row, dict):
+        return row
+    return dict(zip(cur.column_names, row))
+
+
+def _siguiente_capa(cur, empresa_id, tipo_inventario_id, mercancia_id, despues_de_id=None):
+    """Siguiente entrada PEPS (orden fecha, id) posterior a la capa indicada"""
+    if despues_de_id is None:
+        cur.execute("""
+            SELECT id, unidades
+            FROM inventario_movimientos
+            WHERE empresa_id = %s AND tipo_inventario_id = %s AND mercancia_id = %s
+              AND LOWER(tipo_movimiento) IN ('entrada','compra')
+              AND unidades > 0
+            ORDER BY fecha ASC, id ASC
+            LIMIT 1
+        """, (empresa_id, tipo_inventario_id, mercancia_id))
+    else:
+        cur.execute("""
+            SELECT im.id, im.unidades
+            FROM inventario_movimientos im
+            JOIN inventario_movimientos ref ON ref.id = %s
+            WHERE im.empresa_id = %s AND im.tipo_inventario_id = %s AND im.mercancia_id = %s
+              AND LOWER(im.tipo_movimiento) IN ('entrada','compra')
+              AND im.unidades > 0
+              AND (im.fecha > ref.fecha OR (im.fecha = ref.fecha AND im.id > ref.id))
+            ORDER BY im.fecha ASC, im.id ASC
+            LIMIT 1
+        """, (despues_de_id, empresa_id, tipo_inventario_id, mercancia_id))
+    return _fila(cur, cur.fetchone())
+
+
+def _avanzar_fifo(cur, empresa_id, tipo_inventario_id, mercancia_id, capa_id, consumido, unidades):
+    """Consume `unidades` desde la capa apuntada; regresa el nuevo (capa_id, consumido)"""
+    restante = float(unidades)
+    capa = None
+    if capa_id is not None:
+        cur.execute("SELECT id, unidades FROM inventario_movimientos WHERE id = %s", (capa_id,))
+        capa = _fila(cur, cur.fetchone())
+    if capa is None:
+        capa = _siguiente_capa(cur, empresa_id, tipo_inventario_id, mercancia_id)
+        consumido = 0.0
+
+    while capa is not None and restante > 0:
+        disponible = float(capa['unidades']) - float(consumido)
+        if disponible > restante:
+            return capa['id'], float(consumido) + restante
+        restante -= max(disponible, 0.0)
+        capa = _siguiente_capa(cur, empresa_id, tipo_inventario_id, mercancia_id, capa['id'])
+        consumido = 0.0
+
+    if capa is None:
+        return None, 0.0
+    return capa['id'], float(consumido)
+
+
+def aplicar_movimiento(cur, empresa_id, tipo_inventario_id, mercancia_id, tipo_movimiento,
+                       unidades, precio_unitario=0, movimiento_id=None):
+    """
+    Actualiza el saldo materializado con un movimiento recién insertado.
+    No hace commit: debe ir en la transacción del INSERT del movimiento.
+    Si la tabla aún no existe (migración pendiente) no hace nada.
+    """
+    if not empresa_id or not mercancia_id:
+        return
+    if not (_es_entrada(tipo_movimiento) or _es_salida(tipo_movimiento)):
+        return
+
+    tipo_inventario_id = int(tipo_inventario_id or 1)
+    u = float(unidades or 0)
+    pu = float(precio_unitario or 0)
+    if u <= 0:
+        return
+
+    try:
+        cur.execute("""
+            SELECT unidades, valor, entradas, salidas, fifo_mov_id, fifo_consumido
+            FROM inventario_saldos
+            WHERE empresa_id = %s AND tipo_inventario_id = %s AND mercancia_id = %s
+            FOR UPDATE
+        """, (empresa_id, tipo_inventario_id, mercancia_id))
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) == ER_NO_SUCH_TABLE:
+            return
+        raise
+    s = _fila(cur, cur.fetchone()) or {}
+
+    saldo_u = float(s.get('unidades') or 0)
+    saldo_mx = float(s.get('valor') or 0)
+    entradas = float(s.get('entradas') or 0)
+    salidas = float(s.get('salidas') or 0)
+    fifo_id = s.get('fifo_mov_id')
+    fifo_consumido = float(s.get('fifo_consumido') or 0)
+
+    if _es_entrada(tipo_movimiento):
+        saldo_u += u
+        saldo_mx += u * pu
+        entradas += u
+        if fifo_id is None and movimiento_id is not None:
+            fifo_id, fifo_consumido = movimiento_id, 0.0
+    else:
+        costo = saldo_mx / saldo_u if saldo_u > 0 else 0.0
+        saldo_u -= u
+        saldo_mx -= u * costo
+        salidas += u
+        fifo_id, fifo_consumido = _avanzar_fifo(
+            cur, empresa_id, tipo_inventario_id, mercancia_id, fifo_id, fifo_consumido, u
+        )
+
+    costo_promedio = saldo_mx / saldo_u if saldo_u > 0 else 0.0
+
+    cur.execute("""
+        INSERT INTO inventario_saldos
+            (empresa_id, tipo_inventario_id, mercancia_id, unidades, valor, costo_promedio,
+             entradas, salidas, fifo_mov_id, fifo_consumido, ultimo_movimiento_id, actualizado)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
+        ON DUPLICATE KEY UPDATE
+            unidades             = VALUES(unidades),
+            valor                = VALUES(valor),
+            costo_promedio       = VALUES(costo_promedio),
+            entradas             = VALUES(entradas),
+            salidas              = VALUES(salidas),
+            fifo_mov_id          = VALUES(fifo_mov_id),
+            fifo_consumido       = VALUES(fifo_consumido),
+            ultimo_movimiento_id = COALESCE(VALUES(ultimo_movimiento_id), ultimo_movimiento_id),
+            actualizado          = NOW()
+    """, (empresa_id, tipo_inventario_id, mercancia_id, round(saldo_u, 4), round(saldo_mx, 4),
+          round(costo_promedio, 6), round(entradas, 4), round(salidas, 4),
+          fifo_id, round(fifo_consumido, 4), movimiento_id))
+
+
+def snapshot_activo(cur, empresa_id):
+    """True si la empresa ya tiene saldos reconstruidos (las vistas pueden confiar en ellos)"""
+    try:
+        cur.execute("SELECT 1 FROM inventario_saldos_control WHERE empresa_id = %s", (empresa_id,))
+    except mysql.connector.Error as err:
+        if getattr(err, 'errno', None) == ER_NO_SUCH_TABLE:
+            return False
+        raise
+    return cur.fetchone() is not None
+
+
+def leer_saldos(cur, empresa_id, tipo_inventario_id, mercancia_ids=None):
+    """{mercancia_id: {unidades, valor, costo_promedio, entradas, salidas}} leído del snapshot"""
+    params = [empresa_id, tipo_inventario_id]
+    filtro = ""
+    if mercancia_ids is not None:
+        ids = [int(x) for x in mercancia_ids]
+        if not ids:
+            return {}
+        filtro = f"AND mercancia_id IN ({','.join(['%s'] * len(ids))})"
+        params += ids
+
+    cur.execute(f"""
+        SELECT mercancia_id, unidades, valor, costo_promedio, entradas, salidas
+        FROM inventario_saldos
+        WHERE empresa_id = %s AND tipo_inventario_id = %s
+          {filtro}
+    """, params)
+    saldos = {}
+    for row in cur.fetchall():
+        r = _fila(cur, row)
+        saldos[r['mercancia_id']] = {
+            'unidades': float(r['unidades'] or 0),
+            'valor': float(r['valor'] or 0),
+            'costo_promedio': float(r['costo_promedio'] or 0),
+            'entradas': float(r['entradas'] or 0),
+            'salidas': float(r['salidas'] or 0),
+        }
+    return saldos
+
+
+def leer_existencias(cur, empresa_id, mercancia_ids):
+    """{mercancia_id: unidades} sumando todos los tipos de inventario (snapshot)"""
+    ids = [int(x) for x in mercancia_ids]
+    if not ids:
+        return {}
+    cur.execute(f"""
+        SELECT mercancia_id, SUM(unidades) AS unidades
+        FROM inventario_saldos
+        WHERE empresa_id = %s
+          AND mercancia_id IN ({','.join(['%s'] * len(ids))})
+        GROUP BY mercancia_id
+    """, [empresa_id] + ids)
+    return {r['mercancia_id']: float(r['unidades'] or 0)
+            for r in (_fila(cur, row) for row in cur.fetchall())}
+
+
+def calcular_saldos_historia(cur, empresa_id):
+    """
+    Re-ejecuta toda la historia de la empresa en un solo recorrido ordenado.
+    Regresa {(tipo_inventario_id, mercancia_id): saldo}.
+    """
+    cur.execute("""
+        SELECT * FROM (
+            SELECT 1 AS tipo_inventario_id, dc.mercancia_id, lc.fecha AS fecha,
+                   'compra' AS tipo_movimiento,
+                   dc.contenido_neto_total AS unidades,
+                   CASE WHEN dc.contenido_neto_total > 0
+                        THEN dc.precio_total / dc.contenido_neto_total ELSE 0 END AS precio_unitario,
+                   0 AS fuente, dc.id AS id, 0 AS es_capa
+            FROM detalle_compra dc
+            JOIN listado_compras lc ON lc.id = dc.compra_id
+            WHERE dc.empresa_id = %s AND lc.empresa_id = %s
+              AND dc.mercancia_id IS NOT NULL
+            UNION ALL
+            SELECT im.tipo_inventario_id, im.mercancia_id, im.fecha,
+                   im.tipo_movimiento, im.unidades, im.precio_unitario,
+                   1 AS fuente, im.id,
+                   CASE WHEN LOWER(im.tipo_movimiento) IN ('entrada','compra') THEN 1 ELSE 0 END AS es_capa
+            FROM inventario_movimientos im
+            WHERE im.empresa_id = %s
+              AND im.unidades > 0
+              AND im.tipo_movimiento IS NOT NULL
+              AND im.tipo_movimiento <> ''
+        ) t
+        ORDER BY t.fecha ASC, t.fuente ASC, t.id ASC
+    """, (empresa_id, empresa_id, empresa_id))
+
+    saldos = {}
+    capas = {}
+    for row in cur.fetchall():
+        r = _fila(cur, row)
+        clave = (int(r['tipo_inventario_id'] or 1), r['mercancia_id'])
+        s = saldos.setdefault(clave, {'unidades': 0.0, 'valor': 0.0, 'entradas': 0.0,
+                                      'salidas': 0.0, 'ultimo_movimiento_id': None})
+        tipo = r['tipo_movimiento']
+        u = float(r['unidades'] or 0)
+        pu = float(r['precio_unitario'] or 0)
+
+        if r['fuente'] == 1:
+            s['ultimo_movimiento_id'] = r['id']
+            if r['es_capa']:
+                capas.setdefault(clave, []).append((r['id'], u))
+            # En MP la compra ya viene valuada desde detalle_compra
+            if clave[0] == 1 and (tipo or '').strip().upper() == 'COMPRA':
+                continue
+
+        if _es_entrada(tipo):
+            s['unidades'] += u
+            s['valor'] += u * pu
+            s['entradas'] += u
+        elif _es_salida(tipo):
+            costo = s['valor'] / s['unidades'] if s['unidades'] > 0 else 0.0
+            s['unidades'] -= u
+            s['valor'] -= u * costo
+            s['salidas'] += u
+
+    for clave, s in saldos.items():
+        s['costo_promedio'] = s['valor'] / s['unidades'] if s['unidades'] > 0 else 0.0
+        # Apuntador PEPS: primera capa que no alcanzan a cubrir las salidas acumuladas
+        pendiente = s['salidas']
+        s['fifo_mov_id'], s['fifo_consumido'] = None, 0.0
+        for mov_id, u in capas.get(clave, []):
+            if pendiente < u:
+                s['fifo_mov_id'], s['fifo_consumido'] = mov_id, pendiente
+                break
+            pendiente -= u
+    return saldos
+
+
+def reconstruir_saldos(empresa_id):
+    """Reemplaza los saldos de la empresa con el resultado de re-ejecutar la historia (una transacción)"""
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        saldos = calcular_saldos_historia(cur, empresa_id)
+
+        cur.execute("DELETE FROM inventario_saldos WHERE empresa_id = %s", (empresa_id,))
+        filas = [
+            (empresa_id, tipo_id, mid, round(s['unidades'], 4), round(s['valor'], 4),
+             round(s['costo_promedio'], 6), round(s['entradas'], 4), round(s['salidas'], 4),
+             s['fifo_mov_id'], round(s['fifo_consumido'], 4), s['ultimo_movimiento_id'])
+            for (tipo_id, mid), s in saldos.items()
+        ]
+        if filas:
+            cur.executemany("""
+                INSERT INTO inventario_saldos
+                    (empresa_id, tipo_inventario_id, mercancia_id, unidades, valor, costo_promedio,
+                     entradas, salidas, fifo_mov_id, fifo_consumido, ultimo_movimiento_id, actualizado)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
+            """, filas)
+
+        cur.execute("""
+            INSERT INTO inventario_saldos_control (empresa_id, reconstruido_en, productos)
+            VALUES (%s, NOW(), %s)
+            ON DUPLICATE KEY UPDATE reconstruido_en = NOW(), productos = VALUES(productos)
+        """, (empresa_id, len(filas)))
+
+        conn.commit()
+        return len(filas)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def verificar_saldos(empresa_id, tolerancia=0.01):
+    """Compara el snapshot contra la historia; regresa la lista de diferencias"""
+    conn = conexion_db()
+    cur = conn.cursor(dictionary=True)
+    try:
+        esperado = calcular_saldos_historia(cur, empresa_id)
+        cur.execute("""
+            SELECT tipo_inventario_id, mercancia_id, unidades, valor
+            FROM inventario_saldos
+            WHERE empresa_id = %s
+        """, (empresa_id,))
+        actual = {(r['tipo_inventario_id'], r['mercancia_id']): r for r in cur.fetchall()}
+    finally:
+        cur.close()
+        conn.close()
+
+    diferencias = []
+    for clave in set(esperado) | set(actual):
+        e = esperado.get(clave, {})
+        a = actual.get(clave, {})
+        eu, ev = float(e.get('unidades') or 0), float(e.get('valor') or 0)
+        au, av = float(a.get('unidades') or 0), float(a.get('valor') or 0)
+        if abs(eu - au) > tolerancia or abs(ev - av) > tolerancia:
+            diferencias.append({
+                'tipo_inventario_id': clave[0],
+                'mercancia_id': clave[1],
+                'unidades_snapshot': au, 'unidades_historia': eu,
+                'valor_snapshot': av, 'valor_historia': ev,
+            })
+    return sorted(diferencias, key=lambda x: (x['tipo_inventario_id'], x['mercancia_id']))
+
+
+def _empresas_con_movimientos():
+    conn = conexion_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT DISTINCT empresa_id FROM inventario_movimientos WHERE empresa_id IS NOT NULL
+            UNION
+            SELECT DISTINCT empresa_id FROM detalle_compra WHERE empresa_id IS NOT NULL
+        """)
+        return [r[0] for r in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def init_app(app):
+    """Registra los comandos: flask saldos-inventario reconstruir|verificar [--empresa N]"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('saldos-inventario', help='Saldos materializados de inventario')
+
+    @grupo.command('reconstruir')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def reconstruir_cmd(empresa):
+        for eid in ([empresa] if empresa else _empresas_con_movimientos()):
+            n = reconstruir_saldos(eid)
+            click.echo(f"✅ Empresa {eid}: {n} saldos reconstruidos")
+
+    @grupo.command('verificar')
+    @click.option('--empresa', type=int, default=None, help='Solo esta empresa')
+    def verificar_cmd(empresa):
+        total = 0
+        for eid in ([empresa] if empresa else _empresas_con_movimientos()):
+            diferencias = verificar_saldos(eid)
+            total += len(diferencias)
+            for d in diferencias:
+                click.echo(
+                    f"❌ Empresa {eid} tipo {d['tipo_inventario_id']} mercancía {d['mercancia_id']}: "
+                    f"snapshot {d['unidades_snapshot']:.4f} u / ${d['valor_snapshot']:.2f} — "
+                    f"historia {d['unidades_historia']:.4f} u / ${d['valor_historia']:.2f}"
+                )
+            if not diferencias:
+                click.echo(f"✅ Empresa {eid}: saldos consistentes")
+        if total:
+            raise SystemExit(1)
+
+    app.cli.add_command(grupo)
@@ -0,0 +1,268 @@
+"""
+Valuación PEPS (FIFO) por almacén en una sola pasada
+Sustituye el ciclo de _render_inventario_por_almacen que hacía 3 consultas por
+producto (entradas, salidas y capas FIFO). Aquí:
+1. Una consulta trae la base de productos del tipo de inventario (MP=1, WIP=2, PT=3)
+2. Una consulta ordenada por producto_id, fecha, id trae TODOS los movimientos del
+   tipo; se lee en lotes (cursor sin buffer) y se agrupa al vuelo por producto
+3. Al cambiar de producto se cierran sus totales y se valúa su disponible
+
+Mismo criterio que el ciclo anterior:
+- Entradas: UPPER(tipo) IN ('COMPRA','ENTRADA'); salidas: UPPER(tipo) = 'SALIDA'
+- disponible = inventario_inicial + entradas - salidas
+- El disponible se valúa recorriendo las entradas en orden (fecha, id)
+
+Benchmark contra el ciclo por producto: flask valuacion-fifo benchmark --tipo 1
+"""
+
+import time
+from decimal import Decimal
+from db import conexion_db
+
+TIPOS_ENTRADA = ('COMPRA', 'ENTRADA')
+TIPO_SALIDA = 'SALIDA'
+TAMANO_LOTE = 2000
+
+
+def _base_almacen(cur, tipo_inventario_id):
+    cur.execute("""
+        SELECT
+            COALESCE(i.id, 0)               AS id,
+            m.id                             AS mercancia_id,
+            m.nombre                         AS producto,
+            COALESCE(i.inventario_inicial,0) AS inventario_inicial,
+            COALESCE(i.entradas,0)           AS entradas,
+            COALESCE(i.salidas,0)            AS salidas,
+            COALESCE(i.aprobado,0)           AS aprobado
+        FROM mercancia m
+        LEFT JOIN inventario i
+               ON i.mercancia_id = m.id
+        WHERE m.tipo_inventario_id = %s
+            AND (
+                    EXISTS (
+                    SELECT 1 FROM movimientos_inventario mi
+                    WHERE mi.producto_id = m.id
+                    )
+                    OR i.id IS NOT NULL
+                )
+        ORDER BY m.nombre ASC
+    """, (tipo_inventario_id,))
+    return cur.fetchall()
+
+
+def _valor_fifo(capas, disponible):
+    """Valúa `disponible` unidades recorriendo las capas de entrada en orden"""
+    pendientes = disponible
+    valor = 0.0
+    for u, pu in capas:
+        if pendientes <= 0:
+            break
+        usa = min(u, pendientes)
+        valor += usa * pu
+        pendientes -= usa
+    return valor
+
+
+def _movimientos_ordenados(conn, tipo_inventario_id, tamano_lote=TAMANO_LOTE):
+    """Genera (producto_id, tipo, cantidad, costo_unitario) en orden producto, fecha, id"""
+    cur = conn.cursor(buffered=False)
+    try:
+        cur.execute("""
+            SELECT mi.producto_id, UPPER(mi.tipo), mi.cantidad, mi.costo_unitario
+            FROM movimientos_inventario mi
+            JOIN mercancia m ON m.id = mi.producto_id
+            WHERE m.tipo_inventario_id = %s
+              AND UPPER(mi.tipo) IN ('COMPRA','ENTRADA','SALIDA')
+            ORDER BY mi.producto_id ASC, mi.fecha ASC, mi.id ASC
+        """, (tipo_inventario_id,))
+        while True:
+            lote = cur.fetchmany(tamano_lote)
+            if not lote:
+                break
+            yield from lote
+    finally:
+        cur.close()
+
+
+def valuar_movimientos(movimientos, inventario_inicial):
+    """
+    Agrupa movimientos ya ordenados por producto y calcula por cada uno:
+    {producto_id: {'entradas', 'salidas', 'disponible', 'valor_inventario'}}
+    Solo se conservan en memoria las capas del producto en curso.
+    """
+    resultado = {}
+    actual = None
+    entradas = salidas = Decimal(0)
+    capas = []
+
+    def cerrar():
+        total_entradas = float(entradas)
+        total_salidas = float(salidas)
+        disponible = float(inventario_inicial.get(actual) or 0) + total_entradas - total_salidas
+        resultado[actual] = {
+            'entradas': total_entradas,
+            'salidas': total_salidas,
+            'disponible': disponible,
+            'valor_inventario': _valor_fifo(capas, disponible),
+        }
+
+    for producto_id, tipo, cantidad, costo_unitario in movimientos:
+        if producto_id != actual:
+            if actual is not None:
+                cerrar()
+            actual = producto_id
+            entradas = salidas = Decimal(0)
+            capas = []
+
+        if tipo in TIPOS_ENTRADA:
+            entradas += Decimal(str(cantidad or 0))
+            capas.append((float(cantidad or 0), float(costo_unitario or 0)))
+        elif tipo == TIPO_SALIDA:
+            salidas += Decimal(str(cantidad or 0))
+
+    if actual is not None:
+        cerrar()
+    return resultado
+
+
+def _armar_fila(prod, r):
+    return {
+        'id': prod['id'],
+        'mercancia_id': prod['mercancia_id'],
+        'producto': prod['producto'],
+        'inventario_inicial': prod['inventario_inicial'],
+        'entradas': r['entradas'],
+        'salidas': r['salidas'],
+        'disponible': r['disponible'],
+        'valor_inventario': r['valor_inventario'],
+        'aprobado': prod['aprobado']
+    }
+
+
+def inventario_almacen(conn, tipo_inventario_id):
+    """Inventario valuado de un tipo (MP=1, WIP=2, PT=3) con número constante de consultas"""
+    cur = conn.cursor(dictionary=True)
+    try:
+        base = _base_almacen(cur, tipo_inventario_id)
+    finally:
+        cur.close()
+
+    iniciales = {p['mercancia_id']: p['inventario_inicial'] for p in base}
+    valuacion = valuar_movimientos(_movimientos_ordenados(conn, tipo_inventario_id), iniciales)
+
+    inventario_final = []
+    for prod in base:
+        r = valuacion.get(prod['mercancia_id'])
+        if r is None:
+            disponible = float(prod['inventario_inicial'] or 0)
+            r = {'entradas': 0.0, 'salidas': 0.0, 'disponible': disponible, 'valor_inventario': 0.0}
+        inventario_final.append(_armar_fila(prod, r))
+    return inventario_final
+
+
+def _inventario_almacen_por_producto(conn, tipo_inventario_id):
+    """Ciclo anterior (3 consultas por producto); solo para el benchmark"""
+    cur = conn.cursor(dictionary=True)
+    try:
+        base = _base_almacen(cur, tipo_inventario_id)
+        inventario_final = []
+        for prod in base:
+            mercancia_id = prod['mercancia_id']
+
+            cur.execute("""
+                SELECT COALESCE(SUM(cantidad),0) AS total_entradas
+                FROM movimientos_inventario
+                WHERE producto_id = %s
+                    AND UPPER(tipo) IN ('COMPRA','ENTRADA')
+            """, (mercancia_id,))
+            total_entradas = float(cur.fetchone()['total_entradas'] or 0)
+
+            cur.execute("""
+                SELECT COALESCE(SUM(cantidad),0) AS total_salidas
+                FROM movimientos_inventario
+                WHERE producto_id = %s
+                    AND UPPER(tipo) = 'SALIDA'
+            """, (mercancia_id,))
+            total_salidas = float(cur.fetchone()['total_salidas'] or 0)
+
+            disponible = float(prod['inventario_inicial'] or 0) + total_entradas - total_salidas
+
+            cur.execute("""
+                SELECT cantidad, costo_unitario
+                FROM movimientos_inventario
+                WHERE producto_id = %s
+                  AND UPPER(tipo) IN ('COMPRA','ENTRADA')
+                ORDER BY fecha ASC, id ASC
+            """, (mercancia_id,))
+            capas = [(float(e['cantidad'] or 0), float(e['costo_unitario'] or 0)) for e in cur.fetchall()]
+
+            inventario_final.append(_armar_fila(prod, {
+                'entradas': total_entradas,
+                'salidas': total_salidas,
+                'disponible': disponible,
+                'valor_inventario': _valor_fifo(capas, disponible),
+            }))
+        return inventario_final
+    finally:
+        cur.close()
+
+
+def benchmark(tipo_inventario_id, repeticiones=3, tolerancia=0.01):
+    """
+    Compara tiempos del motor en una pasada contra el ciclo por producto
+    y verifica que ambos den el mismo resultado.
+    """
+    conn = conexion_db()
+    try:
+        tiempos = {'una_pasada': [], 'por_producto': []}
+        nuevo = anterior = []
+        for _ in range(repeticiones):
+            t0 = time.perf_counter()
+            nuevo = inventario_almacen(conn, tipo_inventario_id)
+            tiempos['una_pasada'].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            anterior = _inventario_almacen_por_producto(conn, tipo_inventario_id)
+            tiempos['por_producto'].append(time.perf_counter() - t0)
+    finally:
+        conn.close()
+
+    diferencias = []
+    for a, b in zip(nuevo, anterior):
+        for campo in ('entradas', 'salidas', 'disponible', 'valor_inventario'):
+            if abs(a[campo] - b[campo]) > tolerancia:
+                diferencias.append((a['mercancia_id'], campo, a[campo], b[campo]))
+
+    mejor_nuevo = min(tiempos['una_pasada'])
+    mejor_anterior = min(tiempos['por_producto'])
+    return {
+        'productos': len(nuevo),
+        'una_pasada_s': round(mejor_nuevo, 4),
+        'por_producto_s': round(mejor_anterior, 4),
+        'aceleracion': round(mejor_anterior / mejor_nuevo, 1) if mejor_nuevo else None,
+        'diferencias': diferencias,
+    }
+
+
+def init_app(app):
+    """Registra el comando: flask valuacion-fifo benchmark --tipo N"""
+    import click
+    from flask.cli import AppGroup
+
+    grupo = AppGroup('valuacion-fifo', help='Valuación PEPS por almacén')
+
+    @grupo.command('benchmark')
+    @click.option('--tipo', type=click.IntRange(1, 3), default=1, help='1=MP, 2=WIP, 3=PT')
+    @click.option('--repeticiones', type=int, default=3)
+    def benchmark_cmd(tipo, repeticiones):
+        r = benchmark(tipo, repeticiones)
+        click.echo(f"Productos: {r['productos']}")
+        click.echo(f"Una pasada:   {r['una_pasada_s']:.4f} s")
+        click.echo(f"Por producto: {r['por_producto_s']:.4f} s  (x{r['aceleracion']})")
+        for mercancia_id, campo, nuevo, anterior in r['diferencias']:
+            click.echo(f"❌ Mercancía {mercancia_id} {campo}: {nuevo} vs {anterior}")
+        if r['diferencias']:
+            raise SystemExit(1)
+        click.echo("✅ Resultados idénticos")
+
+    app.cli.add_command(grupo)